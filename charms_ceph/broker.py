@@ -15,15 +15,32 @@
 import collections
 import json
 import os
+import time
 
+from contextlib import contextmanager
 from subprocess import check_call, check_output, CalledProcessError
 from tempfile import NamedTemporaryFile
 
 from charms_ceph.utils import (
     get_cephfs,
-    get_osd_weight
+    get_osd_weight,
 )
+from charms_ceph.commands import recording
 from charms_ceph.crush_utils import Crushmap
+from charms_ceph.keys import (
+    get_auth_snapshot,
+    key_caps_need_update,
+)
+from charms_ceph.operations import (
+    get_operations,
+    start_operation,
+    update_operations,
+)
+from charms_ceph.pg_budget import (
+    get_budgeted_pg_num,
+    validate_pg_budget_keys,
+)
+from charms_ceph.pools import get_pool_details
 
 from charmhelpers.core.hookenv import (
     log,
@@ -31,18 +48,22 @@ from charmhelpers.core.hookenv import (
     INFO,
     ERROR,
 )
+from charmhelpers.core.unitdata import kv
 from charmhelpers.contrib.storage.linux.ceph import (
     create_erasure_profile,
     delete_pool,
     erasure_profile_exists,
-    get_osds,
+    get_erasure_profile,
     monitor_key_get,
     monitor_key_set,
     pool_exists,
     pool_set,
     remove_pool_snapshot,
     rename_pool,
+    set_app_name_for_pool,
+    set_pool_quota,
     snapshot_pool,
+    update_pool,
     validator,
     ErasurePool,
     BasePool,
@@ -101,6 +122,12 @@ CEPH_BUCKET_TYPES = [
     'root'
 ]
 
+# unitdata key of the aggregated broker op statistics
+BROKER_OP_STATS_KEY = 'broker-op-stats'
+
+# Upper bounds, in seconds, of the broker op duration histogram buckets
+BROKER_OP_DURATION_BUCKETS = [0.1, 0.5, 1, 5, 10, 30, 60, 300]
+
 
 def decode_req_encode_rsp(f):
     """Decorator to decode incoming requests and encode responses."""
@@ -118,7 +145,10 @@ def process_requests(reqs):
     """Process Ceph broker request(s).
 
     This is a versioned api. API version must be supplied by the client making
-    the request.
+    the request.  Requests with 'plan' set are not applied, the response
+    lists the changes they would make instead, see plan_requests_v1().
+    Requests with 'async' set get a handle for each long running op, see
+    process_requests_v1().
 
     :param reqs: dict of request parameters.
     :returns: dict. exit-code and reason if not 0
@@ -127,8 +157,15 @@ def process_requests(reqs):
     try:
         version = reqs.get('api-version')
         if version == 1:
-            log('Processing request {}'.format(request_id), level=DEBUG)
-            resp = process_requests_v1(reqs['ops'])
+            if reqs.get('plan'):
+                log('Planning request {}'.format(request_id), level=DEBUG)
+                resp = plan_requests_v1(reqs['ops'])
+            else:
+                log('Processing request {}'.format(request_id), level=DEBUG)
+                resp = process_requests_v1(
+                    reqs['ops'], op_results=reqs.get('op-results', False),
+                    async_ops=reqs.get('async', False),
+                    request_id=request_id)
             if request_id:
                 resp['request-id'] = request_id
 
@@ -149,6 +186,170 @@ def process_requests(reqs):
     return resp
 
 
+def normalise_op(op):
+    """Key identifying broker ops that have the same effect.
+
+    :rtype: str
+    """
+    return json.dumps(op, sort_keys=True)
+
+
+# Ops whose effect does not change when they are repeated.  An identical
+# op from another request of a batch is run once, as long as no op that
+# is not idempotent, or that changes the same targets, ran in between.
+IDEMPOTENT_OPS = [
+    'create-pool',
+    'create-erasure-profile',
+    'create-cephfs',
+    'set-pool-value',
+    'move-osd-to-bucket',
+    'add-permissions-to-key',
+    'set-key-permissions',
+    'create-cephfs-client',
+]
+
+
+def op_targets(op):
+    """What an IDEMPOTENT_OPS op changes in the cluster.
+
+    :returns: ('pool', name), ('client', name), ('group', name),
+              ('osd', id), ('erasure-profile', name) and ('fs', name)
+              tuples
+    :rtype: Set[Tuple[str, str]]
+    """
+    name = op.get('op')
+    targets = set()
+    if name in ('create-pool', 'set-pool-value'):
+        targets.add(('pool', op.get('name')))
+    elif name == 'create-erasure-profile':
+        targets.add(('erasure-profile', op.get('name')))
+    elif name == 'create-cephfs':
+        targets.add(('fs', op.get('mds_name')))
+        pools = [op.get('data_pool'), op.get('metadata_pool')]
+        pools.extend(op.get('extra_pools') or [])
+        targets.update(('pool', pool) for pool in pools)
+    elif name == 'move-osd-to-bucket':
+        targets.add(('osd', str(op.get('osd'))))
+    elif name == 'add-permissions-to-key':
+        targets.add(('client', op.get('name')))
+    elif name == 'set-key-permissions':
+        targets.add(('client', op.get('client')))
+    elif name == 'create-cephfs-client':
+        targets.add(('client', op.get('client_id')))
+        targets.add(('fs', op.get('fs_name')))
+    if op.get('group'):
+        targets.add(('group', op.get('group')))
+    return targets
+
+
+def process_requests_batch(raw_reqs):
+    """Process the pending broker requests of many clients at once.
+
+    The requests are processed in order, each request's ops in their
+    order, sharing one permission graph and one read of the pools.  An
+    IDEMPOTENT_OPS op identical to one already run in the batch, e.g. the
+    same create-pool sent by every unit of an application, is not run
+    again and its result is reused, unless an op that is not idempotent,
+    or one changing the same pool, key, group, OSD or filesystem, ran
+    since.  Each request's response is the one process_requests()
+    would return, including the 'operations' of async requests.  Plan
+    requests and requests that are invalid are processed one at a time.
+
+    :param raw_reqs: JSON encoded requests as passed to process_requests()
+    :type raw_reqs: List[Union[str, bytes]]
+    :returns: JSON encoded responses in the order of raw_reqs
+    :rtype: List[str]
+    """
+    responses = [None] * len(raw_reqs)
+    pending = []
+    for index, raw_req in enumerate(raw_reqs):
+        if isinstance(raw_req, bytes):
+            raw_req = raw_req.decode('utf-8')
+        reqs = json.loads(raw_req)
+        ops = reqs.get('ops') or []
+        if (reqs.get('api-version') != 1 or reqs.get('plan') or
+                any(op.get('op') not in V1_OPS for op in ops)):
+            responses[index] = process_requests(raw_req)
+            continue
+        pending.append((index, reqs))
+
+    ran = []
+    done = {}
+    try:
+        with permission_graph(), pool_state('admin'):
+            for index, reqs in pending:
+                try:
+                    resp = _process_batched_request(reqs, ran, done)
+                except Exception as exc:
+                    done.clear()
+                    log(str(exc), level=ERROR)
+                    msg = ("Unexpected error occurred while processing "
+                           "requests: {}".format(reqs))
+                    log(msg, level=ERROR)
+                    resp = {'exit-code': 1, 'stderr': msg}
+                if reqs.get('request-id'):
+                    resp['request-id'] = reqs['request-id']
+                responses[index] = json.dumps(resp)
+    finally:
+        save_op_stats(ran)
+    log("Ran {} ops for {} ops of {} broker requests".format(
+        len(ran), sum(len(reqs.get('ops') or []) for _, reqs in pending),
+        len(pending)), level=INFO)
+    return responses
+
+
+def _process_batched_request(reqs, ran, done):
+    """Process a request of process_requests_batch().
+
+    :param ran: results of the ops run so far in the batch, appended to
+    :type ran: List[dict]
+    :param done: handler return value, result and op_targets() of the
+                 IDEMPOTENT_OPS whose effect still holds, by normalise_op()
+    :type done: Dict[str, Tuple[Any, dict, Set[Tuple[str, str]]]]
+    :returns: the response of the request
+    :rtype: dict
+    """
+    ops = reqs.get('ops') or []
+    results = []
+    ret = None
+    for req in ops:
+        key = normalise_op(req)
+        if req.get('op') in IDEMPOTENT_OPS and key in done:
+            ret, result, _ = done[key]
+        elif req.get('op') in IDEMPOTENT_OPS:
+            targets = op_targets(req)
+            for other in [k for k, v in done.items() if v[2] & targets]:
+                del done[other]
+            ret = _run_op_v1(req, ran)
+            result = ran[-1]
+            done[key] = (ret, result, targets)
+        else:
+            done.clear()
+            ret = _run_op_v1(req, ran)
+            result = ran[-1]
+        results.append(result)
+    resp = _response_v1(ret)
+    if reqs.get('op-results'):
+        resp['op-results'] = results
+    if reqs.get('async'):
+        resp['operations'] = _start_operations(ops, results,
+                                               reqs.get('request-id'))
+    return resp
+
+
+def handle_get_operations(request, service):
+    """Report the state of the ops started by async requests.
+
+    :param request: dict of request operations and params, 'handles' lists
+                    the operations to report, all of them if not given.
+    :param service: The ceph client to run the command under.
+    :returns: dict. exit-code and the 'operations'
+    """
+    update_operations(service)
+    return {'exit-code': 0,
+            'operations': get_operations(request.get('handles'))}
+
+
 def handle_create_erasure_profile(request, service):
     """Create an erasure profile.
 
@@ -209,30 +410,13 @@ def handle_add_permissions_to_key(request, service):
     """
     resp = {'exit-code': 0}
 
-    service_name = request.get('name')
-    group_name = request.get('group')
-    group_namespace = request.get('group-namespace')
-    if group_namespace:
-        group_name = "{}-{}".format(group_namespace, group_name)
-    group = get_group(group_name=group_name)
-    service_obj = get_service_groups(service=service_name,
-                                     namespace=group_namespace)
-    if request.get('object-prefix-permissions'):
-        service_obj['object_prefix_perms'] = request.get(
-            'object-prefix-permissions')
-    format("Service object: {}".format(service_obj))
-    permission = request.get('group-permission') or "rwx"
-    if service_name not in group['services']:
-        group['services'].append(service_name)
-    save_group(group=group, group_name=group_name)
-    if permission not in service_obj['group_names']:
-        service_obj['group_names'][permission] = []
-    if group_name not in service_obj['group_names'][permission]:
-        service_obj['group_names'][permission].append(group_name)
-    save_service(service=service_obj, service_name=service_name)
-    service_obj['groups'] = _build_service_groups(service_obj,
-                                                  group_namespace)
-    update_service_permissions(service_name, service_obj, group_namespace)
+    with permission_graph() as graph:
+        graph.add_service_to_group(
+            service_name=request.get('name'),
+            group=request.get('group'),
+            permission=request.get('group-permission') or "rwx",
+            namespace=request.get('group-namespace'),
+            object_prefix_perms=request.get('object-prefix-permissions'))
 
     return resp
 
@@ -241,12 +425,16 @@ def handle_set_key_permissions(request, service):
     """Ensure the key has the requested permissions."""
     permissions = request.get('permissions')
     client = request.get('client')
-    call = ['ceph', '--id', service, 'auth', 'caps',
-            'client.{}'.format(client)] + permissions
+    entity = 'client.{}'.format(client)
+    if not key_caps_need_update(entity, permissions, client=service):
+        return
+    call = ['ceph', '--id', service, 'auth', 'caps', entity] + permissions
     try:
         check_call(call)
     except CalledProcessError as e:
         log("Error updating key capabilities: {}".format(e), level=ERROR)
+    finally:
+        get_auth_snapshot(service).invalidate(entity)
 
 
 def update_service_permissions(service, service_obj=None, namespace=None):
@@ -254,24 +442,22 @@ def update_service_permissions(service, service_obj=None, namespace=None):
     if not service_obj:
         service_obj = get_service_groups(service=service, namespace=namespace)
     permissions = pool_permission_list_for_service(service_obj)
-    call = ['ceph', 'auth', 'caps', 'client.{}'.format(service)] + permissions
+    entity = 'client.{}'.format(service)
+    if not key_caps_need_update(entity, permissions, client='admin'):
+        return
+    call = ['ceph', 'auth', 'caps', entity] + permissions
     try:
         check_call(call)
     except CalledProcessError as e:
         log("Error updating key capabilities: {}".format(e))
+    finally:
+        get_auth_snapshot('admin').invalidate(entity)
 
 
 def add_pool_to_group(pool, group, namespace=None):
     """Add a named pool to a named group"""
-    group_name = group
-    if namespace:
-        group_name = "{}-{}".format(namespace, group_name)
-    group = get_group(group_name=group_name)
-    if pool not in group['pools']:
-        group["pools"].append(pool)
-    save_group(group, group_name=group_name)
-    for service in group['services']:
-        update_service_permissions(service, namespace=namespace)
+    with permission_graph() as graph:
+        graph.add_pool_to_group(pool=pool, group=group, namespace=namespace)
 
 
 def pool_permission_list_for_service(service):
@@ -398,6 +584,436 @@ def get_group_key(group_name):
     return 'cephx.groups.{}'.format(group_name)
 
 
+CEPHX_KEY_PREFIX = 'cephx.'
+CEPHX_GROUP_PREFIX = 'cephx.groups.'
+CEPHX_SERVICE_PREFIX = 'cephx.services.'
+
+
+def get_cephx_keys():
+    """Read all broker groups and services with one config-key dump.
+
+    :returns: dict of key to its raw JSON value or None if the dump failed.
+    :rtype: Optional[Dict[str, str]]
+    """
+    try:
+        dump = json.loads(check_output(
+            ['ceph', '--id', 'admin', 'config-key', 'dump',
+             CEPHX_KEY_PREFIX]).decode('UTF-8'))
+    except (CalledProcessError, OSError, ValueError) as e:
+        log("Unable to dump {} keys, reading them one at a time: {}".format(
+            CEPHX_KEY_PREFIX, e), level=DEBUG)
+        return None
+    # Older releases ignore the prefix and dump every key
+    return {key: value for key, value in dump.items()
+            if key.startswith(CEPHX_KEY_PREFIX)}
+
+
+def _load_json(value):
+    try:
+        return json.loads(value)
+    except (TypeError, ValueError):
+        return None
+
+
+class CephxStore(object):
+    """Broker groups and services loaded with a single config-key dump.
+
+    Documents keep the existing format, one JSON blob per
+    cephx.groups.<name> and cephx.services.<name> key.  When the dump is
+    not available each key is read with monitor_key_get() on first use.
+    save_group() and save_service() only write documents whose JSON
+    differs from the stored value.
+    """
+
+    def __init__(self):
+        self._values = get_cephx_keys()
+        self._docs = {}
+
+    def _value(self, key):
+        if self._values is None:
+            return monitor_key_get(service='admin', key=key)
+        return self._values.get(key)
+
+    def _doc(self, key):
+        if key not in self._docs:
+            self._docs[key] = _load_json(self._value(key))
+        return self._docs[key]
+
+    def group(self, group_name):
+        """The group document, see get_group()."""
+        key = get_group_key(group_name=group_name)
+        if not self._doc(key):
+            self._docs[key] = {'pools': [], 'services': []}
+        return self._docs[key]
+
+    def service(self, service_name):
+        """The service document, see get_service_groups().
+
+        Stored services carry an empty 'groups', it is rebuilt from the
+        group documents by the caller.
+        """
+        key = "{}{}".format(CEPHX_SERVICE_PREFIX, service_name)
+        if not self._doc(key):
+            self._docs[key] = {'group_names': {}}
+        self._docs[key]['groups'] = {}
+        return self._docs[key]
+
+    def _changed(self, key, value):
+        if self._values is None:
+            return True
+        if self._values.get(key) == value:
+            return False
+        self._values[key] = value
+        return True
+
+    def save_group(self, group_name, group):
+        """Persist a group if it changed, see save_group()."""
+        key = get_group_key(group_name=group_name)
+        self._docs[key] = group
+        if self._changed(key, json.dumps(group, sort_keys=True)):
+            save_group(group=group, group_name=group_name)
+
+    def save_service(self, service_name, service):
+        """Persist a service if it changed, see save_service()."""
+        key = "{}{}".format(CEPHX_SERVICE_PREFIX, service_name)
+        value = json.dumps(dict(service, groups={}), sort_keys=True)
+        if self._changed(key, value):
+            save_service(service=service, service_name=service_name)
+
+
+class PermissionGraph(object):
+    """In-memory view of the broker groups and services.
+
+    Groups and services are read through a CephxStore, changed in memory
+    and written back by flush().  flush() only saves the
+    documents that changed and only updates the key caps of the services
+    whose permissions changed.
+    """
+
+    def __init__(self):
+        self._store = CephxStore()
+        self._dirty_groups = set()
+        self._dirty_services = set()
+        # service name -> (namespace, permissions before any change)
+        self._baselines = {}
+
+    @staticmethod
+    def _group_name(group, namespace=None):
+        if namespace:
+            return "{}-{}".format(namespace, group)
+        return group
+
+    def group(self, group_name):
+        """The group document, see get_group()."""
+        return self._store.group(group_name)
+
+    def service(self, service_name):
+        """The service document without its 'groups'."""
+        return self._store.service(service_name)
+
+    def service_groups(self, service_name, namespace=None):
+        """The service with its groups, see get_service_groups()."""
+        service_obj = dict(self.service(service_name))
+        service_obj['groups'] = {
+            group: self.group(self._group_name(group, namespace))
+            for groups in service_obj['group_names'].values()
+            for group in groups}
+        return service_obj
+
+    def _track(self, service_name, namespace=None):
+        """Record the permissions of a service before it changes."""
+        if service_name not in self._baselines:
+            self._baselines[service_name] = (
+                namespace,
+                pool_permission_list_for_service(
+                    self.service_groups(service_name, namespace)))
+
+    def add_pool_to_group(self, pool, group, namespace=None):
+        """Add a named pool to a named group"""
+        group_name = self._group_name(group, namespace)
+        group_obj = self.group(group_name)
+        if pool in group_obj['pools']:
+            return
+        for service_name in group_obj['services']:
+            self._track(service_name, namespace)
+        group_obj['pools'].append(pool)
+        self._dirty_groups.add(group_name)
+
+    def add_service_to_group(self, service_name, group, permission,
+                             namespace=None, object_prefix_perms=None):
+        """Give a service permission on the pools of a group"""
+        group_name = self._group_name(group, namespace)
+        self._track(service_name, namespace)
+        group_obj = self.group(group_name)
+        service = self.service(service_name)
+        if service_name not in group_obj['services']:
+            group_obj['services'].append(service_name)
+            self._dirty_groups.add(group_name)
+        if (object_prefix_perms and
+                service.get('object_prefix_perms') != object_prefix_perms):
+            service['object_prefix_perms'] = object_prefix_perms
+            self._dirty_services.add(service_name)
+        group_names = service['group_names'].setdefault(permission, [])
+        if group_name not in group_names:
+            group_names.append(group_name)
+            self._dirty_services.add(service_name)
+
+    def _changed_permissions(self):
+        """Services whose pool permissions changed.
+
+        :returns: (service name, namespace, service with its groups)
+        :rtype: Iterator[Tuple[str, Optional[str], dict]]
+        """
+        for service_name, (namespace, permissions) in sorted(
+                self._baselines.items()):
+            service_obj = self.service_groups(service_name, namespace)
+            if pool_permission_list_for_service(service_obj) != permissions:
+                yield service_name, namespace, service_obj
+
+    def pending_changes(self):
+        """The writes flush() would make, see plan_requests_v1().
+
+        :rtype: List[dict]
+        """
+        changes = [{'action': 'save-group', 'group': group_name}
+                   for group_name in sorted(self._dirty_groups)]
+        changes.extend({'action': 'save-service', 'service': service_name}
+                       for service_name in sorted(self._dirty_services))
+        for service_name, _, service_obj in self._changed_permissions():
+            changes.append({
+                'action': 'set-key-caps',
+                'entity': 'client.{}'.format(service_name),
+                'caps': pool_permission_list_for_service(service_obj)})
+        return changes
+
+    def flush(self):
+        """Write changed documents and update changed key caps."""
+        for group_name in sorted(self._dirty_groups):
+            self._store.save_group(group_name, self.group(group_name))
+        for service_name in sorted(self._dirty_services):
+            namespace = self._baselines.get(service_name, (None,))[0]
+            self._store.save_service(
+                service_name, self.service_groups(service_name, namespace))
+        for service_name, namespace, service_obj in list(
+                self._changed_permissions()):
+            update_service_permissions(service_name, service_obj, namespace)
+        self._dirty_groups = set()
+        self._dirty_services = set()
+        self._baselines = {}
+
+
+_permission_graph = None
+
+
+@contextmanager
+def permission_graph(flush=True):
+    """Share a PermissionGraph between the ops of a broker request.
+
+    The outermost use creates the graph and, unless flush is False,
+    flushes it on exit.
+    """
+    global _permission_graph
+    if _permission_graph is not None:
+        yield _permission_graph
+        return
+    graph = _permission_graph = PermissionGraph()
+    try:
+        yield graph
+    finally:
+        _permission_graph = None
+        if flush:
+            graph.flush()
+
+
+# Broker op key -> pool option reconciled by PoolState
+POOL_COMPRESSION_KEYS = [
+    'compression-algorithm',
+    'compression-mode',
+    'compression-required-ratio',
+    'compression-min-blob-size',
+    'compression-min-blob-size-hdd',
+    'compression-min-blob-size-ssd',
+    'compression-max-blob-size',
+    'compression-max-blob-size-hdd',
+    'compression-max-blob-size-ssd',
+]
+
+
+def _same_value(current, desired):
+    """Compare a pool property as stored by Ceph with a requested value."""
+    if current is None:
+        return False
+    try:
+        return float(current) == float(desired)
+    except (TypeError, ValueError):
+        return str(current).lower() == str(desired).lower()
+
+
+class PoolState(object):
+    """Current state of all pools read with one 'osd pool ls detail'.
+
+    Requests for existing pools are compared with that state and only the
+    properties that differ are set, instead of re-setting every property
+    with BasePool.update().  When the pools can not be listed the broker
+    falls back to pool_exists() and BasePool.update().
+    """
+
+    def __init__(self, service):
+        self.service = service
+        self._details = None
+
+    @property
+    def details(self):
+        """dict of pool name to 'osd pool ls detail' entry or None."""
+        if self._details is None:
+            try:
+                self._details = get_pool_details(client=self.service)
+            except (CalledProcessError, ValueError) as e:
+                log("Unable to list pools: {}".format(e), level=ERROR)
+                return None
+        return self._details
+
+    def invalidate(self):
+        """Forget the pool state, e.g. after creating a pool."""
+        self._details = None
+
+    def exists(self, name):
+        if self.details is None:
+            return pool_exists(service=self.service, name=name)
+        return name in self.details
+
+    def diff(self, request):
+        """Properties of an existing pool that differ from a request.
+
+        :returns: dict with the changed 'quota' and pool 'settings' and
+                  the 'application' to enable, only keys with changes are
+                  present.
+        :rtype: dict
+        """
+        detail = self.details[request['name']]
+        changes = {}
+        quota = {}
+        for key in ('max-bytes', 'max-objects'):
+            value = request.get(key)
+            current = detail.get('quota_{}'.format(key.replace('-', '_')))
+            if value and not _same_value(current, value):
+                quota[key.replace('-', '_')] = value
+        if quota:
+            changes['quota'] = quota
+        options = detail.get('options') or {}
+        settings = {}
+        for key in POOL_COMPRESSION_KEYS:
+            value = request.get(key)
+            option = key.replace('-', '_')
+            if value and not _same_value(options.get(option), value):
+                settings[option] = str(value)
+        if settings:
+            changes['settings'] = settings
+        app_name = request.get('app-name')
+        if app_name and app_name not in (
+                detail.get('application_metadata') or {}):
+            changes['application'] = app_name
+        return changes
+
+    def reconcile(self, pool):
+        """Bring an existing pool to the state requested by its op.
+
+        :param pool: pool initialized from a broker op
+        :type pool: BasePool
+        :returns: the changes made, see diff()
+        :rtype: dict
+        """
+        if self.details is None:
+            pool.update()
+            return {}
+        pool.validate()
+        changes = self.diff(pool.op)
+        if not changes:
+            log("Pool '{}' is up to date".format(pool.name), level=DEBUG)
+            return changes
+        log("Updating pool '{}': {}".format(pool.name, changes), level=INFO)
+        if 'quota' in changes:
+            set_pool_quota(service=self.service, pool_name=pool.name,
+                           max_bytes=changes['quota'].get('max_bytes'),
+                           max_objects=changes['quota'].get('max_objects'))
+        if 'settings' in changes:
+            update_pool(self.service, pool.name, changes['settings'])
+        if 'application' in changes:
+            set_app_name_for_pool(client=self.service, pool=pool.name,
+                                  name=changes['application'])
+        self.invalidate()
+        return changes
+
+
+_pool_state = None
+
+
+@contextmanager
+def pool_state(service):
+    """Share a PoolState between the ops of a broker request."""
+    global _pool_state
+    if _pool_state is not None:
+        yield _pool_state
+        return
+    state = _pool_state = PoolState(service)
+    try:
+        yield state
+    finally:
+        _pool_state = None
+
+
+def get_pool_state(service):
+    """The PoolState of the current broker request or a new one."""
+    return _pool_state or PoolState(service)
+
+
+class BudgetedErasurePool(ErasurePool):
+    """ErasurePool created with a pg_num from the PG budget."""
+
+    def __init__(self, service, op, pg_num):
+        super(BudgetedErasurePool, self).__init__(service=service, op=op)
+        self.pg_num = pg_num
+
+    def get_pgs(self, pool_size, percent_data=None, device_class=None):
+        return self.pg_num
+
+
+# create-pool keys set on new pools, by the pool option they set.  The
+# pool classes leave them out while the PG budget sizes pools with them.
+POOL_PG_KEYS = collections.OrderedDict([
+    ('pg-autoscale-mode', 'pg_autoscale_mode'),
+    ('pg-num-min', 'pg_num_min'),
+    ('bulk', 'bulk'),
+])
+
+
+def _set_pg_options(service, pool_name, request):
+    """Set the POOL_PG_KEYS of a create-pool op on the new pool."""
+    settings = collections.OrderedDict()
+    for key, option in POOL_PG_KEYS.items():
+        value = request.get(key)
+        if value is None:
+            continue
+        if isinstance(value, bool):
+            value = str(value).lower()
+        settings[option] = str(value)
+    if settings:
+        update_pool(service, pool_name, settings)
+
+
+def _validate_pg_budget_keys(request):
+    """Validate the PG budget keys of a create-pool op.
+
+    :returns: None or an error response
+    """
+    try:
+        validate_pg_budget_keys(request)
+    except ValueError as e:
+        msg = "Invalid create-pool request: {}".format(e)
+        log(msg, level=ERROR)
+        return {'exit-code': 1, 'stderr': msg}
+
+
 def handle_erasure_pool(request, service):
     """Create a new erasure coded pool.
 
@@ -412,6 +1028,10 @@ def handle_erasure_pool(request, service):
     if erasure_profile is None:
         erasure_profile = "default-canonical"
 
+    error = _validate_pg_budget_keys(request)
+    if error:
+        return error
+
     if group_name:
         group_namespace = request.get('group-namespace')
         # Add the pool to the group named "group_name"
@@ -419,30 +1039,46 @@ def handle_erasure_pool(request, service):
                           group=group_name,
                           namespace=group_namespace)
 
+    state = get_pool_state(service)
+    exists = state.exists(pool_name)
     # TODO: Default to 3/2 erasure coding. I believe this requires min 5 osds
-    if not erasure_profile_exists(service=service, name=erasure_profile):
+    if not exists and not erasure_profile_exists(service=service,
+                                                 name=erasure_profile):
         # TODO: Fail and tell them to create the profile or default
         msg = ("erasure-profile {} does not exist.  Please create it with: "
                "create-erasure-profile".format(erasure_profile))
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
 
+    pg_num = None
+    if not exists:
+        pg_num = get_budgeted_pg_num(service, request,
+                                     erasure_profile=erasure_profile,
+                                     pool_details=state.details)
+
     try:
-        pool = ErasurePool(service=service,
-                           op=request)
+        if pg_num:
+            pool = BudgetedErasurePool(service=service, op=request,
+                                       pg_num=pg_num)
+        else:
+            pool = ErasurePool(service=service,
+                               op=request)
     except KeyError:
         msg = "Missing parameter."
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
 
     # Ok make the erasure pool
-    if not pool_exists(service=service, name=pool_name):
+    if not exists:
         log("Creating pool '{}' (erasure_profile={})"
             .format(pool.name, erasure_profile), level=INFO)
         pool.create()
-
-    # Set/update properties that are allowed to change after pool creation.
-    pool.update()
+        _set_pg_options(service, pool.name, request)
+        state.invalidate()
+    else:
+        # Set/update properties that are allowed to change after pool
+        # creation.
+        state.reconcile(pool)
 
 
 def handle_replicated_pool(request, service):
@@ -455,16 +1091,19 @@ def handle_replicated_pool(request, service):
     pool_name = request.get('name')
     group_name = request.get('group')
 
-    # Optional params
-    # NOTE: Check this against the handling in the Pool classes, reconcile and
-    # remove.
-    pg_num = request.get('pg_num')
+    error = _validate_pg_budget_keys(request)
+    if error:
+        return error
+
+    # Size new pools, and cap any requested pg_num, within the PGs the
+    # cluster can take given all of its pools.
     replicas = request.get('replicas')
-    if pg_num:
-        # Cap pg_num to max allowed just in case.
-        osds = get_osds(service)
-        if osds:
-            pg_num = min(pg_num, (len(osds) * 100 // replicas))
+    state = get_pool_state(service)
+    exists = state.exists(pool_name)
+    if not exists and replicas:
+        pg_num = get_budgeted_pg_num(service, request, replicas,
+                                     pool_details=state.details)
+        if pg_num:
             request.update({'pg_num': pg_num})
 
     if group_name:
@@ -482,16 +1121,18 @@ def handle_replicated_pool(request, service):
         log(msg, level=ERROR)
         return {'exit-code': 1, 'stderr': msg}
 
-    if not pool_exists(service=service, name=pool_name):
+    if not exists:
         log("Creating pool '{}' (replicas={})".format(pool.name, replicas),
             level=INFO)
         pool.create()
+        _set_pg_options(service, pool.name, request)
+        state.invalidate()
     else:
         log("Pool '{}' already exists - skipping create".format(pool.name),
             level=DEBUG)
-
-    # Set/update properties that are allowed to change after pool creation.
-    pool.update()
+        # Set/update properties that are allowed to change after pool
+        # creation.
+        state.reconcile(pool)
 
 
 def handle_create_cache_tier(request, service):
@@ -520,6 +1161,7 @@ def handle_create_cache_tier(request, service):
 
     p = BasePool(service=service, name=storage_pool)
     p.add_cache_tier(cache_pool=cache_pool, mode=cache_mode)
+    get_pool_state(service).invalidate()
 
 
 def handle_remove_cache_tier(request, service):
@@ -541,6 +1183,7 @@ def handle_remove_cache_tier(request, service):
 
     pool = BasePool(name=storage_pool, service=service)
     pool.remove_cache_tier(cache_pool=cache_pool)
+    get_pool_state(service).invalidate()
 
 
 def handle_set_pool_value(request, service, coerce=False):
@@ -583,6 +1226,7 @@ def handle_set_pool_value(request, service, coerce=False):
     # Set the value
     pool_set(service=service, pool_name=params['pool'], key=params['key'],
              value=params['value'])
+    get_pool_state(service).invalidate()
 
 
 def handle_rgw_regionmap_update(request, service):
@@ -857,21 +1501,19 @@ def handle_create_cephfs_client(request, service):
     # This makes it a bit more compatible with older Ceph versions
     # that throw when trying to authorize a user with the same
     # capabilites that it currently has.
+    client = "client.{}".format(client_id)
+    auth = get_auth_snapshot(service)
     try:
-        cmd = ["ceph", "--id", service, "auth", "ls", "-f", "json"]
-        auth_ls = json.loads(check_output(cmd, encoding="utf-8"))
+        key = auth.key(client)
     except CalledProcessError as err:
         log(err.output, level=ERROR)
         return {'exit-code': 1, 'stderr': err.output}
     except ValueError as err:
         log(str(err), level=ERROR)
         return {'exit-code': 1, 'stderr': str(err)}
-
-    client = "client.{}".format(client_id)
-    for elem in auth_ls["auth_dump"]:
-        if client == elem["entity"]:
-            log("Client {} has already been created".format(client))
-            return {'exit-code': 0, 'key': elem["key"]}
+    if key:
+        log("Client {} has already been created".format(client))
+        return {'exit-code': 0, 'key': key}
 
     # Try to authorize the client
     # `ceph fs authorize` already returns the correct error
@@ -894,87 +1536,400 @@ def handle_create_cephfs_client(request, service):
     except ValueError as err:
         log(str(err), level=ERROR)
         return {'exit-code': 1, 'stderr': str(err)}
+    finally:
+        auth.invalidate(client)
 
     return {'exit-code': 0, 'key': fs_auth[0]["key"]}
 
 
-def process_requests_v1(reqs):
+def op_status(ret):
+    """Exit code and error of a broker op from its handler's return value.
+
+    :rtype: dict
+    """
+    status = {'exit-code': 0}
+    if isinstance(ret, dict) and 'exit-code' in ret:
+        status['exit-code'] = ret['exit-code']
+        if 'stderr' in ret:
+            status['stderr'] = ret['stderr']
+    return status
+
+
+@contextmanager
+def op_accounting(op):
+    """Measure the duration and external commands of a broker op.
+
+    :param op: Name of the broker op
+    :type op: str
+    :returns: dict with 'op', 'duration' in seconds and 'commands', filled
+              in when the block exits.  An op that raises is given an
+              exit-code of 1.
+    """
+    result = {'op': op}
+    start = time.time()
+    try:
+        with recording() as records:
+            yield result
+    except Exception as e:
+        result.update({'exit-code': 1, 'stderr': str(e)})
+        raise
+    finally:
+        result['duration'] = round(time.time() - start, 3)
+        result['commands'] = [record['argv'] for record in records]
+
+
+def save_op_stats(results):
+    """Add broker op results to the histograms kept in unitdata.
+
+    Stats are kept per op under BROKER_OP_STATS_KEY, e.g.
+
+        {'create-pool': {'count': 3, 'errors': 0, 'commands': 21,
+                         'duration': 4.2,
+                         'buckets': {'0.1': 0, ..., '5': 3, '+Inf': 0}}}
+
+    :param results: Results recorded by op_accounting()
+    :type results: List[dict]
+    """
+    if not results:
+        return
+    db = kv()
+    stats = db.get(BROKER_OP_STATS_KEY, {})
+    for result in results:
+        op_stats = stats.setdefault(result['op'] or 'unknown', {
+            'count': 0,
+            'errors': 0,
+            'commands': 0,
+            'duration': 0.0,
+            'buckets': {str(bound): 0
+                        for bound in BROKER_OP_DURATION_BUCKETS + ['+Inf']},
+        })
+        op_stats['count'] += 1
+        if result.get('exit-code'):
+            op_stats['errors'] += 1
+        op_stats['commands'] += len(result['commands'])
+        op_stats['duration'] = round(
+            op_stats['duration'] + result['duration'], 3)
+        bucket = '+Inf'
+        for bound in BROKER_OP_DURATION_BUCKETS:
+            if result['duration'] <= bound:
+                bucket = str(bound)
+                break
+        op_stats['buckets'][bucket] += 1
+    db.set(BROKER_OP_STATS_KEY, stats)
+    db.flush()
+
+
+# Long running ops tracked by async requests, mapped to a function
+# returning the pools whose PGs they wait for, None for all PGs.
+LONG_RUNNING_OPS = {
+    'create-pool': lambda req: [req.get('name')],
+    'create-cephfs': lambda req: [req.get('metadata_pool'),
+                                  req.get('data_pool')],
+    'move-osd-to-bucket': lambda req: None,
+}
+
+
+def process_requests_v1(reqs, op_results=False, async_ops=False,
+                        request_id=None):
     """Process v1 requests.
 
     Takes a list of requests (dicts) and processes each one. If an error is
     found, processing stops and the client is notified in the response.
 
-    Returns a response dict containing the exit code (non-zero if any
-    operation failed along with an explanation).
+    The duration and external commands of each op are added to the
+    histograms in unitdata, see save_op_stats().
+
+    :param reqs: List of broker ops
+    :type reqs: List[dict]
+    :param op_results: Add an 'op-results' list with the op name, duration,
+                       commands and exit code of each op to the response.
+    :type op_results: bool
+    :param async_ops: Track LONG_RUNNING_OPS in the operation table and add
+                      their 'operations' to the response instead of
+                      leaving clients to guess when their PGs settled,
+                      see charms_ceph.operations.
+    :type async_ops: bool
+    :param request_id: request-id recorded with the operations
+    :type request_id: Optional[str]
+    :returns: a response dict containing the exit code (non-zero if any
+              operation failed along with an explanation).
     """
-    ret = None
+    results = []
     log("Processing {} ceph broker requests".format(len(reqs)), level=INFO)
-    for req in reqs:
-        op = req.get('op')
-        log("Processing op='{}'".format(op), level=DEBUG)
-        # Use admin client since we do not have other client key locations
-        # setup to use them for these operations.
-        svc = 'admin'
-        if op == "create-pool":
-            pool_type = req.get('pool-type')  # "replicated" | "erasure"
-
-            # Default to replicated if pool_type isn't given
-            if pool_type == 'erasure':
-                ret = handle_erasure_pool(request=req, service=svc)
-            else:
-                ret = handle_replicated_pool(request=req, service=svc)
-        elif op == "create-cephfs":
-            ret = handle_create_cephfs(request=req, service=svc)
-        elif op == "create-cache-tier":
-            ret = handle_create_cache_tier(request=req, service=svc)
-        elif op == "remove-cache-tier":
-            ret = handle_remove_cache_tier(request=req, service=svc)
-        elif op == "create-erasure-profile":
-            ret = handle_create_erasure_profile(request=req, service=svc)
-        elif op == "delete-pool":
-            pool = req.get('name')
-            ret = delete_pool(service=svc, name=pool)
-        elif op == "rename-pool":
-            old_name = req.get('name')
-            new_name = req.get('new-name')
-            ret = rename_pool(service=svc, old_name=old_name,
-                              new_name=new_name)
-        elif op == "snapshot-pool":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = snapshot_pool(service=svc, pool_name=pool,
-                                snapshot_name=snapshot_name)
-        elif op == "remove-pool-snapshot":
-            pool = req.get('name')
-            snapshot_name = req.get('snapshot-name')
-            ret = remove_pool_snapshot(service=svc, pool_name=pool,
-                                       snapshot_name=snapshot_name)
-        elif op == "set-pool-value":
-            ret = handle_set_pool_value(request=req, service=svc)
-        elif op == "rgw-region-set":
-            ret = handle_rgw_region_set(request=req, service=svc)
-        elif op == "rgw-zone-set":
-            ret = handle_rgw_zone_set(request=req, service=svc)
-        elif op == "rgw-regionmap-update":
-            ret = handle_rgw_regionmap_update(request=req, service=svc)
-        elif op == "rgw-regionmap-default":
-            ret = handle_rgw_regionmap_default(request=req, service=svc)
-        elif op == "rgw-create-user":
-            ret = handle_rgw_create_user(request=req, service=svc)
-        elif op == "move-osd-to-bucket":
-            ret = handle_put_osd_in_bucket(request=req, service=svc)
-        elif op == "add-permissions-to-key":
-            ret = handle_add_permissions_to_key(request=req, service=svc)
-        elif op == 'set-key-permissions':
-            ret = handle_set_key_permissions(request=req, service=svc)
-        elif op == "create-cephfs-client":
-            ret = handle_create_cephfs_client(request=req, service=svc)
-        else:
-            msg = "Unknown operation '{}'".format(op)
-            log(msg, level=ERROR)
-            return {'exit-code': 1, 'stderr': msg}
+    try:
+        ret = _process_ops_v1(reqs, results)
+    finally:
+        save_op_stats(results)
+
+    resp = _response_v1(ret)
+    if op_results:
+        resp['op-results'] = results
+    if async_ops:
+        resp['operations'] = _start_operations(reqs, results, request_id)
+    return resp
 
-    if isinstance(ret, dict) and 'exit-code' in ret:
-        return ret
 
+def _response_v1(ret):
+    """Response of a v1 request from the last op's handler return value."""
+    if isinstance(ret, dict) and 'exit-code' in ret:
+        return dict(ret)
     return {'exit-code': 0}
+
+
+def _start_operations(reqs, results, request_id):
+    """Record the LONG_RUNNING_OPS of an async request.
+
+    :returns: the operations, see charms_ceph.operations.start_operation()
+    :rtype: List[dict]
+    """
+    return [start_operation(result['op'], request_id=request_id,
+                            pools=LONG_RUNNING_OPS[result['op']](req),
+                            status=result)
+            for req, result in zip(reqs, results)
+            if result['op'] in LONG_RUNNING_OPS]
+
+
+def _process_ops_v1(reqs, results):
+    """Run the ops of a v1 request, appending their results to results.
+
+    :returns: the return value of the last op's handler
+    """
+    ret = None
+    # Group and service changes of all ops are written back once the
+    # request has been processed and all ops share one read of the pools.
+    with permission_graph(), pool_state('admin'):
+        for req in reqs:
+            ret = _run_op_v1(req, results)
+            if req.get('op') not in V1_OPS:
+                break
+    return ret
+
+
+def _run_op_v1(req, results):
+    """Run a v1 op, appending its result to results.
+
+    :returns: the return value of the op's handler, an error for an
+              unknown op
+    """
+    op = req.get('op')
+    log("Processing op='{}'".format(op), level=DEBUG)
+    # Use admin client since we do not have other client key locations
+    # setup to use them for these operations.
+    svc = 'admin'
+    with op_accounting(op) as result:
+        results.append(result)
+        ret = _process_op_v1(op, req, svc)
+        result.update(op_status(ret))
+    if ret is UNKNOWN_OP:
+        msg = "Unknown operation '{}'".format(op)
+        log(msg, level=ERROR)
+        ret = {'exit-code': 1, 'stderr': msg}
+        result.update(ret)
+    return ret
+
+
+# Ops understood by _process_op_v1()
+V1_OPS = [
+    'create-pool',
+    'create-cephfs',
+    'create-cache-tier',
+    'remove-cache-tier',
+    'create-erasure-profile',
+    'delete-pool',
+    'rename-pool',
+    'snapshot-pool',
+    'remove-pool-snapshot',
+    'set-pool-value',
+    'rgw-region-set',
+    'rgw-zone-set',
+    'rgw-regionmap-update',
+    'rgw-regionmap-default',
+    'rgw-create-user',
+    'move-osd-to-bucket',
+    'add-permissions-to-key',
+    'set-key-permissions',
+    'create-cephfs-client',
+    'get-operations',
+]
+
+
+# Returned by _process_op_v1() for ops it does not know about
+UNKNOWN_OP = object()
+
+
+def _process_op_v1(op, req, svc):
+    """Dispatch a v1 broker op to its handler.
+
+    :returns: the handler's return value or UNKNOWN_OP
+    """
+    ret = UNKNOWN_OP
+    if op == "create-pool":
+        pool_type = req.get('pool-type')  # "replicated" | "erasure"
+
+        # Default to replicated if pool_type isn't given
+        if pool_type == 'erasure':
+            ret = handle_erasure_pool(request=req, service=svc)
+        else:
+            ret = handle_replicated_pool(request=req, service=svc)
+    elif op == "create-cephfs":
+        ret = handle_create_cephfs(request=req, service=svc)
+    elif op == "create-cache-tier":
+        ret = handle_create_cache_tier(request=req, service=svc)
+    elif op == "remove-cache-tier":
+        ret = handle_remove_cache_tier(request=req, service=svc)
+    elif op == "create-erasure-profile":
+        ret = handle_create_erasure_profile(request=req, service=svc)
+    elif op == "delete-pool":
+        pool = req.get('name')
+        ret = delete_pool(service=svc, name=pool)
+        get_pool_state(svc).invalidate()
+    elif op == "rename-pool":
+        old_name = req.get('name')
+        new_name = req.get('new-name')
+        ret = rename_pool(service=svc, old_name=old_name,
+                          new_name=new_name)
+        get_pool_state(svc).invalidate()
+    elif op == "snapshot-pool":
+        pool = req.get('name')
+        snapshot_name = req.get('snapshot-name')
+        ret = snapshot_pool(service=svc, pool_name=pool,
+                            snapshot_name=snapshot_name)
+    elif op == "remove-pool-snapshot":
+        pool = req.get('name')
+        snapshot_name = req.get('snapshot-name')
+        ret = remove_pool_snapshot(service=svc, pool_name=pool,
+                                   snapshot_name=snapshot_name)
+    elif op == "set-pool-value":
+        ret = handle_set_pool_value(request=req, service=svc)
+    elif op == "rgw-region-set":
+        ret = handle_rgw_region_set(request=req, service=svc)
+    elif op == "rgw-zone-set":
+        ret = handle_rgw_zone_set(request=req, service=svc)
+    elif op == "rgw-regionmap-update":
+        ret = handle_rgw_regionmap_update(request=req, service=svc)
+    elif op == "rgw-regionmap-default":
+        ret = handle_rgw_regionmap_default(request=req, service=svc)
+    elif op == "rgw-create-user":
+        ret = handle_rgw_create_user(request=req, service=svc)
+    elif op == "move-osd-to-bucket":
+        ret = handle_put_osd_in_bucket(request=req, service=svc)
+    elif op == "add-permissions-to-key":
+        ret = handle_add_permissions_to_key(request=req, service=svc)
+    elif op == 'set-key-permissions':
+        ret = handle_set_key_permissions(request=req, service=svc)
+    elif op == "create-cephfs-client":
+        ret = handle_create_cephfs_client(request=req, service=svc)
+    elif op == "get-operations":
+        ret = handle_get_operations(request=req, service=svc)
+    return ret
+
+
+def _plan_create_pool(request, service, state, graph):
+    pool_name = request.get('name')
+    if request.get('group'):
+        graph.add_pool_to_group(pool=pool_name, group=request.get('group'),
+                                namespace=request.get('group-namespace'))
+    if state.details is None:
+        return [{'action': 'create-or-update-pool', 'pool': pool_name}]
+    if state.exists(pool_name):
+        changes = state.diff(request)
+        if not changes:
+            return []
+        return [{'action': 'update-pool', 'pool': pool_name,
+                 'changes': changes}]
+    if request.get('pool-type') == 'erasure':
+        profile = get_erasure_profile(
+            service, request.get('erasure-profile') or "default-canonical")
+        profile = profile or {}
+        size = int(profile.get('k', 0)) + int(profile.get('m', 0))
+    else:
+        size = request.get('replicas') or 0
+    pg_num = None
+    if size:
+        pg_num = get_budgeted_pg_num(service, request, size,
+                                     pool_details=state.details)
+    # Every new PG is peered on size OSDs
+    return [{'action': 'create-pool', 'pool': pool_name, 'pg_num': pg_num,
+             'new-pgs': (pg_num or 0) * size, 'heavy': True}]
+
+
+def _plan_add_permissions_to_key(request, service, state, graph):
+    graph.add_service_to_group(
+        service_name=request.get('name'),
+        group=request.get('group'),
+        permission=request.get('group-permission') or "rwx",
+        namespace=request.get('group-namespace'),
+        object_prefix_perms=request.get('object-prefix-permissions'))
+    # The writes are planned with the other graph changes
+    return []
+
+
+def _plan_set_key_permissions(request, service, state, graph):
+    entity = 'client.{}'.format(request.get('client'))
+    permissions = request.get('permissions')
+    if not key_caps_need_update(entity, permissions, client=service):
+        return []
+    return [{'action': 'set-key-caps', 'entity': entity,
+             'caps': permissions}]
+
+
+def _plan_delete_pool(request, service, state, graph):
+    if state.details is not None and not state.exists(request.get('name')):
+        return []
+    return [{'action': 'delete-pool', 'pool': request.get('name'),
+             'heavy': True}]
+
+
+def _plan_move_osd_to_bucket(request, service, state, graph):
+    return [{'action': 'move-osd', 'osd': request.get('osd'),
+             'bucket': request.get('bucket'), 'heavy': True}]
+
+
+# Ops that can be compared with the cluster state without applying them
+OP_PLANNERS = {
+    'create-pool': _plan_create_pool,
+    'add-permissions-to-key': _plan_add_permissions_to_key,
+    'set-key-permissions': _plan_set_key_permissions,
+    'delete-pool': _plan_delete_pool,
+    'move-osd-to-bucket': _plan_move_osd_to_bucket,
+}
+
+
+def plan_requests_v1(reqs):
+    """Plan v1 requests without applying them.
+
+    Each op is compared with the current state of the cluster and turned
+    into the concrete changes it would make, e.g.
+
+        {'action': 'create-pool', 'pool': 'glance', 'pg_num': 64,
+         'new-pgs': 192, 'heavy': True, 'op': 'create-pool', 'op-index': 0}
+
+    Ops that are already satisfied plan no changes.  Changes that peer PGs
+    or move data are flagged 'heavy'.  Ops without a planner are planned as
+    a single 'run-op' change as their effect can not be predicted.  Group,
+    service and key caps changes follow the ops, in the order a real run
+    writes them.
+
+    :param reqs: List of broker ops
+    :type reqs: List[dict]
+    :returns: a response dict with the 'plan' or an exit code and error
+    """
+    plan = []
+    log("Planning {} ceph broker requests".format(len(reqs)), level=INFO)
+    with permission_graph(flush=False) as graph, pool_state('admin') as state:
+        for index, req in enumerate(reqs):
+            op = req.get('op')
+            if op not in V1_OPS:
+                msg = "Unknown operation '{}'".format(op)
+                log(msg, level=ERROR)
+                return {'exit-code': 1, 'stderr': msg}
+            planner = OP_PLANNERS.get(op)
+            if planner:
+                changes = planner(req, 'admin', state, graph)
+            else:
+                changes = [{'action': 'run-op'}]
+            for change in changes:
+                change.update({'op': op, 'op-index': index})
+            plan.extend(changes)
+        plan.extend(graph.pending_changes())
+    return {'exit-code': 0, 'plan': plan}
@@ -0,0 +1,310 @@
+# Copyright 2017 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Instrumentation of the external commands run by a hook.
+
+Every subprocess helper, whether called from charms_ceph, charmhelpers or
+the charm itself, starts its process through subprocess.Popen.  While
+instrumentation is enabled subprocess.Popen is replaced by a subclass
+recording the argv, duration, exit code and output size of each command,
+so nothing has to change at the call sites.  When it is disabled
+subprocess.Popen is left alone and there is no overhead at all.
+
+A charm wraps its hooks with instrument_hook() to log, or save, a summary
+of the commands each hook ran:
+
+    with instrument_hook('/var/lib/juju/command-stats.json'):
+        hooks.execute(sys.argv)
+"""
+
+import json
+import os
+import subprocess
+import threading
+import time
+
+from contextlib import contextmanager
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    ERROR,
+)
+
+# Commands listed in a summary
+SUMMARY_TOP = 10
+
+# Options taking a value that are left out of a command's name
+VALUE_OPTIONS = ('--id', '--name', '-n', '--keyring', '-k', '--cluster',
+                 '-c', '--conf', '-u', '--format', '-f')
+
+# Words of a command kept in its name, e.g. 'ceph osd pool create'
+NAME_WORDS = 4
+
+_popen = subprocess.Popen
+_lock = threading.Lock()
+_stats = {}
+_collecting = False
+# Lists filled by recording(), per thread, and the number open in all
+# threads
+_local = threading.local()
+_open_recordings = 0
+
+
+def command_name(argv):
+    """Name commands are grouped by in a summary.
+
+    'sudo', options and the arguments past the first NAME_WORDS words are
+    left out, e.g. 'ceph osd pool create' for
+    ['sudo', '-u', 'ceph', 'ceph', '--id', 'admin', 'osd', 'pool', 'create',
+     'rbd', '32'].
+
+    :rtype: str
+    """
+    if isinstance(argv, (str, bytes)):
+        argv = str(argv).split()
+    args = iter(argv)
+    words = []
+    for arg in args:
+        arg = str(arg)
+        if arg.startswith('-'):
+            if arg in VALUE_OPTIONS:
+                next(args, None)
+            continue
+        if not words:
+            arg = os.path.basename(arg)
+            if arg == 'sudo':
+                continue
+        words.append(arg)
+        if len(words) == NAME_WORDS:
+            break
+    return ' '.join(words)
+
+
+def _output_size(output):
+    return len(output) if output else 0
+
+
+class InstrumentedPopen(_popen):
+    """subprocess.Popen recording the commands it runs.
+
+    A command is accounted for once it is seen to have exited by wait(),
+    poll() or communicate().
+    """
+
+    def __init__(self, args, *pargs, **kwargs):
+        self._record = {
+            'argv': (list(args) if isinstance(args, (list, tuple))
+                     else [args]),
+            'exit-code': None,
+            'duration': None,
+            'output-bytes': 0,
+        }
+        for records in _recordings():
+            records.append(self._record)
+        self._started = time.time()
+        # communicate() waits for the process before its output is counted
+        self._communicating = False
+        try:
+            super(InstrumentedPopen, self).__init__(args, *pargs, **kwargs)
+        except OSError as e:
+            self._record['error'] = str(e)
+            self._finish()
+            raise
+
+    def _finish(self):
+        if self._communicating or self._record['duration'] is not None:
+            return
+        self._record['duration'] = time.time() - self._started
+        self._record['exit-code'] = getattr(self, 'returncode', None)
+        _account(self._record)
+
+    def communicate(self, input=None, timeout=None):
+        self._communicating = True
+        try:
+            stdout, stderr = super(InstrumentedPopen, self).communicate(
+                input, timeout)
+        finally:
+            self._communicating = False
+        self._record['output-bytes'] += (_output_size(stdout) +
+                                         _output_size(stderr))
+        self._finish()
+        return stdout, stderr
+
+    def wait(self, timeout=None):
+        returncode = super(InstrumentedPopen, self).wait(timeout)
+        self._finish()
+        return returncode
+
+    def poll(self):
+        returncode = super(InstrumentedPopen, self).poll()
+        if returncode is not None:
+            self._finish()
+        return returncode
+
+
+def _account(record):
+    if not _collecting:
+        return
+    failed = record['exit-code'] != 0
+    with _lock:
+        stats = _stats.setdefault(command_name(record['argv']), {
+            'count': 0,
+            'failed': 0,
+            'duration': 0.0,
+            'max-duration': 0.0,
+            'output-bytes': 0,
+        })
+        stats['count'] += 1
+        stats['failed'] += int(failed)
+        stats['duration'] += record['duration']
+        stats['max-duration'] = max(stats['max-duration'],
+                                    record['duration'])
+        stats['output-bytes'] += record['output-bytes']
+
+
+def _recordings():
+    """Lists of the recordings open in the current thread."""
+    try:
+        return _local.recordings
+    except AttributeError:
+        _local.recordings = []
+        return _local.recordings
+
+
+def _install():
+    if subprocess.Popen is _popen:
+        subprocess.Popen = InstrumentedPopen
+
+
+def _uninstall():
+    if (subprocess.Popen is InstrumentedPopen and not _collecting and
+            not _open_recordings):
+        subprocess.Popen = _popen
+
+
+def enable():
+    """Start accounting for the commands run by this process."""
+    global _collecting
+    _collecting = True
+    _install()
+
+
+def disable():
+    """Stop accounting, the stats collected so far are kept."""
+    global _collecting
+    _collecting = False
+    _uninstall()
+
+
+def is_enabled():
+    return _collecting
+
+
+def reset():
+    """Forget the stats collected so far."""
+    with _lock:
+        _stats.clear()
+
+
+@contextmanager
+def recording():
+    """Record the commands run in the block, whether enabled or not.
+
+    Only the commands started by the thread that opened the recording are
+    recorded, commands other threads run meanwhile are not, nor are those
+    of threads started in the block.
+
+    :returns: list each command's record is appended to when it starts,
+              a dict with 'argv' and, once the command exited,
+              'exit-code', 'duration' in seconds and 'output-bytes' of
+              the output read through pipes.
+    """
+    global _open_recordings
+    records = []
+    _recordings().append(records)
+    with _lock:
+        _open_recordings += 1
+        _install()
+    try:
+        yield records
+    finally:
+        _recordings().remove(records)
+        with _lock:
+            _open_recordings -= 1
+            _uninstall()
+
+
+def get_summary(top=SUMMARY_TOP):
+    """Summary of the commands run since enable() or reset().
+
+    :param top: commands to list, by total duration
+    :type top: int
+    :returns: totals and the top commands, e.g.
+              {'count': 12, 'failed': 0, 'duration': 3.2,
+               'output-bytes': 5120,
+               'commands': [{'command': 'ceph osd pool create',
+                             'count': 4, 'failed': 0, 'duration': 2.4,
+                             'max-duration': 0.9, 'output-bytes': 0}, ...]}
+    :rtype: dict
+    """
+    with _lock:
+        stats = [dict(value, command=name) for name, value in _stats.items()]
+    stats.sort(key=lambda entry: (-entry['duration'], entry['command']))
+    for entry in stats:
+        entry['duration'] = round(entry['duration'], 3)
+        entry['max-duration'] = round(entry['max-duration'], 3)
+    return {
+        'count': sum(entry['count'] for entry in stats),
+        'failed': sum(entry['failed'] for entry in stats),
+        'duration': round(sum(entry['duration'] for entry in stats), 3),
+        'output-bytes': sum(entry['output-bytes'] for entry in stats),
+        'commands': stats[:top],
+    }
+
+
+def dump_summary(path=None, top=SUMMARY_TOP):
+    """Write the summary as JSON to path, or to the juju log if None.
+
+    :returns: the summary, see get_summary()
+    :rtype: dict
+    """
+    summary = get_summary(top)
+    if path is None:
+        log("External commands: {}".format(json.dumps(summary)),
+            level=DEBUG)
+        return summary
+    try:
+        with open(path, 'w') as f:
+            json.dump(summary, f, indent=2, sort_keys=True)
+    except OSError as e:
+        log("Unable to save command summary to {}: {}".format(path, e),
+            level=ERROR)
+    return summary
+
+
+@contextmanager
+def instrument_hook(path=None, top=SUMMARY_TOP):
+    """Account for the commands run in the block and dump their summary.
+
+    :param path: file to write the summary to, the juju log if None
+    :type path: Optional[str]
+    """
+    reset()
+    enable()
+    try:
+        yield
+    finally:
+        disable()
+        dump_summary(path, top)
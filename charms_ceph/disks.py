@@ -0,0 +1,1090 @@
+# Copyright 2017-2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Discovery, preparation and activation of OSD devices."""
+
+import collections
+import glob
+import os
+import pyudev
+import re
+import subprocess
+import uuid
+
+from charmhelpers.core.host import (
+    chownr,
+    mkdir,
+)
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    status_set,
+    DEBUG,
+    ERROR,
+    WARNING,
+    storage_get,
+    storage_list,
+)
+from charmhelpers.contrib.storage.linux.utils import (
+    is_block_device,
+    is_device_mounted,
+)
+from charmhelpers.contrib.storage.linux import lvm
+from charmhelpers.core.unitdata import kv
+
+from charms_ceph.utils import (
+    ceph_user,
+    cmp_pkgrevno,
+)
+
+MOUNTINFO_FILE = os.path.join(os.sep, 'proc', 'self', 'mountinfo')
+PROC_DIR = os.path.join(os.sep, 'proc')
+SYS_CLASS_BLOCK = os.path.join(os.sep, 'sys', 'class', 'block')
+
+CEPH_KEY_MANAGER = 'ceph'
+VAULT_KEY_MANAGER = 'vault'
+KEY_MANAGERS = [
+    CEPH_KEY_MANAGER,
+    VAULT_KEY_MANAGER,
+]
+
+
+class Partition(object):
+    def __init__(self, name, number, size, start, end, sectors, uuid):
+        """A block device partition.
+
+        :param name: Name of block device
+        :param number: Partition number
+        :param size: Capacity of the device
+        :param start: Starting block
+        :param end: Ending block
+        :param sectors: Number of blocks
+        :param uuid: UUID of the partition
+        """
+        self.name = name,
+        self.number = number
+        self.size = size
+        self.start = start
+        self.end = end
+        self.sectors = sectors
+        self.uuid = uuid
+
+    def __str__(self):
+        return "number: {} start: {} end: {} sectors: {} size: {} " \
+               "name: {} uuid: {}".format(self.number, self.start,
+                                          self.end,
+                                          self.sectors, self.size,
+                                          self.name, self.uuid)
+
+    def __eq__(self, other):
+        if isinstance(other, self.__class__):
+            return self.__dict__ == other.__dict__
+        return False
+
+    def __ne__(self, other):
+        return not self.__eq__(other)
+
+
+def unmounted_disks():
+    """List of unmounted block devices on the current host."""
+    disks = []
+    context = pyudev.Context()
+    for device in context.list_devices(DEVTYPE='disk'):
+        if device['SUBSYSTEM'] == 'block':
+            if device.device_node is None:
+                continue
+
+            matched = False
+            for block_type in [u'dm-', u'loop', u'ram', u'nbd']:
+                if block_type in device.device_node:
+                    matched = True
+            if matched:
+                continue
+
+            disks.append(device.device_node)
+    log("Found disks: {}".format(disks))
+    mounts = MountTable.load()
+    return [disk for disk in disks if not mounts.device_mounted(disk)]
+
+
+def _unescape_mount_field(field):
+    """Undo the octal escaping of whitespace used in /proc mount tables."""
+    return re.sub(r'\\([0-7]{3})', lambda m: chr(int(m.group(1), 8)), field)
+
+
+def _block_devnos(name):
+    """Return the major:minor numbers of a block device and of everything
+    stacked on it (partitions and holders such as LVM or dm-crypt volumes).
+
+    :param name: Kernel name of the block device. Example: sda
+    :returns: set of 'major:minor' strings
+    """
+    devnos = set()
+    seen = set()
+    pending = [name]
+    while pending:
+        name = pending.pop()
+        if name in seen:
+            continue
+        seen.add(name)
+        base = os.path.join(SYS_CLASS_BLOCK, name)
+        try:
+            with open(os.path.join(base, 'dev'), 'r') as f:
+                devnos.add(f.read().strip())
+            children = os.listdir(base)
+        except (IOError, OSError):
+            continue
+        pending.extend(
+            child for child in children
+            if child.startswith(name) and
+            os.path.exists(os.path.join(base, child, 'partition')))
+        try:
+            pending.extend(os.listdir(os.path.join(base, 'holders')))
+        except OSError:
+            pass
+    return devnos
+
+
+class MountTable(object):
+    """Index of the mount table parsed from /proc/self/mountinfo.
+
+    Built with one read of the mount table; lookups use exact path matching
+    in both directions (device to mount points, mount point to device).
+    """
+
+    def __init__(self, entries):
+        """Build the index.
+
+        :param entries: (devno, source, mountpoint) tuples
+        :type entries: List[Tuple[str, str, str]]
+        """
+        self.mountpoint_to_device = {}
+        self.device_to_mountpoints = collections.defaultdict(list)
+        self.mounted_devnos = set()
+        for devno, source, mountpoint in entries:
+            self.mountpoint_to_device[mountpoint] = source
+            self.device_to_mountpoints[source].append(mountpoint)
+            self.mounted_devnos.add(devno)
+
+    @classmethod
+    def load(cls, path=None):
+        """Parse the mount table of the current process.
+
+        An unreadable mount table is logged and treated as empty.
+
+        :param path: Alternative mountinfo file to parse
+        :type path: str
+        :returns: MountTable
+        """
+        path = path or MOUNTINFO_FILE
+        entries = []
+        try:
+            with open(path, 'r') as f:
+                lines = f.readlines()
+        except OSError as e:
+            log('Unable to read the mount table {}: {}'.format(path, e),
+                level=WARNING)
+            lines = []
+        for line in lines:
+            # id parent major:minor root mountpoint options
+            # [optional fields...] - fstype source super-options
+            fields = line.split()
+            try:
+                separator = fields.index('-', 6)
+                entries.append((
+                    fields[2],
+                    _unescape_mount_field(fields[separator + 2]),
+                    _unescape_mount_field(fields[4])))
+            except (ValueError, IndexError):
+                continue
+        return cls(entries)
+
+    def is_mountpoint(self, path):
+        """Is something mounted at exactly path."""
+        return os.path.normpath(path) in self.mountpoint_to_device
+
+    def device(self, mountpoint):
+        """Return the source device mounted at mountpoint or None."""
+        return self.mountpoint_to_device.get(os.path.normpath(mountpoint))
+
+    def mountpoints(self, device):
+        """Return the mount points of the source device."""
+        return list(self.device_to_mountpoints.get(device, []))
+
+    def device_mounted(self, device):
+        """Is the block device, one of its partitions or a device stacked on
+        top of it mounted.
+
+        :param device: Full path to a block device
+        :type device: str
+        :rtype: bool
+        """
+        realpath = os.path.realpath(device)
+        if (self.device_to_mountpoints.get(device) or
+                self.device_to_mountpoints.get(realpath)):
+            return True
+        return bool(self.mounted_devnos &
+                    _block_devnos(os.path.basename(realpath)))
+
+
+def _get_child_dirs(path):
+    """Returns a list of directory names in the specified path.
+
+    :param path: a full path listing of the parent directory to return child
+                 directory names
+    :returns: list. A list of child directories under the parent directory
+    :raises: ValueError if the specified path does not exist or is not a
+             directory,
+             OSError if an error occurs reading the directory listing
+    """
+    if not os.path.exists(path):
+        raise ValueError('Specified path "%s" does not exist' % path)
+    if not os.path.isdir(path):
+        raise ValueError('Specified path "%s" is not a directory' % path)
+
+    files_in_dir = [os.path.join(path, f) for f in os.listdir(path)]
+    return list(filter(os.path.isdir, files_in_dir))
+
+
+def _get_osd_num_from_dirname(dirname):
+    """Parses the dirname and returns the OSD id.
+
+    Parses a string in the form of 'ceph-{osd#}' and returns the OSD number
+    from the directory name.
+
+    :param dirname: the directory name to return the OSD number from
+    :return int: the OSD number the directory name corresponds to
+    :raises ValueError: if the OSD number cannot be parsed from the provided
+                        directory name.
+    """
+    match = re.search(r'ceph-(?P<osd_id>\d+)', dirname)
+    if not match:
+        raise ValueError("dirname not in correct format: {}".format(dirname))
+
+    return match.group('osd_id')
+
+
+def get_crimson_osd_ids():
+    """Return a set of the OSDs that are running with the Crimson backend."""
+    rv = set()
+    try:
+        pids = [pid for pid in os.listdir(PROC_DIR) if pid.isdigit()]
+    except OSError:
+        return rv
+
+    for pid in pids:
+        try:
+            with open(os.path.join(PROC_DIR, pid, 'comm'), 'r') as f:
+                if f.read().strip() != 'crimson-osd':
+                    continue
+            with open(os.path.join(PROC_DIR, pid, 'cmdline'), 'rb') as f:
+                args = f.read().decode('utf8').split('\0')
+        except (IOError, OSError, UnicodeDecodeError):
+            # Process went away while scanning
+            continue
+        args = [arg for arg in args if arg]
+        if args:
+            rv.add(args[-1])
+
+    return rv
+
+
+def get_local_osd_ids():
+    """This will list the /var/lib/ceph/osd/* directories and try
+    to split the ID off of the directory name and return it in
+    a list. Excludes crimson OSD's from the returned list.
+
+    :returns: list. A list of OSD identifiers
+    :raises: OSError if something goes wrong with listing the directory.
+    """
+    osd_ids = []
+    osd_path = os.path.join(os.sep, 'var', 'lib', 'ceph', 'osd')
+    if os.path.exists(osd_path):
+        crimson_osds = get_crimson_osd_ids()
+        mounts = MountTable.load()
+        try:
+            dirs = os.listdir(osd_path)
+            for osd_dir in dirs:
+                osd_id = osd_dir.split('-')[1] if '-' in osd_dir else ''
+                if (_is_int(osd_id) and
+                        filesystem_mounted(os.path.join(
+                            os.sep, osd_path, osd_dir), mounts=mounts) and
+                        osd_id not in crimson_osds):
+                    osd_ids.append(osd_id)
+        except OSError:
+            raise
+    return osd_ids
+
+
+def get_local_mon_ids():
+    """This will list the /var/lib/ceph/mon/* directories and try
+    to split the ID off of the directory name and return it in
+    a list.
+
+    :returns: list. A list of monitor identifiers
+    :raises: OSError if something goes wrong with listing the directory.
+    """
+    mon_ids = []
+    mon_path = os.path.join(os.sep, 'var', 'lib', 'ceph', 'mon')
+    if os.path.exists(mon_path):
+        try:
+            dirs = os.listdir(mon_path)
+            for mon_dir in dirs:
+                # Basically this takes everything after ceph- as the monitor ID
+                match = re.search('ceph-(?P<mon_id>.*)', mon_dir)
+                if match:
+                    mon_ids.append(match.group('mon_id'))
+        except OSError:
+            raise
+    return mon_ids
+
+
+def _is_int(v):
+    """Return True if the object v can be turned into an integer."""
+    try:
+        int(v)
+        return True
+    except ValueError:
+        return False
+
+
+DISK_FORMATS = [
+    'xfs',
+    'ext4',
+    'btrfs'
+]
+
+CEPH_PARTITIONS = [
+    '89C57F98-2FE5-4DC0-89C1-5EC00CEFF2BE',  # Ceph encrypted disk in creation
+    '45B0969E-9B03-4F30-B4C6-5EC00CEFF106',  # Ceph encrypted journal
+    '4FBD7E29-9D25-41B8-AFD0-5EC00CEFF05D',  # Ceph encrypted OSD data
+    '4FBD7E29-9D25-41B8-AFD0-062C0CEFF05D',  # Ceph OSD data
+    '45B0969E-9B03-4F30-B4C6-B4B80CEFF106',  # Ceph OSD journal
+    '89C57F98-2FE5-4DC0-89C1-F3AD0CEFF2BE',  # Ceph disk in creation
+]
+
+
+def get_partition_list(dev):
+    """Lists the partitions of a block device.
+
+    :param dev: Path to a block device. ex: /dev/sda
+    :returns: Returns a list of Partition objects.
+    :raises: CalledProcessException if lsblk fails
+    """
+    partitions_list = []
+    try:
+        partitions = get_partitions(dev)
+        # For each line of output
+        for partition in partitions:
+            parts = partition.split()
+            try:
+                partitions_list.append(
+                    Partition(number=parts[0],
+                              start=parts[1],
+                              end=parts[2],
+                              sectors=parts[3],
+                              size=parts[4],
+                              name=parts[5],
+                              uuid=parts[6])
+                )
+            except IndexError:
+                partitions_list.append(
+                    Partition(number=parts[0],
+                              start=parts[1],
+                              end=parts[2],
+                              sectors=parts[3],
+                              size=parts[4],
+                              name="",
+                              uuid=parts[5])
+                )
+
+        return partitions_list
+    except subprocess.CalledProcessError:
+        raise
+
+
+def is_pristine_disk(dev):
+    """
+    Read first 2048 bytes (LBA 0 - 3) of block device to determine whether it
+    is actually all zeros and safe for us to use.
+
+    Existing partitioning tools does not discern between a failure to read from
+    block device, failure to understand a partition table and the fact that a
+    block device has no partition table.  Since we need to be positive about
+    which is which we need to read the device directly and confirm ourselves.
+
+    :param dev: Path to block device
+    :type dev: str
+    :returns: True all 2048 bytes == 0x0, False if not
+    :rtype: bool
+    """
+    want_bytes = 2048
+
+    try:
+        f = open(dev, 'rb')
+    except OSError as e:
+        log(e)
+        return False
+
+    data = f.read(want_bytes)
+    read_bytes = len(data)
+    if read_bytes != want_bytes:
+        log('{}: short read, got {} bytes expected {}.'
+            .format(dev, read_bytes, want_bytes), level=WARNING)
+        return False
+
+    return all(byte == 0x0 for byte in data)
+
+
+def is_osd_disk(dev):
+    db = kv()
+    osd_devices = db.get('osd-devices', [])
+    if dev in osd_devices:
+        log('Device {} already processed by charm,'
+            ' skipping'.format(dev))
+        return True
+
+    partitions = get_partition_list(dev)
+    for partition in partitions:
+        try:
+            info = str(subprocess
+                       .check_output(['sgdisk', '-i', partition.number, dev])
+                       .decode('UTF-8'))
+            info = info.split("\n")  # IGNORE:E1103
+            for line in info:
+                for ptype in CEPH_PARTITIONS:
+                    sig = 'Partition GUID code: {}'.format(ptype)
+                    if line.startswith(sig):
+                        return True
+        except subprocess.CalledProcessError as e:
+            log("sgdisk inspection of partition {} on {} failed with "
+                "error: {}. Skipping".format(partition.minor, dev, e),
+                level=ERROR)
+    return False
+
+
+def start_osds(devices):
+    # Scan for Ceph block devices
+    rescan_osd_devices()
+    if (cmp_pkgrevno('ceph', '0.56.6') >= 0 and
+            cmp_pkgrevno('ceph', '14.2.0') < 0):
+        # Use ceph-disk activate for directory based OSD's
+        for dev_or_path in devices:
+            if os.path.exists(dev_or_path) and os.path.isdir(dev_or_path):
+                subprocess.check_call(
+                    ['ceph-disk', 'activate', dev_or_path])
+
+
+def udevadm_settle():
+    cmd = ['udevadm', 'settle']
+    subprocess.call(cmd)
+
+
+def rescan_osd_devices():
+    cmd = [
+        'udevadm', 'trigger',
+        '--subsystem-match=block', '--action=add'
+    ]
+
+    subprocess.call(cmd)
+
+    udevadm_settle()
+
+
+def get_partitions(dev):
+    cmd = ['partx', '--raw', '--noheadings', dev]
+    try:
+        out = str(subprocess.check_output(cmd).decode('UTF-8')).splitlines()
+        log("get partitions: {}".format(out), level=DEBUG)
+        return out
+    except subprocess.CalledProcessError as e:
+        log("Can't get info for {0}: {1}".format(dev, e.output))
+        return []
+
+
+def get_lvs(dev):
+    """
+    List logical volumes for the provided block device
+
+    :param: dev: Full path to block device.
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           operation failed.
+    :returns: list: List of logical volumes provided by the block device
+    """
+    if not lvm.is_lvm_physical_volume(dev):
+        return []
+    vg_name = lvm.list_lvm_volume_group(dev)
+    return lvm.list_logical_volumes('vg_name={}'.format(vg_name))
+
+
+def find_least_used_utility_device(utility_devices, lvs=False):
+    """
+    Find a utility device which has the smallest number of partitions
+    among other devices in the supplied list.
+
+    :utility_devices: A list of devices to be used for filestore journal
+    or bluestore wal or db.
+    :lvs: flag to indicate whether inspection should be based on LVM LV's
+    :return: string device name
+    """
+    if lvs:
+        usages = map(lambda a: (len(get_lvs(a)), a), utility_devices)
+    else:
+        usages = map(lambda a: (len(get_partitions(a)), a), utility_devices)
+    least = min(usages, key=lambda t: t[0])
+    return least[1]
+
+
+def get_devices(name):
+    """Merge config and Juju storage based devices
+
+    :name: The name of the device type, e.g.: wal, osd, journal
+    :returns: Set(device names), which are strings
+    """
+    if config(name):
+        devices = [dev.strip() for dev in config(name).split(' ')]
+    else:
+        devices = []
+    storage_ids = storage_list(name)
+    devices.extend((storage_get('location', sid) for sid in storage_ids))
+    devices = filter(os.path.exists, devices)
+
+    return set(devices)
+
+
+def osdize(dev, osd_format, osd_journal, ignore_errors=False, encrypt=False,
+           key_manager=CEPH_KEY_MANAGER, osd_id=None, bluestore_skip=None):
+    if dev.startswith('/dev'):
+        osdize_dev(dev, osd_format, osd_journal,
+                   ignore_errors, encrypt,
+                   key_manager, osd_id, bluestore_skip)
+    else:
+        if cmp_pkgrevno('ceph', '14.0.0') >= 0:
+            log("Directory backed OSDs can not be created on Nautilus",
+                level=WARNING)
+            return
+        osdize_dir(dev, encrypt)
+
+
+def osdize_dev(dev, osd_format, osd_journal, ignore_errors=False,
+               encrypt=False, key_manager=CEPH_KEY_MANAGER,
+               osd_id=None, bluestore_skip=None):
+    """
+    Prepare a block device for use as a Ceph OSD
+
+    A block device will only be prepared once during the lifetime
+    of the calling charm unit; future executions will be skipped.
+
+    :param: dev: Full path to block device to use
+    :param: osd_format: Format for OSD filesystem
+    :param: osd_journal: List of block devices to use for OSD journals
+    :param: ignore_errors: Don't fail in the event of any errors during
+                           processing
+    :param: encrypt: Encrypt block devices using 'key_manager'
+    :param: key_manager: Key management approach for encryption keys
+    :param: osd_id: The ID for the newly created OSD
+    :param: bluestore_skip: Bluestore parameters to skip ('wal' and/or 'db')
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           subprocess operation failed
+    :raises ValueError: if an invalid key_manager is provided
+    """
+    if key_manager not in KEY_MANAGERS:
+        raise ValueError('Unsupported key manager: {}'.format(key_manager))
+
+    db = kv()
+    osd_devices = db.get('osd-devices', [])
+    try:
+        if dev in osd_devices:
+            log('Device {} already processed by charm,'
+                ' skipping'.format(dev))
+            return
+
+        if not os.path.exists(dev):
+            log('Path {} does not exist - bailing'.format(dev))
+            return
+
+        if not is_block_device(dev):
+            log('Path {} is not a block device - bailing'.format(dev))
+            return
+
+        if is_osd_disk(dev):
+            log('Looks like {} is already an'
+                ' OSD data or journal, skipping.'.format(dev))
+            if is_device_mounted(dev):
+                osd_devices.append(dev)
+            return
+
+        if is_device_mounted(dev):
+            log('Looks like {} is in use, skipping.'.format(dev))
+            return
+
+        if is_active_bluestore_device(dev):
+            log('{} is in use as an active bluestore block device,'
+                ' skipping.'.format(dev))
+            osd_devices.append(dev)
+            return
+
+        if is_mapped_luks_device(dev):
+            log('{} is a mapped LUKS device,'
+                ' skipping.'.format(dev))
+            return
+
+        if cmp_pkgrevno('ceph', '12.2.4') >= 0:
+            cmd = _ceph_volume(dev,
+                               osd_journal,
+                               encrypt,
+                               key_manager,
+                               osd_id,
+                               bluestore_skip)
+        else:
+            cmd = _ceph_disk(dev,
+                             osd_format,
+                             osd_journal,
+                             encrypt)
+
+        try:
+            status_set('maintenance', 'Initializing device {}'.format(dev))
+            log("osdize cmd: {}".format(cmd))
+            subprocess.check_call(cmd)
+        except subprocess.CalledProcessError:
+            try:
+                lsblk_output = subprocess.check_output(
+                    ['lsblk', '-P']).decode('UTF-8')
+            except subprocess.CalledProcessError as e:
+                log("Couldn't get lsblk output: {}".format(e), ERROR)
+            if ignore_errors:
+                log('Unable to initialize device: {}'.format(dev), WARNING)
+                if lsblk_output:
+                    log('lsblk output: {}'.format(lsblk_output), DEBUG)
+            else:
+                log('Unable to initialize device: {}'.format(dev), ERROR)
+                if lsblk_output:
+                    log('lsblk output: {}'.format(lsblk_output), WARNING)
+                raise
+
+        # NOTE: Record processing of device only on success to ensure that
+        #       the charm only tries to initialize a device of OSD usage
+        #       once during its lifetime.
+        osd_devices.append(dev)
+    finally:
+        db.set('osd-devices', osd_devices)
+        db.flush()
+
+
+def _ceph_disk(dev, osd_format, osd_journal, encrypt=False):
+    """
+    Prepare a device for usage as a Ceph OSD using ceph-disk
+
+    :param: dev: Full path to use for OSD block device setup,
+                 The function looks up realpath of the device
+    :param: osd_journal: List of block devices to use for OSD journals
+    :param: encrypt: Use block device encryption (unsupported)
+    :returns: list. 'ceph-disk' command and required parameters for
+                    execution by check_call
+    """
+    cmd = ['ceph-disk', 'prepare']
+
+    if encrypt:
+        cmd.append('--dmcrypt')
+
+    cmd.append('--bluestore')
+    wal = get_devices('bluestore-wal')
+    if wal:
+        cmd.append('--block.wal')
+        least_used_wal = find_least_used_utility_device(wal)
+        cmd.append(least_used_wal)
+    db = get_devices('bluestore-db')
+    if db:
+        cmd.append('--block.db')
+        least_used_db = find_least_used_utility_device(db)
+        cmd.append(least_used_db)
+
+    cmd.append(os.path.realpath(dev))
+
+    if osd_journal:
+        least_used = find_least_used_utility_device(osd_journal)
+        cmd.append(least_used)
+
+    return cmd
+
+
+def _ceph_volume(dev, osd_journal, encrypt=False, key_manager=CEPH_KEY_MANAGER,
+                 osd_id=None, bluestore_skip=None):
+    """
+    Prepare and activate a device for usage as a Ceph OSD using ceph-volume.
+
+    This also includes creation of all PV's, VG's and LV's required to
+    support the initialization of the OSD.
+
+    :param: dev: Full path to use for OSD block device setup
+    :param: osd_journal: List of block devices to use for OSD journals
+    :param: encrypt: Use block device encryption
+    :param: key_manager: dm-crypt Key Manager to use
+    :param: osd_id: The OSD-id to recycle, or None to create a new one
+    :param: bluestore_skip: Bluestore parameters to skip ('wal' and/or 'db')
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           LVM operation failed.
+    :returns: list. 'ceph-volume' command and required parameters for
+                    execution by check_call
+    """
+    cmd = ['ceph-volume', 'lvm', 'create']
+
+    osd_fsid = str(uuid.uuid4())
+    cmd.append('--osd-fsid')
+    cmd.append(osd_fsid)
+    cmd.append('--bluestore')
+    main_device_type = 'block'
+
+    if encrypt and key_manager == CEPH_KEY_MANAGER:
+        cmd.append('--dmcrypt')
+
+    if osd_id is not None:
+        cmd.extend(['--osd-id', str(osd_id)])
+
+    cmd.append('--data')
+    cmd.append(_allocate_logical_volume(dev=dev,
+                                        lv_type=main_device_type,
+                                        osd_fsid=osd_fsid,
+                                        encrypt=encrypt,
+                                        key_manager=key_manager))
+
+    extras = ('wal', 'db')
+    if bluestore_skip:
+        extras = tuple(set(extras) - set(bluestore_skip))
+
+    for extra_volume in extras:
+        devices = get_devices('bluestore-{}'.format(extra_volume))
+        if devices:
+            cmd.append('--block.{}'.format(extra_volume))
+            least_used = find_least_used_utility_device(devices,
+                                                        lvs=True)
+            cmd.append(_allocate_logical_volume(
+                dev=least_used,
+                lv_type=extra_volume,
+                osd_fsid=osd_fsid,
+                size='{}M'.format(calculate_volume_size(extra_volume)),
+                shared=True,
+                encrypt=encrypt,
+                key_manager=key_manager)
+            )
+
+    return cmd
+
+
+def _partition_name(dev):
+    """
+    Derive the first partition name for a block device
+
+    :param: dev: Full path to block device.
+    :returns: str: Full path to first partition on block device.
+    """
+    if dev[-1].isdigit():
+        return '{}p1'.format(dev)
+    else:
+        return '{}1'.format(dev)
+
+
+def is_active_bluestore_device(dev):
+    """
+    Determine whether provided device is part of an active
+    bluestore based OSD (as its block component).
+
+    :param: dev: Full path to block device to check for Bluestore usage.
+    :returns: boolean: indicating whether device is in active use.
+    """
+    if not lvm.is_lvm_physical_volume(dev):
+        return False
+
+    vg_name = lvm.list_lvm_volume_group(dev)
+    try:
+        lv_name = lvm.list_logical_volumes('vg_name={}'.format(vg_name))[0]
+    except IndexError:
+        return False
+
+    block_symlinks = glob.glob('/var/lib/ceph/osd/ceph-*/block')
+    for block_candidate in block_symlinks:
+        if os.path.islink(block_candidate):
+            target = os.readlink(block_candidate)
+            if target.endswith(lv_name):
+                return True
+
+    return False
+
+
+def is_luks_device(dev):
+    """
+    Determine if dev is a LUKS-formatted block device.
+
+    :param: dev: A full path to a block device to check for LUKS header
+    presence
+    :returns: boolean: indicates whether a device is used based on LUKS header.
+    """
+    return True if _luks_uuid(dev) else False
+
+
+def is_mapped_luks_device(dev):
+    """
+    Determine if dev is a mapped LUKS device
+    :param: dev: A full path to a block device to be checked
+    :returns: boolean: indicates whether a device is mapped
+    """
+    _, dirs, _ = next(os.walk(
+        '/sys/class/block/{}/holders/'
+        .format(os.path.basename(os.path.realpath(dev))))
+    )
+    is_held = len(dirs) > 0
+    return is_held and is_luks_device(dev)
+
+
+def get_conf(variable):
+    """
+    Get the value of the given configuration variable from the
+    cluster.
+
+    :param variable: Ceph configuration variable
+    :returns: str. configured value for provided variable
+
+    """
+    return subprocess.check_output([
+        'ceph-osd',
+        '--show-config-value={}'.format(variable),
+        '--no-mon-config',
+    ]).strip()
+
+
+def calculate_volume_size(lv_type):
+    """
+    Determine the configured size for Bluestore DB/WAL or
+    Filestore Journal devices
+
+    :param lv_type: volume type (db, wal or journal)
+    :raises KeyError: if invalid lv_type is supplied
+    :returns: int. Configured size in megabytes for volume type
+    """
+    # lv_type -> Ceph configuration option
+    _config_map = {
+        'db': 'bluestore_block_db_size',
+        'wal': 'bluestore_block_wal_size',
+        'journal': 'osd_journal_size',
+    }
+
+    # default sizes in MB
+    _default_size = {
+        'db': 1024,
+        'wal': 576,
+        'journal': 1024,
+    }
+
+    # conversion of Ceph config units to MB
+    _units = {
+        'db': 1048576,  # Bytes -> MB
+        'wal': 1048576,  # Bytes -> MB
+        'journal': 1,  # Already in MB
+    }
+
+    configured_size = get_conf(_config_map[lv_type])
+
+    if configured_size is None or int(configured_size) == 0:
+        return _default_size[lv_type]
+    else:
+        return int(configured_size) / _units[lv_type]
+
+
+def _luks_uuid(dev):
+    """
+    Check to see if dev is a LUKS encrypted volume, returning the UUID
+    of volume if it is.
+
+    :param: dev: path to block device to check.
+    :returns: str. UUID of LUKS device or None if not a LUKS device
+    """
+    try:
+        cmd = ['cryptsetup', 'luksUUID', dev]
+        return subprocess.check_output(cmd).decode('UTF-8').strip()
+    except subprocess.CalledProcessError:
+        return None
+
+
+def _initialize_disk(dev, dev_uuid, encrypt=False,
+                     key_manager=CEPH_KEY_MANAGER):
+    """
+    Initialize a raw block device consuming 100% of the available
+    disk space.
+
+    Function assumes that block device has already been wiped.
+
+    :param: dev: path to block device to initialize
+    :param: dev_uuid: UUID to use for any dm-crypt operations
+    :param: encrypt: Encrypt OSD devices using dm-crypt
+    :param: key_manager: Key management approach for dm-crypt keys
+    :raises: subprocess.CalledProcessError: if any parted calls fail
+    :returns: str: Full path to new partition.
+    """
+    use_vaultlocker = encrypt and key_manager == VAULT_KEY_MANAGER
+
+    if use_vaultlocker:
+        # NOTE(jamespage): Check to see if already initialized as a LUKS
+        #                  volume, which indicates this is a shared block
+        #                  device for journal, db or wal volumes.
+        luks_uuid = _luks_uuid(dev)
+        if luks_uuid:
+            return '/dev/mapper/crypt-{}'.format(luks_uuid)
+
+    dm_crypt = '/dev/mapper/crypt-{}'.format(dev_uuid)
+
+    if use_vaultlocker and not os.path.exists(dm_crypt):
+        subprocess.check_call([
+            'vaultlocker',
+            'encrypt',
+            '--uuid', dev_uuid,
+            dev,
+        ])
+        subprocess.check_call([
+            'dd',
+            'if=/dev/zero',
+            'of={}'.format(dm_crypt),
+            'bs=512',
+            'count=1',
+        ])
+
+    if use_vaultlocker:
+        return dm_crypt
+    else:
+        return dev
+
+
+def _allocate_logical_volume(dev, lv_type, osd_fsid,
+                             size=None, shared=False,
+                             encrypt=False,
+                             key_manager=CEPH_KEY_MANAGER):
+    """
+    Allocate a logical volume from a block device, ensuring any
+    required initialization and setup of PV's and VG's to support
+    the LV.
+
+    :param: dev: path to block device to allocate from.
+    :param: lv_type: logical volume type to create
+                     (data, block, journal, wal, db)
+    :param: osd_fsid: UUID of the OSD associate with the LV
+    :param: size: Size in LVM format for the device;
+                  if unset 100% of VG
+    :param: shared: Shared volume group (journal, wal, db)
+    :param: encrypt: Encrypt OSD devices using dm-crypt
+    :param: key_manager: dm-crypt Key Manager to use
+    :raises subprocess.CalledProcessError: in the event that any supporting
+                                           LVM or parted operation fails.
+    :returns: str: String in the format 'vg_name/lv_name'.
+    """
+    lv_name = "osd-{}-{}".format(lv_type, osd_fsid)
+    current_volumes = lvm.list_logical_volumes()
+    if shared:
+        dev_uuid = str(uuid.uuid4())
+    else:
+        dev_uuid = osd_fsid
+    pv_dev = _initialize_disk(dev, dev_uuid, encrypt, key_manager)
+
+    vg_name = None
+    if not lvm.is_lvm_physical_volume(pv_dev):
+        lvm.create_lvm_physical_volume(pv_dev)
+        if not os.path.exists(pv_dev):
+            # NOTE: trigger rescan to work around bug 1878752
+            rescan_osd_devices()
+        if shared:
+            vg_name = 'ceph-{}-{}'.format(lv_type,
+                                          str(uuid.uuid4()))
+        else:
+            vg_name = 'ceph-{}'.format(osd_fsid)
+        lvm.create_lvm_volume_group(vg_name, pv_dev)
+    else:
+        vg_name = lvm.list_lvm_volume_group(pv_dev)
+
+    if lv_name not in current_volumes:
+        lvm.create_logical_volume(lv_name, vg_name, size)
+
+    return "{}/{}".format(vg_name, lv_name)
+
+
+def osdize_dir(path, encrypt=False):
+    """Ask ceph-disk to prepare a directory to become an OSD.
+
+    :param path: str. The directory to osdize
+    :param encrypt: bool. Should the OSD directory be encrypted at rest
+    :returns: None
+    """
+
+    db = kv()
+    osd_devices = db.get('osd-devices', [])
+    if path in osd_devices:
+        log('Device {} already processed by charm,'
+            ' skipping'.format(path))
+        return
+
+    for t in ['upstart', 'systemd']:
+        if os.path.exists(os.path.join(path, t)):
+            log('Path {} is already used as an OSD dir - bailing'.format(path))
+            return
+
+    if cmp_pkgrevno('ceph', "0.56.6") < 0:
+        log('Unable to use directories for OSDs with ceph < 0.56.6',
+            level=ERROR)
+        return
+
+    mkdir(path, owner=ceph_user(), group=ceph_user(), perms=0o755)
+    chownr('/var/lib/ceph', ceph_user(), ceph_user())
+    cmd = [
+        'sudo', '-u', ceph_user(),
+        'ceph-disk',
+        'prepare',
+        '--data-dir',
+        path
+    ]
+    if cmp_pkgrevno('ceph', '0.60') >= 0:
+        if encrypt:
+            cmd.append('--dmcrypt')
+    cmd.append('--bluestore')
+
+    log("osdize dir cmd: {}".format(cmd))
+    subprocess.check_call(cmd)
+
+    # NOTE: Record processing of device only on success to ensure that
+    #       the charm only tries to initialize a device of OSD usage
+    #       once during its lifetime.
+    osd_devices.append(path)
+    db.set('osd-devices', osd_devices)
+    db.flush()
+
+
+def filesystem_mounted(fs, mounts=None):
+    """Is a filesystem mounted at exactly the path fs.
+
+    :param fs: Mount point to check
+    :type fs: str
+    :param mounts: Mount table to use instead of reading a fresh one
+    :type mounts: MountTable
+    :rtype: bool
+    """
+    if mounts is None:
+        mounts = MountTable.load()
+    return mounts.is_mountpoint(fs)
+
+
+def get_running_osds():
+    """Returns a list of the pids of the current running OSD daemons"""
+    cmd = ['pgrep', 'ceph-osd|crimson-osd']
+    try:
+        result = str(subprocess.check_output(cmd).decode('UTF-8'))
+        return result.split()
+    except subprocess.CalledProcessError:
+        return []
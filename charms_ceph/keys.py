@@ -0,0 +1,573 @@
+# Copyright 2017-2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Ceph keys, their capabilities and keyrings."""
+
+import collections
+import json
+import os
+import re
+import socket
+import subprocess
+import time
+
+from charmhelpers.core.host import (
+    write_file,
+)
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+)
+
+from charms_ceph.utils import (
+    ceph_user,
+    cmp_pkgrevno,
+    is_leader,
+)
+
+_client_admin_keyring = '/etc/ceph/ceph.client.admin.keyring'
+
+
+def is_bootstrapped():
+    return os.path.exists(
+        '/var/lib/ceph/mon/ceph-{}/done'.format(socket.gethostname()))
+
+
+def wait_for_bootstrap():
+    while not is_bootstrapped():
+        time.sleep(3)
+
+
+def generate_monitor_secret():
+    cmd = [
+        'ceph-authtool',
+        '/dev/stdout',
+        '--name=mon.',
+        '--gen-key'
+    ]
+    res = str(subprocess.check_output(cmd).decode('UTF-8'))
+
+    return "{}==".format(res.split('=')[1].strip())
+
+
+# OSD caps taken from ceph-create-keys
+_osd_bootstrap_caps = {
+    'mon': [
+        'allow command osd create ...',
+        'allow command osd crush set ...',
+        r'allow command auth add * osd allow\ * mon allow\ rwx',
+        'allow command mon getmap'
+    ]
+}
+
+_osd_bootstrap_caps_profile = {
+    'mon': [
+        'allow profile bootstrap-osd'
+    ]
+}
+
+
+def parse_key(raw_key):
+    # get-or-create appears to have different output depending
+    # on whether its 'get' or 'create'
+    # 'create' just returns the key, 'get' is more verbose and
+    # needs parsing
+    key = None
+    if len(raw_key.splitlines()) == 1:
+        key = raw_key
+    else:
+        for element in raw_key.splitlines():
+            if 'key' in element:
+                return element.split(' = ')[1].strip()  # IGNORE:E1103
+    return key
+
+
+def get_osd_bootstrap_key():
+    try:
+        # Attempt to get/create a key using the OSD bootstrap profile first
+        key = get_named_key('bootstrap-osd',
+                            _osd_bootstrap_caps_profile)
+    except Exception:
+        # If that fails try with the older style permissions
+        key = get_named_key('bootstrap-osd',
+                            _osd_bootstrap_caps)
+    return key
+
+
+_radosgw_keyring = "/etc/ceph/keyring.rados.gateway"
+
+
+def import_radosgw_key(key):
+    if not os.path.exists(_radosgw_keyring):
+        cmd = [
+            "sudo",
+            "-u",
+            ceph_user(),
+            'ceph-authtool',
+            _radosgw_keyring,
+            '--create-keyring',
+            '--name=client.radosgw.gateway',
+            '--add-key={}'.format(key)
+        ]
+        subprocess.check_call(cmd)
+
+
+# OSD caps taken from ceph-create-keys
+_radosgw_caps = {
+    'mon': ['allow rw'],
+    'osd': ['allow rwx']
+}
+_upgrade_caps = {
+    'mon': ['allow rwx']
+}
+
+
+def get_radosgw_key(pool_list=None, name=None):
+    return get_named_key(name=name or 'radosgw.gateway',
+                         caps=_radosgw_caps,
+                         pool_list=pool_list)
+
+
+def get_mds_key(name):
+    return create_named_keyring(entity='mds',
+                                name=name,
+                                caps=mds_caps)
+
+
+_mds_bootstrap_caps_profile = {
+    'mon': [
+        'allow profile bootstrap-mds'
+    ]
+}
+
+
+def get_mds_bootstrap_key():
+    return get_named_key('bootstrap-mds',
+                         _mds_bootstrap_caps_profile)
+
+
+_default_caps = collections.OrderedDict([
+    ('mon', ['allow r',
+             'allow command "osd blacklist"',
+             'allow command "osd blocklist"']),
+    ('osd', ['allow rwx']),
+])
+
+admin_caps = collections.OrderedDict([
+    ('mds', ['allow *']),
+    ('mgr', ['allow *']),
+    ('mon', ['allow *']),
+    ('osd', ['allow *'])
+])
+
+mds_caps = collections.OrderedDict([
+    ('osd', ['allow *']),
+    ('mds', ['allow']),
+    ('mon', ['allow rwx']),
+])
+
+osd_upgrade_caps = collections.OrderedDict([
+    ('mon', ['allow command "config-key"',
+             'allow command "osd tree"',
+             'allow command "config-key list"',
+             'allow command "config-key put"',
+             'allow command "config-key get"',
+             'allow command "config-key exists"',
+             'allow command "osd out"',
+             'allow command "osd in"',
+             'allow command "osd rm"',
+             'allow command "auth del"',
+             ])
+])
+
+rbd_mirror_caps = collections.OrderedDict([
+    ('mon', ['allow profile rbd-mirror-peer',
+             'allow command "service dump"',
+             'allow command "service status"'
+             ]),
+    ('osd', ['profile rbd']),
+    ('mgr', ['allow r']),
+])
+
+
+def get_rbd_mirror_key(name):
+    return get_named_key(name=name, caps=rbd_mirror_caps)
+
+
+def create_named_keyring(entity, name, caps=None):
+    caps = caps or _default_caps
+    entity_name = '{entity}.{name}'.format(entity=entity, name=name)
+    key = ceph_auth_get(entity_name)
+    if key:
+        return key
+    cmd = [
+        "sudo",
+        "-u",
+        ceph_user(),
+        'ceph',
+        '--name', 'mon.',
+        '--keyring',
+        '/var/lib/ceph/mon/ceph-{}/keyring'.format(
+            socket.gethostname()
+        ),
+        'auth', 'get-or-create', entity_name,
+    ]
+    for subsystem, subcaps in caps.items():
+        cmd.extend([subsystem, '; '.join(subcaps)])
+    log("Calling check_output: {}".format(cmd), level=DEBUG)
+    key = (parse_key(str(subprocess
+                         .check_output(cmd)
+                         .decode('UTF-8'))
+                     .strip()))  # IGNORE:E1103
+    get_auth_snapshot().invalidate(entity_name)
+    return key
+
+
+def get_upgrade_key():
+    return get_named_key('upgrade-osd', _upgrade_caps)
+
+
+def is_internal_client(name):
+    keys = ('osd-upgrade', 'osd-removal', 'admin', 'rbd-mirror', 'mds')
+    return any(name.startswith(key) for key in keys)
+
+
+def get_named_key(name, caps=None, pool_list=None):
+    """Retrieve a specific named cephx key.
+
+    :param name: String Name of key to get.
+    :param pool_list: The list of pools to give access to
+    :param caps: dict of cephx capabilities
+    :returns: Returns a cephx key
+    """
+    caps = caps or _default_caps
+    key_name = 'client.{}'.format(name)
+
+    key = ceph_auth_get(key_name)
+    if key:
+        if is_internal_client(name):
+            upgrade_key_caps(key_name, caps)
+        return key
+
+    log("Creating new key for {}".format(name), level=DEBUG)
+    cmd = [
+        "sudo",
+        "-u",
+        ceph_user(),
+        'ceph',
+        '--name', 'mon.',
+        '--keyring',
+        '/var/lib/ceph/mon/ceph-{}/keyring'.format(
+            socket.gethostname()
+        ),
+        'auth', 'get-or-create', key_name,
+    ]
+    # Add capabilities
+    for subsystem, subcaps in caps.items():
+        if subsystem == 'osd':
+            if pool_list:
+                # This will output a string similar to:
+                # "pool=rgw pool=rbd pool=something"
+                pools = " ".join(['pool={0}'.format(i) for i in pool_list])
+                subcaps[0] = subcaps[0] + " " + pools
+        cmd.extend([subsystem, '; '.join(subcaps)])
+
+    log("Calling check_output: {}".format(cmd), level=DEBUG)
+    key = parse_key(str(subprocess
+                        .check_output(cmd)
+                        .decode('UTF-8'))
+                    .strip())  # IGNORE:E1103
+    get_auth_snapshot().invalidate(key_name)
+    return key
+
+
+class CephAuthSnapshot(object):
+    """Indexed view of the cephx entities of the cluster.
+
+    All entities are read once with 'auth ls' and indexed by entity name,
+    e.g. 'client.admin'.  Entities invalidated after they are created or
+    their caps change are re-read on their own with 'auth get' on their
+    next lookup.
+    """
+
+    def __init__(self, client=None):
+        """
+        :param client: (Optional) client id to run the commands as,
+                       defaults to the local mon. key.
+        :type client: Optional[str]
+        """
+        self.client = client
+        self._entities = None
+        self._stale = set()
+
+    def _ceph_cmd(self):
+        if self.client:
+            return ['ceph', '--id', self.client]
+        return [
+            'sudo', '-u', ceph_user(), 'ceph',
+            '--name', 'mon.',
+            '--keyring',
+            '/var/lib/ceph/mon/ceph-{}/keyring'.format(socket.gethostname()),
+        ]
+
+    def load(self):
+        """(Re)read all entities.
+
+        :raises: subprocess.CalledProcessError, ValueError
+        """
+        auth_ls = json.loads(subprocess.check_output(
+            self._ceph_cmd() + ['auth', 'ls', '-f', 'json']).decode('UTF-8'))
+        self._entities = {entry['entity']: entry
+                          for entry in auth_ls['auth_dump']}
+        self._stale = set()
+
+    def _refresh(self, entity):
+        try:
+            entries = json.loads(subprocess.check_output(
+                self._ceph_cmd() + ['auth', 'get', entity, '-f', 'json'],
+                stderr=subprocess.DEVNULL).decode('UTF-8'))
+        except subprocess.CalledProcessError:
+            self._entities.pop(entity, None)
+        else:
+            for entry in entries:
+                self._entities[entry['entity']] = entry
+        self._stale.discard(entity)
+
+    def get(self, entity):
+        """The 'auth ls' entry of an entity or None if it does not exist.
+
+        :raises: subprocess.CalledProcessError, ValueError
+        """
+        if self._entities is None:
+            self.load()
+        elif entity in self._stale:
+            self._refresh(entity)
+        return self._entities.get(entity)
+
+    def exists(self, entity):
+        return self.get(entity) is not None
+
+    def key(self, entity):
+        """The cephx key of an entity or None if it does not exist."""
+        entry = self.get(entity)
+        return entry['key'] if entry else None
+
+    def caps(self, entity):
+        """dict of subsystem to caps string of an entity."""
+        entry = self.get(entity)
+        return dict(entry.get('caps', {})) if entry else {}
+
+    def invalidate(self, entity=None):
+        """Mark an entity, or all entities if None, as changed."""
+        if entity is None:
+            self._entities = None
+            self._stale = set()
+        else:
+            self._stale.add(entity)
+
+
+_auth_snapshots = {}
+
+
+def get_auth_snapshot(client=None):
+    """The process wide CephAuthSnapshot for a client.
+
+    :param client: (Optional) client id, defaults to the local mon. key.
+    :type client: Optional[str]
+    :rtype: CephAuthSnapshot
+    """
+    if client not in _auth_snapshots:
+        _auth_snapshots[client] = CephAuthSnapshot(client=client)
+    return _auth_snapshots[client]
+
+
+def ceph_auth_get(key_name):
+    """Get the cephx key of an entity, None if it does not exist."""
+    try:
+        return get_auth_snapshot().key(key_name)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log("Unable to list cephx entities: {}".format(e), level=DEBUG)
+        return None
+
+
+def _split_caps(caps):
+    """Split a cephx caps string into its grants.
+
+    Grants are separated by ',' or ';' outside of double quotes, runs of
+    whitespace are collapsed.
+    """
+    grants = []
+    current = []
+    quoted = False
+    for char in caps:
+        if char == '"':
+            quoted = not quoted
+        if char in ',;' and not quoted:
+            grants.append(''.join(current))
+            current = []
+        else:
+            current.append(char)
+    grants.append(''.join(current))
+    return [' '.join(grant.split()) for grant in grants if grant.strip()]
+
+
+def normalize_caps(caps):
+    """Normalise cephx caps so they can be compared.
+
+    :param caps: Caps as a dict of subsystem to caps string or list of
+                 grants, or as the arguments of 'ceph auth caps', either
+                 ['mon', 'allow r', ...] or ["mon 'allow r'", ...].
+    :type caps: Union[dict, list]
+    :returns: dict of subsystem to sorted tuple of grants or None if caps
+              cannot be parsed.
+    :rtype: Optional[Dict[str, Tuple[str]]]
+    """
+    if isinstance(caps, dict):
+        items = list(caps.items())
+    else:
+        items = []
+        args = list(caps)
+        while args:
+            arg = args.pop(0)
+            match = re.match(r"""^(\w+)\s+(['"])(.*)\2$""", arg)
+            if match:
+                items.append((match.group(1), match.group(3)))
+            elif args and ' ' not in arg:
+                items.append((arg, args.pop(0)))
+            else:
+                return None
+    normalized = {}
+    for subsystem, subcaps in items:
+        if not isinstance(subcaps, str):
+            subcaps = '; '.join(subcaps)
+        grants = _split_caps(subcaps)
+        if grants:
+            normalized.setdefault(subsystem, set()).update(grants)
+    return {subsystem: tuple(sorted(grants))
+            for subsystem, grants in normalized.items()}
+
+
+def key_caps_need_update(entity, caps, client=None):
+    """Do the caps of a cephx entity differ from caps.
+
+    The current caps are read from the auth snapshot of client, see
+    get_auth_snapshot(), so checking many entities costs one listing.
+
+    :param entity: Entity name, e.g. client.glance
+    :type entity: str
+    :param caps: Desired caps, see normalize_caps()
+    :type caps: Union[dict, list]
+    :param client: (Optional) client id to read the caps as
+    :type client: Optional[str]
+    :returns: False only if the entity exists with equivalent caps.
+    :rtype: bool
+    """
+    try:
+        entry = get_auth_snapshot(client).get(entity)
+    except (subprocess.CalledProcessError, ValueError) as e:
+        log("Unable to list cephx entities: {}".format(e), level=DEBUG)
+        return True
+    if entry is None:
+        return True
+    current = normalize_caps(entry.get('caps', {}))
+    desired = normalize_caps(caps)
+    if desired is None or current != desired:
+        return True
+    log("Caps of {} are up to date".format(entity), level=DEBUG)
+    return False
+
+
+def upgrade_key_caps(key, caps, pool_list=None):
+    """Upgrade key to have capabilities caps"""
+    if not is_leader():
+        # Not the MON leader OR not clustered
+        return
+    caps = collections.OrderedDict(
+        (subsystem, list(subcaps)) for subsystem, subcaps in caps.items())
+    if pool_list and caps.get('osd'):
+        # This will output a string similar to:
+        # "pool=rgw pool=rbd pool=something"
+        pools = " ".join(['pool={0}'.format(i) for i in pool_list])
+        caps['osd'][0] = caps['osd'][0] + " " + pools
+    if not key_caps_need_update(key, caps):
+        return
+    cmd = [
+        "sudo", "-u", ceph_user(), 'ceph', 'auth', 'caps', key
+    ]
+    for subsystem, subcaps in caps.items():
+        cmd.extend([subsystem, '; '.join(subcaps)])
+    subprocess.check_call(cmd)
+    get_auth_snapshot().invalidate(key)
+
+
+def create_keyrings():
+    """Create keyrings for operation of ceph-mon units
+
+    NOTE: The quorum should be done before to execute this function.
+
+    :raises: Exception if keyrings cannot be created
+    """
+    if cmp_pkgrevno('ceph', '14.0.0') >= 0:
+        # NOTE(jamespage): At Nautilus, keys are created by the
+        #                  monitors automatically and just need
+        #                  exporting.
+        output = str(subprocess.check_output(
+            [
+                'sudo',
+                '-u', ceph_user(),
+                'ceph',
+                '--name', 'mon.',
+                '--keyring',
+                '/var/lib/ceph/mon/ceph-{}/keyring'.format(
+                    socket.gethostname()
+                ),
+                'auth', 'get', 'client.admin',
+            ]).decode('UTF-8')).strip()
+        if not output:
+            # NOTE: key not yet created, raise exception and retry
+            raise Exception
+        # NOTE: octopus wants newline at end of file LP: #1864706
+        output += '\n'
+        write_file(_client_admin_keyring, output,
+                   owner=ceph_user(), group=ceph_user(),
+                   perms=0o400)
+    else:
+        # NOTE(jamespage): Later Ceph releases require explicit
+        #                  call to ceph-create-keys to setup the
+        #                  admin keys for the cluster; this command
+        #                  will wait for quorum in the cluster before
+        #                  returning.
+        # NOTE(fnordahl): Explicitly run `ceph-create-keys` for older
+        #                 Ceph releases too.  This improves bootstrap
+        #                 resilience as the charm will wait for
+        #                 presence of peer units before attempting
+        #                 to bootstrap.  Note that charms deploying
+        #                 ceph-mon service should disable running of
+        #                 `ceph-create-keys` service in init system.
+        cmd = ['ceph-create-keys', '--id', socket.gethostname()]
+        if cmp_pkgrevno('ceph', '12.0.0') >= 0:
+            # NOTE(fnordahl): The default timeout in ceph-create-keys of 600
+            #                 seconds is not adequate.  Increase timeout when
+            #                 timeout parameter available.  For older releases
+            #                 we rely on retry_on_exception decorator.
+            #                 LP#1719436
+            cmd.extend(['--timeout', '1800'])
+        subprocess.check_call(cmd)
+        osstat = os.stat(_client_admin_keyring)
+        if not osstat.st_size:
+            # NOTE(fnordahl): Retry will fail as long as this file exists.
+            #                 LP#1719436
+            os.remove(_client_admin_keyring)
+            raise Exception
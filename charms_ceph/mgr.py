@@ -0,0 +1,196 @@
+# Copyright 2017-2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Bootstrap and module configuration of Ceph managers."""
+
+import json
+import os
+import socket
+import subprocess
+import functools
+
+from charmhelpers.core.host import (
+    chownr,
+    mkdir,
+    service_restart,
+)
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    WARNING,
+)
+
+from charms_ceph.utils import (
+    ceph_user,
+    cmp_pkgrevno,
+    wait_for_manager,
+    ceph_config_set,
+    ceph_config_get,
+)
+
+
+def bootstrap_manager():
+    hostname = socket.gethostname()
+    path = '/var/lib/ceph/mgr/ceph-{}'.format(hostname)
+    keyring = os.path.join(path, 'keyring')
+
+    if os.path.exists(keyring):
+        log('bootstrap_manager: mgr already initialized.')
+    else:
+        mkdir(path, owner=ceph_user(), group=ceph_user())
+        subprocess.check_call(['ceph', 'auth', 'get-or-create',
+                               'mgr.{}'.format(hostname), 'mon',
+                               'allow profile mgr', 'osd', 'allow *',
+                               'mds', 'allow *', '--out-file',
+                               keyring])
+        chownr(path, ceph_user(), ceph_user())
+
+        unit = 'ceph-mgr@{}'.format(hostname)
+        subprocess.check_call(['systemctl', 'enable', unit])
+        service_restart(unit)
+
+
+def enabled_manager_modules():
+    """Return a list of enabled manager modules.
+
+    :rtype: List[str]
+    """
+    cmd = ['ceph', 'mgr', 'module', 'ls']
+    quincy_or_later = cmp_pkgrevno('ceph-common', '17.1.0') >= 0
+    if quincy_or_later:
+        cmd.append('--format=json')
+    try:
+        modules = subprocess.check_output(cmd).decode('UTF-8')
+    except subprocess.CalledProcessError as e:
+        log("Failed to list ceph modules: {}".format(e), WARNING)
+        return []
+    modules = json.loads(modules)
+    return modules['enabled_modules']
+
+
+def is_mgr_module_enabled(module):
+    """Is a given manager module enabled.
+
+    :param module:
+    :type module: str
+    :returns: Whether the named module is enabled
+    :rtype: bool
+    """
+    return module in enabled_manager_modules()
+
+
+is_dashboard_enabled = functools.partial(is_mgr_module_enabled, 'dashboard')
+
+
+def mgr_enable_module(module):
+    """Enable a Ceph Manager Module.
+
+    :param module: The module name to enable
+    :type module: str
+
+    :raises: subprocess.CalledProcessError
+    """
+    if not is_mgr_module_enabled(module):
+        subprocess.check_call(['ceph', 'mgr', 'module', 'enable', module])
+        return True
+    return False
+
+
+mgr_enable_dashboard = functools.partial(mgr_enable_module, 'dashboard')
+
+
+def mgr_disable_module(module):
+    """Enable a Ceph Manager Module.
+
+    :param module: The module name to enable
+    :type module: str
+
+    :raises: subprocess.CalledProcessError
+    """
+    if is_mgr_module_enabled(module):
+        subprocess.check_call(['ceph', 'mgr', 'module', 'disable', module])
+        return True
+    return False
+
+
+mgr_disable_dashboard = functools.partial(mgr_disable_module, 'dashboard')
+
+
+def mgr_set_modules(enable=None, disable=None, wait=True):
+    """Bring Ceph Manager Modules to a desired state.
+
+    The list of enabled modules is read once and only modules not already
+    in the desired state are enabled or disabled.  As every change makes
+    the manager respawn, wait for the manager a single time once all
+    changes are made.
+
+    :param enable: Names of modules that should be enabled
+    :type enable: Optional[Iterable[str]]
+    :param disable: Names of modules that should be disabled
+    :type disable: Optional[Iterable[str]]
+    :param wait: Wait for the manager to be available after changes
+    :type wait: bool
+    :returns: The modules that were enabled and disabled
+    :rtype: Dict[str, List[str]]
+    :raises: subprocess.CalledProcessError
+    """
+    enabled_modules = set(enabled_manager_modules())
+    changes = {
+        'enabled': sorted(set(enable or []) - enabled_modules),
+        'disabled': sorted(set(disable or []) & enabled_modules),
+    }
+    for module in changes['enabled']:
+        subprocess.check_call(['ceph', 'mgr', 'module', 'enable', module])
+    for module in changes['disabled']:
+        subprocess.check_call(['ceph', 'mgr', 'module', 'disable', module])
+    if wait and (changes['enabled'] or changes['disabled']):
+        wait_for_manager()
+    return changes
+
+
+mgr_config_set = functools.partial(ceph_config_set, who='mgr')
+
+
+mgr_config_get = functools.partial(ceph_config_get, who='mgr')
+
+
+def _dashboard_set_ssl_artifact(path, artifact_name, hostname=None):
+    """Set SSL dashboard config option.
+
+    :param path: Path to file
+    :type path: str
+    :param artifact_name: Option name for setting the artifact
+    :type artifact_name: str
+    :param hostname: If hostname is set artifact will only be associated with
+                     the dashboard on that host.
+    :type hostname: str
+    :raises: subprocess.CalledProcessError
+    """
+    cmd = ['ceph', 'dashboard', artifact_name]
+    if hostname:
+        cmd.append(hostname)
+    cmd.extend(['-i', path])
+    log(cmd, level=DEBUG)
+    subprocess.check_call(cmd)
+
+
+dashboard_set_ssl_certificate = functools.partial(
+    _dashboard_set_ssl_artifact,
+    artifact_name='set-ssl-certificate')
+
+
+dashboard_set_ssl_certificate_key = functools.partial(
+    _dashboard_set_ssl_artifact,
+    artifact_name='set-ssl-certificate-key')
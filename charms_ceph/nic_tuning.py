@@ -0,0 +1,238 @@
+# Copyright 2017 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Ring buffer, channel and IRQ affinity tuning of physical NICs.
+
+Capabilities are read from sysfs and ethtool.  Ring buffers are raised
+to the hardware maximum, the number of combined channels is matched to
+the CPUs local to the NIC and the NIC's IRQs are spread over those CPUs.
+"""
+
+import os
+import re
+import subprocess
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    ERROR,
+)
+
+SYS_CLASS_NET = os.path.join(os.sep, 'sys', 'class', 'net')
+PROC_IRQ = os.path.join(os.sep, 'proc', 'irq')
+
+ETHTOOL_MAXIMUMS = 'maximums'
+ETHTOOL_CURRENT = 'current'
+
+ETHTOOL_SECTIONS = {
+    'Pre-set maximums:': ETHTOOL_MAXIMUMS,
+    'Current hardware settings:': ETHTOOL_CURRENT,
+}
+
+ETHTOOL_VALUE_RE = re.compile(r'^([A-Za-z ]+):\s+(\d+)\s*$')
+
+
+def parse_ethtool_settings(output):
+    """Parse the output of 'ethtool -g' or 'ethtool -l'.
+
+    :param output: ethtool output
+    :type output: str
+    :returns: dict with the 'maximums' and 'current' settings, each a dict
+              of lower cased setting name to int.  Settings reported as
+              n/a are left out.
+    :rtype: Dict[str, Dict[str, int]]
+    """
+    settings = {ETHTOOL_MAXIMUMS: {}, ETHTOOL_CURRENT: {}}
+    section = None
+    for line in output.splitlines():
+        line = line.strip()
+        if line in ETHTOOL_SECTIONS:
+            section = ETHTOOL_SECTIONS[line]
+            continue
+        match = ETHTOOL_VALUE_RE.match(line)
+        if section and match:
+            settings[section][match.group(1).lower()] = int(match.group(2))
+    return settings
+
+
+def get_ring_parameters(network_interface):
+    """Ring buffer sizes of a NIC, see parse_ethtool_settings()."""
+    return parse_ethtool_settings(subprocess.check_output(
+        ['ethtool', '-g', network_interface]).decode('UTF-8'))
+
+
+def get_channel_parameters(network_interface):
+    """Channel counts of a NIC, see parse_ethtool_settings()."""
+    return parse_ethtool_settings(subprocess.check_output(
+        ['ethtool', '-l', network_interface]).decode('UTF-8'))
+
+
+def parse_cpulist(cpulist):
+    """Parse a kernel cpulist such as '0-3,8,10-11'.
+
+    :rtype: List[int]
+    """
+    cpus = []
+    for part in cpulist.strip().split(','):
+        if not part:
+            continue
+        if '-' in part:
+            start, end = part.split('-', 1)
+            cpus.extend(range(int(start), int(end) + 1))
+        else:
+            cpus.append(int(part))
+    return cpus
+
+
+def _read_device_attr(network_interface, attr):
+    path = os.path.join(SYS_CLASS_NET, network_interface, 'device', attr)
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def get_numa_node(network_interface):
+    """NUMA node the NIC is attached to or None if unknown."""
+    try:
+        node = int(_read_device_attr(network_interface, 'numa_node'))
+    except (TypeError, ValueError):
+        return None
+    if node < 0:
+        return None
+    return node
+
+
+def get_local_cpus(network_interface):
+    """CPUs on the NUMA node local to the NIC.
+
+    :returns: CPU numbers, empty if the NIC is not a bus device.
+    :rtype: List[int]
+    """
+    cpulist = _read_device_attr(network_interface, 'local_cpulist')
+    if not cpulist:
+        return []
+    return parse_cpulist(cpulist)
+
+
+def get_nic_irqs(network_interface):
+    """MSI/MSI-X interrupts of the NIC.
+
+    :rtype: List[int]
+    """
+    path = os.path.join(SYS_CLASS_NET, network_interface, 'device',
+                        'msi_irqs')
+    try:
+        return sorted(int(irq) for irq in os.listdir(path) if irq.isdigit())
+    except OSError:
+        return []
+
+
+def set_irq_affinity(irqs, cpus):
+    """Spread IRQs round robin over a set of CPUs.
+
+    :param irqs: IRQ numbers
+    :type irqs: List[int]
+    :param cpus: CPU numbers
+    :type cpus: List[int]
+    :returns: Number of IRQs whose affinity was changed
+    :rtype: int
+    """
+    changed = 0
+    if not cpus:
+        return changed
+    for index, irq in enumerate(irqs):
+        cpu = str(cpus[index % len(cpus)])
+        path = os.path.join(PROC_IRQ, str(irq), 'smp_affinity_list')
+        try:
+            with open(path, 'r') as f:
+                if f.read().strip() == cpu:
+                    continue
+            with open(path, 'w') as f:
+                f.write(cpu)
+            changed += 1
+        except (IOError, OSError) as e:
+            # Managed interrupts refuse affinity changes
+            log('Unable to set affinity of IRQ {} to CPU {}: {}'.format(
+                irq, cpu, e), level=DEBUG)
+    return changed
+
+
+def tune_ring_buffers(network_interface):
+    """Raise the RX and TX ring buffers to the hardware maximum.
+
+    :returns: dict of the ring sizes that were changed
+    :rtype: dict
+    """
+    rings = get_ring_parameters(network_interface)
+    changes = {}
+    for ring in ('rx', 'tx'):
+        maximum = rings[ETHTOOL_MAXIMUMS].get(ring)
+        if maximum and rings[ETHTOOL_CURRENT].get(ring) != maximum:
+            changes[ring] = maximum
+    if changes:
+        cmd = ['ethtool', '-G', network_interface]
+        for ring, size in sorted(changes.items()):
+            cmd.extend([ring, str(size)])
+        subprocess.check_call(cmd)
+    return changes
+
+
+def tune_channels(network_interface, cpus):
+    """Match the number of combined channels to the NIC local CPUs.
+
+    :returns: dict of the channel counts that were changed
+    :rtype: dict
+    """
+    channels = get_channel_parameters(network_interface)
+    maximum = channels[ETHTOOL_MAXIMUMS].get('combined')
+    if not maximum or not cpus:
+        return {}
+    wanted = min(maximum, len(cpus))
+    if channels[ETHTOOL_CURRENT].get('combined') == wanted:
+        return {}
+    subprocess.check_call(['ethtool', '-L', network_interface,
+                           'combined', str(wanted)])
+    return {'combined': wanted}
+
+
+def tune_nic_queues(network_interface):
+    """Tune ring buffers, channels and IRQ affinity of a physical NIC.
+
+    Each step is skipped when the NIC or driver does not support it.
+
+    :param network_interface: string The network adapter name.
+    :returns: dict describing the changes made
+    :rtype: dict
+    """
+    changes = {}
+    cpus = get_local_cpus(network_interface)
+    for name, func, args in (('rings', tune_ring_buffers, ()),
+                             ('channels', tune_channels, (cpus,))):
+        try:
+            changed = func(network_interface, *args)
+        except (subprocess.CalledProcessError, OSError) as e:
+            log('Unable to tune {} of {}: {}'.format(
+                name, network_interface, e), level=ERROR)
+            continue
+        if changed:
+            changes[name] = changed
+    irqs_changed = set_irq_affinity(get_nic_irqs(network_interface), cpus)
+    if irqs_changed:
+        changes['irqs'] = irqs_changed
+    log('Tuned queues of {} (NUMA node {}): {}'.format(
+        network_interface, get_numa_node(network_interface), changes),
+        level=DEBUG)
+    return changes
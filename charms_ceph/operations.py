@@ -0,0 +1,209 @@
+# Copyright 2017 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Completion tracking of long running broker ops.
+
+Ops such as creating a pool return as soon as Ceph accepted them, while
+their PGs are still being created and peered.  The broker records them
+in an operation table kept in unitdata and update_operations(), called
+from a later hook, marks them complete once their PGs are active and
+clean, or failed when their pool went away or they took too long.
+"""
+
+import collections
+import json
+import time
+import uuid
+
+from subprocess import check_output, CalledProcessError
+
+from charmhelpers.core.hookenv import (
+    log,
+    DEBUG,
+    ERROR,
+)
+from charmhelpers.core.unitdata import kv
+
+from charms_ceph.pools import get_pool_details
+
+# unitdata key of the operation table
+OPERATIONS_KEY = 'broker-operations'
+
+# Seconds finished operations are kept for clients to poll
+OPERATION_RETENTION = 24 * 60 * 60
+
+# Seconds after which an operation whose PGs did not settle fails
+OPERATION_TIMEOUT = 6 * 60 * 60
+
+PENDING = 'pending'
+COMPLETE = 'complete'
+FAILED = 'failed'
+
+ACTIVE = 'active'
+CLEAN = 'clean'
+
+
+def _load():
+    return kv().get(OPERATIONS_KEY, {})
+
+
+def _save(operations):
+    db = kv()
+    db.set(OPERATIONS_KEY, operations)
+    db.flush()
+
+
+def start_operation(op, request_id=None, pools=None, status=None):
+    """Record a long running op.
+
+    :param op: Name of the broker op
+    :type op: str
+    :param request_id: request-id of the broker request
+    :type request_id: Optional[str]
+    :param pools: Pools whose PGs have to settle, all PGs of the cluster
+                  if None.
+    :type pools: Optional[List[str]]
+    :param status: exit-code and stderr of the op, see broker.op_status()
+    :type status: Optional[dict]
+    :returns: the operation, its 'handle' identifies it
+    :rtype: dict
+    """
+    now = time.time()
+    failed = bool(status and status.get('exit-code'))
+    operation = {
+        'handle': str(uuid.uuid4()),
+        'op': op,
+        'request-id': request_id,
+        'pools': pools,
+        'state': FAILED if failed else PENDING,
+        'created': now,
+        'updated': now,
+    }
+    if failed:
+        operation['stderr'] = status.get('stderr')
+    operations = _load()
+    operations[operation['handle']] = operation
+    _save(operations)
+    return operation
+
+
+def get_operations(handles=None):
+    """Operations from the table.
+
+    :param handles: handles to return, all operations if None
+    :type handles: Optional[List[str]]
+    :returns: operations, unknown handles are left out
+    :rtype: List[dict]
+    """
+    operations = _load()
+    if handles is None:
+        handles = sorted(operations,
+                         key=lambda handle: operations[handle]['created'])
+    return [operations[handle] for handle in handles
+            if handle in operations]
+
+
+def get_pg_states(service='admin'):
+    """Count the PGs of each pool by state with one 'pg dump'.
+
+    :returns: dict of pool id to a Counter of PG states
+    :rtype: Dict[int, collections.Counter]
+    :raises: subprocess.CalledProcessError
+    """
+    dump = json.loads(check_output(
+        ['ceph', '--id', service, 'pg', 'dump', 'pgs_brief',
+         '--format=json']).decode('UTF-8'))
+    if isinstance(dump, dict):
+        # Octopus and later wrap the list
+        dump = dump.get('pg_stats', [])
+    states = collections.defaultdict(collections.Counter)
+    for pg in dump:
+        states[int(pg['pgid'].split('.')[0])][pg['state']] += 1
+    return states
+
+
+def _active_clean(counts):
+    """Number of PGs whose state is active and clean, scrubbing or not."""
+    return sum(count for state, count in counts.items()
+               if {ACTIVE, CLEAN} <= set(state.split('+')))
+
+
+def _settled(operation, pool_details, pg_states):
+    """Whether all PGs an operation waits for are active and clean.
+
+    :raises: KeyError if a pool of the operation does not exist
+    """
+    if operation['pools'] is None:
+        return all(_active_clean(counts) == sum(counts.values())
+                   for counts in pg_states.values())
+    for pool in operation['pools']:
+        detail = pool_details[pool]
+        counts = pg_states.get(detail['pool_id'], collections.Counter())
+        active_clean = _active_clean(counts)
+        if (active_clean < detail['pg_num'] or
+                active_clean != sum(counts.values())):
+            return False
+    return True
+
+
+def _fail(operation, now, stderr):
+    log("Broker operation {} failed: {}".format(operation['handle'], stderr),
+        level=ERROR)
+    operation.update({'state': FAILED, 'updated': now, 'stderr': stderr})
+
+
+def update_operations(service='admin'):
+    """Mark pending operations whose PGs settled as complete.
+
+    Pending operations whose pool no longer exists, or that are older than
+    OPERATION_TIMEOUT, are marked failed.  Finished operations older than
+    OPERATION_RETENTION are removed.  The cluster is only queried when
+    operations are pending.
+
+    :returns: operations that completed in this call
+    :rtype: List[dict]
+    """
+    operations = _load()
+    now = time.time()
+    for handle, operation in list(operations.items()):
+        if operation['state'] == PENDING:
+            if now - operation['created'] > OPERATION_TIMEOUT:
+                _fail(operation, now, "PGs did not settle within {} "
+                      "seconds".format(OPERATION_TIMEOUT))
+        elif now - operation['updated'] > OPERATION_RETENTION:
+            del operations[handle]
+    pending = [operation for operation in operations.values()
+               if operation['state'] == PENDING]
+    completed = []
+    if pending:
+        try:
+            pool_details = get_pool_details(client=service)
+            pg_states = get_pg_states(service)
+        except (CalledProcessError, ValueError) as e:
+            log("Unable to read PG states: {}".format(e), level=ERROR)
+        else:
+            for operation in pending:
+                try:
+                    settled = _settled(operation, pool_details, pg_states)
+                except KeyError as e:
+                    _fail(operation, now,
+                          "Pool {} does not exist".format(e))
+                    continue
+                if settled:
+                    operation.update({'state': COMPLETE, 'updated': now})
+                    completed.append(operation)
+        log("{} of {} pending broker operations completed".format(
+            len(completed), len(pending)), level=DEBUG)
+    _save(operations)
+    return completed
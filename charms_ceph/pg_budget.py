@@ -0,0 +1,243 @@
+# Copyright 2017 Canonical Limited.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Cluster-wide placement group budget for new pools.
+
+The cluster is given a budget of mon_target_pg_per_osd PG replicas per
+OSD.  Pools without a target_size_ratio keep the PGs they have, the rest
+of the budget is shared between the pools that have one, in proportion
+to their ratio and divided by their size (replicas or k+m).  The result
+is rounded to a power of two the same way the charmhelpers pool classes
+round it and never takes the cluster over its budget.
+"""
+
+import math
+
+from subprocess import CalledProcessError
+
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    DEBUG,
+    ERROR,
+)
+from charmhelpers.contrib.storage.linux.ceph import (
+    enabled_manager_modules,
+    get_erasure_profile,
+    get_osds,
+    validator,
+)
+
+from charms_ceph.pools import get_pool_details
+from charms_ceph.utils import CephConfig
+
+DEFAULT_TARGET_PG_PER_OSD = 100
+DEFAULT_POOL_WEIGHT = 10.0
+MINIMUM_PGS = 2
+# pg_num the autoscaler starts non-bulk pools with
+AUTOSCALER_DEFAULT_PGS = 32
+
+# Request keys used by the calculator, see POOL_KEYS in broker
+PG_BUDGET_KEYS = {
+    "pg_num": [int],
+    "replicas": [int],
+    "weight": [(int, float), [0.0, 100.0]],
+    "target-size-ratio": [(int, float), [0.0, 1.0]],
+    "pg-num-min": [int],
+    "bulk": [bool],
+    "pg-autoscale-mode": [str, ["on", "off", "warn"]],
+}
+
+
+def validate_pg_budget_keys(request):
+    """Check the types and ranges of the PG budget keys of a request.
+
+    :raises: ValueError
+    """
+    for key, validator_params in PG_BUDGET_KEYS.items():
+        if request.get(key) is None:
+            continue
+        try:
+            validator(request[key], *validator_params)
+        except AssertionError as e:
+            raise ValueError("'{}': {}".format(key, e))
+
+
+def pool_from_detail(detail):
+    """Pool description from an 'osd pool ls detail -f json' entry.
+
+    :rtype: dict
+    """
+    options = detail.get('options') or {}
+    return {
+        'name': detail['pool_name'],
+        'size': detail['size'],
+        'pg_num': detail.get('pg_num_target') or detail['pg_num'],
+        'target_size_ratio': float(options.get('target_size_ratio', 0.0)),
+        'pg_num_min': int(options.get('pg_num_min', 0)),
+        'bulk': 'bulk' in detail.get('flags_names', '').split(','),
+        'pg_autoscale_mode': detail.get('pg_autoscale_mode', 'off'),
+    }
+
+
+def pool_from_request(request, size, autoscale_mode='off'):
+    """Pool description of a create-pool broker request.
+
+    :param request: validated create-pool op
+    :type request: dict
+    :param size: replicas or k+m of the pool
+    :type size: int
+    :param autoscale_mode: pg_autoscale_mode of the pool if the request
+                           does not set one, see get_autoscale_mode()
+    :type autoscale_mode: str
+    :rtype: dict
+    """
+    ratio = request.get('target-size-ratio')
+    if ratio is None:
+        ratio = (request.get('weight') or DEFAULT_POOL_WEIGHT) / 100.0
+    return {
+        'name': request['name'],
+        'size': size,
+        'pg_num': request.get('pg_num'),
+        'target_size_ratio': float(ratio),
+        'pg_num_min': request.get('pg-num-min') or 0,
+        'bulk': bool(request.get('bulk')),
+        'pg_autoscale_mode': (request.get('pg-autoscale-mode') or
+                              autoscale_mode),
+    }
+
+
+def round_pg_num(pg_num):
+    """Round to the nearest power of two, up if that is more than 25% off.
+
+    :rtype: int
+    """
+    pg_num = max(pg_num, 1)
+    nearest = 2 ** int(math.floor(math.log2(pg_num)))
+    if (pg_num - nearest) > (pg_num * 0.25):
+        return nearest * 2
+    return nearest
+
+
+def calculate_pg_num(pool, pools, osd_count,
+                     target_pg_per_osd=DEFAULT_TARGET_PG_PER_OSD):
+    """pg_num of a new pool within the cluster-wide PG budget.
+
+    :param pool: pool to size, see pool_from_request()
+    :type pool: dict
+    :param pools: existing pools, see pool_from_detail().  An existing pool
+                  with the same name is replaced by pool.
+    :type pools: List[dict]
+    :param osd_count: OSDs the pools are spread over
+    :type osd_count: int
+    :param target_pg_per_osd: PG replicas each OSD should hold
+    :type target_pg_per_osd: int
+    :returns: power of two pg_num.  An explicit pg_num in pool is used as
+              an upper bound.  Non-bulk pools managed by the autoscaler get
+              at most AUTOSCALER_DEFAULT_PGS and are grown by it later.
+    :rtype: int
+    """
+    pools = [p for p in pools if p['name'] != pool['name']] + [pool]
+    budget = osd_count * target_pg_per_osd
+    fixed = sum(p['pg_num'] * p['size'] for p in pools
+                if not p['target_size_ratio'] and p is not pool)
+    total_ratio = sum(p['target_size_ratio'] for p in pools)
+    ratio = pool['target_size_ratio']
+    if total_ratio > 1.0:
+        ratio /= total_ratio
+    remaining = max(budget - fixed, 0)
+
+    floor = max(MINIMUM_PGS, pool['pg_num_min'] or 0)
+    pg_num = round_pg_num(remaining * ratio / pool['size'])
+    # Rounding up must not take the cluster over its budget
+    shared = sum(
+        round_pg_num(remaining * p['target_size_ratio'] /
+                     max(total_ratio, 1.0) / p['size']) * p['size']
+        for p in pools if p['target_size_ratio'] and p is not pool)
+    while pg_num > floor and shared + pg_num * pool['size'] > remaining:
+        pg_num //= 2
+    if pool.get('pg_num'):
+        pg_num = min(pg_num, 1 << (pool['pg_num'].bit_length() - 1))
+    if pool['pg_autoscale_mode'] == 'on' and not pool['bulk']:
+        pg_num = min(pg_num, AUTOSCALER_DEFAULT_PGS)
+    return max(pg_num, floor)
+
+
+def get_autoscale_mode():
+    """pg_autoscale_mode new pools get when their request does not set one.
+
+    BasePool.create() turns the autoscaler on for the pools it creates
+    when the pg_autoscaler manager module is enabled.
+    """
+    if 'pg_autoscaler' in enabled_manager_modules():
+        return 'on'
+    return 'off'
+
+
+def get_target_pg_per_osd():
+    """mon_target_pg_per_osd from the config database or its default."""
+    try:
+        config_db = CephConfig()
+        value = (config_db.get('mon_target_pg_per_osd', 'mon') or
+                 config_db.get('mon_target_pg_per_osd', 'global'))
+    except (CalledProcessError, ValueError) as e:
+        log("Unable to read mon_target_pg_per_osd: {}".format(e),
+            level=ERROR)
+        value = None
+    return int(value or DEFAULT_TARGET_PG_PER_OSD)
+
+
+def get_budgeted_pg_num(service, request, size=None, erasure_profile=None,
+                        pool_details=None):
+    """pg_num for a new pool from the cluster-wide PG budget.
+
+    :param service: The Ceph user name to run commands under.
+    :type service: str
+    :param request: validated create-pool op
+    :type request: dict
+    :param size: replicas of a replicated pool
+    :type size: Optional[int]
+    :param erasure_profile: erasure profile of an erasure coded pool, its
+                            size is k+m.
+    :type erasure_profile: Optional[str]
+    :param pool_details: 'osd pool ls detail' of the cluster by pool name,
+                         read if not given.
+    :type pool_details: Optional[Dict[str, dict]]
+    :returns: pg_num or None if the OSDs, pools or erasure profile can not
+              be read
+    :rtype: Optional[int]
+    """
+    if erasure_profile:
+        profile = get_erasure_profile(service, erasure_profile) or {}
+        if 'k' not in profile or 'm' not in profile:
+            return None
+        size = int(profile['k']) + int(profile['m'])
+    osds = get_osds(service)
+    if not osds:
+        return None
+    osd_count = max(config('expected-osd-count') or 0, len(osds))
+    try:
+        if pool_details is None:
+            pool_details = get_pool_details(client=service)
+        pools = [pool_from_detail(detail)
+                 for detail in pool_details.values()]
+    except (CalledProcessError, ValueError) as e:
+        log("Unable to list pools: {}".format(e), level=ERROR)
+        return None
+    pool = pool_from_request(request, size, get_autoscale_mode())
+    pg_num = calculate_pg_num(pool, pools, osd_count,
+                              get_target_pg_per_osd())
+    log("Budgeted pg_num {} for pool {} ({} OSDs, {} pools)".format(
+        pg_num, pool['name'], osd_count, len(pools)), level=DEBUG)
+    return pg_num
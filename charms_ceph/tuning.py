@@ -0,0 +1,900 @@
+# Copyright 2017-2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Sysctl, NIC and block device tuning of Ceph nodes."""
+
+import concurrent.futures
+import json
+import os
+import subprocess
+
+from charmhelpers.core import hookenv
+from charmhelpers.core import templating
+from charmhelpers.core.hookenv import (
+    log,
+    status_set,
+    DEBUG,
+    ERROR,
+    WARNING,
+)
+from charmhelpers.core.unitdata import kv
+
+from charms_ceph.utils import OSD_MAX_WORKERS
+from charms_ceph.disks import get_local_osd_ids
+from charms_ceph import nic_tuning
+
+HDPARM_FILE = os.path.join(os.sep, 'etc', 'hdparm.conf')
+UDEV_TUNING_RULES_FILE = os.path.join(os.sep, 'etc', 'udev', 'rules.d',
+                                      '60-ceph-osd-charm-tuning.rules')
+SYS_BLOCK = os.path.join(os.sep, 'sys', 'block')
+SYS_CLASS_NET = os.path.join(os.sep, 'sys', 'class', 'net')
+PROC_SYS = os.path.join(os.sep, 'proc', 'sys')
+
+LinkSpeed = {
+    "BASE_10": 10,
+    "BASE_100": 100,
+    "BASE_1000": 1000,
+    "GBASE_10": 10000,
+    "GBASE_25": 25000,
+    "GBASE_40": 40000,
+    "GBASE_50": 50000,
+    "GBASE_100": 100000,
+    "GBASE_200": 200000,
+    "GBASE_400": 400000,
+    "UNKNOWN": None
+}
+
+# Mapping of adapter speed to sysctl settings
+NETWORK_ADAPTER_SYSCTLS = {
+    # 10Gb
+    LinkSpeed["GBASE_10"]: {
+        'net.core.rmem_default': 524287,
+        'net.core.wmem_default': 524287,
+        'net.core.rmem_max': 524287,
+        'net.core.wmem_max': 524287,
+        'net.core.optmem_max': 524287,
+        'net.core.netdev_max_backlog': 300000,
+        'net.ipv4.tcp_rmem': '10000000 10000000 10000000',
+        'net.ipv4.tcp_wmem': '10000000 10000000 10000000',
+        'net.ipv4.tcp_mem': '10000000 10000000 10000000'
+    },
+    # Mellanox 10/40Gb
+    LinkSpeed["GBASE_40"]: {
+        'net.ipv4.tcp_timestamps': 0,
+        'net.ipv4.tcp_sack': 1,
+        'net.core.netdev_max_backlog': 250000,
+        'net.core.rmem_max': 4194304,
+        'net.core.wmem_max': 4194304,
+        'net.core.rmem_default': 4194304,
+        'net.core.wmem_default': 4194304,
+        'net.core.optmem_max': 4194304,
+        'net.ipv4.tcp_rmem': '4096 87380 4194304',
+        'net.ipv4.tcp_wmem': '4096 65536 4194304',
+        'net.ipv4.tcp_low_latency': 1,
+        'net.ipv4.tcp_adv_win_scale': 1
+    },
+    # 25Gb
+    LinkSpeed["GBASE_25"]: {
+        'net.core.netdev_max_backlog': 250000,
+        'net.core.rmem_max': 67108864,
+        'net.core.wmem_max': 67108864,
+        'net.core.rmem_default': 4194304,
+        'net.core.wmem_default': 4194304,
+        'net.core.optmem_max': 4194304,
+        'net.ipv4.tcp_rmem': '4096 87380 67108864',
+        'net.ipv4.tcp_wmem': '4096 65536 67108864',
+        'net.ipv4.tcp_sack': 1,
+        'net.ipv4.tcp_mtu_probing': 1
+    },
+    # 50Gb
+    LinkSpeed["GBASE_50"]: {
+        'net.core.netdev_max_backlog': 250000,
+        'net.core.rmem_max': 134217728,
+        'net.core.wmem_max': 134217728,
+        'net.core.rmem_default': 4194304,
+        'net.core.wmem_default': 4194304,
+        'net.core.optmem_max': 4194304,
+        'net.ipv4.tcp_rmem': '4096 87380 134217728',
+        'net.ipv4.tcp_wmem': '4096 65536 134217728',
+        'net.ipv4.tcp_sack': 1,
+        'net.ipv4.tcp_mtu_probing': 1
+    },
+    # 100Gb
+    LinkSpeed["GBASE_100"]: {
+        'net.core.netdev_max_backlog': 300000,
+        'net.core.netdev_budget': 600,
+        'net.core.rmem_max': 268435456,
+        'net.core.wmem_max': 268435456,
+        'net.core.rmem_default': 8388608,
+        'net.core.wmem_default': 8388608,
+        'net.core.optmem_max': 8388608,
+        'net.ipv4.tcp_rmem': '4096 131072 268435456',
+        'net.ipv4.tcp_wmem': '4096 131072 268435456',
+        'net.ipv4.tcp_sack': 1,
+        'net.ipv4.tcp_mtu_probing': 1
+    },
+    # 200Gb
+    LinkSpeed["GBASE_200"]: {
+        'net.core.netdev_max_backlog': 500000,
+        'net.core.netdev_budget': 600,
+        'net.core.rmem_max': 536870912,
+        'net.core.wmem_max': 536870912,
+        'net.core.rmem_default': 8388608,
+        'net.core.wmem_default': 8388608,
+        'net.core.optmem_max': 8388608,
+        'net.ipv4.tcp_rmem': '4096 131072 536870912',
+        'net.ipv4.tcp_wmem': '4096 131072 536870912',
+        'net.ipv4.tcp_sack': 1,
+        'net.ipv4.tcp_mtu_probing': 1
+    },
+    # 400Gb
+    LinkSpeed["GBASE_400"]: {
+        'net.core.netdev_max_backlog': 1000000,
+        'net.core.netdev_budget': 1200,
+        'net.core.rmem_max': 1073741824,
+        'net.core.wmem_max': 1073741824,
+        'net.core.rmem_default': 16777216,
+        'net.core.wmem_default': 16777216,
+        'net.core.optmem_max': 16777216,
+        'net.ipv4.tcp_rmem': '4096 262144 1073741824',
+        'net.ipv4.tcp_wmem': '4096 262144 1073741824',
+        'net.ipv4.tcp_sack': 1,
+        'net.ipv4.tcp_mtu_probing': 1
+    }
+}
+
+
+DEVICE_CLASS_HDD = 'hdd'
+DEVICE_CLASS_SSD = 'ssd'
+DEVICE_CLASS_NVME = 'nvme'
+
+# Block queue settings per device class, written to
+# /sys/block/<dev>/queue/<setting>.  A value of None leaves the kernel
+# default in place.  Each profile can be overridden from the
+# 'device-tuning-profiles' charm config option.
+DEVICE_TUNING_PROFILES = {
+    DEVICE_CLASS_HDD: {
+        'scheduler': 'mq-deadline',
+        'nr_requests': 256,
+        'rq_affinity': 1,
+        'read_ahead_kb': 128,
+        'wbt_lat_usec': 75000,
+        'write_cache': None,
+    },
+    DEVICE_CLASS_SSD: {
+        'scheduler': 'mq-deadline',
+        'nr_requests': 256,
+        'rq_affinity': 2,
+        'read_ahead_kb': 16,
+        'wbt_lat_usec': 2000,
+        'write_cache': None,
+    },
+    DEVICE_CLASS_NVME: {
+        'scheduler': 'none',
+        'nr_requests': None,
+        'rq_affinity': 2,
+        'read_ahead_kb': 16,
+        'wbt_lat_usec': 0,
+        'write_cache': None,
+    },
+}
+
+# The scheduler must be set first as changing it resets nr_requests.
+DEVICE_TUNING_ORDER = (
+    'scheduler',
+    'nr_requests',
+    'rq_affinity',
+    'read_ahead_kb',
+    'wbt_lat_usec',
+    'write_cache',
+)
+
+
+def save_sysctls(sysctl_dict, save_location):
+    """Persist the sysctls to the hard drive.
+
+    :param sysctl_dict: dict
+    :param save_location: path to save the settings to
+    :raises: IOError if anything goes wrong with writing.
+    """
+    try:
+        # Persist the settings for reboots
+        with open(save_location, "w") as fd:
+            for key, value in sysctl_dict.items():
+                fd.write("{}={}\n".format(key, value))
+
+    except IOError as e:
+        log("Unable to persist sysctl settings to {}. Error {}".format(
+            save_location, e), level=ERROR)
+        raise
+
+
+def apply_sysctls(sysctl_dict):
+    """Apply sysctls by writing them to /proc/sys.
+
+    Settings whose current value already matches are not written.
+
+    :param sysctl_dict: dict of sysctl name to value
+    :type sysctl_dict: dict
+    :returns: dict of the sysctls that were changed
+    :rtype: dict
+    """
+    changed = {}
+    for key, value in sysctl_dict.items():
+        path = os.path.join(PROC_SYS, *key.split('.'))
+        wanted = str(value).split()
+        try:
+            with open(path, 'r') as f:
+                if f.read().split() == wanted:
+                    continue
+            with open(path, 'w') as f:
+                f.write(' '.join(wanted))
+            changed[key] = value
+        except (IOError, OSError) as e:
+            log('Unable to set sysctl {} to {}: {}'.format(key, value, e),
+                level=ERROR)
+    return changed
+
+
+def get_network_tuning_tier(speed):
+    """Find the sysctl profile for a link speed.
+
+    :param speed: Link speed in Mb/s
+    :type speed: Optional[int]
+    :returns: The speed of the nearest profile at or below speed or None
+    :rtype: Optional[int]
+    """
+    if not speed:
+        return None
+    tiers = [tier for tier in NETWORK_ADAPTER_SYSCTLS if tier <= speed]
+    if not tiers:
+        return None
+    return max(tiers)
+
+
+def tune_nic(network_interface):
+    """This will set optimal sysctls for the particular network adapter.
+
+    The profile of the nearest speed tier at or below the link speed is
+    used.  Bonds, VLANs and bridges are tuned for the speed of their
+    underlying interfaces.  The ring buffers, channels and IRQ affinity of
+    the underlying physical NICs are tuned too, see nic_tuning.
+
+    :param network_interface: string The network adapter name.
+    """
+    speed = get_link_speed(network_interface)
+    tier = get_network_tuning_tier(speed)
+    if tier is not None:
+        status_set('maintenance', 'Tuning device {}'.format(
+            network_interface))
+        sysctl_file = os.path.join(
+            os.sep,
+            'etc',
+            'sysctl.d',
+            '51-ceph-osd-charm-{}.conf'.format(network_interface))
+        try:
+            log("Saving sysctl_file: {} values: {}".format(
+                sysctl_file, NETWORK_ADAPTER_SYSCTLS[tier]),
+                level=DEBUG)
+            save_sysctls(sysctl_dict=NETWORK_ADAPTER_SYSCTLS[tier],
+                         save_location=sysctl_file)
+        except IOError as e:
+            log("Write to /etc/sysctl.d/51-ceph-osd-charm-{} "
+                "failed. {}".format(network_interface, e),
+                level=ERROR)
+
+        log("Applying sysctl settings", level=DEBUG)
+        apply_sysctls(NETWORK_ADAPTER_SYSCTLS[tier])
+
+        for physical_interface in get_physical_interfaces(network_interface):
+            nic_tuning.tune_nic_queues(physical_interface)
+    else:
+        log("No settings found for network adapter: {}".format(
+            network_interface), level=DEBUG)
+
+
+def get_lower_interfaces(network_interface):
+    """List the interfaces a bond, VLAN or bridge is stacked on.
+
+    :param network_interface: string The network adapter interface.
+    :returns: Names of the lower interfaces, empty for physical devices.
+    :rtype: List[str]
+    """
+    try:
+        entries = os.listdir(os.path.join(SYS_CLASS_NET, network_interface))
+    except OSError:
+        return []
+    return sorted(entry[len('lower_'):] for entry in entries
+                  if entry.startswith('lower_'))
+
+
+def get_physical_interfaces(network_interface):
+    """Resolve a bond, VLAN or bridge to the physical interfaces below it.
+
+    :param network_interface: string The network adapter interface.
+    :rtype: List[str]
+    """
+    lower_interfaces = get_lower_interfaces(network_interface)
+    if not lower_interfaces:
+        return [network_interface]
+    physical_interfaces = []
+    for lower_interface in lower_interfaces:
+        for iface in get_physical_interfaces(lower_interface):
+            if iface not in physical_interfaces:
+                physical_interfaces.append(iface)
+    return physical_interfaces
+
+
+def get_link_speed(network_interface):
+    """This will find the link speed for a given network device. Returns None
+    if an error occurs.
+
+    For a bond, VLAN or bridge the speed of its slowest lower interface is
+    returned rather than the aggregate speed reported by the kernel.
+
+    :param network_interface: string The network adapter interface.
+    :returns: Link speed in Mb/s or None
+    :rtype: Optional[int]
+    """
+    lower_interfaces = get_lower_interfaces(network_interface)
+    if lower_interfaces:
+        speeds = [speed for speed in map(get_link_speed, lower_interfaces)
+                  if speed is not None]
+        return min(speeds) if speeds else LinkSpeed["UNKNOWN"]
+
+    speed_path = os.path.join(SYS_CLASS_NET, network_interface, 'speed')
+    try:
+        with open(speed_path, 'r') as sysfs:
+            nic_speed = sysfs.read().strip()
+    except (IOError, OSError) as e:
+        # Virtual devices and links that are down raise EINVAL on read
+        log("Unable to read {path} because of error: {error}".format(
+            path=speed_path,
+            error=e), level=DEBUG)
+        return LinkSpeed["UNKNOWN"]
+    try:
+        speed = int(nic_speed)
+    except ValueError:
+        return LinkSpeed["UNKNOWN"]
+    if speed <= 0:
+        return LinkSpeed["UNKNOWN"]
+    return speed
+
+
+def persist_settings(settings_dict):
+    # Write all settings to /etc/hdparm.conf
+    """This will persist the hard drive settings to the /etc/hdparm.conf file
+
+    The settings_dict should be in the form of {"uuid": {"key":"value"}}.
+    The file is only rewritten when the rendered content differs from what
+    is already on disk.
+
+    :param settings_dict: dict of settings to save
+    :returns: True if the file was written.
+    :rtype: bool
+    """
+    if not settings_dict:
+        return False
+
+    try:
+        content = templating.render(source='hdparm.conf', target=None,
+                                    context=settings_dict)
+        if _write_file_if_changed(HDPARM_FILE, content):
+            log('Updated {}'.format(HDPARM_FILE), level=DEBUG)
+            return True
+    except (IOError, OSError) as err:
+        log("Unable to open {path} because of error: {error}".format(
+            path=HDPARM_FILE, error=err), level=ERROR)
+    except Exception as e:
+        # The templating.render can raise a jinja2 exception if the
+        # template is not found. Rather than polluting the import
+        # space of this charm, simply catch Exception
+        log('Unable to render {path} due to error: {error}'.format(
+            path=HDPARM_FILE, error=e), level=ERROR)
+    return False
+
+
+def set_max_sectors_kb(dev_name, max_sectors_size):
+    """This function sets the max_sectors_kb size of a given block device.
+
+    :param dev_name: Name of the block device to query
+    :param max_sectors_size: int of the max_sectors_size to save
+    """
+    max_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
+                                       'max_sectors_kb')
+    try:
+        with open(max_sectors_kb_path, 'w') as f:
+            f.write(max_sectors_size)
+    except IOError as e:
+        log('Failed to write max_sectors_kb to {}. Error: {}'.format(
+            max_sectors_kb_path, e), level=ERROR)
+
+
+def get_max_sectors_kb(dev_name):
+    """This function gets the max_sectors_kb size of a given block device.
+
+    :param dev_name: Name of the block device to query
+    :returns: int which is either the max_sectors_kb or 0 on error.
+    """
+    max_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
+                                       'max_sectors_kb')
+
+    # Read in what Linux has set by default
+    if os.path.exists(max_sectors_kb_path):
+        try:
+            with open(max_sectors_kb_path, 'r') as f:
+                max_sectors_kb = f.read().strip()
+                return int(max_sectors_kb)
+        except IOError as e:
+            log('Failed to read max_sectors_kb to {}. Error: {}'.format(
+                max_sectors_kb_path, e), level=ERROR)
+            # Bail.
+            return 0
+    return 0
+
+
+def get_max_hw_sectors_kb(dev_name):
+    """This function gets the max_hw_sectors_kb for a given block device.
+
+    :param dev_name: Name of the block device to query
+    :returns: int which is either the max_hw_sectors_kb or 0 on error.
+    """
+    max_hw_sectors_kb_path = os.path.join('sys', 'block', dev_name, 'queue',
+                                          'max_hw_sectors_kb')
+    # Read in what the hardware supports
+    if os.path.exists(max_hw_sectors_kb_path):
+        try:
+            with open(max_hw_sectors_kb_path, 'r') as f:
+                max_hw_sectors_kb = f.read().strip()
+                return int(max_hw_sectors_kb)
+        except IOError as e:
+            log('Failed to read max_hw_sectors_kb to {}. Error: {}'.format(
+                max_hw_sectors_kb_path, e), level=ERROR)
+            return 0
+    return 0
+
+
+def set_hdd_read_ahead(dev_name, read_ahead_sectors=256):
+    """This function sets the hard drive read ahead.
+
+    :param dev_name: Name of the block device to set read ahead on.
+    :param read_ahead_sectors: int How many sectors to read ahead.
+    """
+    try:
+        # Set the read ahead sectors to 256
+        log('Setting read ahead to {} for device {}'.format(
+            read_ahead_sectors,
+            dev_name))
+        subprocess.check_output(['hdparm',
+                                 '-a{}'.format(read_ahead_sectors),
+                                 dev_name])
+    except subprocess.CalledProcessError as e:
+        log('hdparm failed with error: {}'.format(e.output),
+            level=ERROR)
+
+
+def get_block_uuid(block_dev):
+    """This queries blkid to get the uuid for a block device.
+
+    :param block_dev: Name of the block device to query.
+    :returns: The UUID of the device or None on Error.
+    """
+    try:
+        block_info = str(subprocess
+                         .check_output(['blkid', '-o', 'export', block_dev])
+                         .decode('UTF-8'))
+        for tag in block_info.split('\n'):
+            parts = tag.split('=')
+            if parts[0] == 'UUID':
+                return parts[1]
+        return None
+    except subprocess.CalledProcessError as err:
+        log('get_block_uuid failed with error: {}'.format(err.output),
+            level=ERROR)
+        return None
+
+
+def check_max_sectors(save_settings_dict,
+                      block_dev,
+                      uuid):
+    """Tune the max_hw_sectors if needed.
+
+    make sure that /sys/.../max_sectors_kb matches max_hw_sectors_kb or at
+    least 1MB for spinning disks
+    If the box has a RAID card with cache this could go much bigger.
+
+    :param save_settings_dict: The dict used to persist settings
+    :param block_dev: A block device name: Example: /dev/sda
+    :param uuid: The uuid of the block device
+    """
+    dev_name = None
+    path_parts = os.path.split(block_dev)
+    if len(path_parts) == 2:
+        dev_name = path_parts[1]
+    else:
+        log('Unable to determine the block device name from path: {}'.format(
+            block_dev))
+        # Play it safe and bail
+        return
+    max_sectors_kb = get_max_sectors_kb(dev_name=dev_name)
+    max_hw_sectors_kb = get_max_hw_sectors_kb(dev_name=dev_name)
+
+    if max_sectors_kb < max_hw_sectors_kb:
+        # OK we have a situation where the hardware supports more than Linux is
+        # currently requesting
+        config_max_sectors_kb = hookenv.config('max-sectors-kb')
+        if config_max_sectors_kb < max_hw_sectors_kb:
+            # Set the max_sectors_kb to the config.yaml value if it is less
+            # than the max_hw_sectors_kb
+            log('Setting max_sectors_kb for device {} to {}'.format(
+                dev_name, config_max_sectors_kb))
+            save_settings_dict[
+                "drive_settings"][uuid][
+                "read_ahead_sect"] = config_max_sectors_kb
+            set_max_sectors_kb(dev_name=dev_name,
+                               max_sectors_size=config_max_sectors_kb)
+        else:
+            # Set to the max_hw_sectors_kb
+            log('Setting max_sectors_kb for device {} to {}'.format(
+                dev_name, max_hw_sectors_kb))
+            save_settings_dict[
+                "drive_settings"][uuid]['read_ahead_sect'] = max_hw_sectors_kb
+            set_max_sectors_kb(dev_name=dev_name,
+                               max_sectors_size=max_hw_sectors_kb)
+    else:
+        log('max_sectors_kb match max_hw_sectors_kb. No change needed for '
+            'device: {}'.format(block_dev))
+
+
+def get_device_class(dev_name):
+    """Classify a block device as HDD, SATA/SAS SSD or NVMe using sysfs.
+
+    :param dev_name: Name of the block device. Example: sda
+    :returns: One of DEVICE_CLASS_HDD, DEVICE_CLASS_SSD, DEVICE_CLASS_NVME
+              or None if the device could not be classified.
+    :rtype: Optional[str]
+    """
+    rotational = _read_queue_setting(dev_name, 'rotational')
+    if rotational == '1':
+        return DEVICE_CLASS_HDD
+    if rotational == '0':
+        if dev_name.startswith('nvme'):
+            return DEVICE_CLASS_NVME
+        return DEVICE_CLASS_SSD
+    return None
+
+
+def get_device_tuning_profile(device_class):
+    """Return the queue tuning profile for a class of device.
+
+    The defaults from DEVICE_TUNING_PROFILES are merged with the optional
+    'device-tuning-profiles' charm config option, a JSON dict keyed by
+    device class.  Example: '{"nvme": {"read_ahead_kb": 128}}'
+
+    :param device_class: One of the DEVICE_CLASS_* values
+    :type device_class: str
+    :returns: dict of queue setting to value
+    :rtype: dict
+    """
+    profile = dict(DEVICE_TUNING_PROFILES.get(device_class, {}))
+    overrides = hookenv.config('device-tuning-profiles')
+    if overrides:
+        try:
+            profile.update(json.loads(overrides).get(device_class, {}))
+        except (TypeError, ValueError, AttributeError) as e:
+            log('Ignoring invalid device-tuning-profiles config: {}'.format(
+                e), level=ERROR)
+    return profile
+
+
+def _read_queue_setting(dev_name, key):
+    """Read /sys/block/<dev_name>/queue/<key>, None if unreadable."""
+    path = os.path.join(SYS_BLOCK, dev_name, 'queue', key)
+    try:
+        with open(path, 'r') as f:
+            return f.read().strip()
+    except (IOError, OSError):
+        return None
+
+
+def _queue_setting_matches(key, current, value):
+    """Does the current sysfs value already match the desired one."""
+    if key == 'scheduler':
+        # Example: "mq-deadline kyber [none]"
+        return '[{}]'.format(value) in current.split()
+    return current == str(value)
+
+
+def apply_device_tuning_profile(dev_name, profile):
+    """Write a queue tuning profile to a block device through sysfs.
+
+    Settings that already have the desired value, or that the device does
+    not support, are skipped.
+
+    :param dev_name: Name of the block device. Example: sda
+    :type dev_name: str
+    :param profile: dict of queue setting to value
+    :type profile: dict
+    :returns: dict of the settings that were changed
+    :rtype: dict
+    """
+    changed = {}
+    for key in DEVICE_TUNING_ORDER:
+        value = profile.get(key)
+        if value is None:
+            continue
+        current = _read_queue_setting(dev_name, key)
+        if current is None:
+            log('Device {} does not support {}'.format(dev_name, key),
+                level=DEBUG)
+            continue
+        if _queue_setting_matches(key, current, value):
+            continue
+        if (key == 'scheduler' and
+                value not in current.replace('[', '').replace(']', '')
+                .split()):
+            log('Scheduler {} not available for device {}'.format(
+                value, dev_name), level=WARNING)
+            continue
+        path = os.path.join(SYS_BLOCK, dev_name, 'queue', key)
+        try:
+            with open(path, 'w') as f:
+                f.write(str(value))
+            changed[key] = value
+        except (IOError, OSError) as e:
+            log('Failed to write {} to {}. Error: {}'.format(
+                value, path, e), level=ERROR)
+    log('Changed settings for device {}: {}'.format(dev_name, changed),
+        level=DEBUG)
+    return changed
+
+
+def get_block_uuids():
+    """Map block devices to their UUIDs with a single blkid call.
+
+    :returns: dict of device path (Example: /dev/sda) to UUID
+    :rtype: dict
+    """
+    try:
+        block_info = subprocess.check_output(
+            ['blkid', '-o', 'export']).decode('UTF-8')
+    except subprocess.CalledProcessError as err:
+        log('get_block_uuids failed with error: {}'.format(err.output),
+            level=ERROR)
+        return {}
+    uuids = {}
+    for stanza in block_info.split('\n\n'):
+        tags = dict(line.split('=', 1) for line in stanza.splitlines()
+                    if '=' in line)
+        if 'DEVNAME' in tags and 'UUID' in tags:
+            uuids[tags['DEVNAME']] = tags['UUID']
+    return uuids
+
+
+def render_udev_tuning_rules(queue_settings):
+    """Render udev rules that re-apply queue settings on device add.
+
+    :param queue_settings: dict of device UUID to queue settings
+    :type queue_settings: dict
+    :returns: Contents of the udev rules file
+    :rtype: str
+    """
+    lines = ['# Generated by the ceph-osd charm. Do not edit.']
+    for dev_uuid, settings in sorted(queue_settings.items()):
+        attrs = ['ATTR{{queue/{}}}="{}"'.format(key, settings[key])
+                 for key in DEVICE_TUNING_ORDER
+                 if settings.get(key) is not None]
+        if attrs:
+            lines.append(', '.join(
+                ['ACTION=="add|change"', 'SUBSYSTEM=="block"',
+                 'ENV{{ID_FS_UUID}}=="{}"'.format(dev_uuid)] + attrs))
+    return '\n'.join(lines) + '\n'
+
+
+def _write_file_if_changed(path, content):
+    """Write content to path unless the file already holds it.
+
+    :returns: True if the file was written.
+    :rtype: bool
+    """
+    try:
+        with open(path, 'r') as f:
+            if f.read() == content:
+                return False
+    except (IOError, OSError):
+        pass
+    with open(path, 'w') as f:
+        f.write(content)
+    return True
+
+
+def persist_device_tuning(drive_settings, queue_settings):
+    """Merge device settings with those persisted by earlier calls and
+    write hdparm.conf and the udev rules once.
+
+    Files are only rewritten when the merged result differs from what is
+    already on disk.
+
+    :param drive_settings: dict of UUID to hdparm settings
+    :type drive_settings: dict
+    :param queue_settings: dict of UUID to queue settings
+    :type queue_settings: dict
+    """
+    db = kv()
+    persisted = db.get('device-tuning', {})
+    old_drive_settings = persisted.get('drive_settings', {})
+    old_queue_settings = persisted.get('queue_settings', {})
+    merged_drive_settings = dict(old_drive_settings, **drive_settings)
+    merged_queue_settings = dict(old_queue_settings, **queue_settings)
+
+    if merged_drive_settings:
+        persist_settings(
+            settings_dict={'drive_settings': merged_drive_settings})
+
+    if merged_queue_settings:
+        try:
+            if _write_file_if_changed(
+                    UDEV_TUNING_RULES_FILE,
+                    render_udev_tuning_rules(merged_queue_settings)):
+                log('Updated {}'.format(UDEV_TUNING_RULES_FILE),
+                    level=DEBUG)
+        except (IOError, OSError) as e:
+            log('Unable to write {}: {}'.format(UDEV_TUNING_RULES_FILE, e),
+                level=ERROR)
+
+    db.set('device-tuning', {'drive_settings': merged_drive_settings,
+                             'queue_settings': merged_queue_settings})
+    db.flush()
+
+
+def tune_devs(block_devs):
+    """Tune a set of block devices according to their class of media.
+
+    Each device is classified from sysfs as HDD, SATA/SAS SSD or NVMe and
+    the matching profile from get_device_tuning_profile() is written to the
+    device queue through sysfs.  UUIDs for all devices are resolved with
+    one blkid call and the settings of every device, merged with those of
+    devices tuned earlier, are persisted once to hdparm.conf (read ahead
+    and max write sectors of HDDs) and to udev rules (queue settings).
+
+    :param block_devs: Block device names: Example: ['/dev/sda']
+    :type block_devs: Iterable[str]
+    """
+    uuids = None
+    drive_settings = {}
+    queue_settings = {}
+    for block_dev in block_devs:
+        realpath = os.path.realpath(block_dev)
+        dev_name = os.path.basename(realpath)
+        device_class = get_device_class(dev_name)
+        if device_class is None:
+            log('Unable to determine the type of block device {}, not '
+                'tuning'.format(block_dev), level=DEBUG)
+            continue
+        log('Tuning {} device {}'.format(device_class, block_dev))
+        status_set('maintenance', 'Tuning device {}'.format(block_dev))
+        profile = get_device_tuning_profile(device_class)
+        apply_device_tuning_profile(dev_name, profile)
+
+        if uuids is None:
+            uuids = get_block_uuids()
+        dev_uuid = uuids.get(block_dev) or uuids.get(realpath)
+        if dev_uuid is None:
+            log('block device {} uuid is None. Unable to persist '
+                'settings'.format(block_dev), level=DEBUG)
+            continue
+        queue_settings[dev_uuid] = {k: v for k, v in profile.items()
+                                    if v is not None}
+        if device_class == DEVICE_CLASS_HDD:
+            read_ahead_kb = profile.get('read_ahead_kb') or 128
+            # hdparm takes the read ahead in 512 byte sectors
+            save_settings_dict = {"drive_settings": {
+                dev_uuid: {'read_ahead_sect': int(read_ahead_kb) * 2}}}
+            check_max_sectors(block_dev=block_dev,
+                              save_settings_dict=save_settings_dict,
+                              uuid=dev_uuid)
+            drive_settings.update(save_settings_dict["drive_settings"])
+
+    if drive_settings or queue_settings:
+        persist_device_tuning(drive_settings, queue_settings)
+
+
+def tune_dev(block_dev):
+    """Tune a single block device, see tune_devs().
+
+    :param block_dev: A block device name: Example: /dev/sda
+    """
+    tune_devs([block_dev])
+    status_set('maintenance', 'Finished tuning device {}'.format(block_dev))
+
+
+class OSDConfigSetError(Exception):
+    """Error occurred applying OSD settings."""
+    pass
+
+
+def get_osd_running_config(osd_id):
+    """Get the running configuration of a local OSD.
+
+    :param osd_id: the OSD id
+    :returns: dict of option name to value, or None on error
+    :rtype: Optional[dict]
+    """
+    cmd = ['ceph', 'daemon', 'osd.{}'.format(osd_id), 'config',
+           '--format=json', 'show']
+    out = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    if 'error' in out:
+        log("Error retrieving OSD settings: {}".format(out['error']),
+            level=ERROR)
+        return None
+    return out
+
+
+def _apply_osd_settings(osd_id, settings):
+    """Apply settings to one local OSD, see apply_osd_settings()."""
+    def _get_cli_key(key):
+        return key.replace(' ', '_')
+
+    current_settings = get_osd_running_config(osd_id)
+    if current_settings is None:
+        return False
+    settings_diff = {}
+    for key, value in sorted(settings.items()):
+        cli_key = _get_cli_key(key)
+        if cli_key not in current_settings:
+            log("Error retrieving OSD setting: unrecognized option "
+                "'{}'".format(cli_key), level=ERROR)
+            return False
+        if str(value) != str(current_settings[cli_key]):
+            settings_diff[cli_key] = value
+    if not settings_diff:
+        return True
+
+    log("Setting {} on osd.{}".format(settings_diff, osd_id), level=DEBUG)
+    cmd = ['ceph', 'daemon', 'osd.{}'.format(osd_id), '--format=json',
+           'injectargs', ' '.join('--{}={}'.format(key, value)
+                                  for key, value in
+                                  sorted(settings_diff.items()))]
+    out = json.loads(subprocess.check_output(cmd).decode('UTF-8'))
+    if 'error' in out:
+        log("Error applying OSD setting: {}".format(out['error']),
+            level=ERROR)
+        raise OSDConfigSetError
+    return True
+
+
+def apply_osd_settings(settings):
+    """Applies the provided OSD settings
+
+    Apply the provided settings to all local OSD unless settings are already
+    present. The running configuration of each OSD is read with a single
+    'config show' and the settings that differ are applied with a single
+    'injectargs' over its admin socket.  OSDs are handled in parallel, an
+    error on one OSD does not stop the others.
+
+    :param settings: dict. Dictionary of settings to apply.
+    :returns: bool. True if commands ran successfully.
+    :raises: OSDConfigSetError
+    """
+    osd_ids = get_local_osd_ids()
+    if not osd_ids:
+        return True
+    workers = min(len(osd_ids), OSD_MAX_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [pool.submit(_apply_osd_settings, osd_id, settings)
+                   for osd_id in osd_ids]
+        concurrent.futures.wait(futures)
+    results = [future.result() for future in futures]
+    return all(results)
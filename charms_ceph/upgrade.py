@@ -0,0 +1,1243 @@
+# Copyright 2017-2021 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+
+"""Rolling upgrades of monitors and OSDs and the OSD states."""
+
+import collections
+import concurrent.futures
+import grp
+import json
+import os
+import pwd
+import random
+import socket
+import stat
+import subprocess
+import sys
+import time
+
+from contextlib import contextmanager
+from datetime import datetime
+
+from charmhelpers.core.host import (
+    chownr,
+    mkdir,
+    owner,
+    service_restart,
+    service_start,
+    service_stop,
+)
+from charmhelpers.core.hookenv import (
+    config,
+    log,
+    status_set,
+    DEBUG,
+    ERROR,
+    WARNING,
+)
+from charmhelpers.fetch import (
+    add_source,
+    apt_install,
+    apt_purge,
+    apt_update,
+)
+from charmhelpers.contrib.storage.linux.ceph import (
+    get_mon_map,
+    monitor_key_set,
+    monitor_key_exists,
+    monitor_key_get,
+)
+from charmhelpers.contrib.openstack.utils import (
+    get_os_codename_install_source,
+)
+
+from charms_ceph.utils import (
+    CEPH_BASE_DIR,
+    OSD_BASE_DIR,
+    OSD_MAX_WORKERS,
+    ceph_user,
+    get_osd_tree,
+    refresh_package_versions,
+    cmp_pkgrevno,
+    get_version,
+    systemd,
+    determine_packages,
+    determine_packages_to_remove,
+    enable_msgr2,
+)
+from charms_ceph.disks import (
+    _get_child_dirs,
+    _get_osd_num_from_dirname,
+    get_local_osd_ids,
+)
+from charms_ceph.mgr import bootstrap_manager
+
+# Seconds between checks of an OSD that has not reached its goal state,
+# and the initial and maximum backoff after a failed status query.
+OSD_STATE_POLL_INTERVAL = 3
+OSD_STATE_ERROR_BACKOFF = 0.1
+OSD_STATE_MAX_BACKOFF = 3
+# Default seconds to wait for an OSD, and for all local OSDs, to reach
+# their goal state.
+OSD_STATE_TIMEOUT = 10 * 60
+OSD_STATES_TIMEOUT = 30 * 60
+
+# Maximum number of processes changing the ownership of a tree, the number
+# of subtrees a tree is split into for them and the seconds between kicks
+# while they run.
+OWNER_MAX_WORKERS = 8
+OWNER_SPLIT_DIRS = 4 * OWNER_MAX_WORKERS
+OWNER_KICK_INTERVAL = 30
+
+
+def wait_for_all_monitors_to_upgrade(new_version, upgrade_key):
+    """Fairly self explanatory name. This function will wait
+    for all monitors in the cluster to upgrade or it will
+    return after a timeout period has expired.
+
+    :param new_version: str of the version to watch
+    :param upgrade_key: the cephx key name to use
+    """
+    done = False
+    start_time = time.time()
+    monitor_list = []
+
+    mon_map = get_mon_map('admin')
+    if mon_map['monmap']['mons']:
+        for mon in mon_map['monmap']['mons']:
+            monitor_list.append(mon['name'])
+    while not done:
+        try:
+            done = all(monitor_key_exists(upgrade_key, "{}_{}_{}_done".format(
+                "mon", mon, new_version
+            )) for mon in monitor_list)
+            current_time = time.time()
+            if current_time > (start_time + 10 * 60):
+                raise Exception
+            else:
+                # Wait 30 seconds and test again if all monitors are upgraded
+                time.sleep(30)
+        except subprocess.CalledProcessError:
+            raise
+
+
+# Edge cases:
+# 1. Previous node dies on upgrade, can we retry?
+def roll_monitor_cluster(new_version, upgrade_key):
+    """This is tricky to get right so here's what we're going to do.
+
+    There's 2 possible cases: Either I'm first in line or not.
+    If I'm not first in line I'll wait a random time between 5-30 seconds
+    and test to see if the previous monitor is upgraded yet.
+
+    :param new_version: str of the version to upgrade to
+    :param upgrade_key: the cephx key name to use when upgrading
+    """
+    log('roll_monitor_cluster called with {}'.format(new_version))
+    my_name = socket.gethostname()
+    monitor_list = []
+    mon_map = get_mon_map('admin')
+    if mon_map['monmap']['mons']:
+        for mon in mon_map['monmap']['mons']:
+            monitor_list.append(mon['name'])
+    else:
+        status_set('blocked', 'Unable to get monitor cluster information')
+        sys.exit(1)
+    log('monitor_list: {}'.format(monitor_list))
+
+    # A sorted list of OSD unit names
+    mon_sorted_list = sorted(monitor_list)
+
+    # Install packages immediately but defer restarts to when it's our time.
+    upgrade_monitor(new_version, restart_daemons=False)
+    try:
+        position = mon_sorted_list.index(my_name)
+        log("upgrade position: {}".format(position))
+        if position == 0:
+            # I'm first!  Roll
+            # First set a key to inform others I'm about to roll
+            lock_and_roll(upgrade_key=upgrade_key,
+                          service='mon',
+                          my_name=my_name,
+                          version=new_version)
+        else:
+            # Check if the previous node has finished
+            status_set('waiting',
+                       'Waiting on {} to finish upgrading'.format(
+                           mon_sorted_list[position - 1]))
+            wait_on_previous_node(upgrade_key=upgrade_key,
+                                  service='mon',
+                                  previous_node=mon_sorted_list[position - 1],
+                                  version=new_version)
+            lock_and_roll(upgrade_key=upgrade_key,
+                          service='mon',
+                          my_name=my_name,
+                          version=new_version)
+        # NOTE(jamespage):
+        # Wait until all monitors have upgraded before bootstrapping
+        # the ceph-mgr daemons due to use of new mgr keyring profiles
+        if new_version == 'luminous':
+            wait_for_all_monitors_to_upgrade(new_version=new_version,
+                                             upgrade_key=upgrade_key)
+            bootstrap_manager()
+
+        # NOTE(jmcvaughn):
+        # Nautilus and later binaries use msgr2 by default, but existing
+        # clusters that have been upgraded from pre-Nautilus will not
+        # automatically have msgr2 enabled. Without this, Ceph will show
+        # a warning only (with no impact to operations), but newly added units
+        # will not be able to join the cluster. Therefore, we ensure it is
+        # enabled on upgrade for all versions including and after Nautilus
+        # (to cater for previous charm versions that will not have done this).
+        nautilus_or_later = cmp_pkgrevno('ceph-common', '14.0.0') >= 0
+        if nautilus_or_later:
+            wait_for_all_monitors_to_upgrade(new_version=new_version,
+                                             upgrade_key=upgrade_key)
+            enable_msgr2()
+    except ValueError:
+        log("Failed to find {} in list {}.".format(
+            my_name, mon_sorted_list))
+        status_set('blocked', 'failed to upgrade monitor')
+
+
+# For E731 we can't assign a lambda, therefore, instead pass this.
+def noop():
+    pass
+
+
+def upgrade_monitor(new_version, kick_function=None, restart_daemons=True):
+    """Upgrade the current Ceph monitor to the new version
+
+    :param new_version: String version to upgrade to.
+    """
+    if kick_function is None:
+        kick_function = noop
+    current_version = get_version()
+    status_set("maintenance", "Upgrading monitor")
+    log("Current Ceph version is {}".format(current_version))
+    log("Upgrading to: {}".format(new_version))
+
+    # Needed to determine if whether to stop/start ceph-mgr
+    luminous_or_later = cmp_pkgrevno('ceph-common', '12.2.0') >= 0
+    # Needed to differentiate between systemd unit names
+    nautilus_or_later = cmp_pkgrevno('ceph-common', '14.0.0') >= 0
+    kick_function()
+    try:
+        add_source(config('source'), config('key'))
+        apt_update(fatal=True)
+    except subprocess.CalledProcessError as err:
+        log("Adding the Ceph source failed with message: {}".format(
+            err))
+        status_set("blocked", "Upgrade to {} failed".format(new_version))
+        sys.exit(1)
+    kick_function()
+
+    try:
+        apt_install(packages=determine_packages(), fatal=True)
+        rm_packages = determine_packages_to_remove()
+        if rm_packages:
+            apt_purge(packages=rm_packages, fatal=True)
+        refresh_package_versions()
+    except subprocess.CalledProcessError as err:
+        log("Upgrading packages failed "
+            "with message: {}".format(err))
+        status_set("blocked", "Upgrade to {} failed".format(new_version))
+        sys.exit(1)
+
+    if not restart_daemons:
+        log("Packages upgraded but not restarting daemons yet.")
+        return
+
+    try:
+        if systemd():
+            if nautilus_or_later:
+                systemd_unit = 'ceph-mon@{}'.format(socket.gethostname())
+            else:
+                systemd_unit = 'ceph-mon'
+            service_stop(systemd_unit)
+            log("restarting ceph-mgr.target maybe: {}"
+                .format(luminous_or_later))
+            if luminous_or_later:
+                service_stop('ceph-mgr.target')
+        else:
+            service_stop('ceph-mon-all')
+
+        kick_function()
+
+        owner = ceph_user()
+
+        # Ensure the files and directories under /var/lib/ceph is chowned
+        # properly as part of the move to the Jewel release, which moved the
+        # ceph daemons to running as ceph:ceph instead of root:root.
+        if new_version == 'jewel':
+            # Ensure the ownership of Ceph's directories is correct
+            chownr(path=os.path.join(os.sep, "var", "lib", "ceph"),
+                   owner=owner,
+                   group=owner,
+                   follow_links=True)
+
+        kick_function()
+
+        # Ensure that mon directory is user writable
+        hostname = socket.gethostname()
+        path = '/var/lib/ceph/mon/ceph-{}'.format(hostname)
+        mkdir(path, owner=ceph_user(), group=ceph_user(),
+              perms=0o755)
+
+        if systemd():
+            if nautilus_or_later:
+                systemd_unit = 'ceph-mon@{}'.format(socket.gethostname())
+            else:
+                systemd_unit = 'ceph-mon'
+            service_restart(systemd_unit)
+            log("starting ceph-mgr.target maybe: {}".format(luminous_or_later))
+            if luminous_or_later:
+                # due to BUG: #1849874 we have to force a restart to get it to
+                # drop the previous version of ceph-manager and start the new
+                # one.
+                service_restart('ceph-mgr.target')
+        else:
+            service_start('ceph-mon-all')
+    except subprocess.CalledProcessError as err:
+        log("Stopping ceph and upgrading packages failed "
+            "with message: {}".format(err))
+        status_set("blocked", "Upgrade to {} failed".format(new_version))
+        sys.exit(1)
+
+
+def lock_and_roll(upgrade_key, service, my_name, version):
+    """Create a lock on the Ceph monitor cluster and upgrade.
+
+    :param upgrade_key: str. The cephx key to use
+    :param service: str. The cephx id to use
+    :param my_name: str. The current hostname
+    :param version: str. The version we are upgrading to
+    """
+    start_timestamp = time.time()
+
+    log('monitor_key_set {}_{}_{}_start {}'.format(
+        service,
+        my_name,
+        version,
+        start_timestamp))
+    monitor_key_set(upgrade_key, "{}_{}_{}_start".format(
+        service, my_name, version), start_timestamp)
+
+    # alive indication:
+    alive_function = (
+        lambda: monitor_key_set(
+            upgrade_key, "{}_{}_{}_alive"
+            .format(service, my_name, version), time.time()))
+    dog = WatchDog(kick_interval=3 * 60,
+                   kick_function=alive_function)
+
+    log("Rolling")
+
+    # This should be quick
+    if service == 'osd':
+        upgrade_osd(version, kick_function=dog.kick_the_dog)
+    elif service == 'mon':
+        upgrade_monitor(version, kick_function=dog.kick_the_dog)
+    else:
+        log("Unknown service {}. Unable to upgrade".format(service),
+            level=ERROR)
+    log("Done")
+
+    stop_timestamp = time.time()
+    # Set a key to inform others I am finished
+    log('monitor_key_set {}_{}_{}_done {}'.format(service,
+                                                  my_name,
+                                                  version,
+                                                  stop_timestamp))
+    status_set('maintenance', 'Finishing upgrade')
+    monitor_key_set(upgrade_key, "{}_{}_{}_done".format(service,
+                                                        my_name,
+                                                        version),
+                    stop_timestamp)
+
+
+def wait_on_previous_node(upgrade_key, service, previous_node, version):
+    """A lock that sleeps the current thread while waiting for the previous
+    node to finish upgrading.
+
+    :param upgrade_key:
+    :param service: str. the cephx id to use
+    :param previous_node: str. The name of the previous node to wait on
+    :param version: str. The version we are upgrading to
+    :returns: None
+    """
+    log("Previous node is: {}".format(previous_node))
+
+    previous_node_started_f = (
+        lambda: monitor_key_exists(
+            upgrade_key,
+            "{}_{}_{}_start".format(service, previous_node, version)))
+    previous_node_finished_f = (
+        lambda: monitor_key_exists(
+            upgrade_key,
+            "{}_{}_{}_done".format(service, previous_node, version)))
+    previous_node_alive_time_f = (
+        lambda: monitor_key_get(
+            upgrade_key,
+            "{}_{}_{}_alive".format(service, previous_node, version)))
+
+    # wait for 30 minutes until the previous node starts.  We don't proceed
+    # unless we get a start condition.
+    try:
+        WatchDog.wait_until(previous_node_started_f, timeout=30 * 60)
+    except WatchDog.WatchDogTimeoutException:
+        log("Waited for previous node to start for 30 minutes. "
+            "It didn't start, so may have a serious issue. Continuing with "
+            "upgrade of this node.",
+            level=WARNING)
+        return
+
+    # keep the time it started from this nodes' perspective.
+    previous_node_started_at = time.time()
+    log("Detected that previous node {} has started.  Time now: {}"
+        .format(previous_node, previous_node_started_at))
+
+    # Now wait for the node to complete.  The node may optionally be kicking
+    # with the *_alive key, which allows this node to wait longer as it 'knows'
+    # the other node is proceeding.
+    try:
+        WatchDog.timed_wait(kicked_at_function=previous_node_alive_time_f,
+                            complete_function=previous_node_finished_f,
+                            wait_time=30 * 60,
+                            compatibility_wait_time=10 * 60,
+                            max_kick_interval=5 * 60)
+    except WatchDog.WatchDogDeadException:
+        # previous node was kicking, but timed out; log this condition and move
+        # on.
+        now = time.time()
+        waited = int((now - previous_node_started_at) / 60)
+        log("Previous node started, but has now not ticked for 5 minutes. "
+            "Waited total of {} mins on node {}. current time: {} > "
+            "previous node start time: {}. "
+            "Continuing with upgrade of this node."
+            .format(waited, previous_node, now, previous_node_started_at),
+            level=WARNING)
+    except WatchDog.WatchDogTimeoutException:
+        # previous node never kicked, or simply took too long; log this
+        # condition and move on.
+        now = time.time()
+        waited = int((now - previous_node_started_at) / 60)
+        log("Previous node is taking too long; assuming it has died."
+            "Waited {} mins on node {}. current time: {} > "
+            "previous node start time: {}. "
+            "Continuing with upgrade of this node."
+            .format(waited, previous_node, now, previous_node_started_at),
+            level=WARNING)
+
+
+class WatchDog(object):
+    """Watch a dog; basically a kickable timer with a timeout between two async
+    units.
+
+    The idea is that you have an overall timeout and then can kick that timeout
+    with intermediary hits, with a max time between those kicks allowed.
+
+    Note that this watchdog doesn't rely on the clock of the other side; just
+    roughly when it detects when the other side started.  All timings are based
+    on the local clock.
+
+    The kicker will not 'kick' more often than a set interval, regardless of
+    how often the kick_the_dog() function is called.  The kicker provides a
+    function (lambda: -> None) that is called when the kick interval is
+    reached.
+
+    The waiter calls the static method with a check function
+    (lambda: -> Boolean) that indicates when the wait should be over and the
+    maximum interval to wait.  e.g. 30 minutes with a 5 minute kick interval.
+
+    So the waiter calls wait(f, 30, 3) and the kicker sets up a 3 minute kick
+    interval, or however long it is expected for the key to propagate and to
+    allow for other delays.
+
+    There is a compatibility mode where if the otherside never kicks, then it
+    simply waits for the compatibility timer.
+    """
+
+    class WatchDogDeadException(Exception):
+        pass
+
+    class WatchDogTimeoutException(Exception):
+        pass
+
+    def __init__(self, kick_interval=3 * 60, kick_function=None):
+        """Initialise a new WatchDog
+
+        :param kick_interval: the interval when this side kicks the other in
+            seconds.
+        :type kick_interval: Int
+        :param kick_function: The function to call that does the kick.
+        :type kick_function: Callable[]
+        """
+        self.start_time = time.time()
+        self.last_run_func = None
+        self.last_kick_at = None
+        self.kick_interval = kick_interval
+        self.kick_f = kick_function
+
+    def kick_the_dog(self):
+        """Might call the kick_function if it's time.
+
+        This function can be called as frequently as needed, but will run the
+        self.kick_function after kick_interval seconds have passed.
+        """
+        now = time.time()
+        if (self.last_run_func is None or
+                (now - self.last_run_func > self.kick_interval)):
+            if self.kick_f is not None:
+                self.kick_f()
+            self.last_run_func = now
+        self.last_kick_at = now
+
+    @staticmethod
+    def wait_until(wait_f, timeout=10 * 60):
+        """Wait for timeout seconds until the passed function return True.
+
+        :param wait_f: The function to call that will end the wait.
+        :type wait_f: Callable[[], Boolean]
+        :param timeout: The time to wait in seconds.
+        :type timeout: int
+        """
+        start_time = time.time()
+        while not wait_f():
+            now = time.time()
+            if now > start_time + timeout:
+                raise WatchDog.WatchDogTimeoutException()
+            wait_time = random.randrange(5, 30)
+            log('wait_until: waiting for {} seconds'.format(wait_time))
+            time.sleep(wait_time)
+
+    @staticmethod
+    def timed_wait(kicked_at_function,
+                   complete_function,
+                   wait_time=30 * 60,
+                   compatibility_wait_time=10 * 60,
+                   max_kick_interval=5 * 60):
+        """Wait a maximum time with an intermediate 'kick' time.
+
+        This function will wait for max_kick_interval seconds unless the
+        kicked_at_function() call returns a time that is not older that
+        max_kick_interval (in seconds).  i.e. the other side can signal that it
+        is still doing things during the max_kick_interval as long as it kicks
+        at least every max_kick_interval seconds.
+
+        The maximum wait is "wait_time", but the otherside must keep kicking
+        during this period.
+
+        The "compatibility_wait_time" is used if the other side never kicks
+        (i.e. the kicked_at_function() always returns None.  In this case the
+        function wait up to "compatibility_wait_time".
+
+        Note that the type of the return from the kicked_at_function is an
+        Optional[str], not a Float.  The function will coerce this to a float
+        for the comparison.  This represents the return value of
+        time.time() at the "other side".  It's a string to simplify the
+        function obtaining the time value from the other side.
+
+        The function raises WatchDogTimeoutException if either the
+        compatibility_wait_time or the wait_time are exceeded.
+
+        The function raises WatchDogDeadException if the max_kick_interval is
+        exceeded.
+
+        Note that it is possible that the first kick interval is extended to
+        compatibility_wait_time if the "other side" doesn't kick immediately.
+        The best solution is for the other side to kick early and often.
+
+        :param kicked_at_function: The function to call to retrieve the time
+            that the other side 'kicked' at.  None if the other side hasn't
+            kicked.
+        :type kicked_at_function: Callable[[], Optional[str]]
+        :param complete_function: The callable that returns True when done.
+        :type complete_function: Callable[[], Boolean]
+        :param wait_time: the maximum time to wait, even with kicks, in
+            seconds.
+        :type wait_time: int
+        :param compatibility_wait_time: The time to wait if no kicks are
+            received, in seconds.
+        :type compatibility_wait_time: int
+        :param max_kick_interval: The maximum time allowed between kicks before
+            the wait is over, in seconds:
+        :type max_kick_interval: int
+        :raises: WatchDog.WatchDogTimeoutException,
+                 WatchDog.WatchDogDeadException
+        """
+        start_time = time.time()
+        while True:
+            if complete_function():
+                break
+            # the time when the waiting for unit last kicked.
+            kicked_at = kicked_at_function()
+            now = time.time()
+            if kicked_at is None:
+                # assume other end doesn't do alive kicks
+                if (now - start_time > compatibility_wait_time):
+                    raise WatchDog.WatchDogTimeoutException()
+            else:
+                # other side is participating in kicks; must kick at least
+                # every 'max_kick_interval' to stay alive.
+                if (now - float(kicked_at) > max_kick_interval):
+                    raise WatchDog.WatchDogDeadException()
+            if (now - start_time > wait_time):
+                raise WatchDog.WatchDogTimeoutException()
+            delay_time = random.randrange(5, 30)
+            log('waiting for {} seconds'.format(delay_time))
+            time.sleep(delay_time)
+
+
+def get_upgrade_position(osd_sorted_list, match_name):
+    """Return the upgrade position for the given OSD.
+
+    :param osd_sorted_list: OSDs sorted
+    :type osd_sorted_list: [str]
+    :param match_name: The OSD name to match
+    :type match_name: str
+    :returns: The position of the name
+    :rtype: int
+    :raises: ValueError if name is not found
+    """
+    for index, item in enumerate(osd_sorted_list):
+        if item.name == match_name:
+            return index
+    raise ValueError("OSD name '{}' not found in get_upgrade_position list"
+                     .format(match_name))
+
+
+# Edge cases:
+# 1. Previous node dies on upgrade, can we retry?
+# 2. This assumes that the OSD failure domain is not set to OSD.
+#    It rolls an entire server at a time.
+def roll_osd_cluster(new_version, upgrade_key):
+    """This is tricky to get right so here's what we're going to do.
+
+    There's 2 possible cases: Either I'm first in line or not.
+    If I'm not first in line I'll wait a random time between 5-30 seconds
+    and test to see if the previous OSD is upgraded yet.
+
+    TODO: If you're not in the same failure domain it's safe to upgrade
+     1. Examine all pools and adopt the most strict failure domain policy
+        Example: Pool 1: Failure domain = rack
+        Pool 2: Failure domain = host
+        Pool 3: Failure domain = row
+
+        outcome: Failure domain = host
+
+    :param new_version: str of the version to upgrade to
+    :param upgrade_key: the cephx key name to use when upgrading
+    """
+    log('roll_osd_cluster called with {}'.format(new_version))
+    my_name = socket.gethostname()
+    osd_tree = get_osd_tree(service=upgrade_key)
+    # A sorted list of OSD unit names
+    osd_sorted_list = sorted(osd_tree)
+    log("osd_sorted_list: {}".format(osd_sorted_list))
+
+    try:
+        position = get_upgrade_position(osd_sorted_list, my_name)
+        log("upgrade position: {}".format(position))
+        if position == 0:
+            # I'm first!  Roll
+            # First set a key to inform others I'm about to roll
+            lock_and_roll(upgrade_key=upgrade_key,
+                          service='osd',
+                          my_name=my_name,
+                          version=new_version)
+        else:
+            # Check if the previous node has finished
+            status_set('waiting',
+                       'Waiting on {} to finish upgrading'.format(
+                           osd_sorted_list[position - 1].name))
+            wait_on_previous_node(
+                upgrade_key=upgrade_key,
+                service='osd',
+                previous_node=osd_sorted_list[position - 1].name,
+                version=new_version)
+            lock_and_roll(upgrade_key=upgrade_key,
+                          service='osd',
+                          my_name=my_name,
+                          version=new_version)
+    except ValueError:
+        log("Failed to find name {} in list {}".format(
+            my_name, osd_sorted_list))
+        status_set('blocked', 'failed to upgrade osd')
+
+
+def upgrade_osd(new_version, kick_function=None):
+    """Upgrades the current OSD
+
+    :param new_version: str. The new version to upgrade to
+    """
+    if kick_function is None:
+        kick_function = noop
+
+    current_version = get_version()
+    status_set("maintenance", "Upgrading OSD")
+    log("Current Ceph version is {}".format(current_version))
+    log("Upgrading to: {}".format(new_version))
+
+    try:
+        add_source(config('source'), config('key'))
+        apt_update(fatal=True)
+    except subprocess.CalledProcessError as err:
+        log("Adding the Ceph sources failed with message: {}".format(
+            err))
+        status_set("blocked", "Upgrade to {} failed".format(new_version))
+        sys.exit(1)
+
+    kick_function()
+
+    try:
+        # Upgrade the packages before restarting the daemons.
+        status_set('maintenance', 'Upgrading packages to %s' % new_version)
+        apt_install(packages=determine_packages(), fatal=True)
+        refresh_package_versions()
+        kick_function()
+
+        # If the upgrade does not need an ownership update of any of the
+        # directories in the OSD service directory, then simply restart
+        # all of the OSDs at the same time as this will be the fastest
+        # way to update the code on the node.
+        if not dirs_need_ownership_update('osd'):
+            log('Restarting all OSDs to load new binaries', DEBUG)
+            with maintain_all_osd_states():
+                if systemd():
+                    service_restart('ceph-osd.target')
+                else:
+                    service_restart('ceph-osd-all')
+            return
+
+        # Need to change the ownership of all directories which are not OSD
+        # directories as well.
+        # TODO - this should probably be moved to the general upgrade function
+        #        and done before mon/OSD.
+        update_owner(CEPH_BASE_DIR, recurse_dirs=False)
+        non_osd_dirs = filter(lambda x: not x == 'osd',
+                              os.listdir(CEPH_BASE_DIR))
+        non_osd_dirs = map(lambda x: os.path.join(CEPH_BASE_DIR, x),
+                           non_osd_dirs)
+        for i, path in enumerate(non_osd_dirs):
+            if i % 100 == 0:
+                kick_function()
+            update_owner(path, kick_function=kick_function)
+
+        # Fast service restart wasn't an option because each of the OSD
+        # directories need the ownership updated for all the files on
+        # the OSD. Walk through the OSDs one-by-one upgrading the OSD.
+        for osd_dir in _get_child_dirs(OSD_BASE_DIR):
+            kick_function()
+            try:
+                osd_num = _get_osd_num_from_dirname(osd_dir)
+                _upgrade_single_osd(osd_num, osd_dir, kick_function)
+            except ValueError as ex:
+                # Directory could not be parsed - junk directory?
+                log('Could not parse OSD directory %s: %s' % (osd_dir, ex),
+                    WARNING)
+                continue
+
+    except (subprocess.CalledProcessError, IOError) as err:
+        log("Stopping Ceph and upgrading packages failed "
+            "with message: {}".format(err))
+        status_set("blocked", "Upgrade to {} failed".format(new_version))
+        sys.exit(1)
+
+
+def _upgrade_single_osd(osd_num, osd_dir, kick_function=None):
+    """Upgrades the single OSD directory.
+
+    :param osd_num: the num of the OSD
+    :param osd_dir: the directory of the OSD to upgrade
+    :param kick_function: called as the ownership of the directory changes
+    :raises CalledProcessError: if an error occurs in a command issued as part
+                                of the upgrade process
+    :raises IOError: if an error occurs reading/writing to a file as part
+                     of the upgrade process
+    """
+    with maintain_osd_state(osd_num):
+        stop_osd(osd_num)
+        disable_osd(osd_num)
+        update_owner(osd_dir, kick_function=kick_function)
+        enable_osd(osd_num)
+        start_osd(osd_num)
+
+
+def stop_osd(osd_num):
+    """Stops the specified OSD number.
+
+    :param osd_num: the OSD number to stop
+    """
+    if systemd():
+        service_stop('ceph-osd@{}'.format(osd_num))
+    else:
+        service_stop('ceph-osd', id=osd_num)
+
+
+def start_osd(osd_num):
+    """Starts the specified OSD number.
+
+    :param osd_num: the OSD number to start.
+    """
+    if systemd():
+        service_start('ceph-osd@{}'.format(osd_num))
+    else:
+        service_start('ceph-osd', id=osd_num)
+
+
+def disable_osd(osd_num):
+    """Disables the specified OSD number.
+
+    Ensures that the specified OSD will not be automatically started at the
+    next reboot of the system. Due to differences between init systems,
+    this method cannot make any guarantees that the specified OSD cannot be
+    started manually.
+
+    :param osd_num: the OSD id which should be disabled.
+    :raises CalledProcessError: if an error occurs invoking the systemd cmd
+                                to disable the OSD
+    :raises IOError, OSError: if the attempt to read/remove the ready file in
+                              an upstart enabled system fails
+    """
+    if systemd():
+        # When running under systemd, the individual ceph-osd daemons run as
+        # templated units and can be directly addressed by referring to the
+        # templated service name ceph-osd@<osd_num>. Additionally, systemd
+        # allows one to disable a specific templated unit by running the
+        # 'systemctl disable ceph-osd@<osd_num>' command. When disabled, the
+        # OSD should remain disabled until re-enabled via systemd.
+        # Note: disabling an already disabled service in systemd returns 0, so
+        # no need to check whether it is enabled or not.
+        cmd = ['systemctl', 'disable', 'ceph-osd@{}'.format(osd_num)]
+        subprocess.check_call(cmd)
+    else:
+        # Neither upstart nor the ceph-osd upstart script provides for
+        # disabling the starting of an OSD automatically. The specific OSD
+        # cannot be prevented from running manually, however it can be
+        # prevented from running automatically on reboot by removing the
+        # 'ready' file in the OSD's root directory. This is due to the
+        # ceph-osd-all upstart script checking for the presence of this file
+        # before starting the OSD.
+        ready_file = os.path.join(OSD_BASE_DIR, 'ceph-{}'.format(osd_num),
+                                  'ready')
+        if os.path.exists(ready_file):
+            os.unlink(ready_file)
+
+
+def enable_osd(osd_num):
+    """Enables the specified OSD number.
+
+    Ensures that the specified osd_num will be enabled and ready to start
+    automatically in the event of a reboot.
+
+    :param osd_num: the osd id which should be enabled.
+    :raises CalledProcessError: if the call to the systemd command issued
+                                fails when enabling the service
+    :raises IOError: if the attempt to write the ready file in an upstart
+                     enabled system fails
+    """
+    if systemd():
+        cmd = ['systemctl', 'enable', 'ceph-osd@{}'.format(osd_num)]
+        subprocess.check_call(cmd)
+    else:
+        # When running on upstart, the OSDs are started via the ceph-osd-all
+        # upstart script which will only start the OSD if it has a 'ready'
+        # file. Make sure that file exists.
+        ready_file = os.path.join(OSD_BASE_DIR, 'ceph-{}'.format(osd_num),
+                                  'ready')
+        with open(ready_file, 'w') as f:
+            f.write('ready')
+
+        # Make sure the correct user owns the file. It shouldn't be necessary
+        # as the upstart script should run with root privileges, but its better
+        # to have all the files matching ownership.
+        update_owner(ready_file)
+
+
+def _chown_inode(path, st, uid, gid):
+    """Change the owner of an inode unless it is already owned by uid:gid.
+
+    :returns: 1 if the owner was changed, 0 otherwise
+    :rtype: int
+    """
+    if st.st_uid == uid and st.st_gid == gid:
+        return 0
+    os.lchown(path, uid, gid)
+    return 1
+
+
+def _chown_entries(path, uid, gid):
+    """Change the owner of the entries of a directory.
+
+    Entries removed while the directory is walked are skipped.
+
+    :returns: the subdirectories of path and the number of inodes changed
+    :rtype: Tuple[List[str], int]
+    """
+    dirs = []
+    changed = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    changed += _chown_inode(
+                        entry.path, entry.stat(follow_symlinks=False),
+                        uid, gid)
+                    if entry.is_dir(follow_symlinks=False):
+                        dirs.append(entry.path)
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return dirs, changed
+
+
+def _chown_tree(path, uid, gid):
+    """Change the owner of everything below a directory.
+
+    Run by the worker processes of update_owner().
+
+    :returns: the number of inodes changed
+    :rtype: int
+    """
+    changed = 0
+    pending = [path]
+    while pending:
+        dirs, count = _chown_entries(pending.pop(), uid, gid)
+        pending.extend(dirs)
+        changed += count
+    return changed
+
+
+def _chown_subtrees(path, uid, gid, kick_function):
+    """Change the owner of everything below a directory in parallel.
+
+    The top of the tree is walked level by level until it has split into
+    OWNER_SPLIT_DIRS subtrees, these are walked by a process pool.
+
+    :returns: the number of inodes changed
+    :rtype: int
+    """
+    changed = 0
+    level = [path]
+    while level and len(level) < OWNER_SPLIT_DIRS:
+        subdirs = []
+        for directory in level:
+            dirs, count = _chown_entries(directory, uid, gid)
+            subdirs.extend(dirs)
+            changed += count
+        kick_function()
+        level = subdirs
+    if not level:
+        return changed
+
+    workers = min(len(level), OWNER_MAX_WORKERS)
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as pool:
+        pending = {pool.submit(_chown_tree, subtree, uid, gid)
+                   for subtree in level}
+        while pending:
+            done, pending = concurrent.futures.wait(
+                pending, timeout=OWNER_KICK_INTERVAL,
+                return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                changed += future.result()
+            kick_function()
+    return changed
+
+
+def update_owner(path, recurse_dirs=True, kick_function=None):
+    """Changes the ownership of the specified path.
+
+    Changes the ownership of the specified path to the new ceph daemon user.
+    Inodes already owned by the ceph user are left alone and the subtrees of
+    a directory are walked by a process pool. This may take awhile, so this
+    method will issue a set_status for any changes of ownership which
+    recurses into directory structures.
+
+    :param path: the path to recursively change ownership for
+    :param recurse_dirs: boolean indicating whether to recursively change the
+                         ownership of all the files in a path's subtree or to
+                         simply change the ownership of the path.
+    :param kick_function: called as the ownership changes progress, e.g. the
+                          kick_the_dog() of the upgrade WatchDog.
+    :type kick_function: Optional[Callable[[], None]]
+    :returns: the number of inodes whose ownership was changed
+    :rtype: int
+    :raises OSError: if the ownership of an inode can not be changed
+    """
+    if kick_function is None:
+        kick_function = noop
+
+    user = ceph_user()
+    uid = pwd.getpwnam(user).pw_uid
+    gid = grp.getgrnam(user).gr_gid
+    st = os.lstat(path)
+    recurse = recurse_dirs and stat.S_ISDIR(st.st_mode)
+    if recurse:
+        status_set('maintenance', ('Updating ownership of %s to %s' %
+                                   (path, user)))
+
+    log('Changing ownership of {path} to {user}:{user}'.format(
+        path=path, user=user), DEBUG)
+    start = datetime.now()
+    changed = _chown_inode(path, st, uid, gid)
+    if recurse:
+        changed += _chown_subtrees(path, uid, gid, kick_function)
+    elapsed_time = (datetime.now() - start)
+
+    log('Took {secs} seconds to change the ownership of {changed} inodes '
+        'of path: {path}'.format(secs=elapsed_time.total_seconds(),
+                                 changed=changed, path=path), DEBUG)
+    return changed
+
+
+def get_osd_state(osd_num, osd_goal_state=None, timeout=OSD_STATE_TIMEOUT):
+    """Get OSD state or loop until OSD state matches OSD goal state.
+
+    If osd_goal_state is None, just return the current OSD state.
+    If osd_goal_state is not None, loop until the current OSD state matches
+    the OSD goal state.
+
+    Failed queries are retried with exponential backoff.  When timeout
+    expires the last state seen is returned, or None if the OSD never
+    answered.
+
+    :param osd_num: the OSD id to get state for
+    :param osd_goal_state: (Optional) string indicating state to wait for
+                           Defaults to None
+    :param timeout: (Optional) seconds to wait before giving up, None to
+                    wait indefinitely
+                    Defaults to OSD_STATE_TIMEOUT
+    :returns: Returns a str, the OSD state.
+    :rtype: Optional[str]
+    """
+    deadline = None if timeout is None else time.time() + timeout
+    backoff = OSD_STATE_ERROR_BACKOFF
+    osd_state = None
+    asok = "/var/run/ceph/ceph-osd.{}.asok".format(osd_num)
+    cmd = [
+        'ceph',
+        'daemon',
+        asok,
+        'status'
+    ]
+    while True:
+        try:
+            result = json.loads(str(subprocess
+                                    .check_output(cmd)
+                                    .decode('UTF-8')))
+        except (subprocess.CalledProcessError, ValueError) as e:
+            log("{}".format(e), level=DEBUG)
+            delay = backoff
+            backoff = min(backoff * 2, OSD_STATE_MAX_BACKOFF)
+        else:
+            backoff = OSD_STATE_ERROR_BACKOFF
+            osd_state = result['state']
+            log("OSD {} state: {}, goal state: {}".format(
+                osd_num, osd_state, osd_goal_state), level=DEBUG)
+            if not osd_goal_state:
+                return osd_state
+            if osd_state == osd_goal_state:
+                return osd_state
+            delay = OSD_STATE_POLL_INTERVAL
+        if deadline is not None:
+            remaining = deadline - time.time()
+            if remaining <= 0:
+                log("Timed out waiting for OSD {} to reach state {}, "
+                    "last state: {}".format(osd_num, osd_goal_state,
+                                            osd_state), level=WARNING)
+                return osd_state
+            delay = min(delay, remaining)
+        time.sleep(delay)
+
+
+def get_all_osd_states(osd_goal_states=None, timeout=OSD_STATES_TIMEOUT,
+                       osd_timeout=OSD_STATE_TIMEOUT):
+    """Get all OSD states or loop until all OSD states match OSD goal states.
+
+    If osd_goal_states is None, just return a dictionary of current OSD states.
+    If osd_goal_states is not None, loop until the current OSD states match
+    the OSD goal states.
+
+    All local OSDs are polled concurrently and the call returns as soon as
+    every OSD has reached its goal state or its deadline.
+
+    :param osd_goal_states: (Optional) dict indicating states to wait for
+                            Defaults to None
+    :param timeout: (Optional) seconds to wait for all OSDs, None to wait
+                    indefinitely
+                    Defaults to OSD_STATES_TIMEOUT
+    :param osd_timeout: (Optional) seconds to wait for each OSD, None to
+                        wait indefinitely
+                        Defaults to OSD_STATE_TIMEOUT
+    :returns: Returns a dictionary of current OSD states.
+    :rtype: dict
+    """
+    osd_ids = get_local_osd_ids()
+    if not osd_ids:
+        return {}
+    deadline = None if timeout is None else time.time() + timeout
+
+    def _poll(osd_num):
+        kwargs = {}
+        if osd_goal_states:
+            kwargs['osd_goal_state'] = osd_goal_states[osd_num]
+        osd_deadlines = [d for d in (
+            deadline,
+            None if osd_timeout is None else time.time() + osd_timeout)
+            if d is not None]
+        kwargs['timeout'] = None
+        if osd_deadlines:
+            kwargs['timeout'] = max(min(osd_deadlines) - time.time(), 0)
+        return get_osd_state(osd_num, **kwargs)
+
+    workers = min(len(osd_ids), OSD_MAX_WORKERS)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=workers) as pool:
+        futures = [(osd_num, pool.submit(_poll, osd_num))
+                   for osd_num in osd_ids]
+        return {osd_num: future.result() for osd_num, future in futures}
+
+
+@contextmanager
+def maintain_osd_state(osd_num):
+    """Ensure the state of an OSD is maintained.
+
+    Ensures the state of an OSD is the same at the end of a block nested
+    in a with statement as it was at the beginning of the block.
+
+    :param osd_num: the OSD id to maintain state for
+    """
+    osd_state = get_osd_state(osd_num)
+    try:
+        yield
+    finally:
+        get_osd_state(osd_num, osd_goal_state=osd_state)
+
+
+@contextmanager
+def maintain_all_osd_states(timeout=OSD_STATES_TIMEOUT,
+                            osd_timeout=OSD_STATE_TIMEOUT):
+    """Ensure all local OSD states are maintained.
+
+    Ensures the states of all local OSDs are the same at the end of a
+    block nested in a with statement as they were at the beginning of
+    the block.
+
+    :param timeout: (Optional) seconds to wait for all OSDs to get back
+                    to their state, see get_all_osd_states()
+    :param osd_timeout: (Optional) seconds to wait for each OSD
+    """
+    osd_states = get_all_osd_states()
+    try:
+        yield
+    finally:
+        get_all_osd_states(osd_goal_states=osd_states, timeout=timeout,
+                           osd_timeout=osd_timeout)
+
+
+def dirs_need_ownership_update(service):
+    """Determines if directories still need change of ownership.
+
+    Examines the set of directories under the /var/lib/ceph/{service} directory
+    and determines if they have the correct ownership or not. This is
+    necessary due to the upgrade from Hammer to Jewel where the daemon user
+    changes from root: to ceph:.
+
+    :param service: the name of the service folder to check (e.g. OSD, mon)
+    :returns: boolean. True if the directories need a change of ownership,
+             False otherwise.
+    :raises IOError: if an error occurs reading the file stats from one of
+                     the child directories.
+    :raises OSError: if the specified path does not exist or some other error
+    """
+    expected_owner = expected_group = ceph_user()
+    path = os.path.join(CEPH_BASE_DIR, service)
+    for child in _get_child_dirs(path):
+        curr_owner, curr_group = owner(child)
+
+        if (curr_owner == expected_owner) and (curr_group == expected_group):
+            continue
+
+        # NOTE(lathiat): when config_changed runs on reboot, the OSD might not
+        # yet be mounted or started, and the underlying directory the OSD is
+        # mounted to is expected to be owned by root. So skip the check. This
+        # may also happen for OSD directories for OSDs that were removed.
+        if (service == 'osd' and
+                not os.path.exists(os.path.join(child, 'magic'))):
+            continue
+
+        log('Directory "%s" needs its ownership updated' % child, DEBUG)
+        return True
+
+    # All child directories had the expected ownership
+    return False
+
+
+# A dict of valid Ceph upgrade paths. Mapping is old -> new
+UPGRADE_PATHS = collections.OrderedDict([
+    ('firefly', 'hammer'),
+    ('hammer', 'jewel'),
+    ('jewel', 'luminous'),
+    ('luminous', 'mimic'),
+    ('mimic', 'nautilus'),
+    ('nautilus', 'octopus'),
+    ('octopus', 'pacific'),
+    ('pacific', 'quincy'),
+    ('quincy', 'reef'),
+    ('reef', 'squid'),
+])
+
+# Map UCA codenames to Ceph codenames
+UCA_CODENAME_MAP = {
+    'icehouse': 'firefly',
+    'juno': 'firefly',
+    'kilo': 'hammer',
+    'liberty': 'hammer',
+    'mitaka': 'jewel',
+    'newton': 'jewel',
+    'ocata': 'jewel',
+    'pike': 'luminous',
+    'queens': 'luminous',
+    'rocky': 'mimic',
+    'stein': 'mimic',
+    'train': 'nautilus',
+    'ussuri': 'octopus',
+    'victoria': 'octopus',
+    'wallaby': 'pacific',
+    'xena': 'pacific',
+    'yoga': 'quincy',
+    'zed': 'quincy',
+    'antelope': 'quincy',
+    'bobcat': 'reef',
+    'caracal': 'squid',
+}
+
+
+def pretty_print_upgrade_paths():
+    """Pretty print supported upgrade paths for Ceph"""
+    return ["{} -> {}".format(key, value)
+            for key, value in UPGRADE_PATHS.items()]
+
+
+def resolve_ceph_version(source):
+    """Resolves a version of Ceph based on source configuration
+    based on Ubuntu Cloud Archive pockets.
+
+    @param: source: source configuration option of charm
+    :returns: Ceph release codename or None if not resolvable
+    """
+    os_release = get_os_codename_install_source(source)
+    return UCA_CODENAME_MAP.get(os_release)
@@ -0,0 +1,423 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Micro-benchmarks of the broker and CRUSH helpers.
+
+Benchmarks run offline against generated data and the fake cluster of
+unit_tests.fake_ceph, charmhelpers is mocked the same way as for the unit
+tests and the broker's commands are answered by the fake.  Run them from
+the top of the tree with:
+
+    python -m unit_tests.benchmarks [--json results.json]
+        [--compare baseline.json] [--threshold 1.25] [-k PATTERN]
+
+Each benchmark is timed with timeit, best and median of --repeat runs are
+reported per call.  Saving the results of a run with --json and passing
+them to a later run with --compare shows the ratio between the runs and
+fails if any benchmark got slower than --threshold.
+"""
+
+import argparse
+import json
+import platform
+import statistics
+import sys
+import timeit
+
+from contextlib import ExitStack
+from unittest.mock import patch
+
+import charms_ceph.broker
+import charms_ceph.crush_utils
+import charms_ceph.keys
+import charms_ceph.pg_budget
+import charms_ceph.pools
+import charms_ceph.utils
+
+from unit_tests.fake_ceph import FakeCeph, patch_charmhelpers
+
+# Benchmarks are registered here in the order they run
+BENCHMARKS = []
+
+# Crushmap of a cluster without any user defined bucket
+CRUSHMAP_HEADER = """# begin crush map
+tunable choose_local_tries 0
+tunable choose_local_fallback_tries 0
+tunable choose_total_tries 50
+tunable chooseleaf_descend_once 1
+tunable chooseleaf_vary_r 1
+tunable straw_calc_version 1
+
+# devices
+{devices}
+
+# types
+type 0 osd
+type 1 host
+type 2 rack
+type 10 root
+
+# buckets
+"""
+
+CRUSHMAP_HOST = """host {name} {{
+    id {id}    # do not change unnecessarily
+    # weight {weight:.3f}
+    alg straw2
+    hash 0  # rjenkins1
+{items}
+}}
+"""
+
+
+class Benchmark(object):
+    """A timed function with an optional setup run before each repeat."""
+
+    def __init__(self, name, func, setup=None, number=1):
+        self.name = name
+        self.func = func
+        self.setup = setup
+        self.number = number
+
+    def run(self, repeat):
+        """Time the benchmark.
+
+        :returns: best and median seconds per call
+        :rtype: dict
+        """
+        timings = []
+        for _ in range(repeat):
+            args = self.setup() if self.setup else ()
+            timer = timeit.Timer(lambda: self.func(*args))
+            timings.append(timer.timeit(self.number) / self.number)
+        return {
+            'best': min(timings),
+            'median': statistics.median(timings),
+            'number': self.number,
+            'repeat': repeat,
+        }
+
+
+def benchmark(name, setup=None, number=1):
+    """Register a benchmark function."""
+    def register(func):
+        BENCHMARKS.append(Benchmark(name, func, setup, number))
+        return func
+    return register
+
+
+def osd_tree_nodes(node_count, osds_per_host=10, hosts_per_rack=20):
+    """Nodes of an 'osd tree --format=json' with about node_count nodes.
+
+    :rtype: List[dict]
+    """
+    host_count = max(node_count // (osds_per_host + 1), 1)
+    rack_count = max(host_count // hosts_per_rack, 1)
+    root = {'id': -1, 'name': 'default', 'type': 'root', 'type_id': 10,
+            'children': []}
+    nodes = [root]
+    bucket_id = -2
+    osd_id = 0
+    racks = []
+    for rack in range(rack_count):
+        rack_node = {'id': bucket_id, 'name': 'rack{}'.format(rack),
+                     'type': 'rack', 'type_id': 2, 'children': []}
+        bucket_id -= 1
+        root['children'].append(rack_node['id'])
+        racks.append(rack_node)
+        nodes.append(rack_node)
+    for host in range(host_count):
+        host_node = {'id': bucket_id, 'name': 'host{}'.format(host),
+                     'type': 'host', 'type_id': 1, 'children': []}
+        bucket_id -= 1
+        racks[host % rack_count]['children'].append(host_node['id'])
+        nodes.append(host_node)
+        for _ in range(osds_per_host):
+            host_node['children'].append(osd_id)
+            nodes.append({'id': osd_id, 'name': 'osd.{}'.format(osd_id),
+                          'type': 'osd', 'type_id': 0,
+                          'crush_weight': 1.0, 'depth': 3,
+                          'status': 'up', 'reweight': 1.0})
+            osd_id += 1
+    return nodes
+
+
+def crushmap_text(host_count, osds_per_host=10, root_count=1):
+    """Decompiled crushmap with root_count roots over host_count hosts.
+
+    :rtype: str
+    """
+    devices = []
+    hosts = []
+    osd_id = 0
+    for host in range(host_count):
+        items = []
+        for _ in range(osds_per_host):
+            devices.append('device {0} osd.{0} class hdd'.format(osd_id))
+            items.append('    item osd.{} weight 1.000'.format(osd_id))
+            osd_id += 1
+        hosts.append(CRUSHMAP_HOST.format(
+            name='host{}'.format(host), id=-(host + root_count + 1),
+            weight=float(osds_per_host), items='\n'.join(items)))
+    roots = []
+    for root in range(root_count):
+        name = 'default' if root == 0 else 'root{}'.format(root)
+        roots.append(charms_ceph.crush_utils.Crushmap.bucket_string(
+            name, -(root + 1)))
+    return '\n'.join(
+        [CRUSHMAP_HEADER.format(devices='\n'.join(devices))] + hosts +
+        roots + ['# end crush map'])
+
+
+def service_with_groups(group_count, pools_per_group):
+    """Service document with its groups, see get_service_groups().
+
+    :rtype: dict
+    """
+    groups = {
+        'group{}'.format(group): {
+            'pools': ['pool{}-{}'.format(group, pool)
+                      for pool in range(pools_per_group)],
+            'services': ['svc'],
+        }
+        for group in range(group_count)}
+    names = sorted(groups)
+    return {
+        'group_names': {'rwx': names[::2], 'r': names[1::2]},
+        'groups': groups,
+        'object_prefix_perms': {'class-read': ['rbd_children']},
+    }
+
+
+def broker_request(op_count):
+    """A broker request creating pools and giving keys access to them.
+
+    Each run of three ops creates a new pool, updates an existing pool
+    and adds a key to the group of both pools.
+
+    :rtype: dict
+    """
+    ops = []
+    for index in range(op_count):
+        group = 'group{}'.format(index // 3 % 10)
+        kind = index % 3
+        if kind == 0:
+            ops.append({'op': 'create-pool', 'name': 'pool{}'.format(index),
+                        'replicas': 3, 'group': group, 'app-name': 'rbd',
+                        'weight': 1})
+        elif kind == 1:
+            ops.append({'op': 'create-pool',
+                        'name': 'existing{}'.format(index),
+                        'replicas': 3, 'group': group, 'app-name': 'rbd',
+                        'compression-mode': 'aggressive'})
+        else:
+            ops.append({'op': 'add-permissions-to-key',
+                        'name': 'client{}'.format(index % 20),
+                        'group': group, 'group-permission': 'rwx'})
+    return {'api-version': 1, 'request-id': 'bench-{}'.format(op_count),
+            'ops': ops}
+
+
+def broker_cluster(pool_count):
+    """FakeCeph with pool_count existing pools and the broker's clients.
+
+    :rtype: FakeCeph
+    """
+    fake = FakeCeph.cluster(hosts=3, osds_per_host=10)
+    for index in range(pool_count):
+        fake.run(['ceph', 'osd', 'pool', 'create',
+                  'existing{}'.format(index), '32'])
+    for index in range(20):
+        fake.run(['ceph', 'auth', 'get-or-create',
+                  'client.client{}'.format(index), 'mon', 'allow r'])
+    return fake
+
+
+def _process_requests_setup(op_count):
+    def setup():
+        return (broker_cluster(op_count),
+                json.dumps(broker_request(op_count)))
+    return setup
+
+
+def _process_requests(fake, request):
+    with ExitStack() as stack:
+        for module in (charms_ceph.broker, charms_ceph.keys,
+                       charms_ceph.pg_budget, charms_ceph.pools):
+            stack.enter_context(patch.object(module, 'log'))
+        stack.enter_context(patch.object(charms_ceph.pg_budget, 'config',
+                                         lambda key: None))
+        stack.enter_context(fake.patch())
+        stack.enter_context(patch_charmhelpers(charms_ceph.broker,
+                                               charms_ceph.pg_budget))
+        response = json.loads(charms_ceph.broker.process_requests(request))
+    assert response['exit-code'] == 0, response
+
+
+for _op_count in (1, 50, 500):
+    benchmark('process_requests[{}]'.format(_op_count),
+              setup=_process_requests_setup(_op_count))(_process_requests)
+
+
+def _crushmap_setup(host_count, root_count):
+    def setup():
+        return (crushmap_text(host_count, root_count=root_count),)
+    return setup
+
+
+def _parse_crushmap(text):
+    with patch.object(charms_ceph.crush_utils.Crushmap, 'load_crushmap',
+                      return_value=text):
+        charms_ceph.crush_utils.Crushmap()
+
+
+def _build_crushmap_setup(host_count, bucket_count):
+    def setup():
+        with patch.object(charms_ceph.crush_utils.Crushmap, 'load_crushmap',
+                          return_value=crushmap_text(host_count)):
+            crushmap = charms_ceph.crush_utils.Crushmap()
+        for bucket in range(bucket_count):
+            crushmap.add_bucket('bucket{}'.format(bucket))
+        return (crushmap,)
+    return setup
+
+
+def _build_crushmap(crushmap):
+    crushmap.build_crushmap()
+
+
+for _host_count in (100, 1000):
+    benchmark('Crushmap.__init__[{}-hosts]'.format(_host_count),
+              setup=_crushmap_setup(_host_count, 10),
+              number=10)(_parse_crushmap)
+    benchmark('Crushmap.build_crushmap[{}-hosts]'.format(_host_count),
+              setup=_build_crushmap_setup(_host_count, 100),
+              number=10)(_build_crushmap)
+
+
+def _osd_tree_setup(node_count):
+    def setup():
+        return (osd_tree_nodes(node_count),)
+    return setup
+
+
+def _flatten_roots(nodes):
+    charms_ceph.utils._flatten_roots(nodes)
+
+
+def _osd_tree_json_setup(node_count):
+    def setup():
+        return (json.dumps({'nodes': osd_tree_nodes(node_count),
+                            'stray': []}).encode('UTF-8'),)
+    return setup
+
+
+def _get_osd_tree(output):
+    with patch.object(charms_ceph.utils.subprocess, 'check_output',
+                      return_value=output):
+        charms_ceph.utils.get_osd_tree('admin')
+
+
+for _node_count in (10000, 100000):
+    benchmark('_flatten_roots[{}-nodes]'.format(_node_count),
+              setup=_osd_tree_setup(_node_count))(_flatten_roots)
+    benchmark('get_osd_tree[{}-nodes]'.format(_node_count),
+              setup=_osd_tree_json_setup(_node_count))(_get_osd_tree)
+
+
+def _service_setup(group_count, pools_per_group):
+    def setup():
+        return (service_with_groups(group_count, pools_per_group),)
+    return setup
+
+
+def _pool_permission_list(service):
+    charms_ceph.broker.pool_permission_list_for_service(service)
+
+
+for _group_count, _pools_per_group in ((10, 10), (1000, 20)):
+    benchmark('pool_permission_list_for_service[{}x{}]'.format(
+        _group_count, _pools_per_group),
+        setup=_service_setup(_group_count, _pools_per_group),
+        number=10)(_pool_permission_list)
+
+
+def run_benchmarks(pattern=None, repeat=5, stream=sys.stdout):
+    """Run the registered benchmarks whose name contains pattern.
+
+    :returns: results by benchmark name, see Benchmark.run()
+    :rtype: Dict[str, dict]
+    """
+    results = {}
+    for bench in BENCHMARKS:
+        if pattern and pattern not in bench.name:
+            continue
+        results[bench.name] = bench.run(repeat)
+        if stream:
+            stream.write('{:<50} {:>12.6f} {:>12.6f}\n'.format(
+                bench.name, results[bench.name]['best'],
+                results[bench.name]['median']))
+            stream.flush()
+    return results
+
+
+def compare_results(results, baseline, threshold):
+    """Ratio of the best timings of a run to the ones of a baseline run.
+
+    :returns: ratios by benchmark name and the names of the benchmarks
+              slower than threshold
+    :rtype: Tuple[Dict[str, float], List[str]]
+    """
+    ratios = {}
+    for name, result in results.items():
+        if name in baseline and baseline[name]['best']:
+            ratios[name] = result['best'] / baseline[name]['best']
+    slower = sorted(name for name, ratio in ratios.items()
+                    if ratio > threshold)
+    return ratios, slower
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('-k', dest='pattern',
+                        help='only run benchmarks whose name contains this')
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--json', help='save the results to this file')
+    parser.add_argument('--compare', help='results of a previous run')
+    parser.add_argument('--threshold', type=float, default=1.25,
+                        help='ratio to the previous run considered a '
+                             'regression')
+    args = parser.parse_args(argv)
+
+    print('{:<50} {:>12} {:>12}'.format('benchmark', 'best (s)',
+                                        'median (s)'))
+    results = run_benchmarks(args.pattern, args.repeat)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump({'python': platform.python_version(),
+                       'results': results}, f, indent=2, sort_keys=True)
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        baseline = json.load(f)['results']
+    ratios, slower = compare_results(results, baseline, args.threshold)
+    print('\n{:<50} {:>12}'.format('benchmark', 'ratio'))
+    for name, ratio in ratios.items():
+        print('{:<50} {:>12.2f}{}'.format(
+            name, ratio, ' SLOWER' if name in slower else ''))
+    return 1 if slower else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
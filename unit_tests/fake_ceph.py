@@ -0,0 +1,1563 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""Stateful fake of the ceph, rados, radosgw-admin and crushtool CLIs.
+
+FakeCeph keeps the OSD tree, pools, config-key, auth, the config database
+and the mon status of a cluster in a JSON serializable dict and answers
+the commands the charms run against it, so whole sequences such as an
+OSD roll or a storm of broker requests can be run on a single machine:
+
+    fake = FakeCeph.cluster(hosts=500)
+    with fake.patch():
+        ...  # subprocess calls to the CLIs are answered by fake
+
+patch() replaces subprocess.Popen in process.  install() writes shims
+for the CLIs to a directory to put on PATH instead, they share the
+state through a JSON file and can be run by any number of processes.
+The charmhelpers functions mocked by unit_tests do not run commands,
+patch_charmhelpers() replaces the ones talking to Ceph in charms_ceph
+modules with functions running the same commands.
+
+Every command can be delayed with set_latency() and made to fail with
+fail(), both match the command words without options, e.g.
+'ceph osd pool create'.  Output of commands run without a pipe is
+dropped.  This module only uses the standard library so the shims can
+load it without the charm dependencies.
+"""
+
+import contextlib
+import errno
+import fcntl
+import io
+import json
+import os
+import subprocess
+import sys
+import threading
+import time
+
+COMMANDS = ('ceph', 'rados', 'radosgw-admin', 'crushtool')
+
+# Environment variable pointing the shims to their state file
+STATE_ENV = 'FAKE_CEPH_STATE'
+
+DEFAULT_VERSION = '17.2.6'
+
+RELEASES = {
+    '12': 'luminous', '13': 'mimic', '14': 'nautilus', '15': 'octopus',
+    '16': 'pacific', '17': 'quincy', '18': 'reef',
+}
+
+# Options of the ceph CLI that take a value
+CEPH_VALUE_OPTIONS = {
+    '--id', '-i', '--name', '-n', '--keyring', '-k', '--cluster', '-c',
+    '--conf', '--connect-timeout', '--admin-daemon', '--out-file', '-o',
+    '--format', '-f', '--in-file',
+}
+
+# Header marking a "compiled" crushmap, the fake compiles to the text form
+COMPILED_CRUSHMAP = b'FAKE-CRUSHMAP\n'
+
+CRUSHMAP_BUCKET = """{type} {name} {{
+    id {id}    # do not change unnecessarily
+    alg straw2
+    hash 0  # rjenkins1
+{items}}}
+"""
+
+CRUSHMAP_RULE = """rule {name} {{
+    id {id}
+    type replicated
+    step take {root}
+    step chooseleaf firstn 0 type {failure_domain}
+    step emit
+}}
+"""
+
+
+class CommandError(Exception):
+    """A command failed, carries its exit code and stderr."""
+
+    def __init__(self, returncode, stderr):
+        super(CommandError, self).__init__(stderr)
+        self.returncode = returncode
+        self.stderr = stderr
+
+
+def _enoent(what):
+    return CommandError(
+        errno.ENOENT, "Error ENOENT: {}".format(what))
+
+
+def _einval(what):
+    return CommandError(
+        errno.EINVAL, "Error EINVAL: {}".format(what))
+
+
+def _version_string(version):
+    return 'ceph version {} (0000000000000000000000000000000000000000) ' \
+           '{} (stable)'.format(version,
+                                RELEASES.get(version.split('.')[0], 'dev'))
+
+
+def parse_args(argv, value_options):
+    """Split arguments into words and options.
+
+    :returns: positional words and a dict of options, options without a
+              value are True.  '--key=value' and '--key value' are both
+              accepted.
+    :rtype: Tuple[List[str], Dict[str, Any]]
+    """
+    words = []
+    options = {}
+    args = iter(argv)
+    for arg in args:
+        if arg.startswith('-') and len(arg) > 1 and not arg[1].isdigit():
+            if '=' in arg:
+                key, value = arg.split('=', 1)
+                options[key] = value
+            elif arg in value_options:
+                options[arg] = next(args, None)
+            else:
+                options[arg] = True
+        else:
+            words.append(arg)
+    return words, options
+
+
+def _option(options, *names):
+    for name in names:
+        if name in options:
+            return options[name]
+    return None
+
+
+class FakeCeph(object):
+    """A cluster answering the ceph, rados, radosgw-admin and crushtool CLIs.
+
+    :param state: cluster state, see cluster()
+    :type state: dict
+    """
+
+    def __init__(self, state):
+        self.state = state
+        self.calls = []
+        self._lock = threading.RLock()
+
+    @classmethod
+    def cluster(cls, hosts=3, osds_per_host=3, mons=3,
+                version=DEFAULT_VERSION):
+        """A healthy cluster with one root of hosts and an admin key.
+
+        :rtype: FakeCeph
+        """
+        nodes = [{'id': -1, 'name': 'default', 'type': 'root',
+                  'type_id': 11, 'children': []}]
+        osd_id = 0
+        for host in range(hosts):
+            host_node = {'id': -(host + 2), 'name': 'host{}'.format(host),
+                         'type': 'host', 'type_id': 1, 'children': []}
+            nodes[0]['children'].append(host_node['id'])
+            nodes.append(host_node)
+            for _ in range(osds_per_host):
+                host_node['children'].append(osd_id)
+                nodes.append({'id': osd_id, 'name': 'osd.{}'.format(osd_id),
+                              'type': 'osd', 'type_id': 0,
+                              'crush_weight': 1.0, 'reweight': 1.0,
+                              'status': 'up', 'depth': 2,
+                              'device_class': 'hdd'})
+                osd_id += 1
+        mon_names = ['mon{}'.format(mon) for mon in range(mons)]
+        state = {
+            'fsid': '5a5e5a5e-0000-4000-8000-000000000000',
+            'version': version,
+            'epoch': 1,
+            'mons': mon_names,
+            'quorum': list(range(mons)),
+            'osd_tree': nodes,
+            'osd_versions': {str(osd): version for osd in range(osd_id)},
+            'flags': ['sortbitwise', 'recovery_deletes',
+                      'purged_snapdirs', 'pglog_hardlimit'],
+            'pools': {},
+            'next_pool_id': 1,
+            'erasure_profiles': {
+                'default': {'k': '2', 'm': '2', 'plugin': 'jerasure',
+                            'technique': 'reed_sol_van'}},
+            'rules': [{'rule_id': 0, 'rule_name': 'replicated_rule',
+                       'type': 1, 'root': 'default',
+                       'failure_domain': 'host'}],
+            'crushmap': None,
+            'config_key': {},
+            'config': [],
+            'auth': {
+                'client.admin': {'key': cls._key('client.admin'),
+                                 'caps': {'mon': 'allow *',
+                                          'osd': 'allow *',
+                                          'mds': 'allow *',
+                                          'mgr': 'allow *'}}},
+            'mgr_modules': ['iostat', 'nfs', 'restful'],
+            'rgw': {'users': {}, 'realm': {}, 'zonegroup': {}, 'zone': {}},
+            'latency': {},
+            'failures': [],
+        }
+        return cls(state)
+
+    @staticmethod
+    def _key(entity):
+        # Deterministic so runs can be compared
+        return 'AQ{:0>38}=='.format(
+            ''.join(c for c in entity if c.isalnum())[:38])
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls(json.load(f))
+
+    def save(self, path):
+        tmp = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp, 'w') as f:
+            json.dump(self.state, f)
+        os.rename(tmp, path)
+
+    # Latency and failure injection
+
+    def set_latency(self, prefix, seconds):
+        """Delay the commands starting with prefix, '' matches all.
+
+        The longest matching prefix is used.
+        """
+        self.state['latency'][prefix] = seconds
+
+    def fail(self, prefix, count=1, returncode=errno.EIO,
+             stderr='Error EIO: injected failure'):
+        """Make the next count commands starting with prefix fail.
+
+        :param count: commands to fail, every one if None
+        :type count: Optional[int]
+        """
+        self.state['failures'].append({'prefix': prefix, 'count': count,
+                                       'returncode': returncode,
+                                       'stderr': stderr})
+
+    # Daemons
+
+    def restart_osds(self, osd_ids, version=None):
+        """Restart OSDs with the binaries of version.
+
+        :param osd_ids: OSDs to restart
+        :type osd_ids: Iterable[Union[int, str]]
+        :param version: version the OSDs run, the cluster's by default
+        :type version: Optional[str]
+        """
+        with self._lock:
+            for osd_id in osd_ids:
+                self.state['osd_versions'][str(osd_id)] = (
+                    version or self.state['version'])
+            self._next_epoch()
+
+    def host_osds(self, host):
+        """Ids of the OSDs under a host of the OSD tree.
+
+        :rtype: List[str]
+        """
+        for node in self.state['osd_tree']:
+            if node['type'] == 'host' and node['name'] == host:
+                return [str(osd_id) for osd_id in node['children']]
+        return []
+
+    @staticmethod
+    def command_line(argv):
+        """Program and words of a command without its options, e.g.
+        'ceph osd pool create'."""
+        program = os.path.basename(argv[0])
+        words, _ = parse_args(argv[1:], CEPH_VALUE_OPTIONS)
+        return ' '.join([program] + words)
+
+    def latency(self, argv):
+        line = self.command_line(argv)
+        matches = [prefix for prefix in self.state['latency']
+                   if line.startswith(prefix)]
+        if not matches:
+            return 0.0
+        return self.state['latency'][max(matches, key=len)]
+
+    def _injected_failure(self, line):
+        for failure in self.state['failures']:
+            if not line.startswith(failure['prefix']):
+                continue
+            if failure['count'] is not None:
+                if failure['count'] <= 0:
+                    continue
+                failure['count'] -= 1
+            return CommandError(failure['returncode'], failure['stderr'])
+        return None
+
+    # Running commands
+
+    def run(self, argv, stdin=b''):
+        """Run a command against the cluster.
+
+        :param argv: command, a leading 'sudo -u user' is ignored
+        :type argv: List[str]
+        :param stdin: data read by the command or a callable returning it,
+                      only called by commands reading their input
+        :type stdin: Union[bytes, Callable[[], bytes]]
+        :returns: exit code, stdout and stderr
+        :rtype: Tuple[int, bytes, bytes]
+        """
+        argv = strip_sudo(argv)
+        delay = self.latency(argv)
+        if delay:
+            time.sleep(delay)
+        return self.execute(argv, stdin)
+
+    def execute(self, argv, stdin=b''):
+        """run() without the latency."""
+        argv = strip_sudo(argv)
+        program = os.path.basename(argv[0])
+        with self._lock:
+            self.calls.append(list(argv))
+            try:
+                failure = self._injected_failure(self.command_line(argv))
+                if failure:
+                    raise failure
+                handler = {
+                    'ceph': self._ceph,
+                    'rados': self._rados,
+                    'radosgw-admin': self._radosgw_admin,
+                    'crushtool': self._crushtool,
+                }[program]
+                output = handler(argv[1:], stdin)
+            except CommandError as e:
+                return e.returncode, b'', (e.stderr + '\n').encode('UTF-8')
+        if isinstance(output, str):
+            output = output.encode('UTF-8')
+        return 0, output or b'', b''
+
+    @contextlib.contextmanager
+    def patch(self):
+        """Answer the CLIs from this cluster in process.
+
+        All the subprocess helpers start their process through
+        subprocess.Popen, which is replaced for the duration of the block.
+        Other commands are run as usual.
+        """
+        popen = subprocess.Popen
+        fake = self
+
+        def fake_popen(args, *pargs, **kwargs):
+            if (not kwargs.get('shell') and
+                    isinstance(args, (list, tuple)) and args and
+                    os.path.basename(strip_sudo(args)[0]) in COMMANDS):
+                return FakePopen(fake, list(args), **kwargs)
+            return popen(args, *pargs, **kwargs)
+
+        subprocess.Popen = fake_popen
+        try:
+            yield self
+        finally:
+            subprocess.Popen = popen
+
+    def install(self, bindir, state_path):
+        """Write shims for the CLIs to bindir, sharing state_path.
+
+        :returns: environment with bindir first on PATH
+        :rtype: dict
+        """
+        self.save(state_path)
+        os.makedirs(bindir, exist_ok=True)
+        for command in COMMANDS:
+            path = os.path.join(bindir, command)
+            with open(path, 'w') as f:
+                f.write(SHIM.format(python=sys.executable,
+                                    module=os.path.abspath(__file__),
+                                    state_env=STATE_ENV,
+                                    state=os.path.abspath(state_path)))
+            os.chmod(path, 0o755)
+        env = dict(os.environ)
+        env['PATH'] = '{}:{}'.format(bindir, env.get('PATH', ''))
+        env[STATE_ENV] = os.path.abspath(state_path)
+        return env
+
+    # Helpers
+
+    def _next_epoch(self):
+        self.state['epoch'] += 1
+
+    def _nodes(self):
+        return {node['id']: node for node in self.state['osd_tree']}
+
+    def _node(self, name):
+        for node in self.state['osd_tree']:
+            if node['name'] == name:
+                return node
+        return None
+
+    def _osds(self):
+        return [node for node in self.state['osd_tree']
+                if node['type'] == 'osd']
+
+    def _pool(self, name):
+        pool = self.state['pools'].get(name)
+        if pool is None:
+            raise _enoent("unrecognized pool '{}'".format(name))
+        return pool
+
+    @staticmethod
+    def _format(options):
+        return _option(options, '--format', '-f') or 'plain'
+
+    @staticmethod
+    def _dump(value, options):
+        if FakeCeph._format(options).startswith('json'):
+            return json.dumps(value)
+        if isinstance(value, (list, tuple)):
+            return ''.join('{}\n'.format(item) for item in value)
+        return '{}\n'.format(value)
+
+    @staticmethod
+    def _read_input(options, stdin, *names):
+        path = _option(options, *names)
+        if path in (None, '-', '/dev/stdin'):
+            return stdin() if callable(stdin) else stdin
+        with open(path, 'rb') as f:
+            return f.read()
+
+    @staticmethod
+    def _write_output(options, output, *names):
+        path = _option(options, *names)
+        if path in (None, '-', '/dev/stdout'):
+            return output
+        if isinstance(output, str):
+            output = output.encode('UTF-8')
+        with open(path, 'wb') as f:
+            f.write(output)
+        return b''
+
+    # ceph
+
+    def _ceph(self, argv, stdin):
+        words, options = parse_args(argv, CEPH_VALUE_OPTIONS)
+        if options.get('-s'):
+            words = ['status']
+        if '--admin-daemon' in options:
+            words = ['daemon', options['--admin-daemon']] + words
+        commands = sorted(CEPH_COMMANDS, key=len, reverse=True)
+        for command in commands:
+            if tuple(words[:len(command)]) == command:
+                handler = getattr(self, CEPH_COMMANDS[command])
+                output = handler(words[len(command):], options, stdin)
+                return self._write_output(options, output, '--out-file',
+                                          '-o')
+        raise _einval('no valid command found; command: {}'.format(
+            ' '.join(words)))
+
+    def _mon_status(self, args, options, stdin):
+        mons = self.state['mons']
+        quorum = self.state['quorum']
+        return json.dumps({
+            'name': mons[0],
+            'rank': 0,
+            'state': 'leader' if 0 in quorum else 'probing',
+            'election_epoch': 2 * len(quorum),
+            'quorum': quorum,
+            'monmap': {
+                'epoch': 1,
+                'fsid': self.state['fsid'],
+                'mons': [{'rank': rank, 'name': name,
+                          'addr': '10.0.0.{}:6789/0'.format(rank + 1)}
+                         for rank, name in enumerate(mons)],
+            },
+        })
+
+    def _quorum_status(self, args, options, stdin):
+        quorum = self.state['quorum']
+        return json.dumps({
+            'quorum': quorum,
+            'quorum_names': [self.state['mons'][rank] for rank in quorum],
+            'quorum_leader_name': self.state['mons'][min(quorum)]
+            if quorum else '',
+        })
+
+    def _pg_counts(self):
+        return sum(pool['pg_num'] for pool in self.state['pools'].values())
+
+    def _status(self, args, options, stdin):
+        osds = self._osds()
+        up = [osd for osd in osds if osd['status'] == 'up']
+        pgs = self._pg_counts()
+        status = {
+            'fsid': self.state['fsid'],
+            'health': {'status': self._health_status(), 'checks': {}},
+            'overall_status': self._health_status(),
+            'quorum': self.state['quorum'],
+            'osdmap': {'epoch': self.state['epoch'],
+                       'num_osds': len(osds),
+                       'num_up_osds': len(up),
+                       'num_in_osds': len(
+                           [osd for osd in osds if osd['reweight']])},
+            'pgmap': {'num_pgs': pgs, 'num_pools': len(self.state['pools']),
+                      'pgs_by_state': [{'state_name': 'active+clean',
+                                        'count': pgs}] if pgs else []},
+        }
+        if self._format(options).startswith('json'):
+            return json.dumps(status)
+        return '  cluster:\n    id:     {}\n    health: {}\n'.format(
+            self.state['fsid'], status['health']['status'])
+
+    def _health_status(self):
+        if any(osd['status'] != 'up' for osd in self._osds()):
+            return 'HEALTH_WARN'
+        if 'noout' in self.state['flags']:
+            return 'HEALTH_WARN'
+        return 'HEALTH_OK'
+
+    def _health(self, args, options, stdin):
+        return self._dump(self._health_status(), options)
+
+    def _versions(self, args, options, stdin):
+        def count(versions):
+            counts = {}
+            for version in versions:
+                string = _version_string(version)
+                counts[string] = counts.get(string, 0) + 1
+            return counts
+        mon = count([self.state['version']] * len(self.state['mons']))
+        osd = count(self.state['osd_versions'].values())
+        overall = dict(mon)
+        for string, number in osd.items():
+            overall[string] = overall.get(string, 0) + number
+        return json.dumps({'mon': mon, 'osd': osd, 'overall': overall})
+
+    def _version(self, args, options, stdin):
+        return _version_string(self.state['version']) + '\n'
+
+    def _osd_tree(self, args, options, stdin):
+        return json.dumps({'nodes': self.state['osd_tree'], 'stray': []})
+
+    def _osd_ls(self, args, options, stdin):
+        return self._dump([osd['id'] for osd in self._osds()], options)
+
+    def _osd_stat(self, args, options, stdin):
+        osds = self._osds()
+        return json.dumps({
+            'epoch': self.state['epoch'], 'num_osds': len(osds),
+            'num_up_osds': len([o for o in osds if o['status'] == 'up']),
+            'num_in_osds': len([o for o in osds if o['reweight']])})
+
+    def _osd_dump(self, args, options, stdin):
+        return json.dumps({
+            'epoch': self.state['epoch'],
+            'fsid': self.state['fsid'],
+            'flags': ','.join(self.state['flags']),
+            'require_osd_release': RELEASES.get(
+                self.state['version'].split('.')[0], ''),
+            'pools': list(self.state['pools'].values()),
+            'osds': [{'osd': osd['id'], 'up': int(osd['status'] == 'up'),
+                      'in': int(bool(osd['reweight'])),
+                      'weight': osd['reweight']}
+                     for osd in self._osds()],
+        })
+
+    def _osd_set(self, args, options, stdin):
+        if args[0] not in self.state['flags']:
+            self.state['flags'].append(args[0])
+            self._next_epoch()
+        return '{} is set\n'.format(args[0])
+
+    def _osd_unset(self, args, options, stdin):
+        if args[0] in self.state['flags']:
+            self.state['flags'].remove(args[0])
+            self._next_epoch()
+        return '{} is unset\n'.format(args[0])
+
+    def _osd_require_release(self, args, options, stdin):
+        return ''
+
+    def _osd_down(self, args, options, stdin):
+        for name in args:
+            node = self._node(name if name.startswith('osd.')
+                              else 'osd.{}'.format(name))
+            if node is None:
+                raise _enoent("osd.{} does not exist".format(name))
+            node['status'] = 'down'
+        self._next_epoch()
+        return ''
+
+    def _osd_crush_add_bucket(self, args, options, stdin):
+        name, bucket_type = args[0], args[1]
+        if self._node(name):
+            return "bucket '{}' already exists\n".format(name)
+        new_id = min(node['id'] for node in self.state['osd_tree']) - 1
+        self.state['osd_tree'].append({'id': new_id, 'name': name,
+                                       'type': bucket_type, 'type_id': 0,
+                                       'children': []})
+        self._next_epoch()
+        return "added bucket {} type {} to crush map\n".format(
+            name, bucket_type)
+
+    def _osd_crush_move(self, args, options, stdin):
+        node = self._node(args[0])
+        if node is None:
+            raise _enoent("item {} does not exist".format(args[0]))
+        parent_name = args[-1].split('=', 1)[-1]
+        parent = self._node(parent_name)
+        if parent is None:
+            raise _enoent("bucket {} does not exist".format(parent_name))
+        for other in self.state['osd_tree']:
+            if node['id'] in other.get('children', []):
+                other['children'].remove(node['id'])
+        parent.setdefault('children', []).append(node['id'])
+        self._next_epoch()
+        return "moved item id {} name '{}' to location {{{}}}\n".format(
+            node['id'], node['name'], args[-1])
+
+    def _osd_crush_reweight(self, args, options, stdin):
+        node = self._node(args[0])
+        if node is None:
+            raise _enoent("device '{}' does not appear in the crush "
+                          "map".format(args[0]))
+        node['crush_weight'] = float(args[1])
+        self._next_epoch()
+        return "reweighted item id {} name '{}' to {} in crush map\n".format(
+            node['id'], node['name'], args[1])
+
+    def _osd_crush_rule_ls(self, args, options, stdin):
+        return self._dump([rule['rule_name'] for rule in self.state['rules']],
+                          options)
+
+    def _osd_crush_rule_dump(self, args, options, stdin):
+        rules = [{'rule_id': rule['rule_id'], 'rule_name': rule['rule_name'],
+                  'type': rule['type'],
+                  'steps': [{'op': 'take', 'item_name': rule['root']},
+                            {'op': 'chooseleaf_firstn', 'num': 0,
+                             'type': rule['failure_domain']},
+                            {'op': 'emit'}]}
+                 for rule in self.state['rules']]
+        if args:
+            rules = [rule for rule in rules if rule['rule_name'] == args[0]]
+            if not rules:
+                raise _enoent("unknown crush rule '{}'".format(args[0]))
+            return json.dumps(rules[0])
+        return json.dumps(rules)
+
+    def _osd_crush_rule_create_replicated(self, args, options, stdin):
+        name = args[0]
+        if any(rule['rule_name'] == name for rule in self.state['rules']):
+            return ''
+        self.state['rules'].append({
+            'rule_id': max(r['rule_id'] for r in self.state['rules']) + 1,
+            'rule_name': name, 'type': 1, 'root': args[1],
+            'failure_domain': args[2] if len(args) > 2 else 'host'})
+        return ''
+
+    def _crushmap_text(self):
+        if self.state['crushmap']:
+            return self.state['crushmap']
+        nodes = self._nodes()
+        lines = ['# begin crush map', '', '# devices']
+        lines.extend('device {0} osd.{0} class {1}'.format(
+            osd['id'], osd.get('device_class', 'hdd'))
+            for osd in self._osds())
+        lines.extend(['', '# types', 'type 0 osd', 'type 1 host',
+                      'type 3 rack', 'type 11 root', '', '# buckets'])
+        for node in sorted(self.state['osd_tree'], key=lambda n: -n['id']):
+            if node['type'] == 'osd':
+                continue
+            items = ''.join(
+                '    item {} weight {:.3f}\n'.format(
+                    nodes[child]['name'],
+                    nodes[child].get('crush_weight', 1.0))
+                for child in node.get('children', []) if child in nodes)
+            lines.append(CRUSHMAP_BUCKET.format(
+                type=node['type'], name=node['name'], id=node['id'],
+                items=items))
+        lines.append('# rules')
+        lines.extend(CRUSHMAP_RULE.format(
+            name=rule['rule_name'], id=rule['rule_id'], root=rule['root'],
+            failure_domain=rule['failure_domain'])
+            for rule in self.state['rules'])
+        lines.append('# end crush map')
+        return '\n'.join(lines) + '\n'
+
+    def _osd_getcrushmap(self, args, options, stdin):
+        return COMPILED_CRUSHMAP + self._crushmap_text().encode('UTF-8')
+
+    def _osd_setcrushmap(self, args, options, stdin):
+        data = self._read_input(options, stdin, '-i', '--in-file')
+        if not data.startswith(COMPILED_CRUSHMAP):
+            raise _einval('failed to decode crushmap')
+        self.state['crushmap'] = data[len(COMPILED_CRUSHMAP):].decode(
+            'UTF-8')
+        self._next_epoch()
+        return ''
+
+    def _osd_pool_ls(self, args, options, stdin):
+        if args and args[0] == 'detail':
+            return json.dumps(list(self.state['pools'].values()))
+        return self._dump(list(self.state['pools']), options)
+
+    def _osd_lspools(self, args, options, stdin):
+        return json.dumps([{'poolnum': pool['pool_id'], 'poolname': name}
+                           for name, pool in self.state['pools'].items()])
+
+    def _osd_pool_create(self, args, options, stdin):
+        name = args[0]
+        if name in self.state['pools']:
+            return "pool '{}' already exists\n".format(name)
+        pg_num = int(args[1]) if len(args) > 1 and args[1].isdigit() else 32
+        pool_type = 'replicated'
+        profile = ''
+        rest = [arg for arg in args[1:] if not arg.isdigit()]
+        if rest and rest[0] in ('replicated', 'erasure'):
+            pool_type = rest.pop(0)
+        if pool_type == 'erasure':
+            profile = rest.pop(0) if rest else 'default'
+            if profile not in self.state['erasure_profiles']:
+                raise _enoent("specified erasure code profile '{}' does "
+                              "not exist".format(profile))
+            ec = self.state['erasure_profiles'][profile]
+            size = int(ec['k']) + int(ec['m'])
+        else:
+            size = 3
+        self.state['pools'][name] = {
+            'pool_id': self.state['next_pool_id'],
+            'pool_name': name,
+            'flags_names': 'hashpspool',
+            'type': 3 if pool_type == 'erasure' else 1,
+            'size': size,
+            'min_size': size - 1,
+            'crush_rule': 0,
+            'pg_num': pg_num,
+            'pg_placement_num': pg_num,
+            'pg_num_target': pg_num,
+            'pgp_num_target': pg_num,
+            'pg_autoscale_mode': 'on',
+            'quota_max_bytes': 0,
+            'quota_max_objects': 0,
+            'erasure_code_profile': profile,
+            'options': {},
+            'application_metadata': {},
+        }
+        self.state['next_pool_id'] += 1
+        self._next_epoch()
+        return "pool '{}' created\n".format(name)
+
+    def _osd_pool_delete(self, args, options, stdin):
+        if args[0] not in self.state['pools']:
+            return "pool '{}' does not exist\n".format(args[0])
+        if not options.get('--yes-i-really-really-mean-it'):
+            raise CommandError(errno.EPERM, 'Error EPERM: WARNING: this '
+                               'will *PERMANENTLY DESTROY* all data')
+        del self.state['pools'][args[0]]
+        self._next_epoch()
+        return "pool '{}' removed\n".format(args[0])
+
+    def _osd_pool_rename(self, args, options, stdin):
+        pool = self._pool(args[0])
+        pool['pool_name'] = args[1]
+        del self.state['pools'][args[0]]
+        self.state['pools'][args[1]] = pool
+        self._next_epoch()
+        return "pool '{}' renamed to '{}'\n".format(args[0], args[1])
+
+    # pool settings that are fields of 'osd pool ls detail'
+    POOL_FIELDS = {'size': int, 'min_size': int, 'pg_num': int,
+                   'pgp_num': int, 'crush_rule': str,
+                   'pg_autoscale_mode': str}
+
+    def _osd_pool_set(self, args, options, stdin):
+        pool = self._pool(args[0])
+        key, value = args[1], args[2]
+        if key in self.POOL_FIELDS:
+            pool[key] = self.POOL_FIELDS[key](value)
+            if key == 'pg_num':
+                pool['pg_num_target'] = pool['pg_num']
+        elif key == 'bulk':
+            flags = set(pool['flags_names'].split(','))
+            if value in ('true', '1'):
+                flags.add('bulk')
+            else:
+                flags.discard('bulk')
+            pool['flags_names'] = ','.join(sorted(flags))
+        else:
+            pool['options'][key] = value
+        self._next_epoch()
+        return 'set pool {} {} to {}\n'.format(pool['pool_id'], key, value)
+
+    def _osd_pool_get(self, args, options, stdin):
+        pool = self._pool(args[0])
+        key = args[1]
+        if key == 'erasure_code_profile' and not pool['erasure_code_profile']:
+            raise CommandError(errno.EACCES, 'Error EACCES: pool {} is not '
+                               'an erasure pool'.format(args[0]))
+        if key in pool:
+            value = pool[key]
+        elif key in pool['options']:
+            value = pool['options'][key]
+        else:
+            raise CommandError(errno.ENOENT, "Error ENOENT: option '{}' is "
+                               "not set on pool '{}'".format(key, args[0]))
+        if self._format(options).startswith('json'):
+            return json.dumps({'pool': args[0],
+                               'pool_id': pool['pool_id'], key: value})
+        return '{}: {}\n'.format(key, value)
+
+    def _osd_pool_set_quota(self, args, options, stdin):
+        pool = self._pool(args[0])
+        pool['quota_{}'.format(args[1])] = int(args[2])
+        return "set-quota {} = {} for pool {}\n".format(
+            args[1], args[2], args[0])
+
+    def _osd_pool_get_quota(self, args, options, stdin):
+        pool = self._pool(args[0])
+
+        def limit(value, unit=''):
+            return '{}{}'.format(value, unit) if value else 'N/A'
+        return ("quotas for pool '{}':\n  max objects: {}\n"
+                "  max bytes  : {}\n").format(
+                    args[0], limit(pool['quota_max_objects'], ' objects'),
+                    limit(pool['quota_max_bytes'], ' B'))
+
+    def _osd_pool_application_enable(self, args, options, stdin):
+        pool = self._pool(args[0])
+        pool['application_metadata'].setdefault(args[1], {})
+        return "enabled application '{}' on pool '{}'\n".format(
+            args[1], args[0])
+
+    def _osd_pool_application_get(self, args, options, stdin):
+        if args:
+            return json.dumps(self._pool(args[0])['application_metadata'])
+        return json.dumps({name: pool['application_metadata']
+                           for name, pool in self.state['pools'].items()})
+
+    def _osd_erasure_code_profile_set(self, args, options, stdin):
+        profile = dict(arg.split('=', 1) for arg in args[1:])
+        profile.setdefault('plugin', 'jerasure')
+        self.state['erasure_profiles'][args[0]] = profile
+        return ''
+
+    def _osd_erasure_code_profile_get(self, args, options, stdin):
+        profile = self.state['erasure_profiles'].get(args[0])
+        if profile is None:
+            raise _enoent("unknown erasure code profile '{}'".format(
+                args[0]))
+        if self._format(options).startswith('json'):
+            return json.dumps(profile)
+        return ''.join('{}={}\n'.format(key, value)
+                       for key, value in sorted(profile.items()))
+
+    def _osd_erasure_code_profile_ls(self, args, options, stdin):
+        return self._dump(sorted(self.state['erasure_profiles']), options)
+
+    def _osd_erasure_code_profile_rm(self, args, options, stdin):
+        self.state['erasure_profiles'].pop(args[0], None)
+        return ''
+
+    def _config_key_get(self, args, options, stdin):
+        if args[0] not in self.state['config_key']:
+            raise _enoent("error obtaining '{}': (2) No such file or "
+                          "directory".format(args[0]))
+        return self._write_output(options, self.state['config_key'][args[0]],
+                                  '-o', '--out-file')
+
+    def _config_key_set(self, args, options, stdin):
+        if len(args) > 1:
+            value = args[1]
+        else:
+            value = self._read_input(options, stdin, '-i',
+                                     '--in-file').decode('UTF-8')
+        self.state['config_key'][args[0]] = value
+        return 'set {}\n'.format(args[0])
+
+    def _config_key_exists(self, args, options, stdin):
+        if args[0] not in self.state['config_key']:
+            raise _enoent("key '{}' doesn't exist".format(args[0]))
+        return "key '{}' exists\n".format(args[0])
+
+    def _config_key_del(self, args, options, stdin):
+        self.state['config_key'].pop(args[0], None)
+        return 'key deleted\n'
+
+    def _config_key_dump(self, args, options, stdin):
+        prefix = args[0] if args else ''
+        return json.dumps({key: value for key, value
+                           in self.state['config_key'].items()
+                           if key.startswith(prefix)})
+
+    def _config_key_ls(self, args, options, stdin):
+        return json.dumps(sorted(self.state['config_key']))
+
+    def _auth_entry(self, entity):
+        auth = self.state['auth'].get(entity)
+        if auth is None:
+            raise _enoent("failed to find {} in keyring".format(entity))
+        return {'entity': entity, 'key': auth['key'],
+                'caps': dict(auth['caps'])}
+
+    @staticmethod
+    def _keyring(entries):
+        lines = []
+        for entry in entries:
+            lines.append('[{}]'.format(entry['entity']))
+            lines.append('\tkey = {}'.format(entry['key']))
+            for service, caps in sorted(entry['caps'].items()):
+                lines.append('\tcaps {} = "{}"'.format(service, caps))
+        return '\n'.join(lines) + '\n'
+
+    def _auth_output(self, entries, options):
+        if self._format(options).startswith('json'):
+            return json.dumps(entries)
+        return self._keyring(entries)
+
+    def _auth_ls(self, args, options, stdin):
+        entries = [self._auth_entry(entity)
+                   for entity in sorted(self.state['auth'])]
+        if self._format(options).startswith('json'):
+            return json.dumps({'auth_dump': entries})
+        return self._keyring(entries)
+
+    def _auth_get(self, args, options, stdin):
+        return self._auth_output([self._auth_entry(args[0])], options)
+
+    def _auth_get_key(self, args, options, stdin):
+        return self._auth_entry(args[0])['key'] + '\n'
+
+    @staticmethod
+    def _caps(args):
+        return dict(zip(args[::2], args[1::2]))
+
+    def _auth_get_or_create(self, args, options, stdin):
+        entity = args[0]
+        caps = self._caps(args[1:])
+        auth = self.state['auth'].get(entity)
+        if auth is None:
+            self.state['auth'][entity] = {'key': self._key(entity),
+                                          'caps': caps}
+        elif caps and caps != auth['caps']:
+            raise _einval("key for {} exists but cap {} does not "
+                          "match".format(entity, sorted(caps)[0]))
+        return self._auth_output([self._auth_entry(entity)], options)
+
+    def _auth_get_or_create_key(self, args, options, stdin):
+        self._auth_get_or_create(args, options, stdin)
+        return self._auth_entry(args[0])['key'] + '\n'
+
+    def _auth_caps(self, args, options, stdin):
+        auth = self.state['auth'].get(args[0])
+        if auth is None:
+            raise _enoent("couldn't find entity {}".format(args[0]))
+        auth['caps'] = self._caps(args[1:])
+        return ''
+
+    def _auth_del(self, args, options, stdin):
+        if self.state['auth'].pop(args[0], None) is None:
+            raise _enoent("failed to find {} in keyring".format(args[0]))
+        return ''
+
+    def _config_set(self, args, options, stdin):
+        who, name, value = args[0], args[1], args[2]
+        section, _, mask = who.partition('/')
+        self._config_rm([who, name], options, stdin)
+        entry = {'section': section, 'name': name, 'value': value}
+        if mask:
+            entry['mask'] = mask
+        self.state['config'].append(entry)
+        return ''
+
+    @staticmethod
+    def _config_who(entry):
+        if entry.get('mask'):
+            return '{}/{}'.format(entry['section'], entry['mask'])
+        return entry['section']
+
+    def _config_get(self, args, options, stdin):
+        for entry in self.state['config']:
+            if self._config_who(entry) == args[0] and \
+                    entry['name'] == args[1]:
+                return entry['value'] + '\n'
+        return '\n'
+
+    def _config_rm(self, args, options, stdin):
+        self.state['config'] = [
+            entry for entry in self.state['config']
+            if (self._config_who(entry), entry['name']) != (args[0], args[1])]
+        return ''
+
+    def _config_dump(self, args, options, stdin):
+        return json.dumps(self.state['config'])
+
+    def _pg_stat(self, args, options, stdin):
+        pgs = self._pg_counts()
+        return json.dumps({
+            'num_pgs': pgs,
+            'num_pg_by_state': [{'name': 'active+clean', 'num': pgs}]
+            if pgs else []})
+
+    def _pg_dump(self, args, options, stdin):
+        stats = [{'pgid': '{}.{:x}'.format(pool['pool_id'], pg),
+                  'state': 'active+clean'}
+                 for pool in self.state['pools'].values()
+                 for pg in range(pool['pg_num'])]
+        return json.dumps({'pg_stats': stats})
+
+    def _mgr_module_ls(self, args, options, stdin):
+        return json.dumps({'always_on_modules': ['balancer', 'crash'],
+                           'enabled_modules': self.state['mgr_modules'],
+                           'disabled_modules': []})
+
+    def _mgr_module_enable(self, args, options, stdin):
+        if args[0] not in self.state['mgr_modules']:
+            self.state['mgr_modules'].append(args[0])
+        return ''
+
+    def _mgr_module_disable(self, args, options, stdin):
+        if args[0] in self.state['mgr_modules']:
+            self.state['mgr_modules'].remove(args[0])
+        return ''
+
+    def _mgr_dump(self, args, options, stdin):
+        return json.dumps({'active_name': self.state['mons'][0],
+                           'available': True,
+                           'modules': self.state['mgr_modules']})
+
+    def _empty_list(self, args, options, stdin):
+        return json.dumps([])
+
+    def _no_output(self, args, options, stdin):
+        return ''
+
+    def _daemon(self, args, options, stdin):
+        daemon = os.path.basename(args[0])
+        command = args[1:]
+        if command == ['mon_status']:
+            return self._mon_status([], options, stdin)
+        if command == ['status'] and 'osd' in daemon:
+            osd_id = int(''.join(c for c in daemon.split('osd.')[-1]
+                                 if c.isdigit()))
+            return json.dumps({'cluster_fsid': self.state['fsid'],
+                               'whoami': osd_id, 'state': 'active',
+                               'oldest_map': 1,
+                               'newest_map': self.state['epoch']})
+        if command[:1] == ['version']:
+            return json.dumps({'version': self.state['version']})
+        return json.dumps({})
+
+    # rados
+
+    def _rados(self, argv, stdin):
+        words, options = parse_args(argv, CEPH_VALUE_OPTIONS | {'-p',
+                                                                '--pool'})
+        if words == ['lspools']:
+            return ''.join('{}\n'.format(name)
+                           for name in self.state['pools'])
+        if words == ['ls']:
+            self._pool(_option(options, '-p', '--pool'))
+            return ''
+        if words == ['df']:
+            return json.dumps({'pools': [
+                {'name': name, 'id': pool['pool_id'], 'size_bytes': 0,
+                 'num_objects': 0}
+                for name, pool in self.state['pools'].items()]})
+        raise CommandError(errno.EINVAL, 'unrecognized command {}'.format(
+            ' '.join(words)))
+
+    # radosgw-admin
+
+    def _radosgw_admin(self, argv, stdin):
+        words, options = parse_args(
+            argv, {'--uid', '--display-name', '--rgw-realm',
+                   '--rgw-zonegroup', '--rgw-zone', '--infile', '-i',
+                   '--url', '--endpoints', '--access-key', '--secret',
+                   '--system', '--default', '--master', '--id', '--name',
+                   '-n', '--format'})
+        rgw = self.state['rgw']
+        if words[:2] == ['user', 'create']:
+            uid = _option(options, '--uid')
+            user = rgw['users'].setdefault(uid, {
+                'user_id': uid,
+                'display_name': _option(options, '--display-name') or uid,
+                'keys': [{'user': uid, 'access_key': self._key(uid)[:20],
+                          'secret_key': self._key(uid)}]})
+            return json.dumps(user)
+        if words[:2] == ['user', 'info']:
+            uid = _option(options, '--uid')
+            if uid not in rgw['users']:
+                raise CommandError(errno.ENOENT, 'could not fetch user info: '
+                                   'no user info saved')
+            return json.dumps(rgw['users'][uid])
+        if words[:2] == ['user', 'list']:
+            return json.dumps(sorted(rgw['users']))
+        if words[:2] == ['user', 'rm']:
+            rgw['users'].pop(_option(options, '--uid'), None)
+            return ''
+        if words and words[0] in ('realm', 'zonegroup', 'zone'):
+            kind = words[0]
+            name = _option(options, '--rgw-{}'.format(kind))
+            if words[1:2] in (['create'], ['modify'], ['set']):
+                rgw[kind].setdefault(name, {'id': self._key(name or kind),
+                                            'name': name})
+                return json.dumps(rgw[kind][name])
+            if words[1:2] == ['get']:
+                if name not in rgw[kind]:
+                    raise CommandError(errno.ENOENT, 'failed to load {}: '
+                                       '(2) No such file or '
+                                       'directory'.format(kind))
+                return json.dumps(rgw[kind][name])
+            if words[1:2] == ['list']:
+                return json.dumps({'{}s'.format(kind): sorted(rgw[kind])})
+            if words[1:2] == ['delete']:
+                rgw[kind].pop(name, None)
+                return ''
+        if words[:1] in (['period'], ['regionmap'], ['region-map']):
+            return json.dumps({})
+        raise CommandError(errno.EINVAL, 'unrecognized arg {}'.format(
+            ' '.join(words)))
+
+    # crushtool
+
+    def _crushtool(self, argv, stdin):
+        words, options = parse_args(argv, {'-d', '-c', '-o', '-i',
+                                           '--decompile', '--compile',
+                                           '--outfn'})
+        decompile = _option(options, '-d', '--decompile')
+        compile_ = _option(options, '-c', '--compile')
+        if decompile is not None:
+            data = self._read_input(options, stdin, '-d', '--decompile')
+            if not data.startswith(COMPILED_CRUSHMAP):
+                raise CommandError(errno.EINVAL,
+                                   'crushtool: unable to decode crushmap')
+            output = data[len(COMPILED_CRUSHMAP):]
+        elif compile_ is not None:
+            text = self._read_input(options, stdin, '-c', '--compile')
+            output = COMPILED_CRUSHMAP + text
+        else:
+            raise CommandError(errno.EINVAL, 'crushtool: no action specified')
+        return self._write_output(options, output, '-o', '--outfn')
+
+
+# words of a ceph command -> FakeCeph method
+CEPH_COMMANDS = {
+    ('mon_status',): '_mon_status',
+    ('mon', 'stat'): '_quorum_status',
+    ('quorum_status',): '_quorum_status',
+    ('status',): '_status',
+    ('health',): '_health',
+    ('versions',): '_versions',
+    ('version',): '_version',
+    ('daemon',): '_daemon',
+    ('osd', 'tree'): '_osd_tree',
+    ('osd', 'ls'): '_osd_ls',
+    ('osd', 'stat'): '_osd_stat',
+    ('osd', 'dump'): '_osd_dump',
+    ('osd', 'set'): '_osd_set',
+    ('osd', 'unset'): '_osd_unset',
+    ('osd', 'down'): '_osd_down',
+    ('osd', 'require-osd-release'): '_osd_require_release',
+    ('osd', 'crush', 'add-bucket'): '_osd_crush_add_bucket',
+    ('osd', 'crush', 'move'): '_osd_crush_move',
+    ('osd', 'crush', 'reweight'): '_osd_crush_reweight',
+    ('osd', 'crush', 'rule', 'ls'): '_osd_crush_rule_ls',
+    ('osd', 'crush', 'rule', 'list'): '_osd_crush_rule_ls',
+    ('osd', 'crush', 'rule', 'dump'): '_osd_crush_rule_dump',
+    ('osd', 'crush', 'rule', 'create-replicated'):
+        '_osd_crush_rule_create_replicated',
+    ('osd', 'getcrushmap'): '_osd_getcrushmap',
+    ('osd', 'setcrushmap'): '_osd_setcrushmap',
+    ('osd', 'lspools'): '_osd_lspools',
+    ('osd', 'pool', 'ls'): '_osd_pool_ls',
+    ('osd', 'pool', 'create'): '_osd_pool_create',
+    ('osd', 'pool', 'delete'): '_osd_pool_delete',
+    ('osd', 'pool', 'rm'): '_osd_pool_delete',
+    ('osd', 'pool', 'rename'): '_osd_pool_rename',
+    ('osd', 'pool', 'set'): '_osd_pool_set',
+    ('osd', 'pool', 'get'): '_osd_pool_get',
+    ('osd', 'pool', 'set-quota'): '_osd_pool_set_quota',
+    ('osd', 'pool', 'get-quota'): '_osd_pool_get_quota',
+    ('osd', 'pool', 'application', 'enable'):
+        '_osd_pool_application_enable',
+    ('osd', 'pool', 'application', 'get'): '_osd_pool_application_get',
+    ('osd', 'erasure-code-profile', 'set'): '_osd_erasure_code_profile_set',
+    ('osd', 'erasure-code-profile', 'get'): '_osd_erasure_code_profile_get',
+    ('osd', 'erasure-code-profile', 'ls'): '_osd_erasure_code_profile_ls',
+    ('osd', 'erasure-code-profile', 'rm'): '_osd_erasure_code_profile_rm',
+    ('config-key', 'get'): '_config_key_get',
+    ('config-key', 'set'): '_config_key_set',
+    ('config-key', 'put'): '_config_key_set',
+    ('config-key', 'exists'): '_config_key_exists',
+    ('config-key', 'del'): '_config_key_del',
+    ('config-key', 'rm'): '_config_key_del',
+    ('config-key', 'dump'): '_config_key_dump',
+    ('config-key', 'ls'): '_config_key_ls',
+    ('config-key', 'list'): '_config_key_ls',
+    ('auth', 'ls'): '_auth_ls',
+    ('auth', 'list'): '_auth_ls',
+    ('auth', 'get'): '_auth_get',
+    ('auth', 'export'): '_auth_get',
+    ('auth', 'get-key'): '_auth_get_key',
+    ('auth', 'print-key'): '_auth_get_key',
+    ('auth', 'print_key'): '_auth_get_key',
+    ('auth', 'get-or-create'): '_auth_get_or_create',
+    ('auth', 'get-or-create-key'): '_auth_get_or_create_key',
+    ('auth', 'caps'): '_auth_caps',
+    ('auth', 'del'): '_auth_del',
+    ('auth', 'rm'): '_auth_del',
+    ('config', 'set'): '_config_set',
+    ('config', 'get'): '_config_get',
+    ('config', 'rm'): '_config_rm',
+    ('config', 'dump'): '_config_dump',
+    ('pg', 'stat'): '_pg_stat',
+    ('pg', 'dump'): '_pg_dump',
+    ('mgr', 'module', 'ls'): '_mgr_module_ls',
+    ('mgr', 'module', 'enable'): '_mgr_module_enable',
+    ('mgr', 'module', 'disable'): '_mgr_module_disable',
+    ('mgr', 'dump'): '_mgr_dump',
+    ('mon', 'enable-msgr2'): '_no_output',
+    ('fs', 'ls'): '_empty_list',
+}
+
+
+def strip_sudo(argv):
+    """argv without a leading 'sudo [-u user]'."""
+    argv = list(argv)
+    if argv and os.path.basename(argv[0]) == 'sudo':
+        argv = argv[1:]
+        while argv and argv[0].startswith('-'):
+            argv = argv[2:] if argv[0] in ('-u', '-g') else argv[1:]
+    return argv
+
+
+class FakePopen(object):
+    """subprocess.Popen running a command against a FakeCeph.
+
+    The command runs on the first communicate(), wait() or poll().
+    """
+
+    def __init__(self, fake, args, stdin=None, stdout=None, stderr=None,
+                 universal_newlines=None, text=None, encoding=None,
+                 errors=None, **kwargs):
+        self._fake = fake
+        self.args = args
+        self.pid = 0
+        self.returncode = None
+        self._stdin = stdin
+        self._stdout = stdout
+        self._stderr = stderr
+        self._text = bool(universal_newlines or text or encoding or errors)
+        self._encoding = encoding or 'UTF-8'
+        self._output = None
+        self.stdin = io.BytesIO() if stdin == subprocess.PIPE else None
+        self.stdout = None
+        self.stderr = None
+
+    def _input(self, input):
+        if input is not None:
+            return input.encode(self._encoding) \
+                if isinstance(input, str) else input
+        if self.stdin is not None:
+            return self.stdin.getvalue()
+        if hasattr(self._stdin, 'read'):
+            data = self._stdin.read()
+            return data.encode(self._encoding) \
+                if isinstance(data, str) else data
+        if isinstance(self._stdin, int) and self._stdin >= 0:
+            return os.read(self._stdin, 1 << 30)
+        return b''
+
+    def _run(self, input=None):
+        if self._output is not None:
+            return
+        self.returncode, out, err = self._fake.run(
+            self.args, lambda: self._input(input))
+        if self._stderr == subprocess.STDOUT:
+            out, err = out + err, b''
+        self._output = (self._deliver(out, self._stdout),
+                        self._deliver(err, self._stderr))
+
+    def _deliver(self, data, target):
+        if target == subprocess.PIPE:
+            return data.decode(self._encoding) if self._text else data
+        if hasattr(target, 'write'):
+            target.write(data.decode(self._encoding)
+                         if isinstance(target, io.TextIOBase) else data)
+        elif isinstance(target, int) and target >= 0:
+            os.write(target, data)
+        return None
+
+    def communicate(self, input=None, timeout=None):
+        self._run(input)
+        return self._output
+
+    def wait(self, timeout=None):
+        self._run()
+        return self.returncode
+
+    def poll(self):
+        self._run()
+        return self.returncode
+
+    def kill(self):
+        pass
+
+    terminate = kill
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.wait()
+
+
+# charmhelpers over the CLIs
+#
+# unit_tests mocks charmhelpers, so the charmhelpers functions charms_ceph
+# uses to talk to Ceph do not run any command.  The ones below run the
+# commands charmhelpers runs, leaving out what the fake ignores, and
+# patch_charmhelpers() puts them in place of the mocks so that the broker
+# and the upgrade code reach a FakeCeph from end to end.
+
+def monitor_key_get(service, key):
+    try:
+        return subprocess.check_output(
+            ['ceph', '--id', service, 'config-key', 'get',
+             str(key)]).decode('UTF-8')
+    except subprocess.CalledProcessError:
+        return None
+
+
+def monitor_key_set(service, key, value):
+    subprocess.check_output(['ceph', '--id', service, 'config-key', 'put',
+                             str(key), str(value)])
+
+
+def monitor_key_exists(service, key):
+    try:
+        subprocess.check_call(['ceph', '--id', service, 'config-key',
+                               'exists', str(key)],
+                              stdout=subprocess.DEVNULL)
+        return True
+    except subprocess.CalledProcessError as e:
+        if e.returncode == errno.ENOENT:
+            return False
+        raise
+
+
+def get_mon_map(service):
+    return json.loads(subprocess.check_output(
+        ['ceph', '--id', service, 'quorum_status',
+         '--format=json']).decode('UTF-8'))
+
+
+def get_osds(service, device_class=None):
+    return json.loads(subprocess.check_output(
+        ['ceph', '--id', service, 'osd', 'ls',
+         '--format=json']).decode('UTF-8'))
+
+
+def enabled_manager_modules():
+    return json.loads(subprocess.check_output(
+        ['ceph', 'mgr', 'module', 'ls',
+         '--format=json']).decode('UTF-8'))['enabled_modules']
+
+
+def pool_exists(service, name):
+    try:
+        out = subprocess.check_output(['rados', '--id', service, 'lspools'])
+    except subprocess.CalledProcessError:
+        return False
+    return name in out.decode('UTF-8').split()
+
+
+def pool_set(service, pool_name, key, value):
+    if isinstance(value, bool):
+        value = str(value).lower()
+    subprocess.check_call(['ceph', '--id', service, 'osd', 'pool', 'set',
+                           pool_name, key, str(value)],
+                          stdout=subprocess.DEVNULL)
+
+
+def update_pool(client, pool, settings):
+    for key, value in settings.items():
+        pool_set(client, pool, key, value)
+
+
+def set_pool_quota(service, pool_name, max_bytes=None, max_objects=None):
+    cmd = ['ceph', '--id', service, 'osd', 'pool', 'set-quota', pool_name]
+    if max_bytes:
+        cmd += ['max_bytes', str(max_bytes)]
+    if max_objects:
+        cmd += ['max_objects', str(max_objects)]
+    subprocess.check_call(cmd, stdout=subprocess.DEVNULL)
+
+
+def set_app_name_for_pool(client, pool, name):
+    subprocess.check_call(['ceph', '--id', client, 'osd', 'pool',
+                           'application', 'enable', pool, name],
+                          stdout=subprocess.DEVNULL)
+
+
+def get_erasure_profile(service, name):
+    try:
+        return json.loads(subprocess.check_output(
+            ['ceph', '--id', service, 'osd', 'erasure-code-profile', 'get',
+             name, '--format=json']).decode('UTF-8'))
+    except subprocess.CalledProcessError:
+        return None
+
+
+def erasure_profile_exists(service, name):
+    return get_erasure_profile(service, name) is not None
+
+
+class ReplicatedPool(object):
+    """charmhelpers ReplicatedPool created from a broker op."""
+
+    COMPRESSION_KEYS = (
+        'compression-algorithm', 'compression-mode',
+        'compression-required-ratio', 'compression-min-blob-size',
+        'compression-max-blob-size')
+
+    def __init__(self, service, op):
+        self.service = service
+        self.op = op
+        self.name = op['name']
+        self.replicas = op['replicas']
+        self.pg_num = op.get('pg_num') or 32
+
+    def validate(self):
+        pass
+
+    def create(self):
+        if pool_exists(self.service, self.name):
+            return
+        subprocess.check_call(['ceph', '--id', self.service, 'osd', 'pool',
+                               'create', self.name, str(self.pg_num)],
+                              stdout=subprocess.DEVNULL)
+        update_pool(self.service, self.name, {'size': self.replicas})
+        set_app_name_for_pool(self.service, self.name,
+                              self.op.get('app-name') or 'unknown')
+        self.update()
+
+    def update(self):
+        if self.op.get('max-bytes') or self.op.get('max-objects'):
+            set_pool_quota(self.service, self.name,
+                           max_bytes=self.op.get('max-bytes'),
+                           max_objects=self.op.get('max-objects'))
+        settings = {key.replace('-', '_'): self.op[key]
+                    for key in self.COMPRESSION_KEYS if self.op.get(key)}
+        if settings:
+            update_pool(self.service, self.name, settings)
+
+
+class UnitData(object):
+    """In memory charmhelpers unitdata."""
+
+    def __init__(self):
+        self.data = {}
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set(self, key, value):
+        self.data[key] = value
+
+    def unset(self, key):
+        self.data.pop(key, None)
+
+    def flush(self):
+        pass
+
+
+CHARMHELPERS = (
+    'monitor_key_get', 'monitor_key_set', 'monitor_key_exists',
+    'get_mon_map', 'get_osds', 'enabled_manager_modules', 'pool_exists',
+    'pool_set', 'update_pool', 'set_pool_quota', 'set_app_name_for_pool',
+    'get_erasure_profile', 'erasure_profile_exists', 'ReplicatedPool',
+)
+
+
+@contextlib.contextmanager
+def patch_charmhelpers(*modules):
+    """Run the CHARMHELPERS functions of modules against the CLIs.
+
+    The modules also get an in memory unitdata as 'kv', the block runs
+    with the UnitData.
+
+    :param modules: charms_ceph modules importing charmhelpers functions
+    :type modules: List[module]
+    """
+    from unittest.mock import patch
+
+    unitdata = UnitData()
+    this = sys.modules[__name__]
+    with contextlib.ExitStack() as stack:
+        for module in modules:
+            for name in CHARMHELPERS:
+                if hasattr(module, name):
+                    stack.enter_context(patch.object(
+                        module, name, getattr(this, name)))
+            if hasattr(module, 'kv'):
+                stack.enter_context(patch.object(module, 'kv',
+                                                 lambda: unitdata))
+        yield unitdata
+
+
+SHIM = """#!{python}
+# Fake Ceph CLI, see unit_tests/fake_ceph.py
+import importlib.util
+import os
+import sys
+
+spec = importlib.util.spec_from_file_location('fake_ceph', '{module}')
+fake_ceph = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(fake_ceph)
+os.environ.setdefault('{state_env}', '{state}')
+sys.exit(fake_ceph.main(sys.argv))
+"""
+
+
+@contextlib.contextmanager
+def locked_state(path):
+    """Load the state at path under an exclusive lock and save it back."""
+    with open('{}.lock'.format(path), 'w') as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        try:
+            fake = FakeCeph.load(path)
+            yield fake
+            fake.save(path)
+        finally:
+            fcntl.flock(lock, fcntl.LOCK_UN)
+
+
+def main(argv=None):
+    """Entry point of the shims, runs argv against $FAKE_CEPH_STATE."""
+    argv = list(argv or sys.argv)
+    path = os.environ[STATE_ENV]
+
+    def stdin():
+        return sys.stdin.buffer.read() if sys.stdin else b''
+
+    delay = FakeCeph.load(path).latency(argv)
+    if delay:
+        time.sleep(delay)
+    with locked_state(path) as fake:
+        returncode, out, err = fake.execute(argv, stdin)
+    sys.stdout.buffer.write(out)
+    sys.stderr.buffer.write(err)
+    return returncode
+
+
+if __name__ == '__main__':
+    sys.exit(main(sys.argv[1:]))
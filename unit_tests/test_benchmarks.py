@@ -0,0 +1,73 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+import charms_ceph.crush_utils
+import charms_ceph.utils
+
+from unittest.mock import patch
+
+from unit_tests import benchmarks
+
+
+class BenchmarksTestCase(unittest.TestCase):
+    """Check the benchmark fixtures on small inputs."""
+
+    def test_process_requests_fake_cluster(self):
+        fake = benchmarks.broker_cluster(pool_count=6)
+        request = json.dumps(benchmarks.broker_request(6))
+        benchmarks._process_requests(fake, request)
+        pools = fake.state['pools']
+        self.assertIn('pool0', pools)
+        self.assertIn('pool3', pools)
+        self.assertEqual(pools['existing1']['options'],
+                         {'compression_mode': 'aggressive'})
+        self.assertIn('cephx.groups.group0', fake.state['config_key'])
+        self.assertIn('cephx.services.client5', fake.state['config_key'])
+        self.assertEqual(len([argv for argv in fake.calls
+                              if argv[:3] == ['ceph', 'auth', 'caps']]), 2)
+
+    def test_osd_tree_nodes(self):
+        nodes = benchmarks.osd_tree_nodes(1100)
+        self.assertEqual(len(nodes), 1106)
+        hosts = charms_ceph.utils._flatten_roots(nodes)
+        self.assertEqual(len(hosts), 100)
+        self.assertEqual(hosts[0]['root'], 'default')
+        self.assertEqual(hosts[0]['rack'], 'rack0')
+
+    def test_crushmap_text(self):
+        text = benchmarks.crushmap_text(4, root_count=3)
+        with patch.object(charms_ceph.crush_utils.Crushmap, 'load_crushmap',
+                          return_value=text):
+            crushmap = charms_ceph.crush_utils.Crushmap()
+        self.assertEqual([bucket.name for bucket in crushmap.buckets()],
+                         ['default', 'root1', 'root2'])
+        self.assertEqual(min(crushmap._ids), -7)
+
+    def test_compare_results(self):
+        ratios, slower = benchmarks.compare_results(
+            {'a': {'best': 2.0}, 'b': {'best': 1.0}, 'c': {'best': 1.0}},
+            {'a': {'best': 1.0}, 'b': {'best': 1.0}}, 1.25)
+        self.assertEqual(ratios, {'a': 2.0, 'b': 1.0})
+        self.assertEqual(slower, ['a'])
+
+    def test_run_benchmarks(self):
+        results = benchmarks.run_benchmarks(
+            'pool_permission_list_for_service[10x10]', repeat=2, stream=None)
+        self.assertEqual(list(results),
+                         ['pool_permission_list_for_service[10x10]'])
+        self.assertEqual(results[
+            'pool_permission_list_for_service[10x10]']['repeat'], 2)
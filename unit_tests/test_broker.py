@@ -19,14 +19,31 @@ import textwrap
 from unittest.mock import patch, ANY
 
 import charms_ceph.broker
+import charms_ceph.keys
 
-from unittest.mock import call
+from unittest.mock import call, MagicMock
 
 
 class CephBrokerTestCase(unittest.TestCase):
     def setUp(self):
         super(CephBrokerTestCase, self).setUp()
+        # Read groups and services one key at a time through monitor_key_get
+        patch.object(charms_ceph.broker, 'get_cephx_keys',
+                     return_value=None).start()
+        self.get_budgeted_pg_num = patch.object(
+            charms_ceph.broker, 'get_budgeted_pg_num',
+            return_value=None).start()
+        # Without a pool listing the broker falls back to pool_exists()
+        self.get_pool_details = patch.object(
+            charms_ceph.broker, 'get_pool_details',
+            side_effect=charms_ceph.broker.CalledProcessError(
+                1, 'ceph')).start()
+        self.kv = patch.object(charms_ceph.broker, 'kv').start()
+        self.kv.return_value.get.return_value = {}
+        self.addCleanup(patch.stopall)
 
+    @patch.object(charms_ceph.broker, 'key_caps_need_update',
+                  lambda *args, **kwargs: True)
     @patch.object(charms_ceph.broker, 'check_call')
     def test_update_service_permission(self, _check_call):
         service_obj = {
@@ -42,40 +59,115 @@ class CephBrokerTestCase(unittest.TestCase):
                      ', allow command "osd blocklist"'),
              'osd', 'allow rwx pool=cinder'])
 
+    @patch.object(charms_ceph.broker, 'key_caps_need_update',
+                  lambda *args, **kwargs: True)
     @patch.object(charms_ceph.broker, 'check_call')
-    @patch.object(charms_ceph.broker, 'get_service_groups')
     @patch.object(charms_ceph.broker, 'monitor_key_set')
     @patch.object(charms_ceph.broker, 'monitor_key_get')
     def test_add_pool_to_existing_group_with_services(self,
                                                       _monitor_key_get,
                                                       _monitor_key_set,
-                                                      _get_service_groups,
                                                       _check_call):
-        _monitor_key_get.return_value = '{"pools": ["glance"],'\
-            ' "services": ["nova"]}'
-        service = {
-            'group_names': {'rwx': ['images']},
-            'groups': {'images': {'pools': [
-                'glance', 'cinder'
-            ], 'services': ['nova']}}
-        }
-        _get_service_groups.return_value = service
+        mkey = {
+            'cephx.groups.images': ('{"pools": ["glance"],'
+                                    ' "services": ["nova"]}'),
+            'cephx.services.nova': '{"group_names": {"rwx": ["images"]}}'}
+        _monitor_key_get.side_effect = lambda service, key: mkey[key]
         charms_ceph.broker.add_pool_to_group(
             pool="cinder",
             group="images"
         )
-        _monitor_key_set.assert_called_with(
+        _monitor_key_set.assert_called_once_with(
             key='cephx.groups.images',
             service='admin',
             value=json.dumps({"pools": ["glance", "cinder"],
                               "services": ["nova"]}, sort_keys=True))
-        _check_call.assert_called_with([
+        _check_call.assert_called_once_with([
             'ceph', 'auth', 'caps',
             'client.nova',
             'mon', ('allow r, allow command "osd blacklist"'
                     ', allow command "osd blocklist"'),
             'osd', 'allow rwx pool=glance, allow rwx pool=cinder'])
 
+        # Adding the pool again changes nothing
+        _monitor_key_set.reset_mock()
+        _check_call.reset_mock()
+        mkey['cephx.groups.images'] = ('{"pools": ["glance", "cinder"],'
+                                       ' "services": ["nova"]}')
+        charms_ceph.broker.add_pool_to_group(
+            pool="cinder",
+            group="images"
+        )
+        _monitor_key_set.assert_not_called()
+        _check_call.assert_not_called()
+
+    @patch.object(charms_ceph.broker, 'update_service_permissions')
+    @patch.object(charms_ceph.broker, 'monitor_key_set')
+    @patch.object(charms_ceph.broker, 'monitor_key_get')
+    def test_permission_graph_request(self, _monitor_key_get,
+                                      _monitor_key_set,
+                                      _update_service_permissions):
+        mkey = {
+            'cephx.groups.images': '{"pools": [], "services": ["nova"]}',
+            'cephx.services.nova': '{"group_names": {"rwx": ["images"]}}',
+            'cephx.services.glance': None}
+        _monitor_key_get.side_effect = lambda service, key: mkey[key]
+        with charms_ceph.broker.permission_graph():
+            for pool in ('glance', 'cinder', 'nova'):
+                charms_ceph.broker.add_pool_to_group(pool=pool,
+                                                     group='images')
+            charms_ceph.broker.handle_add_permissions_to_key(
+                request={'name': 'glance', 'group': 'images'},
+                service='admin')
+            _monitor_key_set.assert_not_called()
+        # Each document is read and written once
+        self.assertEqual(_monitor_key_get.call_count, 3)
+        _monitor_key_set.assert_has_calls([
+            call(key='cephx.groups.images', service='admin',
+                 value=json.dumps(
+                     {"pools": ["glance", "cinder", "nova"],
+                      "services": ["nova", "glance"]}, sort_keys=True)),
+            call(key='cephx.services.glance', service='admin',
+                 value=json.dumps(
+                     {"group_names": {"rwx": ["images"]}, "groups": {}},
+                     sort_keys=True))])
+        self.assertEqual(_monitor_key_set.call_count, 2)
+        self.assertEqual(
+            [c[0][0] for c in _update_service_permissions.call_args_list],
+            ['glance', 'nova'])
+
+    @patch.object(charms_ceph.utils.subprocess, 'check_output')
+    @patch.object(charms_ceph.broker, 'check_call')
+    def test_update_service_permission_noop(self, _check_call,
+                                            _check_output):
+        charms_ceph.keys._auth_snapshots.clear()
+        self.addCleanup(charms_ceph.keys._auth_snapshots.clear)
+        _check_output.return_value = json.dumps({"auth_dump": [{
+            "entity": "client.nova",
+            "key": "nova-key",
+            "caps": {
+                "mon": ('allow r; allow command "osd blacklist"; '
+                        'allow command "osd blocklist"'),
+                "osd": "allow rwx pool=cinder"}}]}).encode()
+        service_obj = {
+            'group_names': {'rwx': ['images']},
+            'groups': {'images': {'pools': ['cinder'], 'services': ['nova']}}
+        }
+        charms_ceph.broker.update_service_permissions(service='nova',
+                                                      service_obj=service_obj)
+        _check_call.assert_not_called()
+        service_obj['groups']['images']['pools'].append('glance')
+        charms_ceph.broker.update_service_permissions(service='nova',
+                                                      service_obj=service_obj)
+        _check_call.assert_called_once_with(
+            ['ceph', 'auth', 'caps',
+             'client.nova',
+             'mon', ('allow r, allow command "osd blacklist"'
+                     ', allow command "osd blocklist"'),
+             'osd', 'allow rwx pool=cinder, allow rwx pool=glance'])
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'auth', 'ls', '-f', 'json'])
+
     @patch.object(charms_ceph.broker, 'monitor_key_set')
     @patch.object(charms_ceph.broker, 'monitor_key_get')
     def test_add_pool_to_existing_group(self,
@@ -141,6 +233,8 @@ class CephBrokerTestCase(unittest.TestCase):
             json.loads(rc),
             {'exit-code': 0, u'request-id': u'0155c14b'})
 
+    @patch.object(charms_ceph.broker, 'key_caps_need_update',
+                  lambda *args, **kwargs: True)
     @patch.object(charms_ceph.broker, 'check_call')
     def test_handle_set_key_permissions(self, _check_call):
         charms_ceph.broker.handle_set_key_permissions(
@@ -156,6 +250,8 @@ class CephBrokerTestCase(unittest.TestCase):
                     'client.manila-ganesha', "mds 'allow *'", "osd 'allow rw'"]
         _check_call.assert_called_once_with(expected)
 
+    @patch.object(charms_ceph.broker, 'key_caps_need_update',
+                  lambda *args, **kwargs: True)
     @patch.object(charms_ceph.broker, 'check_call')
     def test_set_key_permission(self, _check_call):
         request = {
@@ -306,6 +402,297 @@ class CephBrokerTestCase(unittest.TestCase):
         rc = charms_ceph.broker.process_requests(req)
         self.assertEqual(json.loads(rc), {'exit-code': 0})
 
+    @patch.object(charms_ceph.broker, 'handle_set_key_permissions')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_op_results(self, mock_log,
+                                         _handle_set_key_permissions):
+        def set_key_permissions(request, service):
+            charms_ceph.broker.check_call(['true'])
+            return {'exit-code': 1, 'stderr': 'failed'}
+
+        _handle_set_key_permissions.side_effect = set_key_permissions
+        reqs = json.dumps({'api-version': 1,
+                           'request-id': '1ef5aede',
+                           'op-results': True,
+                           'ops': [{'op': 'set-key-permissions'},
+                                   {'op': 'bogus'}]})
+        rc = json.loads(charms_ceph.broker.process_requests(reqs))
+        self.assertEqual(rc['exit-code'], 1)
+        self.assertEqual(rc['stderr'], "Unknown operation 'bogus'")
+        results = rc['op-results']
+        self.assertEqual([r['op'] for r in results],
+                         ['set-key-permissions', 'bogus'])
+        self.assertEqual(results[0]['commands'], [['true']])
+        self.assertEqual(results[0]['exit-code'], 1)
+        self.assertEqual(results[0]['stderr'], 'failed')
+        self.assertEqual(results[1]['commands'], [])
+        self.assertEqual(results[1]['exit-code'], 1)
+        self.assertIsInstance(results[0]['duration'], float)
+
+        stats = self.kv.return_value.set.call_args[0][1]
+        self.assertEqual(stats['set-key-permissions']['count'], 1)
+        self.assertEqual(stats['set-key-permissions']['errors'], 1)
+        self.assertEqual(stats['set-key-permissions']['commands'], 1)
+        self.assertEqual(stats['set-key-permissions']['buckets']['0.1'], 1)
+        self.assertEqual(stats['bogus']['commands'], 0)
+        self.kv.return_value.flush.assert_called_once_with()
+
+    @patch.object(charms_ceph.broker, 'handle_add_permissions_to_key')
+    @patch.object(charms_ceph.broker, 'handle_replicated_pool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_batch(self, mock_log,
+                                    _handle_replicated_pool,
+                                    _handle_add_permissions_to_key):
+        _handle_replicated_pool.return_value = None
+        _handle_add_permissions_to_key.side_effect = [
+            {'exit-code': 0}, {'exit-code': 1, 'stderr': 'no such group'}]
+        pool_op = {'op': 'create-pool', 'name': 'nova', 'replicas': 3}
+        # The same op with its keys in another order
+        same_pool_op = {'replicas': 3, 'name': 'nova', 'op': 'create-pool'}
+        reqs = [
+            json.dumps({'api-version': 1, 'request-id': str(unit),
+                        'ops': [pool_op if unit % 2 else same_pool_op,
+                                {'op': 'add-permissions-to-key',
+                                 'name': 'nova', 'group': 'vms'}]})
+            for unit in range(100)]
+        reqs.append(json.dumps({
+            'api-version': 1, 'request-id': 'other', 'op-results': True,
+            'ops': [pool_op, {'op': 'add-permissions-to-key',
+                              'name': 'cinder', 'group': 'volumes'}]}))
+        reqs.append(json.dumps({'api-version': 1, 'request-id': 'bad',
+                                'ops': [{'op': 'bogus'}]}))
+        reqs.append(json.dumps({'request-id': 'old'}))
+
+        responses = [json.loads(resp) for resp in
+                     charms_ceph.broker.process_requests_batch(reqs)]
+        _handle_replicated_pool.assert_called_once_with(
+            request=pool_op, service='admin')
+        self.assertEqual(_handle_add_permissions_to_key.call_count, 2)
+        self.assertEqual(len(responses), 103)
+        for unit in range(100):
+            self.assertEqual(responses[unit],
+                             {'exit-code': 0, 'request-id': str(unit)})
+        self.assertEqual(responses[100]['exit-code'], 1)
+        self.assertEqual(responses[100]['stderr'], 'no such group')
+        self.assertEqual(
+            [result['op'] for result in responses[100]['op-results']],
+            ['create-pool', 'add-permissions-to-key'])
+        self.assertEqual(responses[101],
+                         {'exit-code': 1, 'request-id': 'bad',
+                          'stderr': "Unknown operation 'bogus'"})
+        self.assertEqual(responses[102]['exit-code'], 1)
+        self.assertEqual(responses[102]['request-id'], 'old')
+
+    @patch.object(charms_ceph.broker, 'get_operations')
+    @patch.object(charms_ceph.broker, 'update_operations')
+    @patch.object(charms_ceph.broker, 'handle_rgw_create_user')
+    @patch.object(charms_ceph.broker, 'handle_create_cephfs_client')
+    @patch.object(charms_ceph.broker, 'handle_set_key_permissions')
+    @patch.object(charms_ceph.broker, 'handle_add_permissions_to_key')
+    @patch.object(charms_ceph.broker, 'handle_replicated_pool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_batch_matches_single(
+            self, mock_log, _handle_replicated_pool,
+            _handle_add_permissions_to_key, _handle_set_key_permissions,
+            _handle_create_cephfs_client, _handle_rgw_create_user,
+            _update_operations, _get_operations):
+        _handle_replicated_pool.return_value = None
+        _handle_add_permissions_to_key.return_value = {
+            'exit-code': 1, 'stderr': 'no such group'}
+        _handle_set_key_permissions.return_value = {'exit-code': 0}
+        _handle_create_cephfs_client.return_value = {
+            'exit-code': 0, 'key': 'fs-key'}
+        _handle_rgw_create_user.return_value = {
+            'exit-code': 0, 'user': {'user_id': 'rgw'}}
+        _get_operations.return_value = [{'handle': 'h1'}]
+        reqs = [
+            # The failing op is not the last one
+            {'request-id': 'mixed',
+             'ops': [{'op': 'create-pool', 'name': 'nova'},
+                     {'op': 'add-permissions-to-key', 'name': 'nova',
+                      'group': 'vms'},
+                     {'op': 'set-key-permissions', 'client': 'nova'}]},
+            {'request-id': 'failed',
+             'ops': [{'op': 'create-pool', 'name': 'nova'},
+                     {'op': 'add-permissions-to-key', 'name': 'nova',
+                      'group': 'vms'}]},
+            {'request-id': 'fs',
+             'ops': [{'op': 'create-cephfs-client', 'fs_name': 'fs',
+                      'client_id': 'fs-client', 'path': '/',
+                      'perms': 'rw'}]},
+            {'request-id': 'rgw',
+             'ops': [{'op': 'rgw-create-user', 'uid': 'rgw',
+                      'display-name': 'rgw'}]},
+            {'request-id': 'get',
+             'ops': [{'op': 'get-operations', 'handles': ['h1']}]},
+        ]
+        reqs = [json.dumps(dict(req, **{'api-version': 1})) for req in reqs]
+        single = [json.loads(charms_ceph.broker.process_requests(req))
+                  for req in reqs]
+        batch = [json.loads(resp) for resp in
+                 charms_ceph.broker.process_requests_batch(reqs)]
+        self.assertEqual(batch, single)
+        self.assertEqual(batch[0], {'exit-code': 0, 'request-id': 'mixed'})
+        self.assertEqual(batch[1], {'exit-code': 1, 'request-id': 'failed',
+                                    'stderr': 'no such group'})
+        self.assertEqual(batch[2]['key'], 'fs-key')
+        self.assertEqual(batch[3]['user'], {'user_id': 'rgw'})
+        self.assertEqual(batch[4]['operations'], [{'handle': 'h1'}])
+
+    @patch.object(charms_ceph.broker, 'start_operation')
+    @patch.object(charms_ceph.broker, 'handle_replicated_pool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_batch_async(self, mock_log,
+                                          _handle_replicated_pool,
+                                          _start_operation):
+        _handle_replicated_pool.return_value = None
+        _start_operation.side_effect = lambda op, request_id, **kwargs: {
+            'handle': request_id, 'op': op, 'state': 'pending'}
+        pool_op = {'op': 'create-pool', 'name': 'nova', 'replicas': 3}
+        responses = [json.loads(resp) for resp in
+                     charms_ceph.broker.process_requests_batch([
+                         json.dumps({'api-version': 1, 'request-id': 'rq1',
+                                     'async': True, 'ops': [pool_op]}),
+                         json.dumps({'api-version': 1, 'request-id': 'rq2',
+                                     'async': True, 'ops': [pool_op]}),
+                         json.dumps({'api-version': 1, 'request-id': 'rq3',
+                                     'ops': [pool_op]})])]
+        _handle_replicated_pool.assert_called_once_with(
+            request=pool_op, service='admin')
+        self.assertEqual(responses[0]['operations'], [
+            {'handle': 'rq1', 'op': 'create-pool', 'state': 'pending'}])
+        self.assertEqual(responses[1]['operations'], [
+            {'handle': 'rq2', 'op': 'create-pool', 'state': 'pending'}])
+        self.assertNotIn('operations', responses[2])
+        _start_operation.assert_has_calls([
+            call('create-pool', request_id='rq1', pools=['nova'],
+                 status=ANY),
+            call('create-pool', request_id='rq2', pools=['nova'],
+                 status=ANY)])
+
+    @patch.object(charms_ceph.broker, 'delete_pool')
+    @patch.object(charms_ceph.broker, 'handle_erasure_pool')
+    @patch.object(charms_ceph.broker, 'handle_create_erasure_profile')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_batch_order(self, mock_log,
+                                          _handle_create_erasure_profile,
+                                          _handle_erasure_pool,
+                                          _delete_pool):
+        calls = []
+        _handle_create_erasure_profile.side_effect = (
+            lambda request, service: calls.append(request['name']))
+        _handle_erasure_pool.side_effect = (
+            lambda request, service: calls.append(request['name']))
+        _delete_pool.side_effect = (
+            lambda service, name: calls.append('delete ' + name))
+
+        def request(*ops):
+            return json.dumps({'api-version': 1, 'ops': list(ops)})
+
+        def profile(name):
+            return {'op': 'create-erasure-profile', 'name': name}
+
+        def pool(name, profile):
+            return {'op': 'create-pool', 'pool-type': 'erasure',
+                    'name': name, 'erasure-profile': profile}
+
+        charms_ceph.broker.process_requests_batch([
+            request(profile('ec-a'), pool('a', 'ec-a')),
+            request(profile('ec-b'), pool('b', 'ec-b')),
+            request(profile('ec-a'), pool('a', 'ec-a')),
+            request({'op': 'delete-pool', 'name': 'a'}),
+            request(profile('ec-a'), pool('a', 'ec-a')),
+        ])
+        # Each request's ops run in order, identical ops are only run
+        # again once an op that is not idempotent ran.
+        self.assertEqual(calls, ['ec-a', 'a', 'ec-b', 'b', 'delete a',
+                                 'ec-a', 'a'])
+
+    @patch.object(charms_ceph.broker, 'handle_set_pool_value')
+    @patch.object(charms_ceph.broker, 'handle_set_key_permissions')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_batch_same_target(self, mock_log,
+                                                _handle_set_key_permissions,
+                                                _handle_set_pool_value):
+        calls = []
+        _handle_set_key_permissions.side_effect = (
+            lambda request, service: calls.append(request['permissions']))
+        _handle_set_pool_value.side_effect = (
+            lambda request, service: calls.append(request['value']))
+
+        def caps(permissions):
+            return json.dumps({'api-version': 1, 'ops': [
+                {'op': 'set-key-permissions', 'client': 'nova',
+                 'permissions': permissions}]})
+
+        def size(value):
+            return json.dumps({'api-version': 1, 'ops': [
+                {'op': 'set-pool-value', 'name': 'nova', 'key': 'size',
+                 'value': value}]})
+
+        charms_ceph.broker.process_requests_batch([
+            caps(['allow r']), caps(['allow rw']), caps(['allow r']),
+            size(3), caps(['allow r']), size(2), size(3),
+        ])
+        # An op is run again once an op changing the same target ran, ops
+        # on other targets do not stop identical ops from being reused.
+        self.assertEqual(calls, [['allow r'], ['allow rw'], ['allow r'],
+                                 3, 2, 3])
+
+    @patch.object(charms_ceph.broker, 'get_operations')
+    @patch.object(charms_ceph.broker, 'update_operations')
+    @patch.object(charms_ceph.broker, 'start_operation')
+    @patch.object(charms_ceph.broker, 'handle_set_key_permissions')
+    @patch.object(charms_ceph.broker, 'handle_replicated_pool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_async(self, mock_log, _handle_replicated_pool,
+                                    _handle_set_key_permissions,
+                                    _start_operation, _update_operations,
+                                    _get_operations):
+        _handle_replicated_pool.return_value = None
+        _handle_set_key_permissions.return_value = None
+        _start_operation.side_effect = lambda op, **kwargs: {
+            'handle': 'h1', 'op': op, 'state': 'pending'}
+        rc = json.loads(charms_ceph.broker.process_requests(json.dumps({
+            'api-version': 1, 'request-id': 'rq1', 'async': True,
+            'ops': [{'op': 'set-key-permissions', 'client': 'nova'},
+                    {'op': 'create-pool', 'name': 'nova',
+                     'replicas': 3}]})))
+        self.assertEqual(rc['operations'], [
+            {'handle': 'h1', 'op': 'create-pool', 'state': 'pending'}])
+        _start_operation.assert_called_once_with(
+            'create-pool', request_id='rq1', pools=['nova'], status=ANY)
+
+        _get_operations.return_value = [
+            {'handle': 'h1', 'op': 'create-pool', 'state': 'complete'}]
+        rc = json.loads(charms_ceph.broker.process_requests(json.dumps({
+            'api-version': 1, 'request-id': 'rq2',
+            'ops': [{'op': 'get-operations', 'handles': ['h1']}]})))
+        _update_operations.assert_called_once_with('admin')
+        _get_operations.assert_called_once_with(['h1'])
+        self.assertEqual(rc['operations'][0]['state'], 'complete')
+        self.assertEqual(rc['request-id'], 'rq2')
+
+    @patch.object(charms_ceph.broker, 'log')
+    def test_save_op_stats(self, mock_log):
+        stats = {}
+        self.kv.return_value.get.return_value = stats
+        charms_ceph.broker.save_op_stats([
+            {'op': 'create-pool', 'duration': 0.05, 'commands': [['a']],
+             'exit-code': 0},
+            {'op': 'create-pool', 'duration': 4.5, 'commands': [['a']] * 6,
+             'exit-code': 0},
+            {'op': 'create-pool', 'duration': 400.0, 'commands': [],
+             'exit-code': 1}])
+        self.assertEqual(stats['create-pool']['count'], 3)
+        self.assertEqual(stats['create-pool']['errors'], 1)
+        self.assertEqual(stats['create-pool']['commands'], 7)
+        self.assertEqual(stats['create-pool']['duration'], 404.55)
+        buckets = stats['create-pool']['buckets']
+        self.assertEqual((buckets['0.1'], buckets['5'], buckets['+Inf']),
+                         (1, 1, 1))
+        self.assertEqual(sum(buckets.values()), 3)
+
     @patch.object(charms_ceph.broker, 'log')
     def test_process_requests_missing_api_version(self, mock_log):
         req = json.dumps({'ops': []})
@@ -330,16 +717,14 @@ class CephBrokerTestCase(unittest.TestCase):
                          {'exit-code': 1,
                           'stderr': "Unknown operation 'invalid_op'"})
 
-    @patch.object(charms_ceph.broker, 'get_osds')
     @patch.object(charms_ceph.broker, 'ReplicatedPool')
     @patch.object(charms_ceph.broker, 'pool_exists')
     @patch.object(charms_ceph.broker, 'log')
     def test_process_requests_create_pool_w_pg_num(self, mock_log,
                                                    mock_pool_exists,
-                                                   mock_replicated_pool,
-                                                   mock_get_osds):
+                                                   mock_replicated_pool):
         mock_pool_exists.return_value = False
-        mock_get_osds.return_value = [0, 1, 2]
+        self.get_budgeted_pg_num.return_value = 64
         op = {
             'op': 'create-pool',
             'name': 'foo',
@@ -349,10 +734,243 @@ class CephBrokerTestCase(unittest.TestCase):
         reqs = json.dumps({'api-version': 1,
                            'ops': [op]})
         rc = charms_ceph.broker.process_requests(reqs)
-        mock_replicated_pool.assert_called_with(service='admin', op=op)
+        self.assertEqual(self.get_budgeted_pg_num.call_args[0][2], 3)
+        mock_replicated_pool.assert_called_with(
+            service='admin', op=dict(op, pg_num=64))
         mock_pool_exists.assert_called_with(service='admin', name='foo')
         self.assertEqual(json.loads(rc), {'exit-code': 0})
 
+    @patch.object(charms_ceph.broker, 'update_pool')
+    @patch.object(charms_ceph.broker, 'erasure_profile_exists')
+    @patch.object(charms_ceph.broker, 'ErasurePool')
+    @patch.object(charms_ceph.broker, 'ReplicatedPool')
+    @patch.object(charms_ceph.broker, 'pool_exists')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_create_pool_pg_options(
+            self, mock_log, mock_pool_exists, mock_replicated_pool,
+            mock_erasure_pool, mock_profile_exists, mock_update_pool):
+        mock_pool_exists.return_value = False
+        mock_replicated_pool.return_value.name = 'foo'
+        mock_erasure_pool.return_value.name = 'bar'
+        reqs = json.dumps({'api-version': 1, 'ops': [
+            {'op': 'create-pool', 'name': 'foo', 'replicas': 3,
+             'bulk': True, 'pg-num-min': 16, 'pg-autoscale-mode': 'warn'},
+            {'op': 'create-pool', 'pool-type': 'erasure', 'name': 'bar',
+             'erasure-profile': 'default', 'bulk': False},
+            {'op': 'create-pool', 'name': 'baz', 'replicas': 3}]})
+        rc = json.loads(charms_ceph.broker.process_requests(reqs))
+        self.assertEqual(rc, {'exit-code': 0})
+        self.assertEqual(mock_update_pool.call_args_list, [
+            call('admin', 'foo', {'pg_autoscale_mode': 'warn',
+                                  'pg_num_min': '16',
+                                  'bulk': 'true'}),
+            call('admin', 'bar', {'bulk': 'false'})])
+
+        # Existing pools are left alone
+        mock_update_pool.reset_mock()
+        mock_pool_exists.return_value = True
+        charms_ceph.broker.process_requests(json.dumps({
+            'api-version': 1, 'ops': [
+                {'op': 'create-pool', 'name': 'foo', 'replicas': 3,
+                 'bulk': True}]}))
+        mock_update_pool.assert_not_called()
+
+    @patch.object(charms_ceph.broker, 'validate_pg_budget_keys')
+    @patch.object(charms_ceph.broker, 'ReplicatedPool')
+    @patch.object(charms_ceph.broker, 'pool_exists')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_create_pool_invalid_budget_key(
+            self, mock_log, mock_pool_exists, mock_replicated_pool,
+            mock_validate):
+        mock_validate.side_effect = ValueError(
+            "'pg-autoscale-mode': sometimes is not in the list")
+        reqs = json.dumps({'api-version': 1,
+                           'ops': [{'op': 'create-pool',
+                                    'name': 'foo',
+                                    'replicas': 3,
+                                    'pg-autoscale-mode': 'sometimes'}]})
+        rc = json.loads(charms_ceph.broker.process_requests(reqs))
+        self.assertEqual(rc['exit-code'], 1)
+        self.assertIn("'pg-autoscale-mode'", rc['stderr'])
+        mock_replicated_pool.assert_not_called()
+
+    def _pool_detail(self, name, **kwargs):
+        detail = {'pool_name': name, 'size': 3, 'pg_num': 32,
+                  'quota_max_bytes': 0, 'quota_max_objects': 0,
+                  'application_metadata': {'rbd': {}}, 'options': {}}
+        detail.update(kwargs)
+        return detail
+
+    @patch.object(charms_ceph.broker, 'set_app_name_for_pool')
+    @patch.object(charms_ceph.broker, 'set_pool_quota')
+    @patch.object(charms_ceph.broker, 'update_pool')
+    @patch.object(charms_ceph.broker, 'ReplicatedPool')
+    @patch.object(charms_ceph.broker, 'pool_exists')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_create_pools_unchanged(
+            self, mock_log, mock_pool_exists, mock_replicated_pool,
+            mock_update_pool, mock_set_pool_quota, mock_set_app_name):
+        names = ['pool{}'.format(i) for i in range(30)]
+        self.get_pool_details.side_effect = None
+        self.get_pool_details.return_value = {
+            name: self._pool_detail(
+                name, quota_max_bytes=1024,
+                options={'compression_mode': 'aggressive',
+                         'compression_required_ratio': 0.875})
+            for name in names}
+        mock_replicated_pool.side_effect = (
+            lambda service, op: MagicMock(op=op))
+        ops = [{'op': 'create-pool', 'name': name, 'replicas': 3,
+                'app-name': 'rbd', 'max-bytes': 1024,
+                'compression-mode': 'aggressive',
+                'compression-required-ratio': 0.875} for name in names]
+        rc = charms_ceph.broker.process_requests(
+            json.dumps({'api-version': 1, 'ops': ops}))
+        self.assertEqual(json.loads(rc), {'exit-code': 0})
+        self.get_pool_details.assert_called_once_with(client='admin')
+        mock_pool_exists.assert_not_called()
+        self.get_budgeted_pg_num.assert_not_called()
+        mock_update_pool.assert_not_called()
+        mock_set_pool_quota.assert_not_called()
+        mock_set_app_name.assert_not_called()
+        for pool in [c[1]['op'] for c in mock_replicated_pool.call_args_list]:
+            self.assertIn(pool['name'], names)
+
+    @patch.object(charms_ceph.broker, 'key_caps_need_update',
+                  lambda *args, **kwargs: True)
+    @patch.object(charms_ceph.broker, 'check_call')
+    @patch.object(charms_ceph.broker, 'update_pool')
+    @patch.object(charms_ceph.broker, 'ReplicatedPool')
+    @patch.object(charms_ceph.broker, 'monitor_key_set')
+    @patch.object(charms_ceph.broker, 'monitor_key_get')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_plan(self, mock_log, mock_monitor_key_get,
+                                   mock_monitor_key_set,
+                                   mock_replicated_pool, mock_update_pool,
+                                   mock_check_call):
+        mkey = {'cephx.groups.images': '{"pools": [], "services": []}',
+                'cephx.services.glance': None}
+        mock_monitor_key_get.side_effect = lambda service, key: mkey[key]
+        self.get_pool_details.side_effect = None
+        self.get_pool_details.return_value = {
+            'cinder': self._pool_detail('cinder'),
+            'nova': self._pool_detail('nova')}
+        self.get_budgeted_pg_num.return_value = 64
+        ops = [
+            {'op': 'create-pool', 'name': 'cinder', 'replicas': 3},
+            {'op': 'create-pool', 'name': 'nova', 'replicas': 3,
+             'compression-mode': 'aggressive'},
+            {'op': 'create-pool', 'name': 'glance', 'replicas': 3,
+             'group': 'images'},
+            {'op': 'add-permissions-to-key', 'name': 'glance',
+             'group': 'images'},
+            {'op': 'move-osd-to-bucket', 'osd': 'osd.1', 'bucket': 'ssd'},
+            {'op': 'create-cephfs', 'mds_name': 'fs'},
+        ]
+        rc = json.loads(charms_ceph.broker.process_requests(
+            json.dumps({'api-version': 1, 'plan': True, 'ops': ops})))
+        self.assertEqual(rc['exit-code'], 0)
+        self.assertEqual(rc['plan'], [
+            {'action': 'update-pool', 'pool': 'nova',
+             'changes': {'settings': {'compression_mode': 'aggressive'}},
+             'op': 'create-pool', 'op-index': 1},
+            {'action': 'create-pool', 'pool': 'glance', 'pg_num': 64,
+             'new-pgs': 192, 'heavy': True, 'op': 'create-pool',
+             'op-index': 2},
+            {'action': 'move-osd', 'osd': 'osd.1', 'bucket': 'ssd',
+             'heavy': True, 'op': 'move-osd-to-bucket', 'op-index': 4},
+            {'action': 'run-op', 'op': 'create-cephfs', 'op-index': 5},
+            {'action': 'save-group', 'group': 'images'},
+            {'action': 'save-service', 'service': 'glance'},
+            {'action': 'set-key-caps', 'entity': 'client.glance',
+             'caps': ['mon', ('allow r, allow command "osd blacklist"'
+                              ', allow command "osd blocklist"'),
+                      'osd', 'allow rwx pool=glance']},
+        ])
+        mock_monitor_key_set.assert_not_called()
+        mock_replicated_pool.assert_not_called()
+        mock_update_pool.assert_not_called()
+        mock_check_call.assert_not_called()
+
+        rc = json.loads(charms_ceph.broker.process_requests(
+            json.dumps({'api-version': 1, 'plan': True,
+                        'ops': [{'op': 'bogus'}]})))
+        self.assertEqual(rc, {'exit-code': 1,
+                              'stderr': "Unknown operation 'bogus'"})
+
+    @patch.object(charms_ceph.broker, 'pool_set')
+    @patch.object(charms_ceph.broker, 'update_pool')
+    @patch.object(charms_ceph.broker, 'ReplicatedPool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_process_requests_create_pool_after_set_pool_value(
+            self, mock_log, mock_replicated_pool, mock_update_pool,
+            mock_pool_set):
+        self.get_pool_details.side_effect = [
+            {'nova': self._pool_detail(
+                'nova', options={'compression_mode': mode})}
+            for mode in ('aggressive', 'none')]
+
+        def replicated_pool(service, op):
+            pool = MagicMock(op=op)
+            pool.name = op['name']
+            return pool
+
+        mock_replicated_pool.side_effect = replicated_pool
+        create = {'op': 'create-pool', 'name': 'nova', 'replicas': 3,
+                  'compression-mode': 'aggressive'}
+        rc = charms_ceph.broker.process_requests(json.dumps({
+            'api-version': 1, 'ops': [
+                create,
+                {'op': 'set-pool-value', 'name': 'nova',
+                 'key': 'compression_mode', 'value': 'none'},
+                create]}))
+        self.assertEqual(json.loads(rc), {'exit-code': 0})
+        mock_pool_set.assert_called_once_with(
+            service='admin', pool_name='nova', key='compression_mode',
+            value='none')
+        # The pools are read again after set-pool-value, so the second
+        # create-pool restores the compression mode
+        self.assertEqual(self.get_pool_details.call_count, 2)
+        mock_update_pool.assert_called_once_with(
+            'admin', 'nova', {'compression_mode': 'aggressive'})
+
+    @patch.object(charms_ceph.broker, 'set_app_name_for_pool')
+    @patch.object(charms_ceph.broker, 'set_pool_quota')
+    @patch.object(charms_ceph.broker, 'update_pool')
+    @patch.object(charms_ceph.broker, 'log')
+    def test_pool_state_reconcile(self, mock_log, mock_update_pool,
+                                  mock_set_pool_quota, mock_set_app_name):
+        self.get_pool_details.side_effect = None
+        self.get_pool_details.return_value = {
+            'foo': self._pool_detail(
+                'foo', quota_max_objects=10,
+                options={'compression_mode': 'passive'})}
+        state = charms_ceph.broker.PoolState('admin')
+        pool = MagicMock(op={'name': 'foo', 'max-objects': 10,
+                             'max-bytes': 2048,
+                             'compression-mode': 'aggressive',
+                             'compression-algorithm': 'lz4',
+                             'app-name': 'cephfs'})
+        pool.name = 'foo'
+        self.assertEqual(state.reconcile(pool), {
+            'quota': {'max_bytes': 2048},
+            'settings': {'compression_mode': 'aggressive',
+                         'compression_algorithm': 'lz4'},
+            'application': 'cephfs'})
+        pool.validate.assert_called_once_with()
+        pool.update.assert_not_called()
+        mock_set_pool_quota.assert_called_once_with(
+            service='admin', pool_name='foo', max_bytes=2048,
+            max_objects=None)
+        mock_update_pool.assert_called_once_with(
+            'admin', 'foo', {'compression_mode': 'aggressive',
+                             'compression_algorithm': 'lz4'})
+        mock_set_app_name.assert_called_once_with(
+            client='admin', pool='foo', name='cephfs')
+        # The pools are read again after a change
+        state.exists('foo')
+        self.assertEqual(self.get_pool_details.call_count, 2)
+
     @patch.object(charms_ceph.broker, 'ReplicatedPool')
     @patch.object(charms_ceph.broker, 'pool_exists')
     @patch.object(charms_ceph.broker, 'log')
@@ -665,16 +1283,16 @@ class CephBrokerTestCase(unittest.TestCase):
                                            mock_save_service):
         mkey = {
             'cephx.services.glance': ('{"groups": {}, '
-                                      '"group_names": {"rwx": ["images"]}}'),
-            'cephx.groups.images': ('{"services": ["glance", "cinder-ceph", '
+                                      '"group_names": {}}'),
+            'cephx.groups.images': ('{"services": ["cinder-ceph", '
                                     '"nova-compute"], "pools": ["glance"]}')}
         mock_monitor_key_get.side_effect = lambda service, key: mkey[key]
         expect_service_name = u'glance'
         expected_group = {
             u'services': [
-                u'glance',
                 u'cinder-ceph',
-                u'nova-compute'],
+                u'nova-compute',
+                u'glance'],
             u'pools': [u'glance']}
         expect_service_obj = {
             u'groups': {
@@ -741,9 +1359,7 @@ class CephBrokerTestCase(unittest.TestCase):
                     u'rwx': [u'rbd_children'], u'r': ['another']},
                 u'op': u'add-permissions-to-key'},
             service='admin')
-        mock_save_group.assert_called_once_with(
-            group=expected_group,
-            group_name='images')
+        mock_save_group.assert_not_called()
         mock_save_service.assert_called_once_with(
             service=expect_service_obj,
             service_name=expect_service_name)
@@ -865,9 +1481,14 @@ class CephBrokerTestCase(unittest.TestCase):
         )
         mock_create_erasure_profile.assert_not_called()
 
+    @patch.object(charms_ceph.utils.subprocess, 'check_output')
     @patch.object(charms_ceph.broker, 'check_output')
     @patch.object(charms_ceph.broker, 'log')
-    def test_create_cephfs_client(self, mock_log, check_output):
+    def test_create_cephfs_client(self, mock_log, check_output,
+                                  utils_check_output):
+        charms_ceph.keys._auth_snapshots.clear()
+        self.addCleanup(charms_ceph.keys._auth_snapshots.clear)
+
         def mock_check_output(*args, **kwargs):
             cmd = args[0]
             if cmd[:5] == ["ceph", "--id", "admin", "auth", "ls"]:
@@ -930,6 +1551,8 @@ class CephBrokerTestCase(unittest.TestCase):
             return unittest.mock.DEFAULT
 
         check_output.side_effect = mock_check_output
+        utils_check_output.side_effect = (
+            lambda cmd, **kwargs: mock_check_output(cmd).encode('UTF-8'))
         reqs = json.dumps({'api-version': 1,
                            'request-id': '1ef5aede',
                            'ops': [{
@@ -957,3 +1580,74 @@ class CephBrokerTestCase(unittest.TestCase):
         self.assertEqual(rc['exit-code'], 0)
         self.assertEqual(rc['request-id'], 'aabbccdd')
         self.assertEqual(rc['key'], 'other-client-key')
+        # auth ls is only run once
+        utils_check_output.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'auth', 'ls', '-f', 'json'])
+
+
+class CephxStoreTestCase(unittest.TestCase):
+
+    KEYS = {
+        'cephx.groups.images': json.dumps({"pools": ["glance", "cinder"],
+                                           "services": ["nova", "glance"]}),
+        'cephx.groups.vms': json.dumps({"pools": ["nova"],
+                                        "services": ["nova"]}),
+        'cephx.services.nova': json.dumps({"group_names": {
+            "rwx": ["images", "vms"]}, "groups": {}}),
+        'cephx.services.glance': json.dumps({"group_names": {
+            "rwx": ["images"]}, "groups": {}}),
+        'mgr/dashboard/key': 'unrelated',
+    }
+
+    @patch.object(charms_ceph.broker, 'check_output')
+    def test_get_cephx_keys(self, _check_output):
+        _check_output.return_value = json.dumps(self.KEYS).encode('UTF-8')
+        keys = charms_ceph.broker.get_cephx_keys()
+        self.assertNotIn('mgr/dashboard/key', keys)
+        self.assertEqual(len(keys), 4)
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'config-key', 'dump', 'cephx.'])
+        _check_output.side_effect = charms_ceph.broker.CalledProcessError(
+            1, 'ceph')
+        self.assertIsNone(charms_ceph.broker.get_cephx_keys())
+
+    @patch.object(charms_ceph.broker, 'monitor_key_set')
+    @patch.object(charms_ceph.broker, 'monitor_key_get')
+    @patch.object(charms_ceph.broker, 'get_cephx_keys')
+    def test_store(self, _get_cephx_keys, _monitor_key_get,
+                   _monitor_key_set):
+        _get_cephx_keys.return_value = dict(self.KEYS)
+        store = charms_ceph.broker.CephxStore()
+        self.assertEqual(store.group('images')['pools'], ['glance', 'cinder'])
+        self.assertEqual(store.service('missing'),
+                         {'group_names': {}, 'groups': {}})
+
+        # Unchanged documents are not written
+        store.save_group('images', store.group('images'))
+        store.save_service('nova', store.service('nova'))
+        _monitor_key_set.assert_not_called()
+
+        group = store.group('vms')
+        group['pools'].append('ephemeral')
+        store.save_group('vms', group)
+        store.save_group('vms', group)
+        _monitor_key_set.assert_called_once_with(
+            service='admin', key='cephx.groups.vms',
+            value=json.dumps({"pools": ["nova", "ephemeral"],
+                              "services": ["nova"]}, sort_keys=True))
+        _monitor_key_get.assert_not_called()
+
+    @patch.object(charms_ceph.broker, 'monitor_key_set')
+    @patch.object(charms_ceph.broker, 'monitor_key_get')
+    @patch.object(charms_ceph.broker, 'get_cephx_keys')
+    def test_store_without_dump(self, _get_cephx_keys, _monitor_key_get,
+                                _monitor_key_set):
+        _get_cephx_keys.return_value = None
+        _monitor_key_get.side_effect = lambda service, key: self.KEYS.get(key)
+        store = charms_ceph.broker.CephxStore()
+        self.assertEqual(store.group('images')['pools'], ['glance', 'cinder'])
+        store.group('images')
+        _monitor_key_get.assert_called_once_with(
+            service='admin', key='cephx.groups.images')
+        store.save_group('images', store.group('images'))
+        self.assertEqual(_monitor_key_set.call_count, 1)
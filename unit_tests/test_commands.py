@@ -0,0 +1,132 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import unittest
+
+from unittest.mock import patch
+
+import charms_ceph.commands
+
+
+class CommandsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(CommandsTestCase, self).setUp()
+        self.log = patch.object(charms_ceph.commands, 'log').start()
+        self.addCleanup(patch.stopall)
+        self.addCleanup(charms_ceph.commands.disable)
+        charms_ceph.commands.reset()
+
+    def test_command_name(self):
+        name = charms_ceph.commands.command_name
+        self.assertEqual(
+            name(['sudo', '-u', 'ceph', '/usr/bin/ceph', '--id', 'admin',
+                  'osd', 'pool', 'create', 'rbd', '32']),
+            'ceph osd pool create')
+        self.assertEqual(name(['ceph', 'osd', 'tree', '--format=json']),
+                         'ceph osd tree')
+        self.assertEqual(name('lsblk -J'), 'lsblk')
+
+    def test_disabled(self):
+        self.assertIs(subprocess.Popen, charms_ceph.commands._popen)
+        subprocess.check_call(['true'])
+        self.assertEqual(charms_ceph.commands.get_summary()['count'], 0)
+
+    def test_summary(self):
+        charms_ceph.commands.enable()
+        self.assertIs(subprocess.Popen,
+                      charms_ceph.commands.InstrumentedPopen)
+        subprocess.check_output(['echo', 'hello'])
+        subprocess.check_output(['echo', 'hello'])
+        subprocess.call(['false'])
+        with self.assertRaises(OSError):
+            subprocess.call(['/nonexistent/command'])
+        charms_ceph.commands.disable()
+        self.assertIs(subprocess.Popen, charms_ceph.commands._popen)
+        subprocess.call(['true'])
+
+        summary = charms_ceph.commands.get_summary()
+        self.assertEqual(summary['count'], 4)
+        self.assertEqual(summary['failed'], 2)
+        self.assertEqual(summary['output-bytes'], 12)
+        commands = {entry['command']: entry
+                    for entry in summary['commands']}
+        self.assertEqual(set(commands), {'echo hello', 'false', 'command'})
+        self.assertEqual(commands['echo hello']['count'], 2)
+        self.assertEqual(commands['echo hello']['failed'], 0)
+        self.assertEqual(commands['false']['failed'], 1)
+        self.assertEqual(
+            len(charms_ceph.commands.get_summary(top=1)['commands']), 1)
+
+    def test_recording(self):
+        with charms_ceph.commands.recording() as records:
+            subprocess.check_output(['echo', 'hello'])
+        self.assertIs(subprocess.Popen, charms_ceph.commands._popen)
+        self.assertEqual(len(records), 1)
+        self.assertEqual(records[0]['argv'], ['echo', 'hello'])
+        self.assertEqual(records[0]['exit-code'], 0)
+        self.assertEqual(records[0]['output-bytes'], 6)
+        # Recording alone does not collect stats
+        self.assertEqual(charms_ceph.commands.get_summary()['count'], 0)
+
+    def test_recording_threads(self):
+        started = threading.Event()
+        release = threading.Event()
+        other = []
+
+        def record_other():
+            with charms_ceph.commands.recording() as records:
+                other.append(records)
+                started.set()
+                release.wait(10)
+                subprocess.check_call(['echo', 'other'],
+                                      stdout=subprocess.DEVNULL)
+
+        thread = threading.Thread(target=record_other)
+        thread.start()
+        started.wait(10)
+        with charms_ceph.commands.recording() as records:
+            release.set()
+            subprocess.check_call(['echo', 'mine'],
+                                  stdout=subprocess.DEVNULL)
+            thread.join(10)
+        self.assertEqual([record['argv'] for record in records],
+                         [['echo', 'mine']])
+        self.assertEqual([record['argv'] for record in other[0]],
+                         [['echo', 'other']])
+        self.assertIs(subprocess.Popen, charms_ceph.commands._popen)
+
+    def test_instrument_hook_log(self):
+        with charms_ceph.commands.instrument_hook():
+            subprocess.check_call(['true'])
+        self.assertFalse(charms_ceph.commands.is_enabled())
+        message = self.log.call_args[0][0]
+        self.assertTrue(message.startswith('External commands: '))
+        summary = json.loads(message[len('External commands: '):])
+        self.assertEqual(summary['commands'][0]['command'], 'true')
+
+    def test_instrument_hook_file(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            path = os.path.join(tmpdir, 'stats.json')
+            with charms_ceph.commands.instrument_hook(path):
+                subprocess.check_call(['true'])
+            with open(path) as f:
+                summary = json.load(f)
+        self.assertEqual(summary['count'], 1)
+        self.log.assert_not_called()
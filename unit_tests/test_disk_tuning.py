@@ -12,10 +12,14 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import json
+import os
+import tempfile
 import unittest
 
 from unittest.mock import patch
 
+import charms_ceph.tuning
 import charms_ceph.utils
 
 
@@ -23,9 +27,13 @@ class DiskTuningTestCase(unittest.TestCase):
     def setUp(self):
         super(DiskTuningTestCase, self).setUp()
 
-    @patch.object(charms_ceph.utils, 'templating')
+    @patch.object(charms_ceph.tuning, 'templating')
     def test_persist_settings(self, _templating):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        hdparm_file = os.path.join(tmpdir.name, 'hdparm.conf')
         renderer = _templating.render
+        renderer.return_value = 'rendered\n'
         settings = {
             'drive_settings': {
                 'some-random-uuid': {
@@ -33,13 +41,200 @@ class DiskTuningTestCase(unittest.TestCase):
                 }
             }
         }
-        charms_ceph.utils.persist_settings(settings)
-        renderer.assert_called_once_with(source='hdparm.conf',
-                                         target=charms_ceph.utils.HDPARM_FILE,
-                                         context=settings)
+        with patch.object(charms_ceph.tuning, 'HDPARM_FILE', hdparm_file):
+            self.assertTrue(charms_ceph.tuning.persist_settings(settings))
+            renderer.assert_called_once_with(source='hdparm.conf',
+                                             target=None,
+                                             context=settings)
+            with open(hdparm_file) as f:
+                self.assertEqual(f.read(), 'rendered\n')
+            # same content on disk, the file is left alone
+            self.assertFalse(charms_ceph.tuning.persist_settings(settings))
+            # a file edited behind our back is rewritten
+            with open(hdparm_file, 'w') as f:
+                f.write('edited\n')
+            self.assertTrue(charms_ceph.tuning.persist_settings(settings))
+            with open(hdparm_file) as f:
+                self.assertEqual(f.read(), 'rendered\n')
 
-    @patch.object(charms_ceph.utils, 'templating')
+    @patch.object(charms_ceph.tuning, 'templating')
     def test_persist_settings_empty_dict(self, _templating):
         renderer = _templating.render
-        charms_ceph.utils.persist_settings({})
+        charms_ceph.tuning.persist_settings({})
         assert not renderer.called, 'renderer should not have been called'
+
+
+class DeviceTuningProfileTestCase(unittest.TestCase):
+
+    QUEUES = {
+        'sda': {
+            'rotational': '1',
+            'scheduler': '[mq-deadline] none',
+            'nr_requests': '64',
+            'rq_affinity': '1',
+            'read_ahead_kb': '128',
+            'wbt_lat_usec': '75000',
+        },
+        'sdb': {
+            'rotational': '0',
+            'scheduler': 'mq-deadline [none]',
+            'nr_requests': '64',
+            'rq_affinity': '1',
+            'read_ahead_kb': '128',
+            'wbt_lat_usec': '2000',
+        },
+        'nvme0n1': {
+            'rotational': '0',
+            'scheduler': '[none] mq-deadline',
+            'nr_requests': '1023',
+            'rq_affinity': '1',
+            'read_ahead_kb': '128',
+        },
+    }
+
+    def setUp(self):
+        super(DeviceTuningProfileTestCase, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        for dev, queue in self.QUEUES.items():
+            os.makedirs(os.path.join(self.tmpdir.name, dev, 'queue'))
+            for key, value in queue.items():
+                with open(self._path(dev, key), 'w') as f:
+                    f.write(value + '\n')
+        patcher = patch.object(charms_ceph.tuning, 'SYS_BLOCK',
+                               self.tmpdir.name)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        patcher = patch.object(charms_ceph.tuning, 'hookenv')
+        self.hookenv = patcher.start()
+        self.hookenv.config.return_value = None
+        self.addCleanup(patcher.stop)
+
+    def _path(self, dev, key):
+        return os.path.join(self.tmpdir.name, dev, 'queue', key)
+
+    def _read(self, dev, key):
+        with open(self._path(dev, key)) as f:
+            return f.read().strip()
+
+    def test_get_device_class(self):
+        self.assertEqual(charms_ceph.tuning.get_device_class('sda'), 'hdd')
+        self.assertEqual(charms_ceph.tuning.get_device_class('sdb'), 'ssd')
+        self.assertEqual(charms_ceph.tuning.get_device_class('nvme0n1'),
+                         'nvme')
+        self.assertIsNone(charms_ceph.tuning.get_device_class('sdz'))
+
+    def test_get_device_tuning_profile_override(self):
+        self.hookenv.config.return_value = json.dumps(
+            {'nvme': {'read_ahead_kb': 256}})
+        profile = charms_ceph.tuning.get_device_tuning_profile('nvme')
+        self.assertEqual(profile['read_ahead_kb'], 256)
+        self.assertEqual(profile['scheduler'], 'none')
+        self.assertEqual(
+            charms_ceph.tuning.DEVICE_TUNING_PROFILES['nvme']['read_ahead_kb'],
+            16)
+
+    def test_get_device_tuning_profile_bad_override(self):
+        self.hookenv.config.return_value = 'not json'
+        self.assertEqual(
+            charms_ceph.tuning.get_device_tuning_profile('hdd'),
+            charms_ceph.tuning.DEVICE_TUNING_PROFILES['hdd'])
+
+    def test_apply_device_tuning_profile(self):
+        changed = charms_ceph.tuning.apply_device_tuning_profile(
+            'sdb', charms_ceph.tuning.get_device_tuning_profile('ssd'))
+        self.assertEqual(changed, {
+            'scheduler': 'mq-deadline',
+            'nr_requests': 256,
+            'rq_affinity': 2,
+            'read_ahead_kb': 16,
+        })
+        self.assertEqual(self._read('sdb', 'scheduler'), 'mq-deadline')
+        self.assertEqual(self._read('sdb', 'nr_requests'), '256')
+
+    def test_apply_device_tuning_profile_unavailable(self):
+        changed = charms_ceph.tuning.apply_device_tuning_profile(
+            'nvme0n1', {'scheduler': 'kyber', 'wbt_lat_usec': 0,
+                        'rq_affinity': 2})
+        # kyber is not offered and wbt_lat_usec is not exposed
+        self.assertEqual(changed, {'rq_affinity': 2})
+
+    def _patch_persistence(self):
+        store = {}
+        kv = patch.object(charms_ceph.tuning, 'kv').start()
+        kv.return_value.get.side_effect = lambda k, d=None: store.get(k, d)
+        kv.return_value.set.side_effect = store.__setitem__
+        self.addCleanup(patch.stopall)
+        self.rules_file = os.path.join(self.tmpdir.name, 'tuning.rules')
+        patch.object(charms_ceph.tuning, 'UDEV_TUNING_RULES_FILE',
+                     self.rules_file).start()
+        patch.object(charms_ceph.tuning, 'HDPARM_FILE',
+                     os.path.join(self.tmpdir.name, 'hdparm.conf')).start()
+        return store
+
+    @patch.object(charms_ceph.tuning, 'persist_settings')
+    @patch.object(charms_ceph.tuning, 'check_max_sectors')
+    @patch.object(charms_ceph.tuning, 'get_block_uuids')
+    @patch.object(charms_ceph.tuning, 'status_set')
+    def test_tune_devs(self, _status_set, _get_block_uuids,
+                       _check_max_sectors, _persist_settings):
+        store = self._patch_persistence()
+        _get_block_uuids.return_value = {'/dev/sda': 'uuid-a',
+                                         '/dev/nvme0n1': 'uuid-n'}
+        charms_ceph.tuning.tune_devs(['/dev/sda', '/dev/nvme0n1', '/dev/sdz'])
+        _get_block_uuids.assert_called_once_with()
+        self.assertEqual(self._read('sda', 'nr_requests'), '256')
+        self.assertEqual(self._read('nvme0n1', 'rq_affinity'), '2')
+        _persist_settings.assert_called_once_with(settings_dict={
+            'drive_settings': {'uuid-a': {'read_ahead_sect': 256}}})
+        with open(self.rules_file) as f:
+            rules = f.read().splitlines()
+        self.assertEqual(len(rules), 3)
+        self.assertIn('ENV{ID_FS_UUID}=="uuid-a"', rules[1])
+        self.assertIn('ATTR{queue/scheduler}="mq-deadline"', rules[1])
+        self.assertIn('ENV{ID_FS_UUID}=="uuid-n"', rules[2])
+        self.assertIn('ATTR{queue/scheduler}="none"', rules[2])
+        self.assertNotIn('nr_requests', rules[2])
+        self.assertEqual(sorted(store['device-tuning']['queue_settings']),
+                         ['uuid-a', 'uuid-n'])
+
+    @patch.object(charms_ceph.tuning, 'templating')
+    @patch.object(charms_ceph.tuning, 'check_max_sectors')
+    @patch.object(charms_ceph.tuning, 'get_block_uuids')
+    @patch.object(charms_ceph.tuning, 'status_set')
+    def test_tune_dev_merges_persisted(self, _status_set, _get_block_uuids,
+                                       _check_max_sectors, _templating):
+        self._patch_persistence()
+        _templating.render.side_effect = (
+            lambda source, target, context: json.dumps(context,
+                                                       sort_keys=True))
+        _get_block_uuids.return_value = {'/dev/sda': 'uuid-a',
+                                         '/dev/sdb': 'uuid-b'}
+        charms_ceph.tuning.tune_dev('/dev/sda')
+        with open(charms_ceph.tuning.HDPARM_FILE) as f:
+            hdparm = f.read()
+        self.assertEqual(json.loads(hdparm), {
+            'drive_settings': {'uuid-a': {'read_ahead_sect': 256}}})
+        # hdparm.conf was changed on disk, the rendered content is restored
+        open(charms_ceph.tuning.HDPARM_FILE, 'w').close()
+        charms_ceph.tuning.tune_dev('/dev/sda')
+        with open(charms_ceph.tuning.HDPARM_FILE) as f:
+            self.assertEqual(f.read(), hdparm)
+        charms_ceph.tuning.tune_dev('/dev/sdb')
+        with open(charms_ceph.tuning.HDPARM_FILE) as f:
+            self.assertEqual(f.read(), hdparm)
+        with open(self.rules_file) as f:
+            rules = f.read()
+        self.assertIn('uuid-a', rules)
+        self.assertIn('uuid-b', rules)
+
+    @patch.object(charms_ceph.tuning, 'subprocess')
+    def test_get_block_uuids(self, _subprocess):
+        _subprocess.check_output.return_value = (
+            b'DEVNAME=/dev/sda\nUUID=uuid-a\nTYPE=LVM2_member\n\n'
+            b'DEVNAME=/dev/sdb\nTYPE=other\n\n'
+            b'DEVNAME=/dev/sdc1\nUUID=uuid-c\n')
+        self.assertEqual(charms_ceph.tuning.get_block_uuids(),
+                         {'/dev/sda': 'uuid-a', '/dev/sdc1': 'uuid-c'})
+        _subprocess.check_output.assert_called_once_with(
+            ['blkid', '-o', 'export'])
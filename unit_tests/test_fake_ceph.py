@@ -0,0 +1,272 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import concurrent.futures
+import json
+import os
+import subprocess
+import tempfile
+import threading
+import time
+import unittest
+
+import charms_ceph.broker
+import charms_ceph.keys
+import charms_ceph.operations
+import charms_ceph.pg_budget
+import charms_ceph.pools
+import charms_ceph.upgrade
+import charms_ceph.utils
+
+from unittest.mock import patch
+
+from unit_tests.fake_ceph import FakeCeph, patch_charmhelpers
+
+
+class FakeCephTestCase(unittest.TestCase):
+    """Run the real helpers against the fake CLIs."""
+
+    def setUp(self):
+        super(FakeCephTestCase, self).setUp()
+        self.fake = FakeCeph.cluster(hosts=4, osds_per_host=2)
+        patch.object(charms_ceph.pools, 'log').start()
+        patch.object(charms_ceph.utils, 'log').start()
+        self.addCleanup(patch.stopall)
+
+    def test_osd_tree(self):
+        with self.fake.patch():
+            hosts = charms_ceph.utils.get_osd_tree('admin')
+        self.assertEqual([host.name for host in hosts],
+                         ['host0', 'host1', 'host2', 'host3'])
+        self.assertEqual(hosts[0].root, 'default')
+
+    def test_pools(self):
+        with self.fake.patch():
+            subprocess.check_call(['ceph', '--id', 'admin', 'osd', 'pool',
+                                   'create', 'rbd', '64'])
+            subprocess.check_call(['ceph', '--id', 'admin', 'osd', 'pool',
+                                   'set', 'rbd', 'compression_mode',
+                                   'aggressive'])
+            details = charms_ceph.pools.get_pool_details()
+            self.assertEqual(charms_ceph.pools.list_pools(), ['rbd'])
+            self.assertEqual(charms_ceph.pools.get_pool_param('rbd', 'size'),
+                             '3')
+            self.assertIsNone(
+                charms_ceph.pools.get_pool_erasure_profile('rbd'))
+            pg_states = charms_ceph.operations.get_pg_states()
+        self.assertEqual(details['rbd']['pg_num'], 64)
+        self.assertEqual(details['rbd']['options'],
+                         {'compression_mode': 'aggressive'})
+        self.assertEqual(pg_states[1]['active+clean'], 64)
+
+    def test_config_key_and_auth(self):
+        with self.fake.patch():
+            subprocess.check_call(['ceph', 'config-key', 'set',
+                                   'cephx.groups.images', '{"pools": []}'])
+            subprocess.check_call(['ceph', 'config-key', 'set', 'other',
+                                   'value'])
+            keys = charms_ceph.broker.get_cephx_keys()
+            with self.assertRaises(subprocess.CalledProcessError) as e:
+                subprocess.check_call(['ceph', 'config-key', 'exists',
+                                       'missing'])
+            keyring = subprocess.check_output(
+                ['sudo', '-u', 'ceph', 'ceph', 'auth', 'get-or-create',
+                 'client.glance', 'mon', 'allow r']).decode('UTF-8')
+            subprocess.check_call(['ceph', 'auth', 'caps', 'client.glance',
+                                   'mon', 'allow r', 'osd', 'allow rwx'])
+            auth = json.loads(subprocess.check_output(
+                ['ceph', 'auth', 'get', 'client.glance', '-f', 'json']))
+        self.assertEqual(keys, {'cephx.groups.images': '{"pools": []}'})
+        self.assertEqual(e.exception.returncode, 2)
+        self.assertTrue(keyring.startswith('[client.glance]\n\tkey = '))
+        self.assertEqual(auth[0]['caps'],
+                         {'mon': 'allow r', 'osd': 'allow rwx'})
+
+    def test_crushmap_round_trip(self):
+        with self.fake.patch():
+            compiled = subprocess.check_output(['ceph', 'osd',
+                                                'getcrushmap'])
+            text = subprocess.check_output(['crushtool', '-d', '-'],
+                                           input=compiled).decode('UTF-8')
+            text += 'root ssd {\n    id -20\n}\n'
+            compiled = subprocess.check_output(
+                ['crushtool', '-c', '/dev/stdin', '-o', '/dev/stdout'],
+                input=text.encode('UTF-8'))
+            subprocess.check_output(['ceph', 'osd', 'setcrushmap', '-i',
+                                     '/dev/stdin'], input=compiled)
+            decompiled = subprocess.check_output(
+                ['crushtool', '-d', '-'],
+                input=subprocess.check_output(['ceph', 'osd', 'getcrushmap']))
+        self.assertIn('host host3 {', text)
+        self.assertIn('item osd.7 weight 1.000', text)
+        self.assertTrue(decompiled.decode('UTF-8').endswith(
+            'root ssd {\n    id -20\n}\n'))
+
+    def test_failure_injection(self):
+        self.fake.fail('ceph osd tree')
+        with self.fake.patch():
+            with self.assertRaises(subprocess.CalledProcessError):
+                charms_ceph.utils.get_osd_tree('admin')
+            self.assertEqual(len(charms_ceph.utils.get_osd_tree('admin')), 4)
+        self.fake.fail('ceph config-key', count=None, returncode=110,
+                       stderr='Error ETIMEDOUT')
+        self.assertEqual(self.fake.run(['ceph', 'config-key', 'ls']),
+                         (110, b'', b'Error ETIMEDOUT\n'))
+        self.assertEqual(self.fake.run(['ceph', 'config-key', 'ls'])[0], 110)
+
+    def test_latency(self):
+        self.fake.set_latency('', 0.0)
+        self.fake.set_latency('ceph osd', 0.05)
+        self.fake.set_latency('ceph osd pool', 0.0)
+        self.assertEqual(self.fake.latency(['ceph', '--id', 'admin', 'osd',
+                                            'tree']), 0.05)
+        self.assertEqual(self.fake.latency(['ceph', 'osd', 'pool', 'ls']),
+                         0.0)
+        start = time.time()
+        self.fake.run(['ceph', 'osd', 'tree', '--format=json'])
+        self.assertGreaterEqual(time.time() - start, 0.05)
+
+    def test_unknown_command(self):
+        returncode, _, stderr = self.fake.run(['ceph', 'osd', 'frobnicate'])
+        self.assertEqual(returncode, 22)
+        self.assertIn(b'no valid command found', stderr)
+
+    def test_shims(self):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = self.fake.install(os.path.join(tmpdir, 'bin'),
+                                    os.path.join(tmpdir, 'state.json'))
+            subprocess.check_call(['ceph', 'osd', 'pool', 'create', 'rbd'],
+                                  env=env, stdout=subprocess.DEVNULL)
+            pools = subprocess.check_output(['rados', 'lspools'], env=env)
+            fake = FakeCeph.load(env['FAKE_CEPH_STATE'])
+        self.assertEqual(pools, b'rbd\n')
+        self.assertIn('rbd', fake.state['pools'])
+
+
+def storm_request(unit):
+    """Broker request sent by every unit of glance."""
+    return json.dumps({
+        'api-version': 1, 'request-id': 'glance-{}'.format(unit),
+        'ops': [
+            {'op': 'create-pool', 'name': 'glance', 'replicas': 3,
+             'group': 'images', 'app-name': 'rbd'},
+            {'op': 'create-pool', 'name': 'glance-cache', 'replicas': 2,
+             'app-name': 'rbd', 'compression-mode': 'aggressive'},
+            {'op': 'add-permissions-to-key', 'name': 'glance',
+             'group': 'images'},
+        ]})
+
+
+class FakeCephScenarioTestCase(unittest.TestCase):
+    """Run the broker and the upgrade code from end to end."""
+
+    def setUp(self):
+        super(FakeCephScenarioTestCase, self).setUp()
+        for module in (charms_ceph.broker, charms_ceph.keys,
+                       charms_ceph.operations, charms_ceph.pg_budget,
+                       charms_ceph.pools, charms_ceph.upgrade,
+                       charms_ceph.utils):
+            patch.object(module, 'log').start()
+        patch.object(charms_ceph.pg_budget, 'config',
+                     lambda key: None).start()
+        self.addCleanup(patch.stopall)
+
+    def _storm(self, process):
+        fake = FakeCeph.cluster(hosts=4, osds_per_host=2)
+        fake.run(['ceph', 'auth', 'get-or-create', 'client.glance',
+                  'mon', 'allow r'])
+        with fake.patch(), patch_charmhelpers(charms_ceph.broker,
+                                              charms_ceph.operations,
+                                              charms_ceph.pg_budget):
+            responses = process([storm_request(unit)
+                                 for unit in range(20)])
+        for unit, response in enumerate(responses):
+            self.assertEqual(json.loads(response), {
+                'exit-code': 0, 'request-id': 'glance-{}'.format(unit)})
+        return fake
+
+    def test_broker_storm(self):
+        batched = self._storm(charms_ceph.broker.process_requests_batch)
+        single = self._storm(
+            lambda reqs: [charms_ceph.broker.process_requests(req)
+                          for req in reqs])
+        pools = batched.state['pools']
+        self.assertEqual(sorted(pools), ['glance', 'glance-cache'])
+        self.assertEqual(pools['glance']['size'], 3)
+        self.assertEqual(pools['glance-cache']['size'], 2)
+        self.assertEqual(pools['glance-cache']['options'],
+                         {'compression_mode': 'aggressive'})
+        self.assertEqual(pools['glance']['application_metadata'],
+                         {'rbd': {}})
+        self.assertEqual(
+            json.loads(batched.state['config_key']['cephx.groups.images']),
+            {'pools': ['glance'], 'services': ['glance']})
+        self.assertEqual(batched.state['auth']['client.glance']['caps'],
+                         {'mon': 'allow r, allow command "osd blacklist", '
+                                 'allow command "osd blocklist"',
+                          'osd': 'allow rwx pool=glance'})
+        # The batch leaves the cluster as processing the requests one by
+        # one does, with fewer commands
+        for key in ('pools', 'config_key', 'auth'):
+            self.assertEqual(batched.state[key], single.state[key])
+        self.assertLess(len(batched.calls), len(single.calls))
+
+    def test_osd_upgrade_roll(self):
+        fake = FakeCeph.cluster(hosts=3, osds_per_host=2, version='16.2.9')
+        fake.state['version'] = '17.2.6'
+        hosts = ['host2', 'host0', 'host1']
+        local = threading.local()
+        sleep = time.sleep
+
+        def service_restart(service):
+            fake.restart_osds(fake.host_osds(local.host))
+
+        def roll(host):
+            local.host = host
+            charms_ceph.upgrade.roll_osd_cluster('quincy', 'osd-upgrade')
+
+        patch.object(charms_ceph.upgrade.socket, 'gethostname',
+                     lambda: local.host).start()
+        patch.object(charms_ceph.upgrade, 'get_local_osd_ids',
+                     lambda: fake.host_osds(local.host)).start()
+        patch.object(charms_ceph.upgrade, 'service_restart',
+                     service_restart).start()
+        patch.object(charms_ceph.upgrade, 'dirs_need_ownership_update',
+                     return_value=False).start()
+        patch.object(charms_ceph.upgrade, 'get_version',
+                     return_value='16.2.9').start()
+        patch.object(charms_ceph.upgrade, 'systemd',
+                     return_value=True).start()
+        for name in ('add_source', 'apt_update', 'apt_install', 'config',
+                     'determine_packages', 'refresh_package_versions',
+                     'status_set'):
+            patch.object(charms_ceph.upgrade, name).start()
+        # Waiting units poll the previous one every 5 to 30 seconds
+        patch.object(charms_ceph.upgrade, 'time', **{
+            'time.side_effect': time.time,
+            'sleep.side_effect': lambda seconds: sleep(0.01)}).start()
+
+        with fake.patch(), patch_charmhelpers(charms_ceph.upgrade):
+            with concurrent.futures.ThreadPoolExecutor(len(hosts)) as pool:
+                for future in [pool.submit(roll, host) for host in hosts]:
+                    future.result()
+
+        self.assertEqual(set(fake.state['osd_versions'].values()),
+                         {'17.2.6'})
+        keys = fake.state['config_key']
+        for previous, host in zip(sorted(hosts), sorted(hosts)[1:]):
+            # Each host started after the previous one was done
+            self.assertLessEqual(
+                float(keys['osd_{}_quincy_done'.format(previous)]),
+                float(keys['osd_{}_quincy_start'.format(host)]))
@@ -16,6 +16,7 @@ import unittest
 
 from unittest.mock import patch
 
+import charms_ceph.disks
 import charms_ceph.utils
 
 
@@ -23,15 +24,15 @@ class GeneralUtilsTestCase(unittest.TestCase):
     def setUp(self):
         super(GeneralUtilsTestCase, self).setUp()
 
-    @patch.object(charms_ceph.utils.subprocess, 'call')
+    @patch.object(charms_ceph.disks.subprocess, 'call')
     def test_udevadm_settle(self, _call):
-        charms_ceph.utils.udevadm_settle()
+        charms_ceph.disks.udevadm_settle()
         _call.assert_called_once_with(['udevadm', 'settle'])
 
-    @patch.object(charms_ceph.utils, 'udevadm_settle')
-    @patch.object(charms_ceph.utils.subprocess, 'call')
+    @patch.object(charms_ceph.disks, 'udevadm_settle')
+    @patch.object(charms_ceph.disks.subprocess, 'call')
     def test_rescan_osd_devices(self, _call, _udevadm_settle):
-        charms_ceph.utils.rescan_osd_devices()
+        charms_ceph.disks.rescan_osd_devices()
         _call.assert_called_once_with([
             'udevadm',
             'trigger',
@@ -42,10 +43,10 @@ class GeneralUtilsTestCase(unittest.TestCase):
 
 class AllocateLVTestCase(unittest.TestCase):
 
-    @patch.object(charms_ceph.utils, 'rescan_osd_devices')
-    @patch.object(charms_ceph.utils, '_initialize_disk')
-    @patch.object(charms_ceph.utils.os.path, 'exists')
-    @patch.object(charms_ceph.utils, 'lvm')
+    @patch.object(charms_ceph.disks, 'rescan_osd_devices')
+    @patch.object(charms_ceph.disks, '_initialize_disk')
+    @patch.object(charms_ceph.disks.os.path, 'exists')
+    @patch.object(charms_ceph.disks, 'lvm')
     def test_allocate_lv_ok(self,
                             _lvm,
                             _exists,
@@ -58,7 +59,7 @@ class AllocateLVTestCase(unittest.TestCase):
             lambda dev, dev_uuid, encrypt, key_manager: dev
         )
         self.assertEqual(
-            charms_ceph.utils._allocate_logical_volume(
+            charms_ceph.disks._allocate_logical_volume(
                 dev="/dev/disk/by-dname/foobar",
                 lv_type="block",
                 osd_fsid="abcdef"
@@ -79,10 +80,10 @@ class AllocateLVTestCase(unittest.TestCase):
         )
         _rescan_osd_devices.assert_not_called()
 
-    @patch.object(charms_ceph.utils, 'rescan_osd_devices')
-    @patch.object(charms_ceph.utils, '_initialize_disk')
-    @patch.object(charms_ceph.utils.os.path, 'exists')
-    @patch.object(charms_ceph.utils, 'lvm')
+    @patch.object(charms_ceph.disks, 'rescan_osd_devices')
+    @patch.object(charms_ceph.disks, '_initialize_disk')
+    @patch.object(charms_ceph.disks.os.path, 'exists')
+    @patch.object(charms_ceph.disks, 'lvm')
     def test_allocate_lv_bug1878752(self,
                                     _lvm,
                                     _exists,
@@ -95,7 +96,7 @@ class AllocateLVTestCase(unittest.TestCase):
             lambda dev, dev_uuid, encrypt, key_manager: dev
         )
         self.assertEqual(
-            charms_ceph.utils._allocate_logical_volume(
+            charms_ceph.disks._allocate_logical_volume(
                 dev="/dev/disk/by-dname/foobar",
                 lv_type="block",
                 osd_fsid="abcdef"
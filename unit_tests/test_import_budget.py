@@ -0,0 +1,101 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import importlib
+import json
+import os
+import subprocess
+import sys
+import unittest
+
+from unittest.mock import patch
+
+import charms_ceph.utils
+
+# Seconds a cold 'import charms_ceph.utils' may take.  unit_tests mocks
+# charmhelpers and is imported before the clock starts, so this bounds
+# the module code of charms_ceph.utils and anything it imports besides
+# charmhelpers, not the import cost on a unit with the real charmhelpers.
+IMPORT_BUDGET = 0.5
+
+# Modules only the submodules of charms_ceph.utils may import
+LAZY_MODULES = [
+    'pyudev',
+    'charms_ceph.disks',
+    'charms_ceph.keys',
+    'charms_ceph.mgr',
+    'charms_ceph.nic_tuning',
+    'charms_ceph.pools',
+    'charms_ceph.tuning',
+    'charms_ceph.upgrade',
+]
+
+COLD_IMPORT = """
+import json
+import sys
+import time
+
+import unit_tests
+
+start = time.perf_counter()
+import charms_ceph.utils
+duration = time.perf_counter() - start
+print(json.dumps({
+    'duration': duration,
+    'loaded': [name for name in %r if name in sys.modules],
+}))
+"""
+
+
+class ImportBudgetTestCase(unittest.TestCase):
+
+    def _cold_import(self):
+        root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+        env = dict(os.environ, PYTHONPATH=os.pathsep.join(sys.path))
+        output = subprocess.check_output(
+            [sys.executable, '-c', COLD_IMPORT % (LAZY_MODULES,)],
+            cwd=root, env=env)
+        return json.loads(output.decode('UTF-8').splitlines()[-1])
+
+    def test_cold_import(self):
+        result = self._cold_import()
+        self.assertEqual(result['loaded'], [])
+        self.assertLess(result['duration'], IMPORT_BUDGET)
+
+    def test_moved_names(self):
+        for module, names in charms_ceph.utils._MOVED.items():
+            submodule = importlib.import_module(module)
+            for name in names:
+                self.assertIs(getattr(charms_ceph.utils, name),
+                              getattr(submodule, name))
+                self.assertIn(name, dir(charms_ceph.utils))
+
+    def test_imported_names(self):
+        for module, names in charms_ceph.utils._IMPORTED.items():
+            submodule = importlib.import_module(module)
+            for name in names:
+                self.assertIs(getattr(charms_ceph.utils, name),
+                              getattr(submodule, name))
+        with patch.object(charms_ceph.utils, 'apt_install') as apt_install:
+            self.assertIs(charms_ceph.utils.apt_install, apt_install)
+
+    def test_module_class(self):
+        # Moved names are resolved without PEP 562 on Python < 3.7
+        self.assertIsInstance(charms_ceph.utils,
+                              charms_ceph.utils._UtilsModule)
+        self.assertNotIn('__getattr__', vars(charms_ceph.utils))
+
+    def test_unknown_name(self):
+        with self.assertRaises(AttributeError):
+            charms_ceph.utils.no_such_name
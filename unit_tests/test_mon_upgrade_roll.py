@@ -18,6 +18,8 @@ import unittest
 
 from unittest.mock import patch, call, MagicMock, ANY
 
+import charms_ceph.disks
+import charms_ceph.upgrade
 import charms_ceph.utils
 
 # python-apt is not installed as part of test-requirements but is imported by
@@ -63,16 +65,16 @@ def monitor_key_exists_side_effect(*args):
 class UpgradeRollingTestCase(unittest.TestCase):
 
     @patch('time.time')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'upgrade_monitor')
-    @patch.object(charms_ceph.utils, 'monitor_key_set')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'upgrade_monitor')
+    @patch.object(charms_ceph.upgrade, 'monitor_key_set')
     def test_lock_and_roll(self, monitor_key_set, upgrade_monitor, log, time):
         time.return_value = 1473279502.69
         monitor_key_set.monitor_key_set.return_value = None
-        charms_ceph.utils.lock_and_roll(my_name='ip-192-168-1-2',
-                                        version='hammer',
-                                        service='mon',
-                                        upgrade_key='admin')
+        charms_ceph.upgrade.lock_and_roll(my_name='ip-192-168-1-2',
+                                          version='hammer',
+                                          service='mon',
+                                          upgrade_key='admin')
         upgrade_monitor.assert_called_once_with('hammer',
                                                 kick_function=ANY)
         log.assert_has_calls(
@@ -85,23 +87,23 @@ class UpgradeRollingTestCase(unittest.TestCase):
                      'mon_ip-192-168-1-2_hammer_done 1473279502.69'),
             ])
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'mkdir')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'chownr')
-    @patch.object(charms_ceph.utils, 'service_stop')
-    @patch.object(charms_ceph.utils, 'service_start')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'get_local_mon_ids')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'ceph_user')
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'mkdir')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'chownr')
+    @patch.object(charms_ceph.upgrade, 'service_stop')
+    @patch.object(charms_ceph.upgrade, 'service_start')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.disks, 'get_local_mon_ids')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_monitor_hammer(self, config, get_version,
                                     systemd, local_mons, add_source,
                                     apt_update, status_set, log,
@@ -119,8 +121,8 @@ class UpgradeRollingTestCase(unittest.TestCase):
 
         mock_kick_function = MagicMock()
 
-        charms_ceph.utils.upgrade_monitor('hammer',
-                                          kick_function=mock_kick_function)
+        charms_ceph.upgrade.upgrade_monitor('hammer',
+                                            kick_function=mock_kick_function)
         service_stop.assert_called_with('ceph-mon-all')
         service_start.assert_called_with('ceph-mon-all')
         add_source.assert_called_with('cloud:trusty-kilo', 'key')
@@ -141,23 +143,23 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                  perms=0o755)
         chownr.assert_not_called()
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'mkdir')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'chownr')
-    @patch.object(charms_ceph.utils, 'service_stop')
-    @patch.object(charms_ceph.utils, 'service_start')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'get_local_mon_ids')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'ceph_user')
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'mkdir')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'chownr')
+    @patch.object(charms_ceph.upgrade, 'service_stop')
+    @patch.object(charms_ceph.upgrade, 'service_start')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.disks, 'get_local_mon_ids')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_monitor_jewel(self, config, get_version,
                                    systemd, local_mons, add_source,
                                    apt_update, status_set, log,
@@ -173,7 +175,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         local_mons.return_value = ['a']
         mock_cmp_pkgrevno.return_value = -1
 
-        charms_ceph.utils.upgrade_monitor('jewel')
+        charms_ceph.upgrade.upgrade_monitor('jewel')
         service_stop.assert_called_with('ceph-mon-all')
         service_start.assert_called_with('ceph-mon-all')
         add_source.assert_called_with('cloud:trusty-kilo', 'key')
@@ -198,23 +200,23 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                  group='ceph',
                                  perms=0o755)
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'mkdir')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'chownr')
-    @patch.object(charms_ceph.utils, 'service_stop')
-    @patch.object(charms_ceph.utils, 'service_start')
-    @patch.object(charms_ceph.utils, 'service_restart')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'ceph_user')
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'mkdir')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'chownr')
+    @patch.object(charms_ceph.upgrade, 'service_stop')
+    @patch.object(charms_ceph.upgrade, 'service_start')
+    @patch.object(charms_ceph.upgrade, 'service_restart')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_monitor_luminous(self, config, get_version,
                                       systemd, add_source,
                                       apt_update, status_set, log,
@@ -230,7 +232,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         systemd.return_value = True
         mock_cmp_pkgrevno.side_effect = [0, -1]   # it is luminous
 
-        charms_ceph.utils.upgrade_monitor('luminous')
+        charms_ceph.upgrade.upgrade_monitor('luminous')
         service_stop.assert_any_call('ceph-mon')
         service_stop.assert_any_call('ceph-mgr.target')
         service_restart.assert_any_call('ceph-mon')
@@ -252,23 +254,23 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                  group='ceph',
                                  perms=0o755)
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'mkdir')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'chownr')
-    @patch.object(charms_ceph.utils, 'service_stop')
-    @patch.object(charms_ceph.utils, 'service_start')
-    @patch.object(charms_ceph.utils, 'service_restart')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'ceph_user')
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'mkdir')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'chownr')
+    @patch.object(charms_ceph.upgrade, 'service_stop')
+    @patch.object(charms_ceph.upgrade, 'service_start')
+    @patch.object(charms_ceph.upgrade, 'service_restart')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_monitor_octopus(self, config, get_version,
                                      systemd, add_source,
                                      apt_update, status_set, log,
@@ -284,7 +286,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         systemd.return_value = True
         mock_cmp_pkgrevno.side_effect = [1, 1]   # it is pacific
 
-        charms_ceph.utils.upgrade_monitor('octopus')
+        charms_ceph.upgrade.upgrade_monitor('octopus')
         service_stop.assert_any_call('ceph-mon@testmon')
         service_stop.assert_any_call('ceph-mgr.target')
         service_restart.assert_any_call('ceph-mon@testmon')
@@ -306,14 +308,14 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                  group='ceph',
                                  perms=0o755)
 
-    @patch.object(charms_ceph.utils, 'upgrade_monitor')
-    @patch.object(charms_ceph.utils, 'bootstrap_manager')
-    @patch.object(charms_ceph.utils, 'wait_for_all_monitors_to_upgrade')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'lock_and_roll')
-    @patch.object(charms_ceph.utils, 'wait_on_previous_node')
-    @patch.object(charms_ceph.utils, 'get_mon_map')
-    @patch.object(charms_ceph.utils, 'socket')
+    @patch.object(charms_ceph.upgrade, 'upgrade_monitor')
+    @patch.object(charms_ceph.upgrade, 'bootstrap_manager')
+    @patch.object(charms_ceph.upgrade, 'wait_for_all_monitors_to_upgrade')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'lock_and_roll')
+    @patch.object(charms_ceph.upgrade, 'wait_on_previous_node')
+    @patch.object(charms_ceph.upgrade, 'get_mon_map')
+    @patch.object(charms_ceph.upgrade, 'socket')
     def _test_roll_monitor_cluster(self,
                                    socket,
                                    get_mon_map,
@@ -337,8 +339,8 @@ class UpgradeRollingTestCase(unittest.TestCase):
                 ]
             }
         }
-        charms_ceph.utils.roll_monitor_cluster(new_version=new_version,
-                                               upgrade_key='admin')
+        charms_ceph.upgrade.roll_monitor_cluster(new_version=new_version,
+                                                 upgrade_key='admin')
         get_mon_map.assert_called_once_with('admin')
         wait_on_previous_node.assert_called_with(
             upgrade_key='admin',
@@ -367,30 +369,30 @@ class UpgradeRollingTestCase(unittest.TestCase):
         upgrade_monitor.assert_has_calls([
             call(new_version, restart_daemons=False)])
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno', lambda _x, _y: 1)
-    @patch.object(charms_ceph.utils, 'enable_msgr2')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno', lambda _x, _y: 1)
+    @patch.object(charms_ceph.upgrade, 'enable_msgr2')
     def test_roll_monitor_cluster_mimic(self, mock_enable_msgr2):
         self._test_roll_monitor_cluster(new_version='mimic')
         mock_enable_msgr2.assert_called_once()
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno', lambda _x, _y: 1)
-    @patch.object(charms_ceph.utils, 'enable_msgr2')
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno', lambda _x, _y: 1)
+    @patch.object(charms_ceph.upgrade, 'enable_msgr2')
     def test_roll_monitor_cluster_luminous(self, mock_enable_msgr2):
         self._test_roll_monitor_cluster(new_version='luminous')
         mock_enable_msgr2.assert_called_once()
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno', lambda _x, _y: -1)
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno', lambda _x, _y: -1)
     def test_roll_monitor_cluster_jewel(self):
         self._test_roll_monitor_cluster(new_version='jewel')
 
-    @patch.object(charms_ceph.utils, 'cmp_pkgrevno', lambda _x, _y: -1)
+    @patch.object(charms_ceph.upgrade, 'cmp_pkgrevno', lambda _x, _y: -1)
     def test_roll_monitor_cluster_hammer(self):
         self._test_roll_monitor_cluster(new_version='hammer')
 
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'time')
-    @patch.object(charms_ceph.utils, 'monitor_key_get')
-    @patch.object(charms_ceph.utils, 'monitor_key_exists')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'time')
+    @patch.object(charms_ceph.upgrade, 'monitor_key_get')
+    @patch.object(charms_ceph.upgrade, 'monitor_key_exists')
     def test_wait_on_previous_node(self, monitor_key_exists, monitor_key_get,
                                    mock_time, log):
         tval = [previous_node_start_time]
@@ -403,7 +405,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         monitor_key_get.side_effect = monitor_key_side_effect
         monitor_key_exists.side_effect = monitor_key_exists_side_effect
 
-        charms_ceph.utils.wait_on_previous_node(
+        charms_ceph.upgrade.wait_on_previous_node(
             previous_node="ip-192-168-1-2",
             version='0.94.1',
             service='mon',
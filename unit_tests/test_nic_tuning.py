@@ -0,0 +1,251 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import subprocess
+import tempfile
+import unittest
+
+from unittest.mock import call, patch
+
+import charms_ceph.nic_tuning
+import charms_ceph.tuning
+import charms_ceph.utils
+
+
+class NicTuningTestCase(unittest.TestCase):
+    """Tests run against a fake /sys/class/net and /proc/sys tree."""
+
+    def setUp(self):
+        super(NicTuningTestCase, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        self.sys_class_net = os.path.join(self.tmpdir.name, 'net')
+        self.proc_sys = os.path.join(self.tmpdir.name, 'proc_sys')
+        self._add_nic('eth0', '25000')
+        self._add_nic('eth1', '25000')
+        self._add_nic('eth2', '100000')
+        self._add_nic('eth3', '1000')
+        self._add_nic('bond0', '50000', lower=['eth0', 'eth1'])
+        self._add_nic('bond0.100', None, lower=['bond0'])
+        self._add_nic('lo', None)
+        patch.object(charms_ceph.tuning, 'SYS_CLASS_NET',
+                     self.sys_class_net).start()
+        patch.object(charms_ceph.tuning, 'PROC_SYS', self.proc_sys).start()
+        self.addCleanup(patch.stopall)
+
+    def _add_nic(self, name, speed, lower=()):
+        path = os.path.join(self.sys_class_net, name)
+        os.makedirs(path)
+        if speed is not None:
+            with open(os.path.join(path, 'speed'), 'w') as f:
+                f.write(speed + '\n')
+        for iface in lower:
+            os.symlink(os.path.join('..', iface),
+                       os.path.join(path, 'lower_{}'.format(iface)))
+
+    def _set_sysctl(self, key, value):
+        path = os.path.join(self.proc_sys, *key.split('.'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.write(value + '\n')
+
+    def _get_sysctl(self, key):
+        with open(os.path.join(self.proc_sys, *key.split('.'))) as f:
+            return f.read()
+
+    def test_get_link_speed(self):
+        self.assertEqual(charms_ceph.tuning.get_link_speed('eth2'), 100000)
+        self.assertEqual(charms_ceph.tuning.get_link_speed('bond0'), 25000)
+        self.assertEqual(charms_ceph.tuning.get_link_speed('bond0.100'),
+                         25000)
+        self.assertIsNone(charms_ceph.tuning.get_link_speed('lo'))
+        self.assertIsNone(charms_ceph.tuning.get_link_speed('missing'))
+
+    def test_get_network_tuning_tier(self):
+        tier = charms_ceph.tuning.get_network_tuning_tier
+        self.assertEqual(tier(10000), 10000)
+        self.assertEqual(tier(20000), 10000)
+        self.assertEqual(tier(25000), 25000)
+        self.assertEqual(tier(56000), 50000)
+        self.assertEqual(tier(400000), 400000)
+        self.assertEqual(tier(800000), 400000)
+        self.assertIsNone(tier(1000))
+        self.assertIsNone(tier(None))
+
+    def test_apply_sysctls(self):
+        self._set_sysctl('net.core.rmem_max', '212992')
+        self._set_sysctl('net.ipv4.tcp_rmem', '4096\t87380\t67108864')
+        changed = charms_ceph.tuning.apply_sysctls({
+            'net.core.rmem_max': 67108864,
+            'net.ipv4.tcp_rmem': '4096 87380 67108864',
+        })
+        self.assertEqual(changed, {'net.core.rmem_max': 67108864})
+        self.assertEqual(self._get_sysctl('net.core.rmem_max'), '67108864')
+
+    def test_get_physical_interfaces(self):
+        self.assertEqual(
+            charms_ceph.tuning.get_physical_interfaces('bond0.100'),
+            ['eth0', 'eth1'])
+        self.assertEqual(charms_ceph.tuning.get_physical_interfaces('eth2'),
+                         ['eth2'])
+
+    @patch.object(charms_ceph.nic_tuning, 'tune_nic_queues')
+    @patch.object(charms_ceph.tuning, 'save_sysctls')
+    @patch.object(charms_ceph.tuning, 'apply_sysctls')
+    @patch.object(charms_ceph.tuning, 'status_set')
+    def test_tune_nic_bond(self, _status_set, _apply_sysctls, _save_sysctls,
+                           _tune_nic_queues):
+        charms_ceph.tuning.tune_nic('bond0.100')
+        profile = charms_ceph.tuning.NETWORK_ADAPTER_SYSCTLS[25000]
+        _save_sysctls.assert_called_once_with(
+            sysctl_dict=profile,
+            save_location='/etc/sysctl.d/51-ceph-osd-charm-bond0.100.conf')
+        _apply_sysctls.assert_called_once_with(profile)
+        _tune_nic_queues.assert_has_calls([call('eth0'), call('eth1')])
+
+    @patch.object(charms_ceph.nic_tuning, 'tune_nic_queues')
+    @patch.object(charms_ceph.tuning, 'save_sysctls')
+    @patch.object(charms_ceph.tuning, 'apply_sysctls')
+    @patch.object(charms_ceph.tuning, 'status_set')
+    def test_tune_nic_slow_link(self, _status_set, _apply_sysctls,
+                                _save_sysctls, _tune_nic_queues):
+        charms_ceph.tuning.tune_nic('eth3')
+        _save_sysctls.assert_not_called()
+        _apply_sysctls.assert_not_called()
+        _tune_nic_queues.assert_not_called()
+
+
+ETHTOOL_RINGS = """Ring parameters for eth0:
+Pre-set maximums:
+RX:		8192
+RX Mini:	n/a
+RX Jumbo:	n/a
+TX:		8192
+Current hardware settings:
+RX:		1024
+RX Mini:	n/a
+RX Jumbo:	n/a
+TX:		8192
+RX Buf Len:	n/a
+"""
+
+ETHTOOL_CHANNELS = """Channel parameters for eth0:
+Pre-set maximums:
+RX:		n/a
+TX:		n/a
+Other:		1
+Combined:	63
+Current hardware settings:
+RX:		n/a
+TX:		n/a
+Other:		1
+Combined:	8
+"""
+
+
+class NicQueueTuningTestCase(unittest.TestCase):
+    """Tests run against a fake sysfs and procfs with a stubbed ethtool."""
+
+    def setUp(self):
+        super(NicQueueTuningTestCase, self).setUp()
+        self.tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmpdir.cleanup)
+        sys_class_net = os.path.join(self.tmpdir.name, 'net')
+        self.proc_irq = os.path.join(self.tmpdir.name, 'irq')
+        device = os.path.join(sys_class_net, 'eth0', 'device')
+        os.makedirs(os.path.join(device, 'msi_irqs'))
+        with open(os.path.join(device, 'numa_node'), 'w') as f:
+            f.write('1\n')
+        with open(os.path.join(device, 'local_cpulist'), 'w') as f:
+            f.write('4-5,12\n')
+        for irq in (40, 41, 42, 43):
+            open(os.path.join(device, 'msi_irqs', str(irq)), 'w').close()
+            os.makedirs(os.path.join(self.proc_irq, str(irq)))
+            self._set_affinity(irq, '0-15')
+        self._set_affinity(43, '4')
+        os.makedirs(os.path.join(sys_class_net, 'lo'))
+        patch.object(charms_ceph.nic_tuning, 'SYS_CLASS_NET',
+                     sys_class_net).start()
+        patch.object(charms_ceph.nic_tuning, 'PROC_IRQ',
+                     self.proc_irq).start()
+        self.check_output = patch.object(
+            charms_ceph.nic_tuning.subprocess, 'check_output').start()
+        self.check_output.side_effect = self._ethtool
+        self.check_call = patch.object(
+            charms_ceph.nic_tuning.subprocess, 'check_call').start()
+        self.addCleanup(patch.stopall)
+
+    def _ethtool(self, cmd):
+        return {'-g': ETHTOOL_RINGS,
+                '-l': ETHTOOL_CHANNELS}[cmd[1]].encode('UTF-8')
+
+    def _affinity_path(self, irq):
+        return os.path.join(self.proc_irq, str(irq), 'smp_affinity_list')
+
+    def _set_affinity(self, irq, cpus):
+        with open(self._affinity_path(irq), 'w') as f:
+            f.write(cpus + '\n')
+
+    def _get_affinity(self, irq):
+        with open(self._affinity_path(irq)) as f:
+            return f.read().strip()
+
+    def test_parse_ethtool_settings(self):
+        settings = charms_ceph.nic_tuning.parse_ethtool_settings(
+            ETHTOOL_CHANNELS)
+        self.assertEqual(settings, {
+            'maximums': {'other': 1, 'combined': 63},
+            'current': {'other': 1, 'combined': 8},
+        })
+
+    def test_parse_cpulist(self):
+        self.assertEqual(charms_ceph.nic_tuning.parse_cpulist('0-2,8,10-11'),
+                         [0, 1, 2, 8, 10, 11])
+
+    def test_tune_nic_queues(self):
+        changes = charms_ceph.nic_tuning.tune_nic_queues('eth0')
+        self.assertEqual(changes, {
+            'rings': {'rx': 8192},
+            'channels': {'combined': 3},
+            'irqs': 3,
+        })
+        self.check_call.assert_has_calls([
+            call(['ethtool', '-G', 'eth0', 'rx', '8192']),
+            call(['ethtool', '-L', 'eth0', 'combined', '3']),
+        ])
+        self.assertEqual([self._get_affinity(irq) for irq in (40, 41, 42)],
+                         ['4', '5', '12'])
+        self.assertEqual(self._get_affinity(43), '4')
+        self.assertEqual(charms_ceph.nic_tuning.get_numa_node('eth0'), 1)
+
+    def test_tune_nic_queues_no_ethtool_support(self):
+        self.check_output.side_effect = OSError('ethtool not found')
+        changes = charms_ceph.nic_tuning.tune_nic_queues('eth0')
+        self.assertEqual(changes, {'irqs': 3})
+        self.check_call.assert_not_called()
+
+    def test_tune_nic_queues_virtual(self):
+        self.check_output.side_effect = \
+            subprocess.CalledProcessError(1, 'ethtool')
+        self.assertEqual(charms_ceph.nic_tuning.tune_nic_queues('lo'), {})
+        self.assertIsNone(charms_ceph.nic_tuning.get_numa_node('lo'))
+
+    def test_get_numa_node_unreadable(self):
+        numa_node = os.path.join(charms_ceph.nic_tuning.SYS_CLASS_NET,
+                                 'eth0', 'device', 'numa_node')
+        for content in ('', 'garbage\n', '-1\n'):
+            with open(numa_node, 'w') as f:
+                f.write(content)
+            self.assertIsNone(charms_ceph.nic_tuning.get_numa_node('eth0'))
@@ -0,0 +1,142 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from unittest.mock import patch
+
+import charms_ceph.operations
+
+
+def pgs(pool_id, count, state='active+clean'):
+    return [{'pgid': '{}.{:x}'.format(pool_id, i), 'state': state}
+            for i in range(count)]
+
+
+class OperationsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        super(OperationsTestCase, self).setUp()
+        self.store = {}
+        kv = patch.object(charms_ceph.operations, 'kv').start()
+        kv.return_value.get.side_effect = (
+            lambda key, default=None: self.store.get(key, default))
+        kv.return_value.set.side_effect = self.store.__setitem__
+        self.time = patch.object(charms_ceph.operations.time, 'time').start()
+        self.time.return_value = 1000.0
+        self.check_output = patch.object(charms_ceph.operations,
+                                         'check_output').start()
+        self.get_pool_details = patch.object(
+            charms_ceph.operations, 'get_pool_details').start()
+        self.get_pool_details.return_value = {
+            'glance': {'pool_name': 'glance', 'pool_id': 1, 'pg_num': 8},
+            'nova': {'pool_name': 'nova', 'pool_id': 2, 'pg_num': 4}}
+        self.addCleanup(patch.stopall)
+
+    def _pg_dump(self, dump):
+        self.check_output.return_value = json.dumps(dump).encode('UTF-8')
+
+    def test_get_pg_states(self):
+        self._pg_dump({'pg_ready': True,
+                       'pg_stats': pgs(1, 3) + pgs(1, 1, 'creating')})
+        self.assertEqual(charms_ceph.operations.get_pg_states(),
+                         {1: {'active+clean': 3, 'creating': 1}})
+        self.check_output.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'pg', 'dump', 'pgs_brief',
+             '--format=json'])
+        # Releases before Octopus return the list itself
+        self._pg_dump(pgs(2, 2))
+        self.assertEqual(charms_ceph.operations.get_pg_states(),
+                         {2: {'active+clean': 2}})
+
+    def test_operation_lifecycle(self):
+        glance = charms_ceph.operations.start_operation(
+            'create-pool', request_id='rq1', pools=['glance'])
+        move = charms_ceph.operations.start_operation(
+            'move-osd-to-bucket', request_id='rq1', pools=None)
+        failed = charms_ceph.operations.start_operation(
+            'create-pool', pools=['nova'],
+            status={'exit-code': 1, 'stderr': 'boom'})
+        self.assertEqual(failed['state'], 'failed')
+        self.assertEqual(
+            [op['handle'] for op in charms_ceph.operations.get_operations()],
+            [glance['handle'], move['handle'], failed['handle']])
+
+        # glance is still creating PGs
+        self._pg_dump(pgs(1, 6) + pgs(1, 2, 'creating') + pgs(2, 4))
+        self.assertEqual(charms_ceph.operations.update_operations(), [])
+
+        self._pg_dump(pgs(1, 8) + pgs(2, 4))
+        completed = charms_ceph.operations.update_operations()
+        self.assertEqual([op['handle'] for op in completed],
+                         [glance['handle'], move['handle']])
+        self.assertEqual(
+            charms_ceph.operations.get_operations(
+                [glance['handle'], 'unknown'])[0]['state'], 'complete')
+
+        # Nothing pending, the cluster is not queried
+        self.check_output.reset_mock()
+        self.assertEqual(charms_ceph.operations.update_operations(), [])
+        self.check_output.assert_not_called()
+
+        # Finished operations expire
+        self.time.return_value += (
+            charms_ceph.operations.OPERATION_RETENTION + 1)
+        charms_ceph.operations.update_operations()
+        self.assertEqual(charms_ceph.operations.get_operations(), [])
+
+    def test_pool_missing(self):
+        cinder = charms_ceph.operations.start_operation('create-pool',
+                                                        pools=['cinder'])
+        self._pg_dump(pgs(1, 8))
+        self.assertEqual(charms_ceph.operations.update_operations(), [])
+        operation = charms_ceph.operations.get_operations()[0]
+        self.assertEqual(operation['handle'], cinder['handle'])
+        self.assertEqual(operation['state'], 'failed')
+        self.assertEqual(operation['stderr'], "Pool 'cinder' does not exist")
+
+        # The failed operation does not keep the cluster being queried
+        self.check_output.reset_mock()
+        charms_ceph.operations.update_operations()
+        self.check_output.assert_not_called()
+
+    def test_scrubbing(self):
+        glance = charms_ceph.operations.start_operation('create-pool',
+                                                        pools=['glance'])
+        charms_ceph.operations.start_operation('move-osd-to-bucket',
+                                               pools=None)
+        self._pg_dump(pgs(1, 4) + pgs(1, 2, 'active+clean+scrubbing') +
+                      pgs(1, 2, 'active+clean+scrubbing+deep') +
+                      pgs(2, 3, 'active+remapped+backfilling') + pgs(2, 1))
+        self.assertEqual(
+            [op['handle'] for op in
+             charms_ceph.operations.update_operations()],
+            [glance['handle']])
+
+    def test_timeout(self):
+        charms_ceph.operations.start_operation('move-osd-to-bucket',
+                                               pools=None)
+        self._pg_dump(pgs(1, 7) + pgs(1, 1, 'active+undersized'))
+        self.assertEqual(charms_ceph.operations.update_operations(), [])
+        self.assertEqual(
+            charms_ceph.operations.get_operations()[0]['state'], 'pending')
+
+        self.time.return_value += charms_ceph.operations.OPERATION_TIMEOUT + 1
+        self.check_output.reset_mock()
+        self.assertEqual(charms_ceph.operations.update_operations(), [])
+        operation = charms_ceph.operations.get_operations()[0]
+        self.assertEqual(operation['state'], 'failed')
+        self.assertIn('did not settle', operation['stderr'])
+        self.check_output.assert_not_called()
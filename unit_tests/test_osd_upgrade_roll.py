@@ -12,14 +12,18 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import concurrent.futures
 import os
 import sys
+import tempfile
 import time
 import subprocess
 import unittest
 
-from unittest.mock import patch, call, mock_open
+from unittest.mock import ANY, patch, call, mock_open, MagicMock
 
+import charms_ceph.disks
+import charms_ceph.upgrade
 import charms_ceph.utils
 
 TO_PATCH = [
@@ -64,20 +68,20 @@ def monitor_key_side_effect(*args):
 
 class UpgradeRollingTestCase(unittest.TestCase):
 
-    @patch.object(charms_ceph.utils, 'get_osd_state')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'dirs_need_ownership_update')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'chownr')
-    @patch.object(charms_ceph.utils, 'service_restart')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'get_local_osd_ids')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, 'get_osd_state')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'dirs_need_ownership_update')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'chownr')
+    @patch.object(charms_ceph.upgrade, 'service_restart')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_osd_hammer(self, config, get_version, systemd, local_osds,
                                 add_source, apt_update, status_set, log,
                                 service_restart, chownr, apt_install,
@@ -90,7 +94,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         dirs_need_ownership_update.return_value = False
         get_osd_state.side_effect = ['active'] * 6
 
-        charms_ceph.utils.upgrade_osd('hammer')
+        charms_ceph.upgrade.upgrade_osd('hammer')
         service_restart.assert_called_with('ceph-osd-all')
         status_set.assert_has_calls([
             call('maintenance', 'Upgrading OSD'),
@@ -102,29 +106,29 @@ class UpgradeRollingTestCase(unittest.TestCase):
             ]
         )
         get_osd_state.assert_has_calls([
-            call(0), call(1), call(2),
-            call(0, osd_goal_state='active'),
-            call(1, osd_goal_state='active'),
-            call(2, osd_goal_state='active'),
-        ])
+            call(0, timeout=ANY), call(1, timeout=ANY), call(2, timeout=ANY),
+            call(0, osd_goal_state='active', timeout=ANY),
+            call(1, osd_goal_state='active', timeout=ANY),
+            call(2, osd_goal_state='active', timeout=ANY),
+        ], any_order=True)
         # Make sure on an Upgrade to Hammer that chownr was NOT called.
         assert not chownr.called
 
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, '_upgrade_single_osd')
-    @patch.object(charms_ceph.utils, 'update_owner')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, '_upgrade_single_osd')
+    @patch.object(charms_ceph.upgrade, 'update_owner')
     @patch('os.listdir')
-    @patch.object(charms_ceph.utils, '_get_child_dirs')
-    @patch.object(charms_ceph.utils, 'dirs_need_ownership_update')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'get_local_osd_ids')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, '_get_child_dirs')
+    @patch.object(charms_ceph.upgrade, 'dirs_need_ownership_update')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_osd_jewel(self, config, get_version, systemd,
                                local_osds, add_source, apt_update, status_set,
                                log, apt_install, dirs_need_ownership_update,
@@ -138,16 +142,18 @@ class UpgradeRollingTestCase(unittest.TestCase):
         _get_child_dirs.return_value = ['ceph-0', 'ceph-1', 'ceph-2']
         dirs_need_ownership_update.return_value = True
 
-        charms_ceph.utils.upgrade_osd('jewel')
+        charms_ceph.upgrade.upgrade_osd('jewel')
         update_owner.assert_has_calls([
             call(charms_ceph.utils.CEPH_BASE_DIR, recurse_dirs=False),
-            call(os.path.join(charms_ceph.utils.CEPH_BASE_DIR, 'mon')),
-            call(os.path.join(charms_ceph.utils.CEPH_BASE_DIR, 'fs')),
+            call(os.path.join(charms_ceph.utils.CEPH_BASE_DIR, 'mon'),
+                 kick_function=charms_ceph.upgrade.noop),
+            call(os.path.join(charms_ceph.utils.CEPH_BASE_DIR, 'fs'),
+                 kick_function=charms_ceph.upgrade.noop),
         ])
         _upgrade_single_osd.assert_has_calls([
-            call('0', 'ceph-0'),
-            call('1', 'ceph-1'),
-            call('2', 'ceph-2'),
+            call('0', 'ceph-0', charms_ceph.upgrade.noop),
+            call('1', 'ceph-1', charms_ceph.upgrade.noop),
+            call('2', 'ceph-2', charms_ceph.upgrade.noop),
         ])
         status_set.assert_has_calls([
             call('maintenance', 'Upgrading OSD'),
@@ -160,23 +166,23 @@ class UpgradeRollingTestCase(unittest.TestCase):
             ]
         )
 
-    @patch.object(charms_ceph.utils, 'get_osd_state')
-    @patch.object(charms_ceph.utils, 'determine_packages')
-    @patch.object(charms_ceph.utils, 'service_restart')
-    @patch.object(charms_ceph.utils, '_upgrade_single_osd')
-    @patch.object(charms_ceph.utils, 'update_owner')
+    @patch.object(charms_ceph.upgrade, 'get_osd_state')
+    @patch.object(charms_ceph.upgrade, 'determine_packages')
+    @patch.object(charms_ceph.upgrade, 'service_restart')
+    @patch.object(charms_ceph.upgrade, '_upgrade_single_osd')
+    @patch.object(charms_ceph.upgrade, 'update_owner')
     @patch('os.listdir')
-    @patch.object(charms_ceph.utils, '_get_child_dirs')
-    @patch.object(charms_ceph.utils, 'dirs_need_ownership_update')
-    @patch.object(charms_ceph.utils, 'apt_install')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'apt_update')
-    @patch.object(charms_ceph.utils, 'add_source')
-    @patch.object(charms_ceph.utils, 'get_local_osd_ids')
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'get_version')
-    @patch.object(charms_ceph.utils, 'config')
+    @patch.object(charms_ceph.upgrade, '_get_child_dirs')
+    @patch.object(charms_ceph.upgrade, 'dirs_need_ownership_update')
+    @patch.object(charms_ceph.upgrade, 'apt_install')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'apt_update')
+    @patch.object(charms_ceph.upgrade, 'add_source')
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'get_version')
+    @patch.object(charms_ceph.upgrade, 'config')
     def test_upgrade_osd_luminous(self, config, get_version, systemd,
                                   local_osds, add_source, apt_update,
                                   status_set,
@@ -195,7 +201,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         dirs_need_ownership_update.return_value = False
         get_osd_state.side_effect = ['active'] * 6
 
-        charms_ceph.utils.upgrade_osd('luminous')
+        charms_ceph.upgrade.upgrade_osd('luminous')
         service_restart.assert_called_with('ceph-osd.target')
         update_owner.assert_not_called()
         _upgrade_single_osd.assert_not_called()
@@ -210,26 +216,27 @@ class UpgradeRollingTestCase(unittest.TestCase):
             ]
         )
         get_osd_state.assert_has_calls([
-            call(0), call(1), call(2),
-            call(0, osd_goal_state='active'),
-            call(1, osd_goal_state='active'),
-            call(2, osd_goal_state='active'),
-        ])
-
-    @patch.object(charms_ceph.utils, 'get_osd_state')
-    @patch.object(charms_ceph.utils, 'stop_osd')
-    @patch.object(charms_ceph.utils, 'disable_osd')
-    @patch.object(charms_ceph.utils, 'update_owner')
-    @patch.object(charms_ceph.utils, 'enable_osd')
-    @patch.object(charms_ceph.utils, 'start_osd')
+            call(0, timeout=ANY), call(1, timeout=ANY), call(2, timeout=ANY),
+            call(0, osd_goal_state='active', timeout=ANY),
+            call(1, osd_goal_state='active', timeout=ANY),
+            call(2, osd_goal_state='active', timeout=ANY),
+        ], any_order=True)
+
+    @patch.object(charms_ceph.upgrade, 'get_osd_state')
+    @patch.object(charms_ceph.upgrade, 'stop_osd')
+    @patch.object(charms_ceph.upgrade, 'disable_osd')
+    @patch.object(charms_ceph.upgrade, 'update_owner')
+    @patch.object(charms_ceph.upgrade, 'enable_osd')
+    @patch.object(charms_ceph.upgrade, 'start_osd')
     def test_upgrade_single_osd(self, start_osd, enable_osd, update_owner,
                                 disable_osd, stop_osd, get_osd_state):
         get_osd_state.side_effect = ['active'] * 2
 
-        charms_ceph.utils._upgrade_single_osd(1, '/var/lib/ceph/osd/ceph-1')
+        charms_ceph.upgrade._upgrade_single_osd(1, '/var/lib/ceph/osd/ceph-1')
         stop_osd.assert_called_with(1)
         disable_osd.assert_called_with(1)
-        update_owner.assert_called_with('/var/lib/ceph/osd/ceph-1')
+        update_owner.assert_called_with('/var/lib/ceph/osd/ceph-1',
+                                        kick_function=None)
         enable_osd.assert_called_with(1)
         start_osd.assert_called_with(1)
         get_osd_state.assert_has_calls([
@@ -237,48 +244,48 @@ class UpgradeRollingTestCase(unittest.TestCase):
             call(1, osd_goal_state='active'),
         ])
 
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'service_stop')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'service_stop')
     def test_stop_osd(self, service_stop, systemd):
         systemd.return_value = False
-        charms_ceph.utils.stop_osd(1)
+        charms_ceph.upgrade.stop_osd(1)
         service_stop.assert_called_with('ceph-osd', id=1)
 
         systemd.return_value = True
-        charms_ceph.utils.stop_osd(2)
+        charms_ceph.upgrade.stop_osd(2)
         service_stop.assert_called_with('ceph-osd@2')
 
-    @patch.object(charms_ceph.utils, 'systemd')
-    @patch.object(charms_ceph.utils, 'service_start')
+    @patch.object(charms_ceph.upgrade, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'service_start')
     def test_start_osd(self, service_start, systemd):
         systemd.return_value = False
-        charms_ceph.utils.start_osd(1)
+        charms_ceph.upgrade.start_osd(1)
         service_start.assert_called_with('ceph-osd', id=1)
 
         systemd.return_value = True
-        charms_ceph.utils.start_osd(2)
+        charms_ceph.upgrade.start_osd(2)
         service_start.assert_called_with('ceph-osd@2')
 
     @patch('subprocess.check_call')
     @patch('os.path.exists')
     @patch('os.unlink')
-    @patch.object(charms_ceph.utils, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'systemd')
     def test_disable_osd(self, systemd, unlink, exists, check_call):
         systemd.return_value = True
-        charms_ceph.utils.disable_osd(4)
+        charms_ceph.upgrade.disable_osd(4)
         check_call.assert_called_with(['systemctl', 'disable', 'ceph-osd@4'])
 
         exists.return_value = True
         systemd.return_value = False
-        charms_ceph.utils.disable_osd(3)
+        charms_ceph.upgrade.disable_osd(3)
         unlink.assert_called_with('/var/lib/ceph/osd/ceph-3/ready')
 
     @patch('subprocess.check_call')
-    @patch.object(charms_ceph.utils, 'update_owner')
-    @patch.object(charms_ceph.utils, 'systemd')
+    @patch.object(charms_ceph.upgrade, 'update_owner')
+    @patch.object(charms_ceph.upgrade, 'systemd')
     def test_enable_osd(self, systemd, update_owner, check_call):
         systemd.return_value = True
-        charms_ceph.utils.enable_osd(5)
+        charms_ceph.upgrade.enable_osd(5)
         check_call.assert_called_with(['systemctl', 'enable', 'ceph-osd@5'])
 
         systemd.return_value = False
@@ -287,22 +294,22 @@ class UpgradeRollingTestCase(unittest.TestCase):
         # the python version.
         bs = 'builtins' if sys.version_info > (3, 0) else '__builtin__'
         with patch('%s.open' % bs, mo):
-            charms_ceph.utils.enable_osd(6)
+            charms_ceph.upgrade.enable_osd(6)
         mo.assert_called_once_with('/var/lib/ceph/osd/ceph-6/ready', 'w')
         handle = mo()
         handle.write.assert_called_with('ready')
         update_owner.assert_called_with('/var/lib/ceph/osd/ceph-6/ready')
 
-    @patch.object(charms_ceph.utils, 'DEBUG')
+    @patch.object(charms_ceph.upgrade, 'DEBUG')
     @patch('subprocess.check_output')
-    @patch.object(charms_ceph.utils, 'log')
+    @patch.object(charms_ceph.upgrade, 'log')
     def test_get_osd_state(self, log, check_output, level_DBG):
         check_output.side_effect = [
             subprocess.CalledProcessError(returncode=2, cmd=["bad"]),
             ValueError("bad value"),
             '{"state":"active"}'.encode()] * 2
 
-        osd_state = charms_ceph.utils.get_osd_state(2)
+        osd_state = charms_ceph.upgrade.get_osd_state(2)
         check_output.assert_called_with(
             ['ceph', 'daemon', '/var/run/ceph/ceph-osd.2.asok', 'status'])
         log.assert_has_calls([
@@ -312,7 +319,8 @@ class UpgradeRollingTestCase(unittest.TestCase):
             call('OSD 2 state: active, goal state: None', level=level_DBG)])
         self.assertEqual(osd_state, 'active')
 
-        osd_state = charms_ceph.utils.get_osd_state(2, osd_goal_state='active')
+        osd_state = charms_ceph.upgrade.get_osd_state(
+            2, osd_goal_state='active')
         check_output.assert_called_with(
             ['ceph', 'daemon', '/var/run/ceph/ceph-osd.2.asok', 'status'])
         log.assert_has_calls([
@@ -322,11 +330,92 @@ class UpgradeRollingTestCase(unittest.TestCase):
             call('OSD 2 state: active, goal state: None', level=level_DBG)])
         self.assertEqual(osd_state, 'active')
 
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'get_osd_tree')
-    @patch.object(charms_ceph.utils, 'log')
-    @patch.object(charms_ceph.utils, 'lock_and_roll')
-    @patch.object(charms_ceph.utils, 'get_upgrade_position')
+    @patch.object(charms_ceph.upgrade, 'time')
+    @patch('subprocess.check_output')
+    @patch.object(charms_ceph.upgrade, 'log')
+    def test_get_osd_state_backoff(self, log, check_output, _time):
+        _time.time.return_value = 0
+        check_output.side_effect = [
+            subprocess.CalledProcessError(returncode=2, cmd=["bad"]),
+            subprocess.CalledProcessError(returncode=2, cmd=["bad"]),
+            '{"state":"booting"}'.encode(),
+            '{"state":"active"}'.encode()]
+
+        osd_state = charms_ceph.upgrade.get_osd_state(
+            2, osd_goal_state='active')
+        self.assertEqual(osd_state, 'active')
+        _time.sleep.assert_has_calls([call(0.1), call(0.2), call(3)])
+
+    @patch.object(charms_ceph.upgrade, 'time')
+    @patch('subprocess.check_output')
+    @patch.object(charms_ceph.upgrade, 'log')
+    def test_get_osd_state_timeout(self, log, check_output, _time):
+        _time.time.side_effect = [0, 1, 11]
+        check_output.return_value = '{"state":"booting"}'.encode()
+
+        osd_state = charms_ceph.upgrade.get_osd_state(
+            2, osd_goal_state='active', timeout=10)
+        self.assertEqual(osd_state, 'booting')
+        _time.sleep.assert_called_once_with(3)
+
+    @patch.object(charms_ceph.upgrade, 'get_osd_state')
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    def test_get_all_osd_states(self, local_osds, get_osd_state):
+        local_osds.return_value = [0, 1, 2]
+        get_osd_state.side_effect = lambda osd_num, **kwargs: (
+            kwargs.get('osd_goal_state', 'active'))
+
+        self.assertEqual(charms_ceph.upgrade.get_all_osd_states(),
+                         {0: 'active', 1: 'active', 2: 'active'})
+        get_osd_state.assert_has_calls(
+            [call(0, timeout=ANY), call(1, timeout=ANY),
+             call(2, timeout=ANY)], any_order=True)
+        for osd_call in get_osd_state.call_args_list:
+            self.assertTrue(
+                0 < osd_call[1]['timeout'] <=
+                charms_ceph.upgrade.OSD_STATE_TIMEOUT)
+
+        get_osd_state.reset_mock()
+        self.assertEqual(
+            charms_ceph.upgrade.get_all_osd_states(
+                osd_goal_states={0: 'active', 1: 'booting', 2: 'active'},
+                timeout=60, osd_timeout=30),
+            {0: 'active', 1: 'booting', 2: 'active'})
+        for osd_call in get_osd_state.call_args_list:
+            self.assertTrue(0 < osd_call[1]['timeout'] <= 30)
+
+    @patch.object(charms_ceph.upgrade, 'time')
+    @patch('subprocess.check_output')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    def test_maintain_all_osd_states_timeout(self, local_osds, log,
+                                             check_output, _time):
+        local_osds.return_value = [0]
+        clock = iter(range(0, 24 * 60 * 60, 60))
+        _time.time.side_effect = lambda: next(clock)
+        check_output.side_effect = [
+            '{"state":"active"}'.encode()] + [
+            '{"state":"booting"}'.encode()] * 100
+
+        # The OSD never gets back to active, the default deadline ends
+        # the wait.
+        with charms_ceph.upgrade.maintain_all_osd_states():
+            pass
+        self.assertLess(check_output.call_count, 100)
+        log.assert_called_with(
+            'Timed out waiting for OSD 0 to reach state active, last '
+            'state: booting', level=charms_ceph.upgrade.WARNING)
+
+    @patch.object(charms_ceph.upgrade, 'get_local_osd_ids')
+    def test_get_all_osd_states_no_osds(self, local_osds):
+        local_osds.return_value = []
+        self.assertEqual(charms_ceph.upgrade.get_all_osd_states(), {})
+
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'get_osd_tree')
+    @patch.object(charms_ceph.upgrade, 'log')
+    @patch.object(charms_ceph.upgrade, 'lock_and_roll')
+    @patch.object(charms_ceph.upgrade, 'get_upgrade_position')
     def test_roll_osd_cluster_first(self,
                                     get_upgrade_position,
                                     lock_and_roll,
@@ -337,8 +426,8 @@ class UpgradeRollingTestCase(unittest.TestCase):
         get_osd_tree.return_value = ""
         get_upgrade_position.return_value = 0
 
-        charms_ceph.utils.roll_osd_cluster(new_version='0.94.1',
-                                           upgrade_key='osd-upgrade')
+        charms_ceph.upgrade.roll_osd_cluster(new_version='0.94.1',
+                                             upgrade_key='osd-upgrade')
         log.assert_has_calls(
             [
                 call('roll_osd_cluster called with 0.94.1'),
@@ -351,12 +440,12 @@ class UpgradeRollingTestCase(unittest.TestCase):
                                          upgrade_key='osd-upgrade',
                                          service='osd')
 
-    @patch.object(charms_ceph.utils, 'get_osd_tree')
-    @patch.object(charms_ceph.utils, 'socket')
-    @patch.object(charms_ceph.utils, 'status_set')
-    @patch.object(charms_ceph.utils, 'lock_and_roll')
-    @patch.object(charms_ceph.utils, 'get_upgrade_position')
-    @patch.object(charms_ceph.utils, 'wait_on_previous_node')
+    @patch.object(charms_ceph.upgrade, 'get_osd_tree')
+    @patch.object(charms_ceph.upgrade, 'socket')
+    @patch.object(charms_ceph.upgrade, 'status_set')
+    @patch.object(charms_ceph.upgrade, 'lock_and_roll')
+    @patch.object(charms_ceph.upgrade, 'get_upgrade_position')
+    @patch.object(charms_ceph.upgrade, 'wait_on_previous_node')
     def test_roll_osd_cluster_second(self,
                                      wait_on_previous_node,
                                      get_upgrade_position,
@@ -388,8 +477,8 @@ class UpgradeRollingTestCase(unittest.TestCase):
         ]
         get_upgrade_position.return_value = 1
 
-        charms_ceph.utils.roll_osd_cluster(new_version='0.94.1',
-                                           upgrade_key='osd-upgrade')
+        charms_ceph.upgrade.roll_osd_cluster(new_version='0.94.1',
+                                             upgrade_key='osd-upgrade')
         status_set.assert_called_with(
             'waiting',
             'Waiting on ip-192-168-1-2 to finish upgrading')
@@ -406,7 +495,7 @@ class UpgradeRollingTestCase(unittest.TestCase):
         listdir.return_value = ['mon', 'bootstrap-osd', 'foo', 'bootstrap-mon']
         exists.return_value = True
 
-        child_dirs = charms_ceph.utils._get_child_dirs('/var/lib/ceph')
+        child_dirs = charms_ceph.disks._get_child_dirs('/var/lib/ceph')
         isdir.assert_has_calls([call('/var/lib/ceph'),
                                 call('/var/lib/ceph/mon'),
                                 call('/var/lib/ceph/bootstrap-osd'),
@@ -423,64 +512,102 @@ class UpgradeRollingTestCase(unittest.TestCase):
         exists.return_value = False
 
         with self.assertRaises(ValueError):
-            charms_ceph.utils._get_child_dirs('/var/lib/ceph')
+            charms_ceph.disks._get_child_dirs('/var/lib/ceph')
 
     @patch('os.path.exists')
     def test__get_child_dirs_no_exist(self, exists):
         exists.return_value = False
 
         with self.assertRaises(ValueError):
-            charms_ceph.utils._get_child_dirs('/var/lib/ceph')
-
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch('os.path.isdir')
-    @patch('subprocess.check_call')
-    @patch.object(charms_ceph.utils, 'status_set')
-    def test_update_owner_no_recurse(self, status_set, check_call,
-                                     isdir, ceph_user):
-        ceph_user.return_value = 'ceph'
-        isdir.return_value = True
-        charms_ceph.utils.update_owner('/var/lib/ceph', False)
-        check_call.assert_called_with(['chown', 'ceph:ceph', '/var/lib/ceph'])
-
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch('os.path.isdir')
-    @patch('subprocess.check_call')
-    @patch.object(charms_ceph.utils, 'status_set')
-    def test_update_owner_recurse_file(self, status_set, check_call,
-                                       isdir, ceph_user):
-        ceph_user.return_value = 'ceph'
-        isdir.return_value = False
-        charms_ceph.utils.update_owner('/var/lib/ceph', True)
-        check_call.assert_called_with(['chown', 'ceph:ceph', '/var/lib/ceph'])
-
-    @patch.object(charms_ceph.utils, 'ceph_user')
-    @patch('os.path.isdir')
-    @patch('subprocess.check_call')
-    @patch.object(charms_ceph.utils, 'status_set')
-    def test_update_owner_recurse(self, status_set, check_call,
-                                  isdir, ceph_user):
-        ceph_user.return_value = 'ceph'
-        isdir.return_value = True
-        charms_ceph.utils.update_owner('/var/lib/ceph', True)
-        check_call.assert_called_with(['chown', '-R', 'ceph:ceph',
-                                       '/var/lib/ceph'])
-
+            charms_ceph.disks._get_child_dirs('/var/lib/ceph')
+
+    def _owner_tree(self):
+        tmpdir = tempfile.TemporaryDirectory()
+        self.addCleanup(tmpdir.cleanup)
+        for osd in range(4):
+            current = os.path.join(tmpdir.name, 'ceph-{}'.format(osd),
+                                   'current')
+            for pg in range(3):
+                os.makedirs(os.path.join(current, '1.{}_head'.format(pg)))
+                for obj in range(2):
+                    open(os.path.join(current, '1.{}_head'.format(pg),
+                                      'obj{}'.format(obj)), 'w').close()
+            os.symlink('/dev/null', os.path.join(
+                tmpdir.name, 'ceph-{}'.format(osd), 'block'))
+        # root, 4 * (ceph-N, current, block, 3 * (pg dir, 2 objects))
+        return tmpdir.name, 1 + 4 * (3 + 3 * 3)
+
+    def _patch_owner(self, uid, gid):
+        getpwnam = patch('pwd.getpwnam').start()
+        getpwnam.return_value.pw_uid = uid
+        getgrnam = patch('grp.getgrnam').start()
+        getgrnam.return_value.gr_gid = gid
+        patch.object(charms_ceph.upgrade, 'ceph_user',
+                     return_value='ceph').start()
+        patch.object(charms_ceph.upgrade, 'status_set').start()
+        patch.object(charms_ceph.upgrade, 'log').start()
+        self.addCleanup(patch.stopall)
+        return patch('os.lchown').start()
+
+    def test_update_owner_no_recurse(self):
+        path, _ = self._owner_tree()
+        lchown = self._patch_owner(os.getuid() + 1, os.getgid())
+        self.assertEqual(charms_ceph.upgrade.update_owner(path, False), 1)
+        lchown.assert_called_once_with(path, os.getuid() + 1, os.getgid())
+
+    def test_update_owner_recurse_file(self):
+        path, _ = self._owner_tree()
+        path = os.path.join(path, 'ceph-0', 'current', '1.0_head', 'obj0')
+        lchown = self._patch_owner(os.getuid(), os.getgid() + 1)
+        self.assertEqual(charms_ceph.upgrade.update_owner(path, True), 1)
+        lchown.assert_called_once_with(path, os.getuid(), os.getgid() + 1)
+
+    @patch.object(charms_ceph.upgrade, 'OWNER_SPLIT_DIRS', 4)
+    @patch.object(charms_ceph.upgrade.concurrent.futures,
+                  'ProcessPoolExecutor',
+                  concurrent.futures.ThreadPoolExecutor)
+    def test_update_owner_recurse(self):
+        path, inodes = self._owner_tree()
+        lchown = self._patch_owner(os.getuid() + 1, os.getgid())
+        kick = MagicMock()
+        self.assertEqual(
+            charms_ceph.upgrade.update_owner(path, True, kick_function=kick),
+            inodes)
+        self.assertEqual(lchown.call_count, inodes)
+        lchown.assert_any_call(
+            os.path.join(path, 'ceph-3', 'current', '1.2_head', 'obj1'),
+            os.getuid() + 1, os.getgid())
+        lchown.assert_any_call(os.path.join(path, 'ceph-3', 'block'),
+                               os.getuid() + 1, os.getgid())
+        self.assertTrue(kick.called)
+
+    @patch.object(charms_ceph.upgrade, 'OWNER_SPLIT_DIRS', 4)
+    def test_update_owner_recurse_owned(self):
+        path, _ = self._owner_tree()
+        lchown = self._patch_owner(os.getuid(), os.getgid())
+        self.assertEqual(charms_ceph.upgrade.update_owner(path, True), 0)
+        lchown.assert_not_called()
+
+    @patch.object(charms_ceph.disks, 'PROC_DIR', '/nonexistent/proc')
+    @patch.object(charms_ceph.disks, 'MOUNTINFO_FILE', os.devnull)
     @patch('os.path.exists')
     @patch('os.listdir')
-    @patch.object(charms_ceph.utils, 'filesystem_mounted')
+    @patch.object(charms_ceph.disks, 'filesystem_mounted')
     def test_unmounted_osds(self, fs_mounted, listdir, exists):
         exists.return_value = True
         listdir.return_value = [
             '/var/lib/ceph/osd/ceph-1', '/var/lib/ceph/osd/ceph-2']
-        fs_mounted.side_effect = lambda x: x == listdir.return_value[0]
-        osds = charms_ceph.utils.get_local_osd_ids()
+        fs_mounted.side_effect = (
+            lambda x, mounts=None: x == listdir.return_value[0])
+        osds = charms_ceph.disks.get_local_osd_ids()
         self.assertIn(listdir.return_value[0][-1], osds)
         self.assertNotIn(listdir.return_value[1][-1], osds)
 
+    @patch.object(charms_ceph.disks, 'PROC_DIR', '/nonexistent/proc')
+    @patch.object(charms_ceph.disks, 'MOUNTINFO_FILE', os.devnull)
     @patch('os.path.exists')
     @patch('os.listdir')
-    @patch.object(charms_ceph.utils, 'filesystem_mounted')
+    @patch.object(charms_ceph.disks, 'filesystem_mounted')
     def test_get_osd_ids_unexpected_files(self, fs_mounted, listdir, exists):
         exists.return_value = True
         listdir.return_value = [
@@ -488,8 +615,9 @@ class UpgradeRollingTestCase(unittest.TestCase):
             '/var/lib/ceph/osd/ceph-2',
             '/var/lib/ceph/osd/ohno!'
         ]
-        fs_mounted.side_effect = lambda x: x == listdir.return_value[0]
-        osds = charms_ceph.utils.get_local_osd_ids()
+        fs_mounted.side_effect = (
+            lambda x, mounts=None: x == listdir.return_value[0])
+        osds = charms_ceph.disks.get_local_osd_ids()
         self.assertIn(listdir.return_value[0][-1], osds)
         self.assertNotIn(listdir.return_value[1][-1], osds)
 
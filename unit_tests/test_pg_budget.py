@@ -0,0 +1,167 @@
+# Copyright 2017 Canonical Ltd
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#  http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import unittest
+
+from unittest.mock import patch
+
+import charms_ceph.pg_budget
+import charms_ceph.utils
+
+
+def pool(name, size=3, pg_num=32, ratio=0.0, pg_num_min=0, bulk=False,
+         mode='off'):
+    return {'name': name, 'size': size, 'pg_num': pg_num,
+            'target_size_ratio': ratio, 'pg_num_min': pg_num_min,
+            'bulk': bulk, 'pg_autoscale_mode': mode}
+
+
+class PGBudgetTestCase(unittest.TestCase):
+
+    def test_round_pg_num(self):
+        round_pg_num = charms_ceph.pg_budget.round_pg_num
+        self.assertEqual(round_pg_num(100), 128)
+        self.assertEqual(round_pg_num(140), 128)
+        self.assertEqual(round_pg_num(0), 1)
+        self.assertEqual(round_pg_num(1024), 1024)
+
+    def test_empty_cluster(self):
+        # 10 OSDs * 100 PGs, a 20% pool with 3 replicas: 66 -> 64
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=None, ratio=0.2), [], 10), 64)
+        # An erasure coded 4+2 pool holding everything: 1000 would round
+        # up to 1024, taking 6144 PGs out of a budget of 6000
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('ec', size=6, pg_num=None, ratio=1.0), [], 60), 512)
+
+    def test_existing_pools_use_budget(self):
+        pools = [pool('big', size=3, pg_num=256),
+                 pool('ec', size=6, pg_num=64)]
+        # 1000 - 768 - 384 leaves nothing, the pool gets the minimum
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('new', pg_num=None, ratio=0.5), pools, 10),
+            charms_ceph.pg_budget.MINIMUM_PGS)
+        # pg_num_min is honoured even when over budget
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('new', pg_num=None, ratio=0.5, pg_num_min=16), pools, 10),
+            16)
+
+    def test_ratios_are_normalised(self):
+        pools = [pool('a', pg_num=512, ratio=0.9),
+                 pool('b', pg_num=512, ratio=0.9)]
+        # The ratios add up to 2.7, the new pool gets a third of 3000
+        pg_num = charms_ceph.pg_budget.calculate_pg_num(
+            pool('c', pg_num=None, ratio=0.9), pools, 30)
+        self.assertEqual(pg_num, 256)
+        self.assertLessEqual(3 * (256 * 3), 3000)
+
+    def test_rounding_stays_within_budget(self):
+        pools = [pool('a', pg_num=64, ratio=0.45)]
+        # 0.45 * 1000 / 3 = 150 would round up to 256, which is too much
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('b', pg_num=None, ratio=0.45), pools, 10), 128)
+
+    def test_requested_pg_num_is_an_upper_bound(self):
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=100, ratio=1.0), [], 100), 64)
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=100000, ratio=0.1), [], 10), 32)
+
+    def test_autoscaled_pools(self):
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=None, ratio=1.0, mode='on'), [], 100),
+            charms_ceph.pg_budget.AUTOSCALER_DEFAULT_PGS)
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=None, ratio=1.0, mode='on', bulk=True),
+            [], 100), 2048)
+
+    def test_replaces_existing_pool(self):
+        pools = [pool('rbd', pg_num=4096)]
+        self.assertEqual(charms_ceph.pg_budget.calculate_pg_num(
+            pool('rbd', pg_num=None, ratio=0.2), pools, 10), 64)
+
+    def test_pool_from_detail(self):
+        detail = {'pool_name': 'rbd', 'size': 3, 'pg_num': 64,
+                  'pg_num_target': 128, 'flags_names': 'hashpspool,bulk',
+                  'pg_autoscale_mode': 'on',
+                  'options': {'target_size_ratio': 0.2, 'pg_num_min': 32}}
+        self.assertEqual(charms_ceph.pg_budget.pool_from_detail(detail),
+                         pool('rbd', pg_num=128, ratio=0.2, pg_num_min=32,
+                              bulk=True, mode='on'))
+
+    def test_pool_from_request(self):
+        self.assertEqual(
+            charms_ceph.pg_budget.pool_from_request(
+                {'name': 'rbd', 'replicas': 3, 'weight': 40}, 3),
+            pool('rbd', pg_num=None, ratio=0.4))
+        self.assertEqual(
+            charms_ceph.pg_budget.pool_from_request(
+                {'name': 'rbd', 'target-size-ratio': 0.3, 'bulk': True,
+                 'pg-autoscale-mode': 'warn', 'pg_num': 64}, 6),
+            pool('rbd', size=6, pg_num=64, ratio=0.3, bulk=True,
+                 mode='warn'))
+
+    def test_pool_from_request_autoscale_mode(self):
+        self.assertEqual(
+            charms_ceph.pg_budget.pool_from_request(
+                {'name': 'rbd', 'weight': 40}, 3, 'on'),
+            pool('rbd', pg_num=None, ratio=0.4, mode='on'))
+        self.assertEqual(
+            charms_ceph.pg_budget.pool_from_request(
+                {'name': 'rbd', 'weight': 40, 'pg-autoscale-mode': 'off'},
+                3, 'on'),
+            pool('rbd', pg_num=None, ratio=0.4, mode='off'))
+
+    @patch.object(charms_ceph.pg_budget, 'enabled_manager_modules')
+    def test_get_autoscale_mode(self, _enabled_manager_modules):
+        _enabled_manager_modules.return_value = ['pg_autoscaler', 'status']
+        self.assertEqual(charms_ceph.pg_budget.get_autoscale_mode(), 'on')
+        _enabled_manager_modules.return_value = ['status']
+        self.assertEqual(charms_ceph.pg_budget.get_autoscale_mode(), 'off')
+
+    @patch.object(charms_ceph.pg_budget, 'validator')
+    def test_validate_pg_budget_keys(self, _validator):
+        _validator.side_effect = AssertionError('5 is not a bool')
+        with self.assertRaises(ValueError):
+            charms_ceph.pg_budget.validate_pg_budget_keys({'bulk': 5})
+        _validator.assert_called_once_with(5, bool)
+
+    @patch.object(charms_ceph.pg_budget, 'get_target_pg_per_osd')
+    @patch.object(charms_ceph.pg_budget, 'config')
+    @patch.object(charms_ceph.pg_budget, 'get_osds')
+    @patch.object(charms_ceph.utils.subprocess, 'check_output')
+    def test_get_budgeted_pg_num(self, _check_output, _get_osds, _config,
+                                 _get_target_pg_per_osd):
+        _get_osds.return_value = list(range(10))
+        _config.return_value = None
+        _get_target_pg_per_osd.return_value = 200
+        _check_output.return_value = json.dumps([
+            {'pool_name': 'big', 'size': 3, 'pg_num': 256}]).encode('UTF-8')
+        self.assertEqual(charms_ceph.pg_budget.get_budgeted_pg_num(
+            'admin', {'name': 'rbd', 'weight': 50}, size=3), 256)
+        _check_output.assert_called_once_with(
+            ['ceph', '--id', 'admin', 'osd', 'pool', 'ls', 'detail',
+             '--format=json'])
+        # Pools created with the autoscaler on start small
+        with patch.object(charms_ceph.pg_budget, 'get_autoscale_mode',
+                          return_value='on'):
+            self.assertEqual(charms_ceph.pg_budget.get_budgeted_pg_num(
+                'admin', {'name': 'rbd', 'weight': 50}, size=3), 32)
+            self.assertEqual(charms_ceph.pg_budget.get_budgeted_pg_num(
+                'admin', {'name': 'rbd', 'weight': 50, 'bulk': True},
+                size=3), 256)
+        _get_osds.return_value = []
+        self.assertIsNone(charms_ceph.pg_budget.get_budgeted_pg_num(
+            'admin', {'name': 'rbd'}, size=3))
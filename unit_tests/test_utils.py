@@ -13,16 +13,25 @@
 # limitations under the License.
 
 import collections
+import os
 import subprocess
+import tempfile
 import unittest
 
 from unittest.mock import (
+    ANY,
     call,
     mock_open,
     MagicMock,
     patch,
 )
 
+import charms_ceph.disks as disks
+import charms_ceph.keys as keys
+import charms_ceph.mgr as mgr
+import charms_ceph.pools as pools
+import charms_ceph.tuning as tuning
+import charms_ceph.upgrade as upgrade
 import charms_ceph.utils as utils
 
 from subprocess import CalledProcessError
@@ -48,10 +57,10 @@ class CephTestCase(unittest.TestCase):
     def setUp(self):
         super(CephTestCase, self).setUp()
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils.subprocess, 'call')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils.os.path, 'isdir')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks.subprocess, 'call')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks.os.path, 'isdir')
     def test_start_osd(self,
                        _isdir,
                        _exists,
@@ -59,7 +68,7 @@ class CephTestCase(unittest.TestCase):
                        _pkgrevno):
         _pkgrevno.side_effect = [1, -1]
         _isdir.return_value = False
-        utils.start_osds(['/dev/sdb'])
+        disks.start_osds(['/dev/sdb'])
         _isdir.assert_called_once_with('/dev/sdb')
         _exists.assert_called_once_with('/dev/sdb')
         _call.assert_has_calls([
@@ -69,14 +78,14 @@ class CephTestCase(unittest.TestCase):
             call(['udevadm', 'settle']),
         ])
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils, '_ceph_disk')
-    @patch.object(utils, 'is_mapped_luks_device')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'is_block_device')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks, '_ceph_disk')
+    @patch.object(disks, 'is_mapped_luks_device')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'is_block_device')
     def test_osdize_dev_ceph_disk(self, _is_blk, _cmp, _mounted, _exists,
                                   _is_mapped_luks_device, _ceph_disk,
                                   _check_call, _kv):
@@ -90,21 +99,21 @@ class CephTestCase(unittest.TestCase):
         _cmp.return_value = -1
         _ceph_disk.return_value = ['ceph-disk', 'prepare']
         _is_mapped_luks_device.return_value = False
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
         _ceph_disk.assert_called_with('/dev/sdb', 'xfs', None, False)
         _check_call.assert_called_with(['ceph-disk', 'prepare'])
         db.get.assert_called_with('osd-devices', [])
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
         db.flush.assert_called_once()
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils, '_ceph_volume')
-    @patch.object(utils, 'is_mapped_luks_device')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'is_block_device')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks, '_ceph_volume')
+    @patch.object(disks, 'is_mapped_luks_device')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'is_block_device')
     def test_osdize_dev_ceph_volume(self, _is_blk, _cmp, _mounted, _exists,
                                     _is_mapped_luks_device,
                                     _ceph_volume,
@@ -119,7 +128,7 @@ class CephTestCase(unittest.TestCase):
         _cmp.return_value = 1
         _ceph_volume.return_value = ['ceph-volume', 'prepare']
         _is_mapped_luks_device.return_value = False
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
         _ceph_volume.assert_called_with('/dev/sdb', None, False,
                                         'ceph', None, None)
         _check_call.assert_called_with(['ceph-volume', 'prepare'])
@@ -127,14 +136,14 @@ class CephTestCase(unittest.TestCase):
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
         db.flush.assert_called_once()
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils, '_ceph_volume')
-    @patch.object(utils, 'is_mapped_luks_device')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'is_block_device')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks, '_ceph_volume')
+    @patch.object(disks, 'is_mapped_luks_device')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'is_block_device')
     def test_osdize_dev_ceph_volume_with_osdid(self, _is_blk, _cmp, _mounted,
                                                _exists, _is_mapped_luks_device,
                                                _ceph_volume, _check_call, _kv):
@@ -148,7 +157,7 @@ class CephTestCase(unittest.TestCase):
         _cmp.return_value = 1
         _ceph_volume.return_value = ['ceph-volume', 'prepare']
         _is_mapped_luks_device.return_value = False
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None,
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None,
                      osd_id=123)
         _ceph_volume.assert_called_with('/dev/sdb', None, False,
                                         'ceph', 123, None)
@@ -157,14 +166,14 @@ class CephTestCase(unittest.TestCase):
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
         db.flush.assert_called_once()
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils, '_ceph_volume')
-    @patch.object(utils, 'is_mapped_luks_device')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'is_block_device')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks, '_ceph_volume')
+    @patch.object(disks, 'is_mapped_luks_device')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'is_block_device')
     def test_osdize_dev_ceph_volume_with_skip(self, _is_blk, _cmp, _mounted,
                                               _exists, _is_mapped_luks_device,
                                               _ceph_volume, _check_call, _kv):
@@ -178,7 +187,7 @@ class CephTestCase(unittest.TestCase):
         _cmp.return_value = 1
         _ceph_volume.return_value = ['ceph-volume', 'prepare']
         _is_mapped_luks_device.return_value = False
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None,
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None,
                      osd_id=123, bluestore_skip=('wal', 'db'))
         _ceph_volume.assert_called_with('/dev/sdb', None, False,
                                         'ceph', 123, ('wal', 'db'))
@@ -187,21 +196,21 @@ class CephTestCase(unittest.TestCase):
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
         db.flush.assert_called_once()
 
-    @patch.object(utils, 'kv')
+    @patch.object(disks, 'kv')
     def test_osdize_dev_already_processed(self, _kv):
         """Ensure that previously processed disks are skipped"""
         db = MagicMock()
         _kv.return_value = db
         db.get.return_value = ['/dev/sdb']
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
         db.get.assert_called_with('osd-devices', [])
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'is_block_device')
-    @patch.object(utils, 'is_osd_disk')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'is_block_device')
+    @patch.object(disks, 'is_osd_disk')
     def test_osdize_dev_already_processed_without_kv(self, _is_osd, _is_blk,
                                                      _mounted, _exists, _kv):
         """Ensure that previously processed disks are skipped"""
@@ -212,18 +221,18 @@ class CephTestCase(unittest.TestCase):
         _is_osd.return_value = True
         _mounted.return_value = True
         _is_blk.return_value = True
-        utils.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
+        disks.osdize('/dev/sdb', osd_format='xfs', osd_journal=None)
         db.get.assert_called_with('osd-devices', [])
         db.set.assert_called_with('osd-devices', ['/dev/sdb'])
 
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils, '_ceph_volume')
-    @patch.object(utils, 'is_mapped_luks_device')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'is_block_device')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks, '_ceph_volume')
+    @patch.object(disks, 'is_mapped_luks_device')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'is_block_device')
     def test_osdize_already_processed_luks_bluestore(
             self, _is_blk, _cmp, _mounted,
             _exists,
@@ -239,20 +248,20 @@ class CephTestCase(unittest.TestCase):
         _cmp.return_value = 1
         _ceph_volume.return_value = ['ceph-volume', 'prepare']
         _is_mapped_luks_device.return_value = True
-        utils.osdize('/dev/sdb', encrypt=True, osd_format=None,
+        disks.osdize('/dev/sdb', encrypt=True, osd_format=None,
                      osd_journal=None, key_manager='vault')
         db.get.assert_called_with('osd-devices', [])
         db.set.assert_called_with('osd-devices', [])
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'mkdir')
-    @patch.object(utils, 'chownr')
-    @patch.object(utils, 'ceph_user')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'mkdir')
+    @patch.object(disks, 'chownr')
+    @patch.object(disks, 'ceph_user')
     def test_osdize_dir(self, _ceph_user, _chown, _mkdir,
                         _cmp, _mounted, _exists, _call, _kv,
                         _cmp_pkgrevno):
@@ -265,22 +274,22 @@ class CephTestCase(unittest.TestCase):
         _mounted.return_value = False
         _exists.return_value = False
         _cmp.return_value = True
-        utils.osdize('/srv/osd', osd_format='xfs', osd_journal=None)
+        disks.osdize('/srv/osd', osd_format='xfs', osd_journal=None)
         _call.assert_called_with(['sudo', '-u', 'ceph', 'ceph-disk', 'prepare',
                                   '--data-dir', '/srv/osd', '--bluestore'])
 
         db.get.assert_called_with('osd-devices', [])
         db.set.assert_called_with('osd-devices', ['/srv/osd'])
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'kv')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils, 'is_device_mounted')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'mkdir')
-    @patch.object(utils, 'chownr')
-    @patch.object(utils, 'ceph_user')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'kv')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks, 'is_device_mounted')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'mkdir')
+    @patch.object(disks, 'chownr')
+    @patch.object(disks, 'ceph_user')
     def test_osdize_dir_nautilus(self, _ceph_user, _chown, _mkdir,
                                  _cmp, _mounted, _exists, _call, _kv,
                                  _cmp_pkgrevno):
@@ -293,7 +302,7 @@ class CephTestCase(unittest.TestCase):
         _mounted.return_value = False
         _exists.return_value = False
         _cmp.return_value = True
-        utils.osdize('/srv/osd', osd_format='xfs', osd_journal=None)
+        disks.osdize('/srv/osd', osd_format='xfs', osd_journal=None)
         _call.assert_not_called()
 
     @patch.object(utils.subprocess, 'check_output')
@@ -547,69 +556,137 @@ class CephTestCase(unittest.TestCase):
         self.assertEqual(osd_tree[0].root, "default")
         self.assertEqual(osd_tree[-1].root, "default")
 
-    @patch.object(utils.subprocess, 'check_output')
-    @patch.object(utils, "ceph_user", lambda: "ceph")
-    @patch.object(utils.socket, "gethostname", lambda: "osd001")
+    AUTH_LS = b"""{"auth_dump": [
+        {"entity": "client.admin", "key": "admin-key",
+         "caps": {"mds": "allow *", "mgr": "allow *", "mon": "allow *",
+                  "osd": "allow *"}},
+        {"entity": "client.rgw001", "key": "rgw-key",
+         "caps": {"mon": "allow rw", "osd": "allow rwx"}}
+    ]}"""
+    MON_CMD = ['sudo', '-u', 'ceph', 'ceph', '--name', 'mon.', '--keyring',
+               '/var/lib/ceph/mon/ceph-osd001/keyring']
+
+    @patch.object(keys.subprocess, 'check_output')
+    @patch.object(keys, "ceph_user", lambda: "ceph")
+    @patch.object(keys.socket, "gethostname", lambda: "osd001")
     def test_get_named_key_with_pool(self, mock_check_output):
-        mock_check_output.side_effect = [CalledProcessError(0, 0, 0), b""]
-        utils.ceph_auth_get.cache_clear()
-        utils.get_named_key(name="rgw001", pool_list=["rbd", "block"])
+        keys._auth_snapshots.clear()
+        mock_check_output.side_effect = [self.AUTH_LS, b""]
+        keys.get_named_key(name="rgw002", pool_list=["rbd", "block"])
         mock_check_output.assert_has_calls([
-            call(['sudo', '-u', 'ceph', 'ceph', '--name',
-                  'mon.', '--keyring',
-                  '/var/lib/ceph/mon/ceph-osd001/keyring',
-                  'auth', 'get', 'client.rgw001']),
-            call(['sudo', '-u', 'ceph', 'ceph', '--name',
-                  'mon.', '--keyring',
-                  '/var/lib/ceph/mon/ceph-osd001/keyring',
-                  'auth', 'get-or-create', 'client.rgw001',
-                  'mon', ('allow r; allow command "osd blacklist"'
-                          '; allow command "osd blocklist"'),
-                  'osd', 'allow rwx pool=rbd pool=block'])])
-
-    @patch.object(utils.subprocess, 'check_output')
-    @patch.object(utils, 'ceph_user', lambda: "ceph")
-    @patch.object(utils.socket, "gethostname", lambda: "osd001")
+            call(self.MON_CMD + ['auth', 'ls', '-f', 'json']),
+            call(self.MON_CMD + [
+                'auth', 'get-or-create', 'client.rgw002',
+                'mon', ('allow r; allow command "osd blacklist"'
+                        '; allow command "osd blocklist"'),
+                'osd', 'allow rwx pool=rbd pool=block'])])
+
+    @patch.object(keys.subprocess, 'check_output')
+    @patch.object(keys, 'ceph_user', lambda: "ceph")
+    @patch.object(keys.socket, "gethostname", lambda: "osd001")
     def test_get_named_key(self, mock_check_output):
-        mock_check_output.side_effect = [CalledProcessError(0, 0, 0), b""]
-        utils.get_named_key(name="rgw001")
+        keys._auth_snapshots.clear()
+        mock_check_output.side_effect = [self.AUTH_LS, b"new-key"]
+        self.assertEqual(keys.get_named_key(name="rgw002"), "new-key")
         mock_check_output.assert_has_calls([
-            call(['sudo', '-u', 'ceph', 'ceph', '--name',
-                  'mon.', '--keyring',
-                  '/var/lib/ceph/mon/ceph-osd001/keyring',
-                  'auth', 'get', 'client.rgw001']),
-            call(['sudo', '-u', 'ceph', 'ceph', '--name',
-                  'mon.', '--keyring',
-                  '/var/lib/ceph/mon/ceph-osd001/keyring',
-                  'auth', 'get-or-create', 'client.rgw001',
-                  'mon', ('allow r; allow command "osd blacklist"'
-                          '; allow command "osd blocklist"'),
-                  'osd', 'allow rwx'])])
+            call(self.MON_CMD + ['auth', 'ls', '-f', 'json']),
+            call(self.MON_CMD + [
+                'auth', 'get-or-create', 'client.rgw002',
+                'mon', ('allow r; allow command "osd blacklist"'
+                        '; allow command "osd blocklist"'),
+                'osd', 'allow rwx'])])
         mock_check_output.reset_mock()
-        mock_check_output.side_effect = [b'key=test']
-        utils.get_named_key(name="rgw001")
-        mock_check_output.assert_called_once_with([
-            'sudo', '-u', 'ceph', 'ceph', '--name',
-            'mon.', '--keyring',
-            '/var/lib/ceph/mon/ceph-osd001/keyring',
-            'auth', 'get', 'client.rgw001'])
+        self.assertEqual(keys.get_named_key(name="rgw001"), "rgw-key")
+        mock_check_output.assert_not_called()
+        # The created key is re-read on its own
+        mock_check_output.side_effect = [
+            b'[{"entity": "client.rgw002", "key": "new-key", "caps": {}}]']
+        self.assertEqual(keys.get_named_key(name="rgw002"), "new-key")
+        mock_check_output.assert_called_once_with(
+            self.MON_CMD + ['auth', 'get', 'client.rgw002', '-f', 'json'],
+            stderr=utils.subprocess.DEVNULL)
         mock_check_output.reset_mock()
-        utils.get_named_key(name="rgw001")
+        keys.get_named_key(name="rgw002")
         mock_check_output.assert_not_called()
 
+    @patch.object(keys.subprocess, 'check_output')
+    @patch.object(keys, 'ceph_user', lambda: "ceph")
+    @patch.object(keys.socket, "gethostname", lambda: "osd001")
+    def test_ceph_auth_get_unavailable(self, mock_check_output):
+        keys._auth_snapshots.clear()
+        mock_check_output.side_effect = CalledProcessError(1, 'ceph')
+        self.assertIsNone(keys.ceph_auth_get('client.rgw001'))
+        mock_check_output.side_effect = [self.AUTH_LS]
+        self.assertEqual(keys.ceph_auth_get('client.rgw001'), 'rgw-key')
+
+    def test_normalize_caps(self):
+        self.assertEqual(
+            keys.normalize_caps({
+                'mon': 'allow r;  allow command "osd blacklist"',
+                'osd': 'allow rwx pool=a, allow rwx pool=b',
+                'mgr': ''}),
+            keys.normalize_caps(
+                ['osd', 'allow rwx pool=b; allow rwx pool=a',
+                 'mon', 'allow command "osd blacklist", allow r']))
+        self.assertEqual(
+            keys.normalize_caps(["mds 'allow *'", "osd 'allow rw'"]),
+            {'mds': ('allow *',), 'osd': ('allow rw',)})
+        self.assertEqual(
+            keys.normalize_caps({'mon': ['allow command "a, b"']}),
+            {'mon': ('allow command "a, b"',)})
+        self.assertIsNone(keys.normalize_caps(['mon allow r']))
+
+    @patch.object(keys, 'get_auth_snapshot')
+    @patch.object(keys.subprocess, 'check_call')
+    @patch.object(keys, 'is_leader', lambda: True)
+    @patch.object(keys, 'ceph_user', lambda: "ceph")
+    def test_upgrade_key_caps(self, _check_call, _get_auth_snapshot):
+        snapshot = keys.CephAuthSnapshot()
+        snapshot._entities = {
+            'client.osd-upgrade': {
+                'entity': 'client.osd-upgrade',
+                'key': 'upgrade-key',
+                'caps': {'mon': 'allow rwx'}}}
+        _get_auth_snapshot.return_value = snapshot
+        keys.upgrade_key_caps('client.osd-upgrade', {'mon': ['allow rwx']})
+        _check_call.assert_not_called()
+        caps = {'mon': ['allow rwx'], 'osd': ['allow rwx']}
+        keys.upgrade_key_caps('client.osd-upgrade', caps,
+                              pool_list=['rbd'])
+        _check_call.assert_called_once_with(
+            ['sudo', '-u', 'ceph', 'ceph', 'auth', 'caps',
+             'client.osd-upgrade', 'mon', 'allow rwx',
+             'osd', 'allow rwx pool=rbd'])
+        self.assertEqual(caps['osd'], ['allow rwx'])
+        self.assertEqual(snapshot._stale, {'client.osd-upgrade'})
+
+    def test_auth_snapshot(self):
+        snapshot = keys.CephAuthSnapshot(client='admin')
+        with patch.object(keys.subprocess, 'check_output') as check_output:
+            check_output.return_value = self.AUTH_LS
+            self.assertTrue(snapshot.exists('client.admin'))
+            self.assertFalse(snapshot.exists('client.missing'))
+            self.assertEqual(snapshot.caps('client.rgw001'),
+                             {'mon': 'allow rw', 'osd': 'allow rwx'})
+            check_output.assert_called_once_with(
+                ['ceph', '--id', 'admin', 'auth', 'ls', '-f', 'json'])
+            check_output.side_effect = CalledProcessError(2, 'ceph')
+            snapshot.invalidate('client.rgw001')
+            self.assertFalse(snapshot.exists('client.rgw001'))
+
     def test_parse_key_with_caps_existing_key(self):
         expected = "AQCm7aVYQFXXFhAAj0WIeqcag88DKOvY4UKR/g=="
         with_caps = "[client.osd-upgrade]\n" \
                     "	key = AQCm7aVYQFXXFhAAj0WIeqcag88DKOvY4UKR/g==\n" \
                     "	caps mon = \"allow command \"config-key\";"
-        key = utils.parse_key(with_caps)
+        key = keys.parse_key(with_caps)
         self.assertEqual(key, expected)
 
     def test_parse_key_without_caps(self):
         expected = "AQCm7aVYQFXXFhAAj0WIeqcag88DKOvY4UKR/g=="
         without_caps = "[client.osd-upgrade]\n" \
                        "	key = AQCm7aVYQFXXFhAAj0WIeqcag88DKOvY4UKR/g=="
-        key = utils.parse_key(without_caps)
+        key = keys.parse_key(without_caps)
         self.assertEqual(key, expected)
 
     def test_unmounted_devices_with_correct_input(self):
@@ -632,16 +709,17 @@ class CephTestCase(unittest.TestCase):
         with patch(
                 'pyudev.Context.list_devices',
                 return_value=input_data):
-            with patch.object(utils, 'is_device_mounted',
-                              return_value=False):
-                actual_output = utils.unmounted_disks()
+            with patch.object(disks.MountTable, 'load') as _load:
+                _load.return_value.device_mounted.return_value = False
+                actual_output = disks.unmounted_disks()
                 self.assertEqual(
                     actual_output,
                     ['/dev/sda', '/dev/sdb', '/dev/sdm']
                 )
-            with patch.object(utils, 'is_device_mounted',
-                              return_value=True):
-                actual_output = utils.unmounted_disks()
+                _load.assert_called_once_with()
+            with patch.object(disks.MountTable, 'load') as _load:
+                _load.return_value.device_mounted.return_value = True
+                actual_output = disks.unmounted_disks()
                 self.assertEqual(actual_output, [])
 
     def test_unmounted_devices_doesnt_raise_with_incorrect_input(self):
@@ -656,16 +734,17 @@ class CephTestCase(unittest.TestCase):
                 'pyudev.Context.list_devices',
                 return_value=input_data):
             for is_device_mounted in (False, True):
-                with patch.object(utils, 'is_device_mounted',
-                                  return_value=is_device_mounted):
+                with patch.object(disks.MountTable, 'load') as _load:
+                    _load.return_value.device_mounted.return_value = (
+                        is_device_mounted)
                     # No assertion, we just want to check that it doesn't raise
-                    utils.unmounted_disks()
+                    disks.unmounted_disks()
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(disks.subprocess, 'check_output')
     def test_get_partition_list(self, output):
         with open('unit_tests/partx_output', 'r') as partx_out:
             output.return_value = partx_out.read().encode('UTF-8')
-        partition_list = utils.get_partition_list('/dev/xvdb')
+        partition_list = disks.get_partition_list('/dev/xvdb')
         self.assertEqual(len(partition_list), 4)
 
     @patch.object(utils.subprocess, 'check_output')
@@ -902,13 +981,13 @@ class CephTestCase(unittest.TestCase):
     def test_create_monitor_nautilus(self):
         self._test_create_monitor(nautilus=True)
 
-    @patch.object(utils, 'write_file')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'ceph_user')
-    @patch.object(utils, 'os')
-    @patch.object(utils.subprocess, 'check_output')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.socket, 'gethostname', lambda: 'TestHost')
+    @patch.object(keys, 'write_file')
+    @patch.object(keys, 'cmp_pkgrevno')
+    @patch.object(keys, 'ceph_user')
+    @patch.object(keys, 'os')
+    @patch.object(keys.subprocess, 'check_output')
+    @patch.object(keys.subprocess, 'check_call')
+    @patch.object(keys.socket, 'gethostname', lambda: 'TestHost')
     def _test_create_keyrings(self,
                               mock_check_call,
                               mock_check_output,
@@ -943,7 +1022,7 @@ class CephTestCase(unittest.TestCase):
                 call(['ceph-create-keys', '--id', test_hostname])
             )
 
-        utils.create_keyrings()
+        keys.create_keyrings()
 
         mock_check_call.assert_has_calls(test_calls)
 
@@ -1019,14 +1098,14 @@ class CephTestCase(unittest.TestCase):
         packages = utils.determine_packages_to_remove()
         self.assertNotIn(utils.CHRONY_PACKAGE, packages)
 
-    @patch.object(utils, 'chownr')
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'ceph_user')
-    @patch.object(utils, 'os')
-    @patch.object(utils, 'log')
-    @patch.object(utils, 'mkdir')
-    @patch.object(utils, 'subprocess')
-    @patch.object(utils, 'service_restart')
+    @patch.object(mgr, 'chownr')
+    @patch.object(mgr, 'cmp_pkgrevno')
+    @patch.object(mgr, 'ceph_user')
+    @patch.object(mgr, 'os')
+    @patch.object(mgr, 'log')
+    @patch.object(mgr, 'mkdir')
+    @patch.object(mgr, 'subprocess')
+    @patch.object(mgr, 'service_restart')
     def test_bootstrap_manager(self,
                                mock_service_restart,
                                mock_subprocess,
@@ -1059,7 +1138,7 @@ class CephTestCase(unittest.TestCase):
 
         fake_open = mock_open()
         with patch('charms_ceph.open', fake_open, create=True):
-            utils.bootstrap_manager()
+            mgr.bootstrap_manager()
 
         self.assertEqual(
             mock_subprocess.check_call.mock_calls,
@@ -1102,12 +1181,12 @@ class CephTestCase(unittest.TestCase):
             'quincy -> reef',
             'reef -> squid',
         ])
-        self.assertEqual(utils.pretty_print_upgrade_paths(), expected)
+        self.assertEqual(upgrade.pretty_print_upgrade_paths(), expected)
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(disks.subprocess, 'check_output')
     def test_get_conf(self, _check_output):
         _check_output.return_value = '12345\n'
-        self.assertEqual(utils.get_conf('bluestore_block_db_size'),
+        self.assertEqual(disks.get_conf('bluestore_block_db_size'),
                          '12345')
         _check_output.assert_called_with([
             'ceph-osd',
@@ -1116,14 +1195,14 @@ class CephTestCase(unittest.TestCase):
         ])
 
     def test_partition_name(self):
-        self.assertEqual(utils._partition_name('/dev/sdb'),
+        self.assertEqual(disks._partition_name('/dev/sdb'),
                          '/dev/sdb1')
-        self.assertEqual(utils._partition_name('/dev/mmcblk0'),
+        self.assertEqual(disks._partition_name('/dev/mmcblk0'),
                          '/dev/mmcblk0p1')
 
-    @patch.object(utils, 'get_named_key')
+    @patch.object(keys, 'get_named_key')
     def test_get_rbd_mirror_key(self, _get_named_key):
-        utils.get_rbd_mirror_key('someid')
+        keys.get_rbd_mirror_key('someid')
         _get_named_key.assert_called_once_with(
             name='someid',
             caps=collections.OrderedDict([
@@ -1135,54 +1214,54 @@ class CephTestCase(unittest.TestCase):
             ])
         )
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(pools.subprocess, 'check_output')
     def test_list_pools(self, _check_output):
         _check_output.return_value = 'poola\npoolb\n'
-        self.assertEqual(utils.list_pools('someuser'), ['poola', 'poolb'])
+        self.assertEqual(pools.list_pools('someuser'), ['poola', 'poolb'])
         _check_output.assert_called_with(['rados', '--id', 'someuser',
                                           'lspools'], universal_newlines=True,
                                          stderr=subprocess.STDOUT)
-        self.assertEqual(utils.list_pools(client='someotheruser'),
+        self.assertEqual(pools.list_pools(client='someotheruser'),
                          ['poola', 'poolb'])
         _check_output.assert_called_with(['rados', '--id', 'someotheruser',
                                           'lspools'], universal_newlines=True,
                                          stderr=subprocess.STDOUT)
-        self.assertEqual(utils.list_pools(),
+        self.assertEqual(pools.list_pools(),
                          ['poola', 'poolb'])
         _check_output.assert_called_with(['rados', '--id', 'admin',
                                           'lspools'], universal_newlines=True,
                                          stderr=subprocess.STDOUT)
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(pools.subprocess, 'check_output')
     def test_get_pool_param(self, _check_output):
         _check_output.return_value = 'size: 3\n'
-        self.assertEqual(utils.get_pool_param('rbd', 'size'), '3')
+        self.assertEqual(pools.get_pool_param('rbd', 'size'), '3')
         _check_output.assert_called_with(['ceph', '--id', 'admin', 'osd',
                                           'pool', 'get', 'rbd', 'size'],
                                          universal_newlines=True,
                                          stderr=subprocess.STDOUT)
 
-    @patch.object(utils, 'get_pool_param')
+    @patch.object(pools, 'get_pool_param')
     def test_get_pool_erasure_profile(self, _get_pool_param):
         _get_pool_param.side_effect = subprocess.CalledProcessError(
             13, [], 'EACCES: pool')
-        self.assertEqual(utils.get_pool_erasure_profile('cinder-ceph'), None)
+        self.assertEqual(pools.get_pool_erasure_profile('cinder-ceph'), None)
         _get_pool_param.side_effect = subprocess.CalledProcessError(
             22, [], 'EINVAL: invalid')
         with self.assertRaises(subprocess.CalledProcessError):
-            utils.get_pool_erasure_profile('cinder-ceph')
+            pools.get_pool_erasure_profile('cinder-ceph')
         _get_pool_param.side_effect = None
         _get_pool_param.return_value = 'my-ec-profile'
-        self.assertEqual(utils.get_pool_erasure_profile('cinder-ceph'),
+        self.assertEqual(pools.get_pool_erasure_profile('cinder-ceph'),
                          'my-ec-profile')
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(pools.subprocess, 'check_output')
     def test_get_pool_quota(self, _check_output):
         _check_output.return_value = (
             "quotas for pool 'rbd':\n"
             "  max objects: N/A\n"
             "  max bytes  : N/A\n")
-        self.assertEqual(utils.get_pool_quota('rbd'),
+        self.assertEqual(pools.get_pool_quota('rbd'),
                          {})
         _check_output.assert_called_with(['ceph', '--id', 'admin', 'osd',
                                           'pool', 'get-quota', 'rbd'],
@@ -1192,20 +1271,20 @@ class CephTestCase(unittest.TestCase):
             "quotas for pool 'rbd':\n"
             "  max objects: 10\n"
             "  max bytes  : N/A\n")
-        self.assertEqual(utils.get_pool_quota('rbd'), {'max_objects': '10'})
+        self.assertEqual(pools.get_pool_quota('rbd'), {'max_objects': '10'})
         _check_output.return_value = (
             "quotas for pool 'rbd':\n"
             "  max objects: N/A\n"
             "  max bytes  : 1000B\n")
-        self.assertEqual(utils.get_pool_quota('rbd'), {'max_bytes': '1000'})
+        self.assertEqual(pools.get_pool_quota('rbd'), {'max_bytes': '1000'})
         _check_output.return_value = (
             "quotas for pool 'rbd':\n"
             "  max objects: 10\n"
             "  max bytes  : 1000B\n")
-        self.assertEqual(utils.get_pool_quota('rbd'),
+        self.assertEqual(pools.get_pool_quota('rbd'),
                          {'max_objects': '10', 'max_bytes': '1000'})
 
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(pools.subprocess, 'check_output')
     def test_get_pool_applications(self, _check_output):
         _check_output.return_value = (
             '{\n'
@@ -1213,27 +1292,27 @@ class CephTestCase(unittest.TestCase):
             '        "application": {}\n'
             '    }\n'
             '}\n')
-        self.assertEqual(utils.get_pool_applications(),
+        self.assertEqual(pools.get_pool_applications(),
                          {'pool': {'application': {}}})
         _check_output.assert_called_with(['ceph', '--id', 'admin', 'osd',
                                           'pool', 'application', 'get'],
                                          universal_newlines=True,
                                          stderr=subprocess.STDOUT)
-        utils.get_pool_applications('42')
+        pools.get_pool_applications('42')
         _check_output.assert_called_with(['ceph', '--id', 'admin', 'osd',
                                           'pool', 'application', 'get', '42'],
                                          universal_newlines=True,
                                          stderr=subprocess.STDOUT)
 
-    @patch.object(utils, 'get_pool_erasure_profile')
-    @patch.object(utils, 'get_pool_param')
-    @patch.object(utils, 'get_pool_quota')
-    @patch.object(utils, 'list_pools')
-    @patch.object(utils, 'get_pool_applications')
+    @patch.object(pools, 'get_pool_erasure_profile')
+    @patch.object(pools, 'get_pool_param')
+    @patch.object(pools, 'get_pool_quota')
+    @patch.object(pools, 'list_pools')
+    @patch.object(pools, 'get_pool_applications')
     def test_list_pools_detail(self, _get_pool_applications, _list_pools,
                                _get_pool_quota, _get_pool_param,
                                _get_pool_erasure_profile):
-        self.assertEqual(utils.list_pools_detail(), {})
+        self.assertEqual(pools.list_pools_detail(), {})
         _get_pool_applications.return_value = {'pool': {'application': {}}}
         _list_pools.return_value = ['pool', 'pool2']
         _get_pool_quota.return_value = {'max_objects': '10',
@@ -1241,7 +1320,7 @@ class CephTestCase(unittest.TestCase):
         _get_pool_param.return_value = '42'
         _get_pool_erasure_profile.return_value = 'my-ec-profile'
         self.assertEqual(
-            utils.list_pools_detail(),
+            pools.list_pools_detail(),
             {'pool': {'applications': {'application': {}},
                       'parameters': {'pg_num': '42',
                                      'size': '42',
@@ -1282,177 +1361,195 @@ class CephApplyOSDSettingsTestCase(unittest.TestCase):
 
     def setUp(self):
         super(CephApplyOSDSettingsTestCase, self).setUp()
-        self.base_cmd = 'ceph daemon osd.{osd_id} config --format=json'
-        self.get_cmd = self.base_cmd + ' get {key}'
-        self.set_cmd = self.base_cmd + ' set {key} {value}'
+        self.show_cmd = 'ceph daemon osd.{osd_id} config --format=json show'
+        self.inject_cmd = (
+            'ceph daemon osd.{osd_id} --format=json injectargs {args}')
         self.grace = 'osd_heartbeat_grace'
         self.interval = 'osd_heartbeat_interval'
 
-    @patch.object(utils.subprocess, 'check_output')
-    @patch.object(utils.os.path, 'exists')
-    @patch.object(utils.os, 'listdir')
-    @patch.object(utils, 'filesystem_mounted')
+    @patch.object(disks, 'get_crimson_osd_ids')
+    @patch.object(disks.MountTable, 'load')
+    @patch.object(disks.os.path, 'exists')
+    @patch.object(disks.os, 'listdir')
+    @patch.object(disks, 'filesystem_mounted')
     def test_osd_ids_with_crimson(self, fs_mounted, listdir,
-                                  path_exists, check_output):
-        check_output.return_value = b'38271 /usr/bin/crimson-osd -i 5\n'
+                                  path_exists, _load, _crimson_osd_ids):
+        _crimson_osd_ids.return_value = {'5'}
+        fs_mounted.return_value = True
         listdir.return_value = ['ceph-3', 'ceph-5']
-        self.assertEqual(['3'], utils.get_local_osd_ids())
-
-    @patch.object(utils, 'get_local_osd_ids')
-    @patch.object(utils.subprocess, 'check_output')
+        self.assertEqual(['3'], disks.get_local_osd_ids())
+        fs_mounted.assert_has_calls([
+            call('/var/lib/ceph/osd/ceph-3', mounts=_load.return_value),
+            call('/var/lib/ceph/osd/ceph-5', mounts=_load.return_value)])
+        _load.assert_called_once_with()
+
+    def test_get_crimson_osd_ids(self):
+        procs = {
+            '100': ('crimson-osd', b'/usr/bin/crimson-osd\0-i\0005\0'),
+            '101': ('ceph-osd', b'/usr/bin/ceph-osd\0-i\0003\0'),
+            '102': ('crimson-osd', b'/usr/bin/crimson-osd\0-i\0007\0'),
+        }
+        with tempfile.TemporaryDirectory() as proc_dir:
+            for pid, (comm, cmdline) in procs.items():
+                os.mkdir(os.path.join(proc_dir, pid))
+                with open(os.path.join(proc_dir, pid, 'comm'), 'w') as f:
+                    f.write(comm + '\n')
+                with open(os.path.join(proc_dir, pid, 'cmdline'), 'wb') as f:
+                    f.write(cmdline)
+            os.mkdir(os.path.join(proc_dir, 'self'))
+            with patch.object(disks, 'PROC_DIR', proc_dir):
+                self.assertEqual(disks.get_crimson_osd_ids(), {'5', '7'})
+
+    @patch.object(tuning, 'get_local_osd_ids')
+    @patch.object(tuning.subprocess, 'check_output')
     def test_apply_osd_settings(self, _check_output, _get_local_osd_ids):
         _get_local_osd_ids.return_value = ['0']
         output = {
-            self.get_cmd.format(osd_id=0, key=self.grace):
-                b'{"osd_heartbeat_grace":"19"}',
-            self.set_cmd.format(osd_id=0, key=self.grace, value='21'):
+            self.show_cmd.format(osd_id=0):
+                b'{"osd_heartbeat_grace":"19","osd_heartbeat_interval":"6"}',
+            self.inject_cmd.format(osd_id=0,
+                                   args='--osd_heartbeat_grace=21'):
                 b"""{"success":"osd_heartbeat_grace = '21'"}"""}
         _check_output.side_effect = lambda x: output[' '.join(x)]
         self.assertTrue(
-            utils.apply_osd_settings({'osd heartbeat grace': '21'}))
+            tuning.apply_osd_settings({'osd heartbeat grace': '21',
+                                      'osd heartbeat interval': '6'}))
         check_output_calls = [
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'get',
-                  'osd_heartbeat_grace']),
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'set',
-                  'osd_heartbeat_grace', '21'])]
+            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json',
+                  'show']),
+            call(['ceph', 'daemon', 'osd.0', '--format=json', 'injectargs',
+                  '--osd_heartbeat_grace=21'])]
         _check_output.assert_has_calls(check_output_calls)
         self.assertTrue(_check_output.call_count == len(check_output_calls))
 
-    @patch.object(utils, 'get_local_osd_ids')
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(tuning, 'get_local_osd_ids')
+    @patch.object(tuning.subprocess, 'check_output')
     def test_apply_osd_settings_noop_on_one_osd(self, _check_output,
                                                 _get_local_osd_ids):
         _get_local_osd_ids.return_value = ['0', '1']
         output = {
-            self.get_cmd.format(osd_id=0, key=self.grace):
-                b'{"osd_heartbeat_grace":"21"}',
-            self.get_cmd.format(osd_id=1, key=self.grace):
-                b'{"osd_heartbeat_grace":"20"}',
-            self.set_cmd.format(osd_id=1, key=self.grace, value='21'):
+            self.show_cmd.format(osd_id=0):
+                b'{"osd_heartbeat_grace":"21","osd_heartbeat_interval":"2"}',
+            self.show_cmd.format(osd_id=1):
+                b'{"osd_heartbeat_grace":"20","osd_heartbeat_interval":"3"}',
+            self.inject_cmd.format(
+                osd_id=1,
+                args='--osd_heartbeat_grace=21 --osd_heartbeat_interval=2'):
                 b"""{"success":"osd_heartbeat_interval = '2'"}"""}
         _check_output.side_effect = lambda x: output[' '.join(x)]
         self.assertTrue(
-            utils.apply_osd_settings({'osd heartbeat grace': '21'}))
+            tuning.apply_osd_settings({'osd heartbeat grace': '21',
+                                      'osd heartbeat interval': '2'}))
         check_output_calls = [
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'get',
-                  'osd_heartbeat_grace']),
-            call(['ceph', 'daemon', 'osd.1', 'config', '--format=json', 'get',
-                  'osd_heartbeat_grace']),
-            call(['ceph', 'daemon', 'osd.1', 'config', '--format=json', 'set',
-                  'osd_heartbeat_grace', '21'])]
-        _check_output.assert_has_calls(check_output_calls)
+            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json',
+                  'show']),
+            call(['ceph', 'daemon', 'osd.1', 'config', '--format=json',
+                  'show']),
+            call(['ceph', 'daemon', 'osd.1', '--format=json', 'injectargs',
+                  '--osd_heartbeat_grace=21 --osd_heartbeat_interval=2'])]
+        _check_output.assert_has_calls(check_output_calls, any_order=True)
         self.assertTrue(_check_output.call_count == len(check_output_calls))
 
-    @patch.object(utils, 'get_local_osd_ids')
-    @patch.object(utils.subprocess, 'check_output')
-    def _test_apply_osd_settings_error(self, _check_output,
-                                       _get_local_osd_ids):
+    @patch.object(tuning, 'get_local_osd_ids')
+    @patch.object(tuning.subprocess, 'check_output')
+    def test_apply_osd_settings_unknown_key(self, _check_output,
+                                            _get_local_osd_ids):
         _get_local_osd_ids.return_value = ['0']
         output = {
-            self.get_cmd.format(osd_id=0, key=self.grace):
-                b"""{"error":"error setting 'osd_heartbeat_grace'"}"""}
+            self.show_cmd.format(osd_id=0):
+                b'{"osd_heartbeat_interval":"6"}'}
         _check_output.side_effect = lambda x: output[' '.join(x)]
         self.assertFalse(
-            utils.apply_osd_settings({'osd heartbeat grace': '21'}))
-        check_output_calls = [
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'get',
-                  'osd_heartbeat_grace'])]
-        _check_output.assert_has_calls(check_output_calls)
-        self.assertTrue(_check_output.call_count == len(check_output_calls))
+            tuning.apply_osd_settings({'osd heartbeat grace': '21'}))
+        self.assertEqual(_check_output.call_count, 1)
 
-    @patch.object(utils, 'get_local_osd_ids')
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(tuning, 'get_local_osd_ids')
+    @patch.object(tuning.subprocess, 'check_output')
     def test_apply_osd_settings_error(self, _check_output,
                                       _get_local_osd_ids):
         _get_local_osd_ids.return_value = ['0', '1']
         output = {
-            self.get_cmd.format(osd_id=0, key=self.grace):
-                b'{"osd_heartbeat_grace":"19"}',
-            self.get_cmd.format(osd_id=0, key=self.interval):
-                b'{"osd_heartbeat_interval":"3"}',
-            self.set_cmd.format(osd_id=0, key=self.interval, value='2'):
-                b"""{"success":"osd_heartbeat_interval = '2'"}""",
-            self.set_cmd.format(osd_id=0, key=self.grace, value='21'):
+            self.show_cmd.format(osd_id=0):
+                b'{"osd_heartbeat_grace":"19","osd_heartbeat_interval":"3"}',
+            self.show_cmd.format(osd_id=1):
+                b'{"osd_heartbeat_grace":"21","osd_heartbeat_interval":"2"}',
+            self.inject_cmd.format(
+                osd_id=0,
+                args='--osd_heartbeat_grace=21 --osd_heartbeat_interval=2'):
                 b"""{"error":"error setting 'osd_heartbeat_grace'"}"""}
         _check_output.side_effect = lambda x: output[' '.join(x)]
-        check_output_calls = [
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'get',
-                  'osd_heartbeat_grace']),
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'get',
-                  'osd_heartbeat_interval']),
-            call(['ceph', 'daemon', 'osd.0', 'config', '--format=json', 'set',
-                  'osd_heartbeat_grace', '21'])]
-        with self.assertRaises(utils.OSDConfigSetError):
-            utils.apply_osd_settings({
+        with self.assertRaises(tuning.OSDConfigSetError):
+            tuning.apply_osd_settings({
                 'osd heartbeat grace': '21',
                 'osd heartbeat interval': '2'})
-            _check_output.assert_has_calls(check_output_calls)
-            self.assertTrue(
-                _check_output.call_count == len(check_output_calls))
+        # The other OSD is still queried
+        _check_output.assert_any_call(
+            ['ceph', 'daemon', 'osd.1', 'config', '--format=json', 'show'])
+        self.assertEqual(_check_output.call_count, 3)
 
 
 class CephVolumeSizeCalculatorTestCase(unittest.TestCase):
 
-    @patch.object(utils, 'get_conf')
+    @patch.object(disks, 'get_conf')
     def test_calculate_volume_size_journal(self, _get_conf):
         _get_conf.return_value = 0
-        self.assertEqual(utils.calculate_volume_size('journal'),
+        self.assertEqual(disks.calculate_volume_size('journal'),
                          1024)
         _get_conf.assert_called_with('osd_journal_size')
 
         _get_conf.return_value = 2048
-        self.assertEqual(utils.calculate_volume_size('journal'),
+        self.assertEqual(disks.calculate_volume_size('journal'),
                          2048)
 
-    @patch.object(utils, 'get_conf')
+    @patch.object(disks, 'get_conf')
     def test_calculate_volume_size_db(self, _get_conf):
         _get_conf.return_value = 0
-        self.assertEqual(utils.calculate_volume_size('db'),
+        self.assertEqual(disks.calculate_volume_size('db'),
                          1024)
         _get_conf.assert_called_with('bluestore_block_db_size')
 
         _get_conf.return_value = 2048 * 1048576
-        self.assertEqual(utils.calculate_volume_size('db'),
+        self.assertEqual(disks.calculate_volume_size('db'),
                          2048)
 
-    @patch.object(utils, 'get_conf')
+    @patch.object(disks, 'get_conf')
     def test_calculate_volume_size_wal(self, _get_conf):
         _get_conf.return_value = 0
-        self.assertEqual(utils.calculate_volume_size('wal'),
+        self.assertEqual(disks.calculate_volume_size('wal'),
                          576)
         _get_conf.assert_called_with('bluestore_block_wal_size')
 
         _get_conf.return_value = 512 * 1048576
-        self.assertEqual(utils.calculate_volume_size('wal'),
+        self.assertEqual(disks.calculate_volume_size('wal'),
                          512)
 
     def test_calculate_volume_size_invalid(self):
         with self.assertRaises(KeyError):
-            utils.calculate_volume_size('invalid')
+            disks.calculate_volume_size('invalid')
 
 
 class CephInitializeDiskTestCase(unittest.TestCase):
 
-    @patch.object(utils, '_luks_uuid')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.os.path, 'exists')
+    @patch.object(disks, '_luks_uuid')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks.os.path, 'exists')
     def test_initialize_disk(self, _exists, _check_call,
                              _luks_uuid):
         _exists.return_value = False
         _luks_uuid.return_value = None
-        self.assertEqual(utils._initialize_disk('/dev/sdb',
+        self.assertEqual(disks._initialize_disk('/dev/sdb',
                                                 'test-UUID'),
                          '/dev/sdb')
         _check_call.assert_not_called()
 
-    @patch.object(utils, '_luks_uuid')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.os.path, 'exists')
+    @patch.object(disks, '_luks_uuid')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks.os.path, 'exists')
     def test_initialize_disk_vaultlocker(self, _exists, _check_call,
                                          _luks_uuid):
         _exists.return_value = False
         _luks_uuid.return_value = None
-        self.assertEqual(utils._initialize_disk('/dev/sdb',
+        self.assertEqual(disks._initialize_disk('/dev/sdb',
                                                 'test-UUID',
                                                 True,
                                                 'vault'),
@@ -1466,16 +1563,16 @@ class CephInitializeDiskTestCase(unittest.TestCase):
                   'bs=512', 'count=1']),
         ])
 
-    @patch.object(utils, '_luks_uuid')
-    @patch.object(utils.subprocess, 'check_call')
-    @patch.object(utils.os.path, 'exists')
+    @patch.object(disks, '_luks_uuid')
+    @patch.object(disks.subprocess, 'check_call')
+    @patch.object(disks.os.path, 'exists')
     def test_initialize_disk_vaultlocker_encrypted(self,
                                                    _exists,
                                                    _check_call,
                                                    _luks_uuid):
         _exists.return_value = True
         _luks_uuid.return_value = 'existing-UUID'
-        self.assertEqual(utils._initialize_disk('/dev/sdb',
+        self.assertEqual(disks._initialize_disk('/dev/sdb',
                                                 'test-UUID',
                                                 True,
                                                 'vault'),
@@ -1502,9 +1599,9 @@ class CephActiveBlueStoreDeviceTestCase(unittest.TestCase):
         '/var/lib/ceph/osd/ceph-6/block': '/dev/ceph-5678/osd-block-5678',
     }
 
-    @patch.object(utils, 'glob')
-    @patch.object(utils, 'os')
-    @patch.object(utils, 'lvm')
+    @patch.object(disks, 'glob')
+    @patch.object(disks, 'os')
+    @patch.object(disks, 'lvm')
     def _test_active_bluestore_device(self, _lvm, _os, _glob, device, active):
         _os.path.is_link.return_value = True
         _glob.glob.return_value = self._test_links.keys()
@@ -1521,7 +1618,7 @@ class CephActiveBlueStoreDeviceTestCase(unittest.TestCase):
             lambda link: self._test_links.get(link)
         )
 
-        self.assertEqual(utils.is_active_bluestore_device(device),
+        self.assertEqual(disks.is_active_bluestore_device(device),
                          active)
         _lvm.is_lvm_physical_volume.assert_called_with(device)
         if device in self._test_pvs:
@@ -1548,21 +1645,21 @@ class CephActiveBlueStoreDeviceTestCase(unittest.TestCase):
 
 class CephLUKSDeviceTestCase(unittest.TestCase):
 
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks, '_luks_uuid')
     def test_no_luks_header(self, _luks_uuid):
         _luks_uuid.return_value = None
-        self.assertEqual(utils.is_luks_device('/dev/sdb'), False)
+        self.assertEqual(disks.is_luks_device('/dev/sdb'), False)
 
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks, '_luks_uuid')
     def test_luks_header(self, _luks_uuid):
         _luks_uuid.return_value = '5e1e4c89-4f68-4b9a-bd93-e25eec34e80f'
-        self.assertEqual(utils.is_luks_device('/dev/sdb'), True)
+        self.assertEqual(disks.is_luks_device('/dev/sdb'), True)
 
 
 class CephMappedLUKSDeviceTestCase(unittest.TestCase):
 
-    @patch.object(utils.os, 'walk')
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks.os, 'walk')
+    @patch.object(disks, '_luks_uuid')
     def test_no_luks_header_not_mapped(self, _luks_uuid, _walk):
         _luks_uuid.return_value = None
 
@@ -1572,10 +1669,10 @@ class CephMappedLUKSDeviceTestCase(unittest.TestCase):
             }[path]
         _walk.side_effect = os_walk_side_effect
 
-        self.assertEqual(utils.is_mapped_luks_device('/dev/sdb'), False)
+        self.assertEqual(disks.is_mapped_luks_device('/dev/sdb'), False)
 
-    @patch.object(utils.os, 'walk')
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks.os, 'walk')
+    @patch.object(disks, '_luks_uuid')
     def test_luks_header_mapped(self, _luks_uuid, _walk):
         _luks_uuid.return_value = 'db76d142-4782-42f2-84c6-914f9db889a0'
 
@@ -1585,10 +1682,10 @@ class CephMappedLUKSDeviceTestCase(unittest.TestCase):
             }[path]
         _walk.side_effect = os_walk_side_effect
 
-        self.assertEqual(utils.is_mapped_luks_device('/dev/sdb'), True)
+        self.assertEqual(disks.is_mapped_luks_device('/dev/sdb'), True)
 
-    @patch.object(utils.os, 'walk')
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks.os, 'walk')
+    @patch.object(disks, '_luks_uuid')
     def test_luks_header_not_mapped(self, _luks_uuid, _walk):
         _luks_uuid.return_value = 'db76d142-4782-42f2-84c6-914f9db889a0'
 
@@ -1598,10 +1695,10 @@ class CephMappedLUKSDeviceTestCase(unittest.TestCase):
             }[path]
         _walk.side_effect = os_walk_side_effect
 
-        self.assertEqual(utils.is_mapped_luks_device('/dev/sdb'), False)
+        self.assertEqual(disks.is_mapped_luks_device('/dev/sdb'), False)
 
-    @patch.object(utils.os, 'walk')
-    @patch.object(utils, '_luks_uuid')
+    @patch.object(disks.os, 'walk')
+    @patch.object(disks, '_luks_uuid')
     def test_no_luks_header_mapped(self, _luks_uuid, _walk):
         """
         This is an edge case where a device is mapped (i.e. used for something
@@ -1615,7 +1712,7 @@ class CephMappedLUKSDeviceTestCase(unittest.TestCase):
             }[path]
         _walk.side_effect = os_walk_side_effect
 
-        self.assertEqual(utils.is_mapped_luks_device('/dev/sdb'), False)
+        self.assertEqual(disks.is_mapped_luks_device('/dev/sdb'), False)
 
 
 class CephAllocateVolumeTestCase(unittest.TestCase):
@@ -1625,15 +1722,15 @@ class CephAllocateVolumeTestCase(unittest.TestCase):
         '/dev/sdb': 'ceph-1234'
     }
 
-    @patch.object(utils, '_initialize_disk')
-    @patch.object(utils.uuid, 'uuid4')
-    @patch.object(utils, 'lvm')
+    @patch.object(disks, '_initialize_disk')
+    @patch.object(disks.uuid, 'uuid4')
+    @patch.object(disks, 'lvm')
     def _test_allocate_logical_volume(self, _lvm, _uuid4, _initialize_disk,
                                       dev, lv_type, osd_fsid,
                                       size=None, shared=False, encrypt=False,
                                       key_manager='ceph'):
         test_uuid = '1234-1234-1234-1234'
-        pv_dev = utils._partition_name(dev)
+        pv_dev = disks._partition_name(dev)
 
         _lvm.list_logical_volumes.return_value = self._lvs
         _initialize_disk.return_value = pv_dev
@@ -1648,7 +1745,7 @@ class CephAllocateVolumeTestCase(unittest.TestCase):
         else:
             vg_name = 'ceph-{}'.format(osd_fsid)
 
-        self.assertEqual(utils._allocate_logical_volume(dev, lv_type, osd_fsid,
+        self.assertEqual(disks._allocate_logical_volume(dev, lv_type, osd_fsid,
                                                         size, shared),
                          '{}/{}'.format(vg_name, lv_name))
 
@@ -1692,9 +1789,9 @@ class CephAllocateVolumeTestCase(unittest.TestCase):
 
 class CephDiskTestCase(unittest.TestCase):
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'find_least_used_utility_device')
-    @patch.object(utils, 'get_devices')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'find_least_used_utility_device')
+    @patch.object(disks, 'get_devices')
     def test_ceph_disk_bluestore(self, _get_devices,
                                  _find_least_used_utility_device,
                                  _cmp_pkgrevno):
@@ -1704,7 +1801,7 @@ class CephDiskTestCase(unittest.TestCase):
         _find_least_used_utility_device.side_effect = \
             lambda x, lvs=False: x[0]
         self.assertEqual(
-            utils._ceph_disk('/dev/sdb',
+            disks._ceph_disk('/dev/sdb',
                              osd_format='xfs',
                              osd_journal=None,
                              encrypt=False),
@@ -1712,9 +1809,9 @@ class CephDiskTestCase(unittest.TestCase):
              '--bluestore', '/dev/sdb']
         )
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils, 'find_least_used_utility_device')
-    @patch.object(utils, 'get_devices')
+    @patch.object(disks, 'cmp_pkgrevno')
+    @patch.object(disks, 'find_least_used_utility_device')
+    @patch.object(disks, 'get_devices')
     def test_ceph_disk_bluestore_dbwal(self, _get_devices,
                                        _find_least_used_utility_device,
                                        _cmp_pkgrevno):
@@ -1728,7 +1825,7 @@ class CephDiskTestCase(unittest.TestCase):
         _find_least_used_utility_device.side_effect = \
             lambda x, lvs=False: x[0]
         self.assertEqual(
-            utils._ceph_disk('/dev/sdb',
+            disks._ceph_disk('/dev/sdb',
                              osd_format='xfs',
                              osd_journal=None,
                              encrypt=False),
@@ -1744,11 +1841,11 @@ class CephVolumeTestCase(unittest.TestCase):
 
     _osd_uuid = '22b371a5-0db9-4154-b011-23f8f03c4d8c'
 
-    @patch.object(utils.uuid, 'uuid4')
-    @patch.object(utils, 'calculate_volume_size')
-    @patch.object(utils, 'find_least_used_utility_device')
-    @patch.object(utils, 'get_devices')
-    @patch.object(utils, '_allocate_logical_volume')
+    @patch.object(disks.uuid, 'uuid4')
+    @patch.object(disks, 'calculate_volume_size')
+    @patch.object(disks, 'find_least_used_utility_device')
+    @patch.object(disks, 'get_devices')
+    @patch.object(disks, '_allocate_logical_volume')
     def test_ceph_volume_bluestore(self, _allocate_logical_volume,
                                    _get_devices,
                                    _find_least_used_utility_device,
@@ -1762,7 +1859,7 @@ class CephVolumeTestCase(unittest.TestCase):
             )
         )
         self.assertEqual(
-            utils._ceph_volume('/dev/sdb',
+            disks._ceph_volume('/dev/sdb',
                                osd_journal=None,
                                encrypt=False),
             ['ceph-volume',
@@ -1783,11 +1880,11 @@ class CephVolumeTestCase(unittest.TestCase):
         _find_least_used_utility_device.assert_not_called()
         _calculate_volume_size.assert_not_called()
 
-    @patch.object(utils.uuid, 'uuid4')
-    @patch.object(utils, 'calculate_volume_size')
-    @patch.object(utils, 'find_least_used_utility_device')
-    @patch.object(utils, 'get_devices')
-    @patch.object(utils, '_allocate_logical_volume')
+    @patch.object(disks.uuid, 'uuid4')
+    @patch.object(disks, 'calculate_volume_size')
+    @patch.object(disks, 'find_least_used_utility_device')
+    @patch.object(disks, 'get_devices')
+    @patch.object(disks, '_allocate_logical_volume')
     def test_ceph_volume_bluestore_db_and_wal(self, _allocate_logical_volume,
                                               _get_devices,
                                               _find_least_used_utility_device,
@@ -1807,7 +1904,7 @@ class CephVolumeTestCase(unittest.TestCase):
             )
         )
         self.assertEqual(
-            utils._ceph_volume('/dev/sdb',
+            disks._ceph_volume('/dev/sdb',
                                osd_journal=None,
                                encrypt=False),
             ['ceph-volume',
@@ -1848,11 +1945,11 @@ class CephVolumeTestCase(unittest.TestCase):
             call('db'),
         ])
 
-    @patch.object(utils.uuid, 'uuid4')
-    @patch.object(utils, 'calculate_volume_size')
-    @patch.object(utils, 'find_least_used_utility_device')
-    @patch.object(utils, 'get_devices')
-    @patch.object(utils, '_allocate_logical_volume')
+    @patch.object(disks.uuid, 'uuid4')
+    @patch.object(disks, 'calculate_volume_size')
+    @patch.object(disks, 'find_least_used_utility_device')
+    @patch.object(disks, 'get_devices')
+    @patch.object(disks, '_allocate_logical_volume')
     def test_ceph_volume_bluestore_skip_db(self, _allocate_logical_volume,
                                            _get_devices,
                                            _find_least_used_utility_device,
@@ -1872,7 +1969,7 @@ class CephVolumeTestCase(unittest.TestCase):
             )
         )
         self.assertEqual(
-            utils._ceph_volume('/dev/sdb',
+            disks._ceph_volume('/dev/sdb',
                                osd_journal=None,
                                encrypt=False,
                                bluestore_skip=('db',)),
@@ -1907,28 +2004,188 @@ class CephVolumeTestCase(unittest.TestCase):
 
 
 class CephVersionTestCase(unittest.TestCase):
-    @patch.object(utils, 'get_os_codename_install_source')
+    @patch.object(upgrade, 'get_os_codename_install_source')
     def test_resolve_ceph_version_trusty(self, get_os_codename_install_source):
         get_os_codename_install_source.return_value = 'juno'
-        self.assertEqual(utils.resolve_ceph_version('cloud:trusty-juno'),
+        self.assertEqual(upgrade.resolve_ceph_version('cloud:trusty-juno'),
                          'firefly')
         get_os_codename_install_source.return_value = 'kilo'
-        self.assertEqual(utils.resolve_ceph_version('cloud:trusty-kilo'),
+        self.assertEqual(upgrade.resolve_ceph_version('cloud:trusty-kilo'),
                          'hammer')
         get_os_codename_install_source.return_value = 'liberty'
-        self.assertEqual(utils.resolve_ceph_version(
+        self.assertEqual(upgrade.resolve_ceph_version(
                          'cloud:trusty-liberty'), 'hammer')
         get_os_codename_install_source.return_value = 'mitaka'
-        self.assertEqual(utils.resolve_ceph_version(
+        self.assertEqual(upgrade.resolve_ceph_version(
                          'cloud:trusty-mitaka'), 'jewel')
         get_os_codename_install_source.return_value = 'newton'
-        self.assertEqual(utils.resolve_ceph_version(
+        self.assertEqual(upgrade.resolve_ceph_version(
                          'cloud:xenial-newton'), 'jewel')
         get_os_codename_install_source.return_value = 'ocata'
-        self.assertEqual(utils.resolve_ceph_version(
+        self.assertEqual(upgrade.resolve_ceph_version(
                          'cloud:xenial-ocata'), 'jewel')
 
 
+class MountTableTestCase(unittest.TestCase):
+
+    MOUNTINFO = (
+        "22 1 8:2 / / rw,relatime shared:1 - ext4 /dev/sda2 rw\n"
+        "60 22 8:17 / /var/lib/ceph/osd/ceph-10 rw,noatime shared:30 - "
+        "xfs /dev/sdb1 rw,attr2\n"
+        "61 22 0:55 / /var/lib/ceph/osd/ceph-3 rw,relatime shared:31 - "
+        "tmpfs tmpfs rw\n"
+        "62 22 253:0 / /srv/with\\040space rw - ext4 "
+        "/dev/mapper/vg-lv rw\n"
+        "garbage line\n")
+
+    def setUp(self):
+        with patch('builtins.open', mock_open(read_data=self.MOUNTINFO)):
+            self.mounts = disks.MountTable.load()
+
+    def test_is_mountpoint_exact(self):
+        self.assertTrue(
+            self.mounts.is_mountpoint('/var/lib/ceph/osd/ceph-10'))
+        self.assertTrue(
+            self.mounts.is_mountpoint('/var/lib/ceph/osd/ceph-3/'))
+        self.assertFalse(
+            self.mounts.is_mountpoint('/var/lib/ceph/osd/ceph-1'))
+        self.assertFalse(self.mounts.is_mountpoint('/var/lib/ceph'))
+        self.assertTrue(self.mounts.is_mountpoint('/srv/with space'))
+
+    def test_both_directions(self):
+        self.assertEqual(self.mounts.device('/var/lib/ceph/osd/ceph-10'),
+                         '/dev/sdb1')
+        self.assertEqual(self.mounts.mountpoints('/dev/mapper/vg-lv'),
+                         ['/srv/with space'])
+        self.assertEqual(self.mounts.mountpoints('/dev/sdc'), [])
+
+    @patch.object(disks, 'log')
+    def test_load_unreadable(self, _log):
+        with tempfile.TemporaryDirectory() as tmpdir:
+            mounts = disks.MountTable.load(
+                os.path.join(tmpdir, 'mountinfo'))
+        self.assertFalse(mounts.is_mountpoint('/'))
+        self.assertEqual(mounts.mountpoints('/dev/sda2'), [])
+        _log.assert_called_once_with(ANY, level=disks.WARNING)
+
+    @patch.object(disks.os.path, 'realpath', lambda x: x)
+    @patch.object(disks, '_block_devnos')
+    def test_device_mounted(self, _block_devnos):
+        self.assertTrue(self.mounts.device_mounted('/dev/sdb1'))
+        _block_devnos.assert_not_called()
+        # Partition of sdb is mounted
+        _block_devnos.return_value = {'8:16', '8:17'}
+        self.assertTrue(self.mounts.device_mounted('/dev/sdb'))
+        _block_devnos.assert_called_once_with('sdb')
+        # LVM volume stacked on sdd is mounted
+        _block_devnos.return_value = {'8:48', '253:0'}
+        self.assertTrue(self.mounts.device_mounted('/dev/sdd'))
+        _block_devnos.return_value = {'8:32'}
+        self.assertFalse(self.mounts.device_mounted('/dev/sdc'))
+
+    def test_block_devnos(self):
+        tree = {
+            'sdb': '8:16',
+            'sdb/sdb1': '8:17',
+            'sdb1': '8:17',
+            'dm-0': '253:0',
+        }
+        with tempfile.TemporaryDirectory() as sys_block:
+            for name, devno in tree.items():
+                os.makedirs(os.path.join(sys_block, name, 'holders'))
+                with open(os.path.join(sys_block, name, 'dev'), 'w') as f:
+                    f.write(devno + '\n')
+            open(os.path.join(sys_block, 'sdb', 'sdb1', 'partition'),
+                 'w').close()
+            os.mkdir(os.path.join(sys_block, 'sdb1', 'holders', 'dm-0'))
+            with patch.object(disks, 'SYS_CLASS_BLOCK', sys_block):
+                self.assertEqual(disks._block_devnos('sdb'),
+                                 {'8:16', '8:17', '253:0'})
+                self.assertEqual(disks._block_devnos('sdz'), set())
+
+    @patch.object(disks.MountTable, 'load')
+    def test_filesystem_mounted(self, _load):
+        self.assertTrue(disks.filesystem_mounted('/var/lib/ceph/osd/ceph-10',
+                                                 mounts=self.mounts))
+        self.assertFalse(disks.filesystem_mounted('/var/lib/ceph/osd/ceph-1',
+                                                  mounts=self.mounts))
+        _load.assert_not_called()
+        disks.filesystem_mounted('/srv')
+        _load.return_value.is_mountpoint.assert_called_once_with('/srv')
+
+
+class PackageVersionSnapshotTestCase(unittest.TestCase):
+
+    DPKG_STATUS = (
+        "Package: ceph\n"
+        "Status: install ok installed\n"
+        "Priority: optional\n"
+        "Version: 17.2.6-0ubuntu0.22.04.1\n"
+        "Description: distributed storage\n"
+        " continuation line: not a field\n"
+        "\n"
+        "Package: ceph-common\n"
+        "Status: install ok installed\n"
+        "Version: 17.2.6-0ubuntu0.22.04.1\n"
+        "\n"
+        "Package: radosgw\n"
+        "Status: deinstall ok config-files\n"
+        "Version: 15.2.1-0ubuntu1\n")
+
+    def setUp(self):
+        self.snapshot = utils.PackageVersionSnapshot(status_file='/status')
+
+    def test_versions(self):
+        with patch('builtins.open',
+                   mock_open(read_data=self.DPKG_STATUS)) as _open:
+            self.assertEqual(self.snapshot.version('ceph'),
+                             '17.2.6-0ubuntu0.22.04.1')
+            self.assertEqual(self.snapshot.version('ceph-common'),
+                             '17.2.6-0ubuntu0.22.04.1')
+            self.assertIsNone(self.snapshot.version('radosgw'))
+        _open.assert_called_once_with('/status', 'r')
+
+    @patch.object(utils, '_host_cmp_pkgrevno')
+    @patch.object(utils, 'apt_pkg')
+    def test_cmp_memoised(self, _apt_pkg, _host_cmp_pkgrevno):
+        _apt_pkg.version_compare.return_value = 1
+        with patch('builtins.open',
+                   mock_open(read_data=self.DPKG_STATUS)) as _open:
+            for _ in range(3):
+                self.assertEqual(self.snapshot.cmp('ceph', '14.0.0'), 1)
+        _open.assert_called_once_with('/status', 'r')
+        _apt_pkg.version_compare.assert_called_once_with(
+            '17.2.6-0ubuntu0.22.04.1', '14.0.0')
+        _host_cmp_pkgrevno.assert_not_called()
+
+    @patch.object(utils, '_host_cmp_pkgrevno')
+    @patch.object(utils, 'apt_pkg')
+    def test_cmp_uninstalled_falls_back(self, _apt_pkg, _host_cmp_pkgrevno):
+        _host_cmp_pkgrevno.return_value = -1
+        with patch('builtins.open', mock_open(read_data=self.DPKG_STATUS)):
+            self.assertEqual(self.snapshot.cmp('radosgw', '14.0.0'), -1)
+        _host_cmp_pkgrevno.assert_called_once_with('radosgw', '14.0.0')
+        _apt_pkg.version_compare.assert_not_called()
+
+    @patch.object(utils, 'apt_pkg')
+    def test_refresh(self, _apt_pkg):
+        with patch('builtins.open',
+                   mock_open(read_data=self.DPKG_STATUS)) as _open:
+            self.snapshot.cmp('ceph', '14.0.0')
+            self.snapshot.refresh()
+            self.snapshot.cmp('ceph', '14.0.0')
+        self.assertEqual(_open.call_count, 2)
+        self.assertEqual(_apt_pkg.version_compare.call_count, 2)
+
+    @patch.object(utils, 'apt_pkg')
+    @patch.object(utils, '_package_versions')
+    def test_get_version(self, _package_versions, _apt_pkg):
+        _package_versions.version.return_value = '17.2.6-0ubuntu0.22.04.1'
+        _apt_pkg.upstream_version.return_value = '17.2.6'
+        self.assertEqual(utils.get_version(), 17.2)
+        _package_versions.version.assert_called_once_with('ceph')
+
+
 class CephFindLeastUsedDeviceTestCase(unittest.TestCase):
 
     _parts = {
@@ -1936,42 +2193,42 @@ class CephFindLeastUsedDeviceTestCase(unittest.TestCase):
         '/dev/sdc': ['1']
     }
 
-    @patch.object(utils, 'get_partitions')
+    @patch.object(disks, 'get_partitions')
     def test_find_least_used_utility_device(self, _get_partitions):
         _get_partitions.side_effect = lambda dev: self._parts.get(dev, [])
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb',
+            disks.find_least_used_utility_device(['/dev/sdb',
                                                   '/dev/sdx',
                                                   '/dev/sdc']),
             '/dev/sdx'
         )
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb', '/dev/sdc']),
+            disks.find_least_used_utility_device(['/dev/sdb', '/dev/sdc']),
             '/dev/sdc'
         )
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb']),
+            disks.find_least_used_utility_device(['/dev/sdb']),
             '/dev/sdb'
         )
         _get_partitions.assert_called()
 
-    @patch.object(utils, 'get_lvs')
+    @patch.object(disks, 'get_lvs')
     def test_find_least_used_utility_device_lvs(self, _get_lvs):
         _get_lvs.side_effect = lambda dev: self._parts.get(dev, [])
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb',
+            disks.find_least_used_utility_device(['/dev/sdb',
                                                   '/dev/sdx',
                                                   '/dev/sdc'],
                                                  lvs=True),
             '/dev/sdx'
         )
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb', '/dev/sdc'],
+            disks.find_least_used_utility_device(['/dev/sdb', '/dev/sdc'],
                                                  lvs=True),
             '/dev/sdc'
         )
         self.assertEqual(
-            utils.find_least_used_utility_device(['/dev/sdb'],
+            disks.find_least_used_utility_device(['/dev/sdb'],
                                                  lvs=True),
             '/dev/sdb'
         )
@@ -1984,14 +2241,14 @@ class CephGetLVSTestCase(unittest.TestCase):
         'testvg': ['lv1', 'lv2', 'lv3']
     }
 
-    @patch.object(utils, 'lvm')
+    @patch.object(disks, 'lvm')
     def test_get_lvs(self, _lvm):
         _lvm.is_lvm_physical_volume.return_value = True
         _lvm.list_lvm_volume_group.return_value = 'testvg'
         _lvm.list_logical_volumes.side_effect = (
             lambda vg: self._lvs.get(vg.lstrip('vg_name='), [])
         )
-        self.assertEqual(utils.get_lvs('/dev/sdb'),
+        self.assertEqual(disks.get_lvs('/dev/sdb'),
                          self._lvs['testvg'])
         _lvm.is_lvm_physical_volume.assert_called_with(
             '/dev/sdb'
@@ -2001,14 +2258,14 @@ class CephGetLVSTestCase(unittest.TestCase):
         )
         _lvm.list_logical_volumes.assert_called_with('vg_name=testvg')
 
-    @patch.object(utils, 'lvm')
+    @patch.object(disks, 'lvm')
     def test_get_lvs_no_lvs(self, _lvm):
         _lvm.is_lvm_physical_volume.return_value = True
         _lvm.list_lvm_volume_group.return_value = 'missingvg'
         _lvm.list_logical_volumes.side_effect = (
             lambda vg: self._lvs.get(vg.lstrip('vg_name='), [])
         )
-        self.assertEqual(utils.get_lvs('/dev/sdb'), [])
+        self.assertEqual(disks.get_lvs('/dev/sdb'), [])
         _lvm.is_lvm_physical_volume.assert_called_with(
             '/dev/sdb'
         )
@@ -2017,42 +2274,42 @@ class CephGetLVSTestCase(unittest.TestCase):
         )
         _lvm.list_logical_volumes.assert_called_with('vg_name=missingvg')
 
-    @patch.object(utils, 'lvm')
+    @patch.object(disks, 'lvm')
     def test_get_lvs_no_pv(self, _lvm):
         _lvm.is_lvm_physical_volume.return_value = False
-        self.assertEqual(utils.get_lvs('/dev/sdb'), [])
+        self.assertEqual(disks.get_lvs('/dev/sdb'), [])
         _lvm.is_lvm_physical_volume.assert_called_with(
             '/dev/sdb'
         )
 
-    @patch.object(utils, 'log')
+    @patch.object(disks, 'log')
     def test_is_pristine_disk(self, _log):
         data = b'\0' * 2048
         fake_open = mock_open(read_data=data)
-        with patch('charms_ceph.utils.open', fake_open):
-            result = utils.is_pristine_disk('/dev/vdz')
+        with patch('charms_ceph.disks.open', fake_open):
+            result = disks.is_pristine_disk('/dev/vdz')
         fake_open.assert_called_with('/dev/vdz', 'rb')
         self.assertFalse(_log.called)
         self.assertEqual(result, True)
 
-    @patch.object(utils, 'log')
+    @patch.object(disks, 'log')
     def test_is_pristine_disk_oserror(self, _log):
         fake_open = mock_open()
         oserror_exception = OSError('error')
         fake_open.side_effect = oserror_exception
-        with patch('charms_ceph.utils.open', fake_open):
-            result = utils.is_pristine_disk('/dev/sr0')
+        with patch('charms_ceph.disks.open', fake_open):
+            result = disks.is_pristine_disk('/dev/sr0')
         fake_open.assert_called_with('/dev/sr0', 'rb')
         _log.assert_called_with(oserror_exception)
         self.assertEqual(result, False)
 
-    @patch.object(utils, 'WARNING')
-    @patch.object(utils, 'log')
+    @patch.object(disks, 'WARNING')
+    @patch.object(disks, 'log')
     def test_is_pristine_disk_short_read(self, _log, _level_WRN):
         data = b'\0' * 2047
         fake_open = mock_open(read_data=data)
-        with patch('charms_ceph.utils.open', fake_open):
-            result = utils.is_pristine_disk('/dev/vdz')
+        with patch('charms_ceph.disks.open', fake_open):
+            result = disks.is_pristine_disk('/dev/vdz')
         fake_open.assert_called_with('/dev/vdz', 'rb')
         _log.assert_called_with(
             '/dev/vdz: short read, got 2047 bytes expected 2048.',
@@ -2063,8 +2320,8 @@ class CephGetLVSTestCase(unittest.TestCase):
         data = b'\0' * 2047
         data = data + b'\42'
         fake_open = mock_open(read_data=data)
-        with patch('charms_ceph.utils.open', fake_open):
-            result = utils.is_pristine_disk('/dev/vdz')
+        with patch('charms_ceph.disks.open', fake_open):
+            result = disks.is_pristine_disk('/dev/vdz')
         fake_open.assert_called_with('/dev/vdz', 'rb')
         self.assertEqual(result, False)
 
@@ -2079,64 +2336,95 @@ class CephManagerAndConfig(unittest.TestCase):
         "restful"
     ]}"""
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(mgr, 'cmp_pkgrevno')
+    @patch.object(mgr.subprocess, 'check_output')
     def test_enabled_manager_modules_pre_quincy(
             self, _check_output, _cmp_pkgrevno):
         _check_output.return_value = self.MODULE_OUT
         _cmp_pkgrevno.return_value = -1
-        utils.enabled_manager_modules()
+        mgr.enabled_manager_modules()
         _check_output.assert_called_once_with(['ceph', 'mgr', 'module', 'ls'])
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(mgr, 'cmp_pkgrevno')
+    @patch.object(mgr.subprocess, 'check_output')
     def test_enabled_manager_modules_quincy(
             self, _check_output, _cmp_pkgrevno):
         _check_output.return_value = self.MODULE_OUT
         _cmp_pkgrevno.return_value = 0
-        utils.enabled_manager_modules()
+        mgr.enabled_manager_modules()
         _check_output.assert_called_once_with(
             ['ceph', 'mgr', 'module', 'ls', '--format=json'])
 
-    @patch.object(utils, 'cmp_pkgrevno')
-    @patch.object(utils.subprocess, 'check_output')
+    @patch.object(mgr, 'cmp_pkgrevno')
+    @patch.object(mgr.subprocess, 'check_output')
     def test_enabled_manager_modules(self, _check_output, _cmp_pkgrevno):
         _cmp_pkgrevno.return_value = -1
         _check_output.return_value = self.MODULE_OUT
         self.assertEqual(
-            utils.enabled_manager_modules(),
+            mgr.enabled_manager_modules(),
             ['dashboard', 'iostat', 'restful'])
 
-    @patch.object(utils, 'enabled_manager_modules')
+    @patch.object(mgr, 'enabled_manager_modules')
     def test_is_mgr_module_enabled(self, _enabled_manager_modules):
         _enabled_manager_modules.return_value = ['dashboard', 'restful']
         self.assertTrue(
-            utils.is_mgr_module_enabled('dashboard'))
+            mgr.is_mgr_module_enabled('dashboard'))
         self.assertFalse(
-            utils.is_mgr_module_enabled('ostrich'))
+            mgr.is_mgr_module_enabled('ostrich'))
 
-    @patch.object(utils, 'is_mgr_module_enabled')
-    @patch.object(utils.subprocess, 'check_call')
+    @patch.object(mgr, 'is_mgr_module_enabled')
+    @patch.object(mgr.subprocess, 'check_call')
     def test_mgr_enable_module(self, _check_call, _is_mgr_module_enabled):
         _is_mgr_module_enabled.return_value = True
-        utils.mgr_enable_module('dashboard')
+        mgr.mgr_enable_module('dashboard')
         self.assertFalse(_check_call.called)
         _is_mgr_module_enabled.return_value = False
-        utils.mgr_enable_module('dashboard')
+        mgr.mgr_enable_module('dashboard')
         _check_call.assert_called_once_with(
             ['ceph', 'mgr', 'module', 'enable', 'dashboard'])
 
-    @patch.object(utils, 'is_mgr_module_enabled')
-    @patch.object(utils.subprocess, 'check_call')
+    @patch.object(mgr, 'is_mgr_module_enabled')
+    @patch.object(mgr.subprocess, 'check_call')
     def test_mgr_disable_module(self, _check_call, _is_mgr_module_enabled):
         _is_mgr_module_enabled.return_value = False
-        utils.mgr_disable_module('dashboard')
+        mgr.mgr_disable_module('dashboard')
         self.assertFalse(_check_call.called)
         _is_mgr_module_enabled.return_value = True
-        utils.mgr_disable_module('dashboard')
+        mgr.mgr_disable_module('dashboard')
         _check_call.assert_called_once_with(
             ['ceph', 'mgr', 'module', 'disable', 'dashboard'])
 
+    @patch.object(mgr, 'wait_for_manager')
+    @patch.object(mgr, 'enabled_manager_modules')
+    @patch.object(mgr.subprocess, 'check_call')
+    def test_mgr_set_modules(self, _check_call, _enabled_manager_modules,
+                             _wait_for_manager):
+        _enabled_manager_modules.return_value = ['dashboard', 'restful']
+        self.assertEqual(
+            mgr.mgr_set_modules(
+                enable=['dashboard', 'prometheus', 'balancer'],
+                disable=['restful', 'telemetry']),
+            {'enabled': ['balancer', 'prometheus'],
+             'disabled': ['restful']})
+        _enabled_manager_modules.assert_called_once_with()
+        _check_call.assert_has_calls([
+            call(['ceph', 'mgr', 'module', 'enable', 'balancer']),
+            call(['ceph', 'mgr', 'module', 'enable', 'prometheus']),
+            call(['ceph', 'mgr', 'module', 'disable', 'restful'])])
+        _wait_for_manager.assert_called_once_with()
+
+    @patch.object(mgr, 'wait_for_manager')
+    @patch.object(mgr, 'enabled_manager_modules')
+    @patch.object(mgr.subprocess, 'check_call')
+    def test_mgr_set_modules_noop(self, _check_call, _enabled_manager_modules,
+                                  _wait_for_manager):
+        _enabled_manager_modules.return_value = ['dashboard']
+        self.assertEqual(
+            mgr.mgr_set_modules(enable=['dashboard'], disable=['restful']),
+            {'enabled': [], 'disabled': []})
+        _check_call.assert_not_called()
+        _wait_for_manager.assert_not_called()
+
     @patch.object(utils.subprocess, 'check_call')
     def test_ceph_config_set(self, _check_call):
         utils.ceph_config_set('mgr/dashboard/ssl', 'true', 'mgr')
@@ -2148,3 +2436,42 @@ class CephManagerAndConfig(unittest.TestCase):
         utils.ceph_config_get('mgr/dashboard/ssl', 'mgr')
         _check_output.assert_called_once_with(
             ['ceph', 'config', 'get', 'mgr', 'mgr/dashboard/ssl'])
+
+    CONFIG_DUMP = b"""[
+        {"section": "global", "name": "mon_allow_pool_size_one",
+         "value": "true", "level": "advanced", "mask": ""},
+        {"section": "mgr", "name": "mgr/dashboard/ssl", "value": "false",
+         "level": "advanced", "mask": ""},
+        {"section": "osd", "name": "osd_memory_target", "value": "4294967296",
+         "level": "basic", "mask": "host:node1"}
+    ]"""
+
+    @patch.object(utils.subprocess, 'check_call')
+    @patch.object(utils.subprocess, 'check_output')
+    def test_ceph_config(self, _check_output, _check_call):
+        _check_output.return_value = self.CONFIG_DUMP
+        config = utils.CephConfig()
+        self.assertEqual(config.get('mgr/dashboard/ssl', 'mgr'), 'false')
+        self.assertEqual(
+            config.get('osd_memory_target', 'osd/host:node1'), '4294967296')
+        self.assertIsNone(config.get('osd_memory_target', 'osd'))
+        desired = {
+            'global': {'mon_allow_pool_size_one': True},
+            'mgr': {'mgr/dashboard/ssl': 'true',
+                    'mgr/dashboard/ssl_server_port': 8443},
+            'osd/host:node1': {'osd_memory_target': 4294967296},
+        }
+        changes = config.apply(desired)
+        self.assertEqual(changes, {
+            ('mgr', 'mgr/dashboard/ssl'): 'true',
+            ('mgr', 'mgr/dashboard/ssl_server_port'): '8443'})
+        _check_call.assert_has_calls([
+            call(['ceph', 'config', 'set', 'mgr', 'mgr/dashboard/ssl',
+                  'true']),
+            call(['ceph', 'config', 'set', 'mgr',
+                  'mgr/dashboard/ssl_server_port', '8443'])])
+        _check_call.reset_mock()
+        self.assertEqual(config.apply(desired), {})
+        _check_call.assert_not_called()
+        _check_output.assert_called_once_with(
+            ['ceph', 'config', 'dump', '-f', 'json'])